@@ -0,0 +1,41 @@
+-- RIWA POS Bulk Menu Update SQL Migration
+-- Run this in Supabase SQL Editor
+
+-- Applies partial updates to many menu rows in one call. Each element of
+-- `rows` is a JSON object with an `id` plus only the columns to change.
+-- Used by POST /api/admin/menu/bulk and /api/admin/menu/import.
+CREATE OR REPLACE FUNCTION riwa_bulk_patch(target_table TEXT, tenant UUID, rows JSONB)
+RETURNS SETOF UUID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    r JSONB;
+    cols TEXT;
+    updated UUID;
+BEGIN
+    IF target_table NOT IN ('categories', 'items', 'item_variants', 'modifiers') THEN
+        RAISE EXCEPTION 'riwa_bulk_patch: table % is not allowed', target_table;
+    END IF;
+
+    FOR r IN SELECT * FROM jsonb_array_elements(rows) LOOP
+        SELECT string_agg(format('%I', key), ', ') INTO cols FROM jsonb_object_keys(r - 'id') AS key;
+        CONTINUE WHEN cols IS NULL;
+
+        updated := NULL;
+        EXECUTE format(
+            'UPDATE %I t SET (%s) = (SELECT %s FROM jsonb_populate_record(NULL::%I, $1)) WHERE t.id = ($1->>''id'')::uuid %s RETURNING t.id',
+            target_table, cols, cols, target_table,
+            CASE WHEN tenant IS NOT NULL THEN 'AND t.tenant_id = $2' ELSE '' END
+        ) INTO updated USING r, tenant;
+
+        IF updated IS NOT NULL THEN
+            RETURN NEXT updated;
+        END IF;
+    END LOOP;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION riwa_bulk_patch(TEXT, UUID, JSONB) TO service_role;
+
+-- Success message
+SELECT 'Bulk menu function created successfully!' as message;
@@ -0,0 +1,15 @@
+-- RIWA POS Coupon Engine SQL Migration
+-- Run this in Supabase SQL Editor
+
+-- Optional scope: when either array is set the coupon only discounts
+-- matching lines. Empty/NULL means the whole order.
+ALTER TABLE coupons ADD COLUMN IF NOT EXISTS item_ids UUID[];
+ALTER TABLE coupons ADD COLUMN IF NOT EXISTS category_ids UUID[];
+
+-- Redemptions are counted with a conditional PATCH on used_count
+ALTER TABLE coupons ALTER COLUMN used_count SET DEFAULT 0;
+UPDATE coupons SET used_count = 0 WHERE used_count IS NULL;
+
+-- Codes are matched case-insensitively per tenant
+CREATE UNIQUE INDEX IF NOT EXISTS idx_coupons_tenant_code ON coupons(tenant_id, UPPER(code));
+CREATE INDEX IF NOT EXISTS idx_coupons_active ON coupons(tenant_id) WHERE is_active;
@@ -0,0 +1,61 @@
+-- RIWA POS Loyalty Engine SQL Migration
+-- Run this in Supabase SQL Editor
+
+-- Running points balance per customer phone
+CREATE TABLE IF NOT EXISTS loyalty_balances (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    tenant_id UUID NOT NULL,
+    customer_phone VARCHAR(32) NOT NULL,
+    points INTEGER DEFAULT 0,
+    orders_count INTEGER DEFAULT 0,
+    lifetime_spend DECIMAL(12,3) DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    UNIQUE (tenant_id, customer_phone)
+);
+
+-- One row per credited order; the unique order_id makes accrual idempotent
+CREATE TABLE IF NOT EXISTS loyalty_transactions (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    tenant_id UUID NOT NULL,
+    order_id UUID NOT NULL UNIQUE,
+    customer_phone VARCHAR(32) NOT NULL,
+    points INTEGER NOT NULL,
+    amount DECIMAL(12,3) DEFAULT 0,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_loyalty_transactions_phone ON loyalty_transactions(tenant_id, customer_phone);
+
+-- Credits a batch of orders in one statement: inserts the transactions,
+-- skipping orders already credited, and increments the matching balances.
+-- Each element of `entries` has order_id, customer_phone, points and amount.
+-- Used by the loyalty accrual worker in server.py.
+CREATE OR REPLACE FUNCTION riwa_loyalty_accrue(tenant UUID, entries JSONB)
+RETURNS SETOF UUID
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    RETURN QUERY
+    WITH inserted AS (
+        INSERT INTO loyalty_transactions (tenant_id, order_id, customer_phone, points, amount)
+        SELECT tenant, (e->>'order_id')::UUID, e->>'customer_phone', (e->>'points')::INTEGER, (e->>'amount')::DECIMAL
+        FROM jsonb_array_elements(entries) AS e
+        ON CONFLICT (order_id) DO NOTHING
+        RETURNING order_id, customer_phone, points, amount
+    ), totals AS (
+        SELECT customer_phone, SUM(points) AS points, COUNT(*) AS orders_count, SUM(amount) AS spend
+        FROM inserted
+        GROUP BY customer_phone
+    ), balances AS (
+        INSERT INTO loyalty_balances (tenant_id, customer_phone, points, orders_count, lifetime_spend, updated_at)
+        SELECT tenant, customer_phone, points, orders_count, spend, NOW() FROM totals
+        ON CONFLICT (tenant_id, customer_phone) DO UPDATE SET
+            points = loyalty_balances.points + EXCLUDED.points,
+            orders_count = loyalty_balances.orders_count + EXCLUDED.orders_count,
+            lifetime_spend = loyalty_balances.lifetime_spend + EXCLUDED.lifetime_spend,
+            updated_at = NOW()
+        RETURNING 1
+    )
+    SELECT inserted.order_id FROM inserted;
+END;
+$$;
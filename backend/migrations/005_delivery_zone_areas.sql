@@ -0,0 +1,8 @@
+-- RIWA POS Delivery Zone Areas SQL Migration
+-- Run this in Supabase SQL Editor
+
+-- Area names (e.g. 'Salmiya', 'Hawally Block 3') matched against the
+-- customer address when an order has no coordinates
+ALTER TABLE delivery_zones ADD COLUMN IF NOT EXISTS areas TEXT[];
+
+CREATE INDEX IF NOT EXISTS idx_delivery_zones_tenant ON delivery_zones(tenant_id, branch_id);
@@ -0,0 +1,11 @@
+-- RIWA POS KDS Stations SQL Migration
+-- Run this in Supabase SQL Editor
+
+-- Kitchen station (e.g. 'grill', 'fryer', 'drinks') for an item; items
+-- without one use their category's, then KDS_DEFAULT_STATION
+ALTER TABLE categories ADD COLUMN IF NOT EXISTS kds_station VARCHAR(50);
+ALTER TABLE items ADD COLUMN IF NOT EXISTS kds_station VARCHAR(50);
+
+-- Board rebuilds read open items for the active orders in one query
+CREATE INDEX IF NOT EXISTS idx_order_items_order_status ON order_items(order_id, status);
+CREATE INDEX IF NOT EXISTS idx_orders_tenant_status ON orders(tenant_id, status, created_at);
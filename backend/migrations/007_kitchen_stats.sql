@@ -0,0 +1,27 @@
+-- RIWA POS Kitchen Analytics SQL Migration
+-- Run this in Supabase SQL Editor
+
+-- One row per tenant, hour and KDS station (plus station 'all'), written by
+-- the backend when an hour closes. Ticket columns are only set on 'all'.
+-- prep_histogram holds counts for the PREP_BUCKETS upper bounds in server.py
+-- (60..3600 seconds) followed by an overflow bucket.
+CREATE TABLE IF NOT EXISTS kitchen_hourly_stats (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    tenant_id UUID NOT NULL,
+    hour_start TIMESTAMPTZ NOT NULL,
+    station VARCHAR(50) NOT NULL,
+    items_prepared INTEGER DEFAULT 0,
+    prep_avg_seconds DECIMAL(10,1),
+    prep_p50_seconds DECIMAL(10,1),
+    prep_p90_seconds DECIMAL(10,1),
+    prep_max_seconds DECIMAL(10,1),
+    prep_histogram JSONB,
+    tickets INTEGER DEFAULT 0,
+    ticket_avg_seconds DECIMAL(10,1),
+    ticket_max_seconds DECIMAL(10,1),
+    max_queue INTEGER DEFAULT 0,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    UNIQUE (tenant_id, hour_start, station)
+);
+
+CREATE INDEX IF NOT EXISTS idx_kitchen_hourly_stats_lookup ON kitchen_hourly_stats(tenant_id, station, hour_start);
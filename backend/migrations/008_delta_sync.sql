@@ -0,0 +1,70 @@
+-- RIWA POS Delta Sync SQL Migration
+-- Run this in Supabase SQL Editor
+
+-- /api/sync returns rows whose updated_at is newer than the client's cursor,
+-- so updated_at has to move on every update (including edits made outside the
+-- backend) and deletes have to leave a tombstone behind.
+
+CREATE TABLE IF NOT EXISTS sync_tombstones (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    tenant_id UUID,
+    table_name VARCHAR(63) NOT NULL,
+    row_id UUID NOT NULL,
+    deleted_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_sync_tombstones_tenant ON sync_tombstones(tenant_id, deleted_at);
+CREATE INDEX IF NOT EXISTS idx_sync_tombstones_deleted ON sync_tombstones(deleted_at);
+
+CREATE OR REPLACE FUNCTION riwa_touch_updated_at() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at := NOW();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION riwa_record_tombstone() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO sync_tombstones (tenant_id, table_name, row_id)
+    VALUES ((to_jsonb(OLD) ->> 'tenant_id')::UUID, TG_TABLE_NAME, OLD.id);
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Tables served by /api/sync and pulled by the SQLite edge store
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY[
+        'categories', 'items', 'item_variants', 'modifier_groups', 'modifiers', 'system_settings',
+        'printers', 'printer_configs', 'payment_providers', 'delivery_zones', 'coupons',
+        'loyalty_settings', 'loyalty_rules', 'users', 'orders'
+    ] LOOP
+        IF to_regclass(t) IS NULL THEN
+            CONTINUE;
+        END IF;
+        EXECUTE format('ALTER TABLE %I ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW()', t);
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I(updated_at)', 'idx_' || t || '_updated_at', t);
+        EXECUTE format('DROP TRIGGER IF EXISTS riwa_touch_updated_at ON %I', t);
+        EXECUTE format('CREATE TRIGGER riwa_touch_updated_at BEFORE UPDATE ON %I '
+                       'FOR EACH ROW EXECUTE FUNCTION riwa_touch_updated_at()', t);
+        EXECUTE format('DROP TRIGGER IF EXISTS riwa_record_tombstone ON %I', t);
+        EXECUTE format('CREATE TRIGGER riwa_record_tombstone AFTER DELETE ON %I '
+                       'FOR EACH ROW EXECUTE FUNCTION riwa_record_tombstone()', t);
+    END LOOP;
+END;
+$$;
+
+-- Cursors older than SYNC_TOMBSTONE_RETENTION_DAYS (server.py, default 30)
+-- get a full snapshot, so older tombstones can go. Schedule with pg_cron, e.g.
+-- SELECT cron.schedule('riwa-prune-tombstones', '0 4 * * *', 'SELECT riwa_prune_tombstones(30)');
+CREATE OR REPLACE FUNCTION riwa_prune_tombstones(retention_days INTEGER) RETURNS INTEGER AS $$
+DECLARE
+    removed INTEGER;
+BEGIN
+    DELETE FROM sync_tombstones WHERE deleted_at < NOW() - make_interval(days => retention_days);
+    GET DIAGNOSTICS removed = ROW_COUNT;
+    RETURN removed;
+END;
+$$ LANGUAGE plpgsql;
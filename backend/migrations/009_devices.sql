@@ -0,0 +1,25 @@
+-- RIWA POS Device Registry SQL Migration
+-- Run this in Supabase SQL Editor
+
+-- Last known state of each POS/KDS terminal. The backend keeps heartbeats in
+-- memory and upserts here in batches (DEVICE_PERSIST_SECONDS in server.py),
+-- so last_seen can lag the live view by that much.
+CREATE TABLE IF NOT EXISTS devices (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    tenant_id UUID NOT NULL,
+    branch_id UUID,
+    device_id VARCHAR(64) NOT NULL,
+    role VARCHAR(20) DEFAULT 'pos',
+    name VARCHAR(100),
+    app_version VARCHAR(50),
+    station VARCHAR(50),
+    ip_address VARCHAR(64),
+    printer_status JSONB DEFAULT '{}'::jsonb,
+    poll_latency_ms DECIMAL(10,1),
+    last_seen TIMESTAMPTZ,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    UNIQUE (tenant_id, device_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_devices_tenant_seen ON devices(tenant_id, last_seen DESC);
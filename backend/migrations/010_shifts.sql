@@ -0,0 +1,33 @@
+-- RIWA POS Shifts SQL Migration
+-- Run this in Supabase SQL Editor
+
+-- Orders record how they were paid, for the per-shift payment breakdown
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS payment_method VARCHAR(20);
+
+-- Cashier shifts. While open, the backend keeps the Z-report totals in memory
+-- (rebuilt from orders since opened_at after a restart); closing freezes them
+-- into report along with expected vs counted cash.
+CREATE TABLE IF NOT EXISTS shifts (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    tenant_id UUID NOT NULL,
+    branch_id UUID NOT NULL,
+    status VARCHAR(20) DEFAULT 'open',  -- open, closed
+    opened_by UUID,
+    closed_by UUID,
+    opened_at TIMESTAMPTZ DEFAULT NOW(),
+    closed_at TIMESTAMPTZ,
+    opening_float DECIMAL(12,3) DEFAULT 0,
+    expected_cash DECIMAL(12,3),
+    counted_cash DECIMAL(12,3),
+    cash_variance DECIMAL(12,3),
+    total_sales DECIMAL(12,3),
+    report JSONB,
+    notes TEXT,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- At most one open shift per branch
+CREATE UNIQUE INDEX IF NOT EXISTS idx_shifts_one_open ON shifts(tenant_id, branch_id) WHERE status = 'open';
+CREATE INDEX IF NOT EXISTS idx_shifts_branch_opened ON shifts(tenant_id, branch_id, opened_at DESC);
+CREATE INDEX IF NOT EXISTS idx_orders_branch_created ON orders(tenant_id, branch_id, created_at);
@@ -0,0 +1,36 @@
+-- RIWA POS Coupon Redemptions SQL Migration
+-- Run this in Supabase SQL Editor
+
+-- One row per order that used a coupon. Redemptions are journaled with the
+-- order and replayed after it, so counting has to be idempotent per order.
+CREATE TABLE IF NOT EXISTS coupon_redemptions (
+    order_id UUID PRIMARY KEY,
+    coupon_id UUID NOT NULL REFERENCES coupons(id) ON DELETE CASCADE,
+    tenant_id UUID,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_coupon_redemptions_coupon ON coupon_redemptions(coupon_id);
+
+-- Records the redemption and bumps used_count in one transaction; a replay
+-- of the same order is a no-op. Used by the order journal replayer.
+CREATE OR REPLACE FUNCTION riwa_redeem_coupon(coupon UUID, order_ref UUID)
+RETURNS BOOLEAN
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO coupon_redemptions (order_id, coupon_id, tenant_id)
+    SELECT order_ref, c.id, c.tenant_id FROM coupons c WHERE c.id = coupon
+    ON CONFLICT (order_id) DO NOTHING;
+    IF NOT FOUND THEN
+        RETURN FALSE;
+    END IF;
+    UPDATE coupons SET used_count = COALESCE(used_count, 0) + 1 WHERE id = coupon;
+    RETURN TRUE;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION riwa_redeem_coupon(UUID, UUID) TO service_role;
+
+-- Success message
+SELECT 'Coupon redemptions created successfully!' as message;
@@ -0,0 +1,85 @@
+-- RIWA POS Kitchen Analytics Merge SQL Migration
+-- Run this in Supabase SQL Editor
+
+-- Every backend worker rolls up its own share of an hour, and a worker
+-- shutting down mid-hour writes what it has so far, so rows for the same
+-- (tenant_id, hour_start, station) are merged: counts, sums and histogram
+-- buckets add up, maxima take the larger, averages and percentiles are
+-- recomputed from the merged sums and histogram.
+ALTER TABLE kitchen_hourly_stats ADD COLUMN IF NOT EXISTS prep_total_seconds DECIMAL(14,1) DEFAULT 0;
+ALTER TABLE kitchen_hourly_stats ADD COLUMN IF NOT EXISTS ticket_total_seconds DECIMAL(14,1) DEFAULT 0;
+
+-- Upper bound of the bucket holding the q-quantile; mirrors histogram_quantile
+-- and PREP_BUCKETS in server.py (NULL past the last bucket)
+CREATE OR REPLACE FUNCTION riwa_histogram_quantile(counts JSONB, q NUMERIC)
+RETURNS DECIMAL
+LANGUAGE plpgsql
+IMMUTABLE
+AS $$
+DECLARE
+    bounds INTEGER[] := ARRAY[60, 120, 180, 300, 420, 600, 900, 1200, 1800, 2700, 3600];
+    total NUMERIC;
+    seen NUMERIC := 0;
+    idx INTEGER;
+BEGIN
+    SELECT COALESCE(SUM(value::NUMERIC), 0) INTO total FROM jsonb_array_elements_text(counts) AS value;
+    IF total = 0 THEN
+        RETURN NULL;
+    END IF;
+    FOR idx IN 0 .. jsonb_array_length(counts) - 1 LOOP
+        seen := seen + (counts->>idx)::NUMERIC;
+        IF seen >= q * total THEN
+            RETURN bounds[idx + 1];
+        END IF;
+    END LOOP;
+    RETURN NULL;
+END;
+$$;
+
+-- Used by the write-behind flush of kitchen_hourly_stats
+CREATE OR REPLACE FUNCTION riwa_merge_kitchen_stats(rows JSONB)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    r JSONB;
+BEGIN
+    FOR r IN SELECT * FROM jsonb_array_elements(rows) LOOP
+        INSERT INTO kitchen_hourly_stats AS k (
+            tenant_id, hour_start, station, items_prepared, prep_total_seconds, prep_max_seconds,
+            prep_histogram, tickets, ticket_total_seconds, ticket_max_seconds, max_queue
+        )
+        SELECT tenant_id, hour_start, station, items_prepared, prep_total_seconds, prep_max_seconds,
+               prep_histogram, tickets, ticket_total_seconds, ticket_max_seconds, max_queue
+        FROM jsonb_populate_record(NULL::kitchen_hourly_stats, r)
+        ON CONFLICT (tenant_id, hour_start, station) DO UPDATE SET
+            items_prepared = COALESCE(k.items_prepared, 0) + COALESCE(EXCLUDED.items_prepared, 0),
+            prep_total_seconds = COALESCE(k.prep_total_seconds, 0) + COALESCE(EXCLUDED.prep_total_seconds, 0),
+            prep_max_seconds = GREATEST(k.prep_max_seconds, EXCLUDED.prep_max_seconds),
+            prep_histogram = (
+                SELECT jsonb_agg(COALESCE((k.prep_histogram->>(i - 1))::INTEGER, 0)
+                                 + COALESCE((EXCLUDED.prep_histogram->>(i - 1))::INTEGER, 0) ORDER BY i)
+                FROM generate_series(1, GREATEST(jsonb_array_length(COALESCE(k.prep_histogram, '[]')),
+                                                 jsonb_array_length(COALESCE(EXCLUDED.prep_histogram, '[]')))) AS i
+            ),
+            tickets = COALESCE(k.tickets, 0) + COALESCE(EXCLUDED.tickets, 0),
+            ticket_total_seconds = COALESCE(k.ticket_total_seconds, 0) + COALESCE(EXCLUDED.ticket_total_seconds, 0),
+            ticket_max_seconds = GREATEST(k.ticket_max_seconds, EXCLUDED.ticket_max_seconds),
+            max_queue = GREATEST(k.max_queue, EXCLUDED.max_queue);
+
+        UPDATE kitchen_hourly_stats SET
+            prep_avg_seconds = CASE WHEN items_prepared > 0 THEN ROUND(prep_total_seconds / items_prepared, 1) END,
+            prep_p50_seconds = riwa_histogram_quantile(prep_histogram, 0.5),
+            prep_p90_seconds = riwa_histogram_quantile(prep_histogram, 0.9),
+            ticket_avg_seconds = CASE WHEN tickets > 0 THEN ROUND(ticket_total_seconds / tickets, 1) END
+        WHERE tenant_id = (r->>'tenant_id')::UUID
+          AND hour_start = (r->>'hour_start')::TIMESTAMPTZ
+          AND station = r->>'station';
+    END LOOP;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION riwa_merge_kitchen_stats(JSONB) TO service_role;
+
+-- Success message
+SELECT 'Kitchen stats merge function created successfully!' as message;
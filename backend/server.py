@@ -1,20 +1,51 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Any, Dict
+from typing import List, Optional, Any, Dict, Tuple
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import hashlib
 import hmac
+import ipaddress
 import json
+import base64
+import csv
+import io
+import tempfile
+import time
+import socket
+import bisect
+import math
+import asyncio
+import sqlite3
+import re
 import httpx
+from collections import OrderedDict, deque
+from itertools import islice
+from urllib.parse import quote, parse_qsl
+from contextvars import ContextVar
 from jose import jwt, JWTError
 
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # OpenTelemetry export is optional
+    otel_trace = None
+
+try:
+    import asyncpg
+except ImportError:  # only needed for STORAGE_BACKEND=asyncpg
+    asyncpg = None
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # only needed for RATE_LIMIT_BACKEND=redis
+    aioredis = None
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
@@ -24,7 +55,7 @@ SUPABASE_ANON_KEY = os.environ.get('SUPABASE_PUBLIC_ANON_KEY', '')
 SUPABASE_SERVICE_KEY = os.environ.get('SUPABASE_SECRET_SERVICE_ROLE_KEY', '')
 JWT_SECRET = os.environ.get('SUPABASE_LEGACY_JWT_SECRET', '')
 
-# Correct tenant/branch from user specification
+# Default tenant/branch, used when a request carries neither a token claim nor a header
 TENANT_ID = 'af8d6568-fb4d-43ce-a97d-8cebca6a44d9'
 BRANCH_ID = 'd73bf34c-5c8c-47c8-9518-b85c7447ebde'
 
@@ -67,14 +98,34 @@ class OrderCreateRequest(BaseModel):
     customer_phone: Optional[str] = None
     customer_address: Optional[str] = None
     notes: Optional[str] = None
+    coupon_code: Optional[str] = None
+    customer_lat: Optional[float] = None
+    customer_lng: Optional[float] = None
+
+class CouponValidateRequest(BaseModel):
+    code: str
+    items: List[Dict[str, Any]] = []
+    subtotal: Optional[float] = None
+
+class DeliveryResolveRequest(BaseModel):
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    address: Optional[str] = None
+    subtotal: Optional[float] = None
 
 class OrderStatusUpdateRequest(BaseModel):
     order_id: str
     status: str
+    expected_status: Optional[str] = None  # apply only if the order is still in this status
+    expected_updated_at: Optional[str] = None  # ...and unchanged since this version
 
 class KDSBumpRequest(BaseModel):
     kds_item_id: str
 
+class KDSBulkRequest(BaseModel):
+    item_ids: List[str] = []
+    order_id: Optional[str] = None
+
 # Printer Models
 class PrinterConfig(BaseModel):
     name: str
@@ -99,21 +150,357 @@ class PrintJobRequest(BaseModel):
     open_drawer: bool = False
     receipt_data: Optional[Dict[str, Any]] = None
 
-# ==================== HELPER FUNCTIONS ====================
+# Device Models
+class DeviceHeartbeat(BaseModel):
+    device_id: str = Field(..., min_length=1, max_length=64)
+    role: str = "pos"  # pos, kds, kiosk, admin
+    name: Optional[str] = None
+    app_version: Optional[str] = None
+    station: Optional[str] = None  # KDS station
+    poll_latency_ms: Optional[float] = None  # client-measured latency of its last poll
+    printer_status: Dict[str, str] = {}  # printer id or ip:port -> ok, offline, paper_out, ...
+
+# Shift Models
+class ShiftOpenRequest(BaseModel):
+    opening_float: float = Field(0, ge=0)  # cash in the drawer at open
+    notes: Optional[str] = None
+
+class ShiftCloseRequest(BaseModel):
+    counted_cash: float = Field(..., ge=0)  # cash counted in the drawer at close
+    notes: Optional[str] = None
+
+class ShiftPrintRequest(BaseModel):
+    printer_id: Optional[str] = None  # default: first enabled cashier printer
+
+class MenuBulkRequest(BaseModel):
+    categories: List[Dict[str, Any]] = []
+    items: List[Dict[str, Any]] = []
+    variants: List[Dict[str, Any]] = []
+    modifiers: List[Dict[str, Any]] = []
+    delete: Dict[str, List[str]] = {}  # entity -> ids
+
+# ==================== METRICS ====================
+
+# Latency buckets in seconds, tuned for Supabase round trips and LAN printers
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class MetricsRegistry:
+    """Minimal in-process Prometheus-style registry (counters, gauges, histograms).
+
+    Series are keyed by a sorted label tuple; recording is a dict lookup plus
+    a bisect, so it is cheap enough to leave on for every request.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._meta: Dict[str, tuple] = {}
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._gauges: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, List[float]]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+        store = {"counter": self._counters, "gauge": self._gauges, "histogram": self._histograms}[kind]
+        store.setdefault(name, {})
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        self._gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def add_gauge(self, name: str, value: float, **labels):
+        series = self._gauges.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        hist = series.get(key)
+        if hist is None:
+            # one slot per bucket, then +Inf, sum, count
+            hist = series[key] = [0.0] * (len(self.buckets) + 3)
+        hist[bisect.bisect_left(self.buckets, value)] += 1
+        hist[-2] += value
+        hist[-1] += 1
+
+    @staticmethod
+    def _format_labels(key: tuple, extra: Optional[tuple] = None) -> str:
+        pairs = list(key) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        body = ",".join(f'{k}="{MetricsRegistry._escape(v)}"' for k, v in pairs)
+        return "{" + body + "}"
+
+    @staticmethod
+    def _escape(value: Any) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self) -> str:
+        """Render all series in the Prometheus text exposition format"""
+        lines = []
+        for store in (self._counters, self._gauges):
+            for name, series in store.items():
+                kind, help_text = self._meta.get(name, ("counter" if store is self._counters else "gauge", ""))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in series.items():
+                    lines.append(f"{name}{self._format_labels(key)} {value:g}")
+        for name, series in self._histograms.items():
+            _, help_text = self._meta.get(name, ("histogram", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, hist in series.items():
+                cumulative = 0
+                for idx, bound in enumerate(self.buckets):
+                    cumulative += hist[idx]
+                    lines.append(f"{name}_bucket{self._format_labels(key, ('le', f'{bound:g}'))} {cumulative:g}")
+                cumulative += hist[len(self.buckets)]
+                lines.append(f"{name}_bucket{self._format_labels(key, ('le', '+Inf'))} {cumulative:g}")
+                lines.append(f"{name}_sum{self._format_labels(key)} {hist[-2]:.6f}")
+                lines.append(f"{name}_count{self._format_labels(key)} {hist[-1]:g}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("riwa_http_requests_total", "counter", "HTTP requests handled, by route, method and status")
+metrics.describe("riwa_http_request_duration_seconds", "histogram", "HTTP request latency by route and method")
+metrics.describe("riwa_http_requests_in_flight", "gauge", "HTTP requests currently being handled")
+metrics.describe("riwa_upstream_requests_total", "counter", "Supabase REST calls by table, method and status")
+metrics.describe("riwa_upstream_request_duration_seconds", "histogram", "Supabase REST latency by table and method")
+metrics.describe("riwa_printer_send_seconds", "histogram", "Time to connect and send ESC/POS data to a printer")
+metrics.describe("riwa_printer_failures_total", "counter", "Failed printer sends by printer and reason")
+metrics.describe("riwa_cache_requests_total", "counter", "Cache lookups by cache and result (hit/miss)")
+metrics.describe("riwa_cache_hit_ratio", "gauge", "Cache hit ratio since process start")
+
+def record_cache_lookup(cache: str, hit: bool):
+    """Count a cache lookup so /api/metrics can report hit ratios"""
+    metrics.inc("riwa_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+def _refresh_cache_ratios():
+    totals: Dict[str, List[float]] = {}
+    for key, value in metrics._counters.get("riwa_cache_requests_total", {}).items():
+        labels = dict(key)
+        entry = totals.setdefault(labels["cache"], [0, 0])
+        entry[0 if labels["result"] == "hit" else 1] += value
+    for cache, (hits, misses) in totals.items():
+        metrics.set_gauge("riwa_cache_hit_ratio", hits / (hits + misses) if hits + misses else 0, cache=cache)
+
+def upstream_table(endpoint: str) -> str:
+    """Table (or rpc) name of a PostgREST endpoint, used as a low-cardinality label"""
+    return endpoint.split("?", 1)[0]
+
+# ==================== TRACING ====================
+
+# Requests slower than this, or making more upstream calls than the budget, are logged
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '500'))
+UPSTREAM_CALL_BUDGET = int(os.environ.get('UPSTREAM_CALL_BUDGET', '10'))
+# Optional span export: JSON lines to a local file and/or OpenTelemetry (OTLP) collector
+TRACE_EXPORT_FILE = os.environ.get('TRACE_EXPORT_FILE', '')
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT', '')
 
-async def supabase_request(method: str, endpoint: str, data: Optional[Dict] = None, use_service_key: bool = False):
-    """Make authenticated request to Supabase"""
-    key = SUPABASE_SERVICE_KEY if use_service_key else SUPABASE_ANON_KEY
-    headers = {
-        "apikey": key,
-        "Authorization": f"Bearer {key}",
-        "Content-Type": "application/json",
-        "Prefer": "return=representation"
+# Spans recorded while handling the current request; None outside a request
+_request_trace: ContextVar[Optional[Dict[str, Any]]] = ContextVar('request_trace', default=None)
+
+def start_request_trace() -> Dict[str, Any]:
+    trace = {
+        "trace_id": uuid.uuid4().hex,
+        "start": time.perf_counter(),
+        "start_ns": time.time_ns(),
+        "spans": []
     }
-    
-    url = f"{SUPABASE_URL}/rest/v1/{endpoint}"
-    
-    async with httpx.AsyncClient() as client:
+    _request_trace.set(trace)
+    return trace
+
+def record_span(kind: str, name: str, method: str, start: float, status: str):
+    """Attach an upstream call (supabase or printer) to the current request trace"""
+    trace = _request_trace.get()
+    if trace is None:
+        return
+    trace["spans"].append({
+        "kind": kind,
+        "name": name,
+        "method": method,
+        "offset_ms": (start - trace["start"]) * 1000,
+        "duration_ms": (time.perf_counter() - start) * 1000,
+        "status": status
+    })
+
+def summarize_trace(trace: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    """Call count and total time per span kind"""
+    summary: Dict[str, Dict[str, float]] = {}
+    for span in trace["spans"]:
+        entry = summary.setdefault(span["kind"], {"count": 0, "duration_ms": 0.0})
+        entry["count"] += 1
+        entry["duration_ms"] += span["duration_ms"]
+    return summary
+
+def server_timing_header(summary: Dict[str, Dict[str, float]], total_ms: float) -> str:
+    parts = [f'{kind};dur={entry["duration_ms"]:.1f};desc="{entry["count"]} calls"' for kind, entry in summary.items()]
+    parts.append(f'total;dur={total_ms:.1f}')
+    return ", ".join(parts)
+
+_trace_file = None
+_otel_tracer = None
+
+if OTEL_EXPORTER_OTLP_ENDPOINT and otel_trace is not None:
+    try:
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        _provider = TracerProvider(resource=Resource.create({"service.name": "riwa-pos-api"}))
+        _provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        otel_trace.set_tracer_provider(_provider)
+        _otel_tracer = otel_trace.get_tracer("riwa-pos")
+    except ImportError as e:
+        logging.getLogger(__name__).warning(f"OpenTelemetry export disabled, SDK not installed: {e}")
+
+def export_trace(trace: Dict[str, Any], route: str, method: str, status: int, total_ms: float):
+    """Write the finished request trace to the configured exporters"""
+    global _trace_file
+    if TRACE_EXPORT_FILE:
+        if _trace_file is None:
+            _trace_file = open(TRACE_EXPORT_FILE, 'a', buffering=1)
+        _trace_file.write(json.dumps({
+            "trace_id": trace["trace_id"],
+            "route": route,
+            "method": method,
+            "status": status,
+            "duration_ms": round(total_ms, 3),
+            "spans": trace["spans"]
+        }) + "\n")
+    if _otel_tracer is not None:
+        start_ns = trace["start_ns"]
+        root = _otel_tracer.start_span(f"{method} {route}", start_time=start_ns, attributes={
+            "http.method": method, "http.route": route, "http.status_code": status
+        })
+        ctx = otel_trace.set_span_in_context(root)
+        for span in trace["spans"]:
+            child_start = start_ns + int(span["offset_ms"] * 1e6)
+            child = _otel_tracer.start_span(f'{span["kind"]} {span["method"]} {span["name"]}', context=ctx, start_time=child_start, attributes={
+                "riwa.kind": span["kind"], "riwa.target": span["name"], "riwa.status": span["status"]
+            })
+            child.end(end_time=child_start + int(span["duration_ms"] * 1e6))
+        root.end(end_time=start_ns + int(total_ms * 1e6))
+
+# ==================== STORAGE BACKENDS ====================
+
+# postgrest: HTTP to Supabase (default). asyncpg: direct pool to the same
+# database for on-premise or co-located installs (needs DATABASE_URL and the
+# optional asyncpg package). sqlite: offline-capable single-branch edge store
+# synced to Supabase in the background. Handlers keep speaking PostgREST
+# endpoints; the other backends translate them.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'postgrest').lower()
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+DATABASE_POOL_MIN = int(os.environ.get('DATABASE_POOL_MIN', '2'))
+DATABASE_POOL_MAX = int(os.environ.get('DATABASE_POOL_MAX', '10'))
+DATABASE_STATEMENT_CACHE = int(os.environ.get('DATABASE_STATEMENT_CACHE', '512'))
+EDGE_DB_PATH = os.environ.get('EDGE_DB_PATH', str(ROOT_DIR / 'data' / 'edge.db'))
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', '20'))
+UPSTREAM_KEEPALIVE_SECONDS = float(os.environ.get('UPSTREAM_KEEPALIVE_SECONDS', '30'))
+UPSTREAM_TIMEOUT = float(os.environ.get('UPSTREAM_TIMEOUT', '5'))
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_FILTER_OPERATORS = {"eq": "=", "neq": "<>", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+_RESERVED_PARAMS = ("select", "order", "limit", "offset", "on_conflict")
+
+class StorageError(Exception):
+    """Query the asyncpg backend cannot express; surfaced as a PostgREST-style 400"""
+
+class StorageNotFound(StorageError):
+    """Unknown table; surfaced as 404 like PostgREST"""
+
+class StorageResponse:
+    """The subset of httpx.Response the handlers use"""
+
+    def __init__(self, status_code: int, payload: Any = None):
+        self.status_code = status_code
+        self._payload = payload
+
+    def json(self) -> Any:
+        return self._payload
+
+    @property
+    def text(self) -> str:
+        return "" if self._payload is None else json.dumps(self._payload, default=str)
+
+def permanent_failure(status_code: int) -> bool:
+    """A rejection retrying cannot fix: any 4xx except timeout (408) and rate limiting (429)"""
+    return 400 <= status_code < 500 and status_code not in (408, 429)
+
+# Supabase refused the data itself. Background queues give up only on these:
+# auth and route errors (a rotated key, a table not migrated yet) clear up
+# once the configuration is fixed, so they are retried like outages
+DATA_REJECTIONS = (400, 409, 422)
+
+# SQLSTATE classes for bad data, constraint violations and schema errors
+_PERMANENT_SQLSTATE_CLASSES = ("22", "23", "42")
+
+def permanent_storage_error(error: str) -> bool:
+    """Whether an insert_order error ("table: <status or SQLSTATE> ...") is a permanent rejection"""
+    code = error.partition(": ")[2].split(" ", 1)[0]
+    if len(code) == 3 and code.isdigit():
+        return permanent_failure(int(code))
+    return len(code) == 5 and code[:2] in _PERMANENT_SQLSTATE_CLASSES
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Process-wide pooled client for Supabase REST and Auth, so requests reuse warm keep-alive connections"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=UPSTREAM_TIMEOUT,
+            limits=httpx.Limits(max_connections=UPSTREAM_POOL_SIZE, max_keepalive_connections=UPSTREAM_POOL_SIZE,
+                                keepalive_expiry=UPSTREAM_KEEPALIVE_SECONDS)
+        )
+    return _http_client
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+class PostgrestBackend:
+    """Supabase REST API over HTTP"""
+
+    name = "postgrest"
+
+    async def start(self):
+        get_http_client()
+
+    async def close(self):
+        pass  # the shared client is closed last, at shutdown
+
+    async def warm(self, connections: int):
+        """Open up to `connections` keep-alive connections with concurrent HEAD requests"""
+        client = get_http_client()
+        headers = {"apikey": SUPABASE_SERVICE_KEY, "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}"}
+        results = await asyncio.gather(
+            *[client.head(f"{SUPABASE_URL}/rest/v1/", headers=headers) for _ in range(min(connections, UPSTREAM_POOL_SIZE))],
+            return_exceptions=True
+        )
+        errors = [r for r in results if isinstance(r, Exception)]
+        if len(errors) == len(results):
+            raise errors[0]
+
+    async def request(self, method: str, endpoint: str, data: Optional[Any], use_service_key: bool, prefer: str):
+        key = SUPABASE_SERVICE_KEY if use_service_key else SUPABASE_ANON_KEY
+        headers = {
+            "apikey": key,
+            "Authorization": f"Bearer {key}",
+            "Content-Type": "application/json",
+            "Prefer": prefer
+        }
+        
+        url = f"{SUPABASE_URL}/rest/v1/{endpoint}"
+        
+        client = get_http_client()
         if method == "GET":
             response = await client.get(url, headers=headers)
         elif method == "POST":
@@ -127,27 +514,1034 @@ async def supabase_request(method: str, endpoint: str, data: Optional[Dict] = No
         
         return response
 
-def generate_order_number() -> str:
+    async def insert_order(self, orders: List[Dict[str, Any]], items: List[Dict[str, Any]], prefer: str) -> Optional[str]:
+        """Orders then their items as two bulk inserts; returns an error message or None"""
+        response = await supabase_request("POST", "orders", orders, use_service_key=True, prefer=prefer)
+        if response.status_code not in [200, 201, 204]:
+            return f"orders: {response.status_code} {response.text[:200]}"
+        if items:
+            response = await supabase_request("POST", "order_items", items, use_service_key=True, prefer=prefer)
+            if response.status_code not in [200, 201, 204]:
+                return f"order_items: {response.status_code} {response.text[:200]}"
+        return None
+
+def _quote_ident(name: str) -> str:
+    if not _IDENTIFIER.match(name):
+        raise StorageError(f"Invalid identifier: {name}")
+    return f'"{name}"'
+
+def _split_list(raw: str) -> List[str]:
+    """Values of an in.(...) filter, honouring double-quoted entries"""
+    return [value.strip('"') for value in next(csv.reader([raw.strip()[1:-1]]))] if raw.strip("()") else []
+
+def build_select_sql(table: str, params: List[tuple], columns: Dict[str, str], args: List[Any]) -> tuple:
+    """WHERE / ORDER BY / LIMIT clauses for PostgREST query params. Returns (select list, tail SQL)."""
+    def typed(value: Any, column: str) -> str:
+        args.append(value)
+        return f"${len(args)}::text::{columns[column]}"
+    
+    def condition(column: str, expression: str) -> str:
+        if column not in columns:
+            raise StorageError(f"column {table}.{column} does not exist")
+        op, _, raw = expression.partition(".")
+        if op == "not":
+            return f"NOT ({condition(column, raw)})"
+        target = _quote_ident(column)
+        if op == "is":
+            if raw not in ("null", "true", "false"):
+                raise StorageError(f"Invalid is. value: {raw}")
+            return f"{target} IS {raw.upper()}"
+        if op == "in":
+            args.append(_split_list(raw))
+            return f"{target} = ANY(${len(args)}::text[]::{columns[column]}[])"
+        if op in _FILTER_OPERATORS:
+            return f"{target} {_FILTER_OPERATORS[op]} {typed(raw, column)}"
+        if op in ("like", "ilike"):
+            return f"{target}::text {op.upper()} {typed(raw.replace('*', '%'), column)}"
+        raise StorageError(f"Unsupported operator: {op}")
+    
+    select, where, order, tail = "*", [], [], ""
+    for key, value in params:
+        if key == "select":
+            select = ", ".join("*" if c == "*" else _quote_ident(c) for c in value.split(","))
+        elif key == "order":
+            for term in value.split(","):
+                parts = term.split(".")
+                clause = _quote_ident(parts[0])
+                if "desc" in parts[1:]:
+                    clause += " DESC"
+                if "nullsfirst" in parts[1:]:
+                    clause += " NULLS FIRST"
+                elif "nullslast" in parts[1:]:
+                    clause += " NULLS LAST"
+                order.append(clause)
+        elif key in ("limit", "offset"):
+            args.append(int(value))
+            tail += f" {key.upper()} ${len(args)}"
+        elif key not in _RESERVED_PARAMS:
+            where.append(condition(key, value))
+    sql = ""
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if order:
+        sql += " ORDER BY " + ", ".join(order)
+    return select, sql + tail
+
+class AsyncpgBackend:
+    """Direct PostgreSQL access through an asyncpg pool.
+
+    asyncpg prepares and caches every statement and uses the binary protocol;
+    rows come back already JSON-encoded by json_agg so responses match
+    PostgREST's shape. Column types are read once per table for casting
+    filter values.
+    """
+
+    name = "asyncpg"
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool = None
+        self._columns: Dict[str, Dict[str, str]] = {}
+
+    async def start(self):
+        if asyncpg is None:
+            raise RuntimeError("STORAGE_BACKEND=asyncpg requires the asyncpg package")
+        if not self.dsn:
+            raise RuntimeError("STORAGE_BACKEND=asyncpg requires DATABASE_URL")
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=DATABASE_POOL_MIN, max_size=DATABASE_POOL_MAX,
+            statement_cache_size=DATABASE_STATEMENT_CACHE, init=self._init_connection
+        )
+        logger.info(f"asyncpg storage pool ready ({DATABASE_POOL_MIN}-{DATABASE_POOL_MAX} connections)")
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def warm(self, connections: int):
+        """The pool already holds DATABASE_POOL_MIN connections; read the hot tables' column types"""
+        async with self.pool.acquire() as conn:
+            for table in ("orders", "order_items", "items", "categories"):
+                await self._table_columns(conn, table)
+
+    @staticmethod
+    async def _init_connection(conn):
+        for type_name in ("json", "jsonb"):
+            await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+    async def _table_columns(self, conn, table: str) -> Dict[str, str]:
+        columns = self._columns.get(table)
+        if columns is None:
+            rows = await conn.fetch(
+                "SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+                "WHERE attrelid = to_regclass($1) AND attnum > 0 AND NOT attisdropped",
+                _quote_ident(table)
+            )
+            if not rows:
+                raise StorageNotFound(f'relation "{table}" does not exist')
+            columns = self._columns[table] = {row[0]: row[1] for row in rows}
+        return columns
+
+    async def _execute(self, conn, method: str, endpoint: str, data: Optional[Any], prefer: str) -> StorageResponse:
+        path, _, query = endpoint.partition("?")
+        params = parse_qsl(query, keep_blank_values=True)
+        minimal = "return=minimal" in prefer
+        
+        if path.startswith("rpc/"):
+            args = list((data or {}).values())
+            named = ", ".join(f"{_quote_ident(k)} => ${i + 1}" for i, k in enumerate((data or {}).keys()))
+            result = await conn.fetchval(
+                f"SELECT coalesce(json_agg(r), '[]'::json) FROM {_quote_ident(path[4:])}({named}) r", *args
+            )
+            return StorageResponse(200, result)
+        
+        table = _quote_ident(path)
+        columns = await self._table_columns(conn, path)
+        args: List[Any] = []
+        
+        if method == "GET":
+            select, tail = build_select_sql(path, params, columns, args)
+            result = await conn.fetchval(
+                f"SELECT coalesce(json_agg(t), '[]'::json) FROM (SELECT {select} FROM {table}{tail}) t", *args
+            )
+            return StorageResponse(200, result)
+        
+        select = next((v for k, v in params if k == "select"), "*")
+        returning = "*" if select == "*" else ", ".join(_quote_ident(c) for c in select.split(","))
+        if method == "POST":
+            rows = data if isinstance(data, list) else [data]
+            if not rows:
+                return StorageResponse(201, [])
+            keys = list(dict.fromkeys(k for row in rows for k in row))
+            target = ", ".join(_quote_ident(k) for k in keys)
+            args.append(rows)
+            sql = f"INSERT INTO {table} ({target}) SELECT {target} FROM jsonb_populate_recordset(NULL::{table}, $1::jsonb)"
+            conflict = next((v for k, v in params if k == "on_conflict"), None)
+            conflict_columns = conflict.split(",") if conflict else []
+            if "resolution=merge-duplicates" in prefer:
+                conflict_columns = conflict_columns or ["id"]
+                updates = ", ".join(f"{_quote_ident(k)} = EXCLUDED.{_quote_ident(k)}"
+                                    for k in keys if k not in conflict_columns)
+                target_sql = ", ".join(_quote_ident(c) for c in conflict_columns)
+                sql += f" ON CONFLICT ({target_sql}) DO UPDATE SET {updates}" if updates else f" ON CONFLICT ({target_sql}) DO NOTHING"
+            elif "resolution=ignore-duplicates" in prefer:
+                target_sql = f" ({', '.join(_quote_ident(c) for c in conflict_columns)})" if conflict_columns else ""
+                sql += f" ON CONFLICT{target_sql} DO NOTHING"
+            status = 201
+        elif method == "PATCH":
+            keys = list(data or {})
+            if not keys:
+                raise StorageError("Empty update")
+            target = ", ".join(_quote_ident(k) for k in keys)
+            args.append(data)
+            _, where = build_select_sql(path, [p for p in params if p[0] != "select"], columns, args)
+            sql = (f"UPDATE {table} SET ({target}) = "
+                   f"(SELECT {target} FROM jsonb_populate_record(NULL::{table}, $1::jsonb)){where}")
+            status = 200
+        elif method == "DELETE":
+            _, where = build_select_sql(path, [p for p in params if p[0] != "select"], columns, args)
+            sql = f"DELETE FROM {table}{where}"
+            status = 200
+        else:
+            raise ValueError(f"Unsupported method: {method}")
+        
+        if minimal:
+            await conn.execute(sql, *args)
+            return StorageResponse(204 if method != "POST" else 201)
+        result = await conn.fetchval(
+            f"WITH affected AS ({sql} RETURNING {returning}) SELECT coalesce(json_agg(affected), '[]'::json) FROM affected",
+            *args
+        )
+        return StorageResponse(status, result)
+
+    async def request(self, method: str, endpoint: str, data: Optional[Any], use_service_key: bool, prefer: str):
+        try:
+            async with self.pool.acquire() as conn:
+                return await self._execute(conn, method, endpoint, data, prefer)
+        except StorageNotFound as e:
+            return StorageResponse(404, {"message": str(e)})
+        except StorageError as e:
+            return StorageResponse(400, {"message": str(e)})
+        except (asyncpg.UndefinedTableError, asyncpg.UndefinedFunctionError) as e:
+            return StorageResponse(404, {"message": str(e)})
+        except asyncpg.UniqueViolationError as e:
+            return StorageResponse(409, {"message": str(e), "code": e.sqlstate})
+        except asyncpg.PostgresError as e:
+            return StorageResponse(400, {"message": str(e), "code": e.sqlstate})
+
+    async def insert_order(self, orders: List[Dict[str, Any]], items: List[Dict[str, Any]], prefer: str) -> Optional[str]:
+        """Orders and their items in one transaction"""
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await self._execute(conn, "POST", "orders", orders, prefer)
+                    if items:
+                        await self._execute(conn, "POST", "order_items", items, prefer)
+            return None
+        except StorageError as e:
+            return f"orders: 400 {e}"
+        except asyncpg.PostgresError as e:
+            return f"orders: {e.sqlstate} {str(e)[:200]}"
+
+class SqliteBackend:
+    """Single-branch edge store: every table lives in a local SQLite file (WAL).
+
+    Rows are kept as JSON documents (id + data), so the local file needs no
+    migrations of its own and accepts whatever columns the handlers write.
+    PostgREST filters become json_extract() comparisons. Every local write is
+    also recorded in _outbox for the edge sync task to push to Supabase.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self._tables: set = set()
+
+    async def start(self):
+        if self.conn is not None:
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")  # local orders are the only copy until pushed
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS _outbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                tbl TEXT NOT NULL,
+                row_id TEXT NOT NULL,
+                op TEXT NOT NULL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS _outbox_dead (
+                seq INTEGER PRIMARY KEY,
+                tbl TEXT NOT NULL,
+                row_id TEXT NOT NULL,
+                op TEXT NOT NULL,
+                error TEXT,
+                dead_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS _sync_state (tbl TEXT PRIMARY KEY, high_water TEXT)")
+        self._tables = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        logger.info(f"SQLite edge store at {self.path}")
+
+    async def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    async def warm(self, connections: int):
+        pass  # local file, nothing to open
+
+    def _table(self, name: str) -> str:
+        table = _quote_ident(name)
+        if name not in self._tables:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            for column in ("tenant_id", "status", "order_id", "created_at", "updated_at"):
+                self.conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {_quote_ident(f'idx_{name}_{column}')} "
+                    f"ON {table} (json_extract(data, '$.{column}'))"
+                )
+            self._tables.add(name)
+        return table
+
+    @staticmethod
+    def _literals(raw: str) -> List[Any]:
+        """Forms a PostgREST literal may take inside the JSON document (numbers and booleans are typed there)"""
+        if raw == "true":
+            return [1]
+        if raw == "false":
+            return [0]
+        if re.fullmatch(r'-?\d+(\.\d+)?', raw):
+            return [float(raw) if '.' in raw else int(raw), raw]
+        return [raw]
+
+    def _where(self, params: List[tuple], args: List[Any]) -> str:
+        def condition(column: str, expression: str) -> str:
+            target = f"json_extract(data, '$.{_quote_ident(column)[1:-1]}')"
+            op, _, raw = expression.partition(".")
+            if op == "not":
+                return f"NOT ({condition(column, raw)})"
+            if op == "is":
+                if raw not in ("null", "true", "false"):
+                    raise StorageError(f"Invalid is. value: {raw}")
+                return f"{target} IS NULL" if raw == "null" else f"{target} = {1 if raw == 'true' else 0}"
+            if op in ("eq", "neq", "in"):
+                values = [v for item in (_split_list(raw) if op == "in" else [raw]) for v in self._literals(item)]
+                if not values:
+                    return "0"
+                args.extend(values)
+                clause = f"{target} IN ({', '.join('?' * len(values))})"
+                return f"NOT ({clause})" if op == "neq" else clause
+            if op in _FILTER_OPERATORS:
+                args.append(self._literals(raw)[0])
+                return f"{target} {_FILTER_OPERATORS[op]} ?"
+            if op in ("like", "ilike"):
+                args.append(raw.replace('*', '%'))
+                return f"{target} LIKE ?"
+            raise StorageError(f"Unsupported operator: {op}")
+        
+        where = [condition(k, v) for k, v in params if k not in _RESERVED_PARAMS]
+        return " WHERE " + " AND ".join(where) if where else ""
+
+    def _select(self, table: str, params: List[tuple]) -> List[Dict[str, Any]]:
+        args: List[Any] = []
+        sql = f"SELECT data FROM {self._table(table)}{self._where(params, args)}"
+        for key, value in params:
+            if key == "order":
+                terms = []
+                for term in value.split(","):
+                    parts = term.split(".")
+                    clause = f"json_extract(data, '$.{_quote_ident(parts[0])[1:-1]}')"
+                    clause += " DESC" if "desc" in parts[1:] else " ASC"
+                    if "nullsfirst" in parts[1:]:
+                        clause += " NULLS FIRST"
+                    elif "nullslast" in parts[1:]:
+                        clause += " NULLS LAST"
+                    terms.append(clause)
+                sql += " ORDER BY " + ", ".join(terms)
+        params_dict = dict(params)
+        if "limit" in params_dict or "offset" in params_dict:
+            sql += " LIMIT ? OFFSET ?"
+            args.extend([int(params_dict.get("limit", -1)), int(params_dict.get("offset", 0))])
+        return [json.loads(row[0]) for row in self.conn.execute(sql, args)]
+
+    @staticmethod
+    def _project(rows: List[Dict[str, Any]], params: List[tuple]) -> List[Dict[str, Any]]:
+        select = dict(params).get("select", "*")
+        if select == "*":
+            return rows
+        columns = select.split(",")
+        return [{c: row.get(c) for c in columns} for row in rows]
+
+    def _write(self, table: str, row: Dict[str, Any], op: str = "upsert", track: bool = True):
+        if op == "delete":
+            self.conn.execute(f"DELETE FROM {self._table(table)} WHERE id = ?", (row['id'],))
+        else:
+            self.conn.execute(
+                f"INSERT INTO {self._table(table)} (id, data) VALUES (?, ?) "
+                f"ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                (row['id'], json.dumps(row, default=str))
+            )
+        if track:
+            self.conn.execute("INSERT INTO _outbox (tbl, row_id, op) VALUES (?, ?, ?)", (table, row['id'], op))
+
+    def _execute(self, method: str, endpoint: str, data: Optional[Any], prefer: str) -> StorageResponse:
+        path, _, query = endpoint.partition("?")
+        if path.startswith("rpc/"):
+            # Callers fall back to plain table operations when a function is missing
+            return StorageResponse(404, {"message": f"function {path[4:]} is not available in edge mode"})
+        params = parse_qsl(query, keep_blank_values=True)
+        minimal = "return=minimal" in prefer
+        
+        if method == "GET":
+            return StorageResponse(200, self._project(self._select(path, params), params))
+        
+        if method == "POST":
+            rows = data if isinstance(data, list) else [data]
+            conflict = dict(params).get("on_conflict", "id").split(",")
+            written = []
+            self.conn.execute("BEGIN")
+            try:
+                for row in rows:
+                    row = dict(row)
+                    if conflict == ["id"]:
+                        existing = self._select(path, [("id", f"eq.{row['id']}")]) if row.get('id') else []
+                    else:
+                        existing = self._select(path, [(c, f"eq.{row.get(c)}") for c in conflict])
+                    if existing:
+                        if "resolution=ignore-duplicates" in prefer:
+                            continue
+                        if "resolution=merge-duplicates" not in prefer:
+                            self.conn.execute("ROLLBACK")
+                            return StorageResponse(409, {"message": f"duplicate key value violates unique constraint on {path}"})
+                        row = dict(existing[0], **row, id=existing[0]['id'])
+                    row.setdefault('id', str(uuid.uuid4()))
+                    self._write(path, row)
+                    written.append(row)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            return StorageResponse(201, None if minimal else self._project(written, params))
+        
+        if method in ("PATCH", "DELETE"):
+            rows = self._select(path, [p for p in params if p[0] not in ("select", "order", "limit", "offset")])
+            self.conn.execute("BEGIN")
+            try:
+                for row in rows:
+                    if method == "PATCH":
+                        row.update(data or {})
+                        self._write(path, row)
+                    else:
+                        self._write(path, row, op="delete")
+                        if path != "sync_tombstones":
+                            # What the DELETE trigger records upstream, so /api/sync sees local deletes too
+                            self._write("sync_tombstones", {
+                                "id": str(uuid.uuid4()), "tenant_id": row.get('tenant_id'), "table_name": path,
+                                "row_id": row['id'], "deleted_at": datetime.now(timezone.utc).isoformat()
+                            }, track=False)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            return StorageResponse(204) if minimal else StorageResponse(200, self._project(rows, params))
+        
+        raise ValueError(f"Unsupported method: {method}")
+
+    async def request(self, method: str, endpoint: str, data: Optional[Any], use_service_key: bool, prefer: str):
+        try:
+            return self._execute(method, endpoint, data, prefer)
+        except StorageError as e:
+            return StorageResponse(400, {"message": str(e)})
+        except sqlite3.Error as e:
+            return StorageResponse(500, {"message": str(e)})
+
+    async def insert_order(self, orders: List[Dict[str, Any]], items: List[Dict[str, Any]], prefer: str) -> Optional[str]:
+        """Orders and their items in one local transaction"""
+        try:
+            self.conn.execute("BEGIN")
+            for table, rows in (("orders", orders), ("order_items", items)):
+                for row in rows:
+                    exists = self.conn.execute(f"SELECT 1 FROM {self._table(table)} WHERE id = ?", (row['id'],)).fetchone()
+                    if exists and "resolution=ignore-duplicates" in prefer:
+                        continue
+                    if exists:
+                        raise StorageError(f"duplicate key in {table}: {row['id']}")
+                    self._write(table, row)
+            self.conn.execute("COMMIT")
+            return None
+        except (StorageError, sqlite3.Error) as e:
+            self.conn.execute("ROLLBACK")
+            return f"orders: {e}"
+
+    # ---- used by the edge sync task ----
+
+    def outbox(self, limit: int) -> List[tuple]:
+        return self.conn.execute("SELECT seq, tbl, row_id, op FROM _outbox ORDER BY seq LIMIT ?", (limit,)).fetchall()
+
+    def outbox_size(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM _outbox").fetchone()[0]
+
+    def clear_outbox(self, up_to_seq: int):
+        self.conn.execute("DELETE FROM _outbox WHERE seq <= ?", (up_to_seq,))
+
+    def dead_letter_outbox(self, up_to_seq: int, rejected: Dict[tuple, str]):
+        """Park the outbox entries of rows Supabase rejected permanently ({(table, row_id): error})"""
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO _outbox_dead (seq, tbl, row_id, op, error, dead_at) "
+            "SELECT seq, tbl, row_id, op, ?, ? FROM _outbox WHERE seq <= ? AND tbl = ? AND row_id = ?",
+            [(error, now, up_to_seq, table, row_id) for (table, row_id), error in rejected.items()]
+        )
+
+    def dead_outbox_size(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM _outbox_dead").fetchone()[0]
+
+    def requeue_dead_outbox(self) -> int:
+        """Push dead-lettered rows again (after fixing the cause, e.g. a migration)"""
+        self.conn.execute("BEGIN")
+        try:
+            count = self.conn.execute(
+                "INSERT INTO _outbox (tbl, row_id, op) SELECT tbl, row_id, op FROM _outbox_dead ORDER BY seq"
+            ).rowcount
+            self.conn.execute("DELETE FROM _outbox_dead")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return count
+
+    def get_row(self, table: str, row_id: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute(f"SELECT data FROM {self._table(table)} WHERE id = ?", (row_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def apply_remote(self, table: str, rows: List[Dict[str, Any]]) -> int:
+        """Upsert pulled rows, keeping local rows that still have unpushed changes. Returns rows changed."""
+        pending = {r[0] for r in self.conn.execute("SELECT DISTINCT row_id FROM _outbox WHERE tbl = ?", (table,))}
+        applied = 0
+        self.conn.execute("BEGIN")
+        try:
+            for row in rows:
+                if not row.get('id') or row['id'] in pending:
+                    continue
+                data = json.dumps(row, default=str)
+                current = self.conn.execute(f"SELECT data FROM {self._table(table)} WHERE id = ?", (row['id'],)).fetchone()
+                if current is None or current[0] != data:
+                    self._write(table, row, track=False)
+                    applied += 1
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return applied
+
+    def apply_remote_deletes(self, table: str, ids: List[str]) -> int:
+        """Delete rows removed upstream, keeping local rows that still have unpushed changes"""
+        pending = {r[0] for r in self.conn.execute("SELECT DISTINCT row_id FROM _outbox WHERE tbl = ?", (table,))}
+        applied = 0
+        self.conn.execute("BEGIN")
+        try:
+            for row_id in ids:
+                if row_id not in pending:
+                    applied += self.conn.execute(f"DELETE FROM {self._table(table)} WHERE id = ?", (row_id,)).rowcount
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return applied
+
+    def high_water(self, table: str) -> Optional[str]:
+        row = self.conn.execute("SELECT high_water FROM _sync_state WHERE tbl = ?", (table,)).fetchone()
+        return row[0] if row else None
+
+    def set_high_water(self, table: str, value: str):
+        self.conn.execute(
+            "INSERT INTO _sync_state (tbl, high_water) VALUES (?, ?) "
+            "ON CONFLICT(tbl) DO UPDATE SET high_water = excluded.high_water", (table, value)
+        )
+
+    def pull_cursor(self, table: str) -> Tuple[Optional[str], Optional[str]]:
+        """The (timestamp, id) of the last pulled row; marks stored before ids were kept have no id"""
+        stamp, _, row_id = (self.high_water(table) or "").partition("|")
+        return stamp or None, row_id or None
+
+    def set_pull_cursor(self, table: str, stamp: str, row_id: str):
+        # One row, so the timestamp and the id can never be written apart
+        self.set_high_water(table, f"{stamp}|{row_id}")
+
+def create_storage_backend():
+    if STORAGE_BACKEND == "asyncpg":
+        return AsyncpgBackend(DATABASE_URL)
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteBackend(EDGE_DB_PATH)
+    return PostgrestBackend()
+
+storage = create_storage_backend()
+
+# ==================== UPSTREAM RESILIENCE ====================
+
+# Every supabase_request passes through three guards:
+#  - the upstream scheduler: UPSTREAM_POOL_SIZE permits handed out by request
+#    class priority (critical, then normal, then background), with a bulkhead
+#    cap per class so a slow report cannot take the connections checkout and
+#    the KDS need;
+#  - a circuit breaker per table that fails fast (503) after consecutive
+#    failures and lets one probe through every BREAKER_RESET_SECONDS;
+#  - a timeout from the table's observed p99, capped by UPSTREAM_TIMEOUT.
+#    Writes always get the full UPSTREAM_TIMEOUT; cutting one short would
+#    leave it unknown whether it landed.
+# Cached reads fall back to the stale entry while the upstream fails (see TenantCache).
+UPSTREAM_TIMEOUT_MIN = float(os.environ.get('UPSTREAM_TIMEOUT_MIN', '0.5'))
+UPSTREAM_TIMEOUT_P99_FACTOR = float(os.environ.get('UPSTREAM_TIMEOUT_P99_FACTOR', '3'))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', '2'))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', '15'))
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+
+def parse_class_limits(name: str, default: str) -> Dict[str, int]:
+    """'critical=12,normal=6,background=2' style settings, one value per request class"""
+    limits = {cls: int(limit) for cls, _, limit in (entry.partition("=") for entry in os.environ.get(name, default).split(","))}
+    missing = set(REQUEST_CLASSES) - set(limits)
+    if missing:
+        raise RuntimeError(f"{name} needs a value for {', '.join(sorted(missing))}")
+    return limits
+
+# Request classes in priority order. Work started outside a request (write-behind,
+# journal replay, loyalty, warm-up) runs as normal.
+REQUEST_CLASSES = ("critical", "normal", "background")
+# First matching prefix wins; anything else is normal. None: never queued or shed.
+REQUEST_CLASS_ROUTES = [
+    ("/api/health", None),
+    ("/api/metrics", None),
+    ("/api/orders", "critical"),
+    ("/api/kds", "critical"),
+    ("/api/prints", "critical"),
+    ("/api/printers", "critical"),
+    ("/api/receipt", "critical"),
+    ("/api/auth", "critical"),
+    ("/api/coupons/validate", "critical"),
+    ("/api/delivery-zones/resolve", "critical"),
+    ("/api/customers", "critical"),
+    ("/api/loyalty", "critical"),
+    ("/api/admin/reports", "background"),
+    ("/api/admin/dashboard", "background"),
+    ("/api/admin/audit-logs", "background"),
+    ("/api/admin/menu/export", "background"),
+    ("/api/kitchen/performance/history", "background"),
+]
+UPSTREAM_BULKHEADS = parse_class_limits('UPSTREAM_BULKHEADS', 'critical=16,normal=8,background=3')
+
+metrics.describe("riwa_upstream_breaker_state", "gauge", "Circuit breaker per table and request class: 0 closed, 1 half-open, 2 open")
+metrics.describe("riwa_upstream_rejections_total", "counter", "Upstream calls not made, by table and reason")
+metrics.describe("riwa_upstream_timeout_seconds", "gauge", "Current adaptive read timeout per table and request class")
+
+_request_class: ContextVar[str] = ContextVar('request_class', default='normal')
+
+def request_class_for(path: str) -> Optional[str]:
+    for prefix, cls in REQUEST_CLASS_ROUTES:
+        if path.startswith(prefix):
+            return cls
+    return "normal"
+
+class UpstreamScheduler:
+    """Permits for upstream calls: at most `size` in flight, at most caps[class]
+    per class, and waiters granted strictly by class priority, then arrival."""
+
+    def __init__(self, size: int, caps: Dict[str, int]):
+        self.size = size
+        self.caps = caps
+        self.in_use = 0
+        self.by_class = {cls: 0 for cls in caps}
+        self._waiters: List[list] = []  # [priority, seq, class, future], kept sorted
+        self._seq = 0
+
+    def _can_run(self, cls: str) -> bool:
+        return self.in_use < self.size and self.by_class[cls] < self.caps[cls]
+
+    def _take(self, cls: str):
+        self.in_use += 1
+        self.by_class[cls] += 1
+
+    def waiting(self, cls: str) -> int:
+        return sum(1 for waiter in self._waiters if waiter[2] == cls and not waiter[3].done())
+
+    async def acquire(self, cls: str, timeout: float) -> bool:
+        if self._can_run(cls):
+            self._take(cls)
+            return True
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        bisect.insort(self._waiters, [REQUEST_CLASSES.index(cls), self._seq, cls, future], key=lambda w: (w[0], w[1]))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            if future.done():
+                return True  # granted as the timeout fired; the permit is ours
+            future.cancel()
+            return False
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(cls)  # granted, but the caller went away
+            future.cancel()
+            raise
+        finally:
+            self._waiters = [w for w in self._waiters if not w[3].done()]
+
+    def release(self, cls: str):
+        self.in_use -= 1
+        self.by_class[cls] -= 1
+        for waiter in self._waiters:
+            if waiter[3].done():
+                continue
+            if not self._can_run(waiter[2]):
+                if self.in_use >= self.size:
+                    break
+                continue  # that class is at its cap; a lower class may still go
+            self._take(waiter[2])
+            waiter[3].set_result(True)
+
+class UpstreamTarget:
+    """Breaker state and recent latencies for one upstream table and request class.
+
+    Classes are kept apart so an unbounded background report is timed against
+    its own latencies, and its timeouts cannot open the breaker checkout uses.
+    """
+
+    STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self, table: str, cls: str = "normal"):
+        self.table = table
+        self.cls = cls
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started: Optional[float] = None
+        self.latencies: deque = deque(maxlen=LATENCY_WINDOW)
+        self._timeout = UPSTREAM_TIMEOUT
+        self._samples = 0
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning(f"Upstream circuit for {self.table} ({self.cls}): {self.state} -> {state}")
+            self.state = state
+        metrics.set_gauge("riwa_upstream_breaker_state", self.STATES[state],
+                          table=self.table, request_class=self.cls)
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == "open":
+            if now - self.opened_at < BREAKER_RESET_SECONDS:
+                return False
+            self._set_state("half_open")
+        if self.state == "half_open":
+            # One probe at a time; a probe that never reported (cancelled) expires
+            if self.probe_started is not None and now - self.probe_started < BREAKER_RESET_SECONDS:
+                return False
+            self.probe_started = now
+        return True
+
+    def record(self, ok: bool, seconds: Optional[float] = None):
+        if ok:
+            self.failures = 0
+            self.probe_started = None
+            self._set_state("closed")
+            if seconds is not None:
+                self.latencies.append(seconds)
+                self._samples += 1
+                if self._samples % LATENCY_MIN_SAMPLES == 0:
+                    self._recompute_timeout()
+            return
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= BREAKER_FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+            self.probe_started = None
+            self._set_state("open")
+
+    def _recompute_timeout(self):
+        ordered = sorted(self.latencies)
+        p99 = ordered[int(0.99 * (len(ordered) - 1))]
+        self._timeout = min(UPSTREAM_TIMEOUT, max(UPSTREAM_TIMEOUT_MIN, p99 * UPSTREAM_TIMEOUT_P99_FACTOR))
+        metrics.set_gauge("riwa_upstream_timeout_seconds", self._timeout, table=self.table, request_class=self.cls)
+
+    def timeout(self, method: str) -> float:
+        if method != "GET" or len(self.latencies) < LATENCY_MIN_SAMPLES:
+            return UPSTREAM_TIMEOUT
+        return self._timeout
+
+_upstream_targets: Dict[tuple, UpstreamTarget] = {}  # (table, request class) -> target
+upstream_scheduler = UpstreamScheduler(UPSTREAM_POOL_SIZE, UPSTREAM_BULKHEADS)
+
+def upstream_target(table: str, cls: str) -> UpstreamTarget:
+    target = _upstream_targets.get((table, cls))
+    if target is None:
+        target = _upstream_targets[(table, cls)] = UpstreamTarget(table, cls)
+    return target
+
+def upstream_status() -> Dict[str, Any]:
+    """Breakers that are not closed, and upstream permits per request class"""
+    return {
+        "circuits": {f"{t.table}:{t.cls}": {"state": t.state, "failures": t.failures}
+                     for t in _upstream_targets.values() if t.state != "closed"},
+        "pool": {"size": upstream_scheduler.size, "in_use": upstream_scheduler.in_use},
+        "bulkheads": {cls: {"limit": UPSTREAM_BULKHEADS[cls], "in_use": upstream_scheduler.by_class[cls],
+                            "waiting": upstream_scheduler.waiting(cls)} for cls in REQUEST_CLASSES},
+    }
+
+# ==================== HELPER FUNCTIONS ====================
+
+async def supabase_request(method: str, endpoint: str, data: Optional[Any] = None, use_service_key: bool = False,
+                           prefer: str = "return=representation"):
+    """Make authenticated request to Supabase, recording per-table latency and status.
+
+    Waits for an upstream permit for the caller's request class, then checks
+    the circuit breaker for the table and that class; no permit in time or an
+    open circuit returns 503 and a timeout 504 without waiting on the upstream.
+    """
+    table = upstream_table(endpoint)
+    cls = _request_class.get()
+    target = upstream_target(table, cls)
+    start = time.perf_counter()
+    status = "error"
+    try:
+        if not await upstream_scheduler.acquire(cls, UPSTREAM_QUEUE_TIMEOUT):
+            status = "bulkhead_full"
+            metrics.inc("riwa_upstream_rejections_total", table=table, reason=status)
+            return StorageResponse(503, {"message": f"Too many concurrent upstream calls ({cls})"})
+        try:
+            if not target.allow():
+                status = "circuit_open"
+                metrics.inc("riwa_upstream_rejections_total", table=table, reason=status)
+                return StorageResponse(503, {"message": f"Upstream circuit open for {table}"})
+            sent = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(
+                    storage.request(method, endpoint, data, use_service_key, prefer), target.timeout(method)
+                )
+            except asyncio.TimeoutError:
+                target.record(False)
+                status = "timeout"
+                return StorageResponse(504, {"message": f"Upstream timeout for {table}"})
+            except Exception:
+                target.record(False)
+                raise
+            target.record(response.status_code < 500, time.perf_counter() - sent)
+            status = str(response.status_code)
+            return response
+        finally:
+            upstream_scheduler.release(cls)
+    finally:
+        metrics.observe("riwa_upstream_request_duration_seconds", time.perf_counter() - start, table=table, method=method)
+        metrics.inc("riwa_upstream_requests_total", table=table, method=method, status=status)
+        record_span("supabase", table, method, start, status)
+
+def generate_order_number(branch_id: str) -> str:
     """Generate unique order number in XXX-YYY format with timestamp to ensure uniqueness"""
-    global _bill_counter
+    counter = _bill_counters.setdefault(branch_id, {"prefix": 1, "number": 0})
     
     # Increment counter
-    _bill_counter["number"] += 1
+    counter["number"] += 1
     
     # Reset to next prefix when reaching 999
-    if _bill_counter["number"] > 999:
-        _bill_counter["prefix"] += 1
-        _bill_counter["number"] = 1
+    if counter["number"] > 999:
+        counter["prefix"] += 1
+        counter["number"] = 1
     
     # Add timestamp suffix for uniqueness
     timestamp = datetime.now(timezone.utc).strftime("%H%M%S")
-    prefix = str(_bill_counter["prefix"]).zfill(3)
-    number = str(_bill_counter["number"]).zfill(3)
+    prefix = str(counter["prefix"]).zfill(3)
+    number = str(counter["number"]).zfill(3)
     
     return f"{prefix}-{number}-{timestamp}"
 
-# Global bill counter (stored in memory, persists during runtime)
-_bill_counter = {"prefix": 1, "number": 0}
+# Bill counters per branch (stored in memory, persists during runtime)
+_bill_counters: Dict[str, Dict[str, int]] = {}
+
+# ==================== TENANCY ====================
+
+# X-Tenant-ID / X-Branch-ID are trusted from these peers only (comma-separated
+# IPs or CIDRs of an ingress or device gateway that authenticates the tenant
+# itself); from anyone else they must agree with the caller's verified token.
+TENANT_TRUSTED_PROXIES = [ipaddress.ip_network(entry.strip(), strict=False)
+                          for entry in os.environ.get('TENANT_TRUSTED_PROXIES', '').split(',') if entry.strip()]
+
+# (tenant_id, branch_id) for the request being handled, resolved by tenant_middleware
+_tenant_scope: ContextVar[tuple] = ContextVar('tenant_scope', default=(TENANT_ID, BRANCH_ID))
+
+def current_tenant_id() -> str:
+    return _tenant_scope.get()[0]
+
+def current_branch_id() -> str:
+    return _tenant_scope.get()[1]
+
+def _valid_uuid(value: Optional[str]) -> bool:
+    # Tenant values end up inside PostgREST query strings, so only accept real UUIDs
+    try:
+        uuid.UUID(str(value))
+        return True
+    except ValueError:
+        return False
+
+def _trusted_peer(peer: Optional[str]) -> bool:
+    try:
+        address = ipaddress.ip_address(peer or "")
+    except ValueError:
+        return False
+    return any(address in network for network in TENANT_TRUSTED_PROXIES)
+
+def client_address(request: Request, trust_forwarded: bool = False) -> Optional[str]:
+    """The caller's address: the peer, or behind a trusted proxy (or with
+    trust_forwarded) the nearest X-Forwarded-For hop that is not one of ours"""
+    peer = request.client.host if request.client else None
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded and (trust_forwarded or _trusted_peer(peer)):
+        # Anything left of the nearest untrusted hop is client-supplied
+        hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+        while len(hops) > 1 and _trusted_peer(hops[-1]):
+            hops.pop()
+        if hops:
+            return hops[-1]
+    return peer
+
+def resolve_tenant_scope(authorization: Optional[str], tenant_header: Optional[str], branch_header: Optional[str],
+                         peer: Optional[str] = None) -> tuple:
+    """Tenant/branch from our JWT claims, then the defaults.
+
+    The X-Tenant-ID/X-Branch-ID headers can pick another branch of the
+    tenant the token names, or anything when the peer is a trusted proxy.
+    Naming a tenant the caller cannot prove raises PermissionError.
+    """
+    tenant_id, branch_id = None, None
+    if authorization:
+        try:
+            payload = jwt.decode(authorization.replace("Bearer ", ""), JWT_SECRET, algorithms=["HS256"])
+            tenant_id, branch_id = payload.get('tenant_id'), payload.get('branch_id')
+        except JWTError:
+            pass  # Supabase session tokens carry no tenant claims
+    if tenant_header and tenant_header != (tenant_id or TENANT_ID) and not _trusted_peer(peer):
+        raise PermissionError("X-Tenant-ID does not match the session")
+    if tenant_id is None and branch_header and branch_header != BRANCH_ID and not _trusted_peer(peer):
+        raise PermissionError("X-Branch-ID needs a session for the tenant")
+    tenant_id = tenant_header or tenant_id or TENANT_ID
+    branch_id = branch_header or branch_id or (BRANCH_ID if tenant_id == TENANT_ID else None)
+    if not _valid_uuid(tenant_id) or not _valid_uuid(branch_id):
+        raise ValueError("Invalid or missing tenant/branch")
+    return str(tenant_id), str(branch_id)
+
+# ==================== CACHES ====================
+
+# Memory budgets for cached tenant data; least recently used entries are evicted first
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CACHE_SCOPE_MAX_BYTES = int(os.environ.get('CACHE_SCOPE_MAX_BYTES', str(8 * 1024 * 1024)))
+MENU_CACHE_TTL = float(os.environ.get('MENU_CACHE_TTL', '300'))
+SETTINGS_CACHE_TTL = float(os.environ.get('SETTINGS_CACHE_TTL', '300'))
+PRINTER_CACHE_TTL = float(os.environ.get('PRINTER_CACHE_TTL', '300'))
+DASHBOARD_CACHE_TTL = float(os.environ.get('DASHBOARD_CACHE_TTL', '15'))
+COUPON_CACHE_TTL = float(os.environ.get('COUPON_CACHE_TTL', '60'))
+# How long past its TTL an entry may still be served when reloading it fails
+CACHE_STALE_SECONDS = float(os.environ.get('CACHE_STALE_SECONDS', '3600'))
+
+metrics.describe("riwa_cache_bytes", "gauge", "Approximate bytes held by the tenant cache")
+metrics.describe("riwa_cache_evictions_total", "counter", "Tenant cache entries evicted to stay within memory limits")
+metrics.describe("riwa_cache_stale_served_total", "counter", "Expired cache entries served because reloading failed")
+
+class TenantCache:
+    """LRU + TTL cache keyed by (tenant, branch, key) with global and per-scope byte limits.
+
+    Concurrent misses for the same key share one loader call. Expired entries
+    stay until evicted or invalidated and are served (up to
+    CACHE_STALE_SECONDS past expiry) when the loader fails.
+    """
+
+    def __init__(self, max_bytes: int, scope_max_bytes: int):
+        self.max_bytes = max_bytes
+        self.scope_max_bytes = scope_max_bytes
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (expires_at, size, value)
+        self._scope_bytes: Dict[tuple, int] = {}
+        self._total_bytes = 0
+        self._loading: Dict[tuple, asyncio.Future] = {}
+
+    def _drop(self, key: tuple):
+        _, size, _ = self._entries.pop(key)
+        scope = key[:2]
+        self._scope_bytes[scope] -= size
+        if not self._scope_bytes[scope]:
+            del self._scope_bytes[scope]
+        self._total_bytes -= size
+
+    def _evict(self, scope: tuple):
+        while self._total_bytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+            metrics.inc("riwa_cache_evictions_total", reason="global")
+        while self._scope_bytes.get(scope, 0) > self.scope_max_bytes:
+            oldest = next(k for k in self._entries if k[:2] == scope)
+            self._drop(oldest)
+            metrics.inc("riwa_cache_evictions_total", reason="scope")
+        metrics.set_gauge("riwa_cache_bytes", self._total_bytes)
+
+    def get(self, key: tuple) -> tuple:
+        """(hit, value) for a fresh entry"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return False, None
+        self._entries.move_to_end(key)
+        return True, entry[2]
+
+    def set(self, key: tuple, value: Any, ttl: float):
+        if key in self._entries:
+            self._drop(key)
+        size = len(json.dumps(value, default=str))
+        self._entries[key] = (time.monotonic() + ttl, size, value)
+        scope = key[:2]
+        self._scope_bytes[scope] = self._scope_bytes.get(scope, 0) + size
+        self._total_bytes += size
+        self._evict(scope)
+
+    def invalidate(self, prefix: str, tenant_id: Optional[str] = None):
+        """Drop entries whose key starts with prefix, for one tenant (all branches) or everyone"""
+        for key in [k for k in self._entries if k[2].startswith(prefix) and (tenant_id is None or k[0] == tenant_id)]:
+            self._drop(key)
+        metrics.set_gauge("riwa_cache_bytes", self._total_bytes)
+
+    async def get_or_load(self, name: str, loader, ttl: float) -> Any:
+        key = (current_tenant_id(), current_branch_id(), name)
+        hit, value = self.get(key)
+        record_cache_lookup(name.split(':', 1)[0], hit)
+        if hit:
+            return value
+        pending = self._loading.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            value = await loader()
+            self.set(key, value, ttl)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] + CACHE_STALE_SECONDS >= time.monotonic():
+                logger.warning(f"Serving stale {name} after load failure: {e}")
+                metrics.inc("riwa_cache_stale_served_total", cache=name.split(':', 1)[0])
+                future.set_result(entry[2])
+                return entry[2]
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else is waiting
+            raise
+        finally:
+            del self._loading[key]
+
+tenant_cache = TenantCache(CACHE_MAX_BYTES, CACHE_SCOPE_MAX_BYTES)
+
+def invalidate_cache(prefix: str):
+    """Invalidate cached data for every branch of the current tenant"""
+    tenant_cache.invalidate(prefix, current_tenant_id())
 
 # ==================== AUTH ENDPOINTS ====================
 
@@ -158,7 +1552,7 @@ async def pin_login(request: PinLoginRequest):
         # Query user by name/email and PIN for this tenant
         response = await supabase_request(
             "GET",
-            f"users?tenant_id=eq.{TENANT_ID}&pin=eq.{request.pin}&select=id,name,email,role,branch_id,tenant_id",
+            f"users?tenant_id=eq.{current_tenant_id()}&pin=eq.{request.pin}&select=id,name,email,role,branch_id,tenant_id",
             use_service_key=True
         )
         
@@ -183,8 +1577,8 @@ async def pin_login(request: PinLoginRequest):
         token_data = {
             "user_id": matched_user['id'],
             "role": matched_user['role'],
-            "branch_id": matched_user.get('branch_id', BRANCH_ID),
-            "tenant_id": matched_user.get('tenant_id', TENANT_ID),
+            "branch_id": matched_user.get('branch_id', current_branch_id()),
+            "tenant_id": matched_user.get('tenant_id', current_tenant_id()),
             "exp": datetime.now(timezone.utc).timestamp() + 86400  # 24h
         }
         token = jwt.encode(token_data, JWT_SECRET, algorithm="HS256")
@@ -212,70 +1606,70 @@ async def pin_login(request: PinLoginRequest):
 async def email_login(request: EmailLoginRequest):
     """Login with email/password via Supabase Auth"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{SUPABASE_URL}/auth/v1/token?grant_type=password",
-                headers={
-                    "apikey": SUPABASE_ANON_KEY,
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "email": request.email,
-                    "password": request.password
-                }
-            )
-            
-            if response.status_code != 200:
-                raise HTTPException(status_code=401, detail="Invalid credentials")
-            
-            auth_data = response.json()
-            user_id = auth_data['user']['id']
-            
-            # Get user from public.users
+        client = get_http_client()
+        response = await client.post(
+            f"{SUPABASE_URL}/auth/v1/token?grant_type=password",
+            headers={
+                "apikey": SUPABASE_ANON_KEY,
+                "Content-Type": "application/json"
+            },
+            json={
+                "email": request.email,
+                "password": request.password
+            }
+        )
+        
+        if response.status_code != 200:
+            raise HTTPException(status_code=401, detail="Invalid credentials")
+        
+        auth_data = response.json()
+        user_id = auth_data['user']['id']
+        
+        # Get user from public.users
+        user_response = await supabase_request(
+            "GET",
+            f"users?id=eq.{user_id}&tenant_id=eq.{current_tenant_id()}",
+            use_service_key=True
+        )
+        
+        users = user_response.json() if user_response.status_code == 200 else []
+        
+        if not users:
+            # Try to find by email
             user_response = await supabase_request(
                 "GET",
-                f"users?id=eq.{user_id}&tenant_id=eq.{TENANT_ID}",
+                f"users?email=eq.{request.email}&tenant_id=eq.{current_tenant_id()}",
                 use_service_key=True
             )
-            
             users = user_response.json() if user_response.status_code == 200 else []
-            
-            if not users:
-                # Try to find by email
-                user_response = await supabase_request(
-                    "GET",
-                    f"users?email=eq.{request.email}&tenant_id=eq.{TENANT_ID}",
-                    use_service_key=True
-                )
-                users = user_response.json() if user_response.status_code == 200 else []
-            
-            if users:
-                user = users[0]
-            else:
-                user = {
-                    "id": user_id,
-                    "name": request.email.split('@')[0],
-                    "role": "admin",
-                    "tenant_id": TENANT_ID,
-                    "branch_id": BRANCH_ID
-                }
-            
-            return {
-                "success": True,
-                "token": auth_data['access_token'],
-                "refresh_token": auth_data.get('refresh_token'),
-                "user": {
-                    "id": user.get('id', user_id),
-                    "name": user.get('name', request.email),
-                    "email": request.email,
-                    "role": user.get('role', 'admin'),
-                    "branch_id": user.get('branch_id', BRANCH_ID),
-                    "tenant_id": user.get('tenant_id', TENANT_ID)
-                }
+        
+        if users:
+            user = users[0]
+        else:
+            user = {
+                "id": user_id,
+                "name": request.email.split('@')[0],
+                "role": "admin",
+                "tenant_id": current_tenant_id(),
+                "branch_id": current_branch_id()
             }
-            
-    except HTTPException:
-        raise
+        
+        return {
+            "success": True,
+            "token": auth_data['access_token'],
+            "refresh_token": auth_data.get('refresh_token'),
+            "user": {
+                "id": user.get('id', user_id),
+                "name": user.get('name', request.email),
+                "email": request.email,
+                "role": user.get('role', 'admin'),
+                "branch_id": user.get('branch_id', current_branch_id()),
+                "tenant_id": user.get('tenant_id', current_tenant_id())
+            }
+        }
+        
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Email login error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -302,22 +1696,22 @@ async def get_current_user(authorization: str = Header(None)):
             pass
         
         # Try as Supabase token
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{SUPABASE_URL}/auth/v1/user",
-                headers={
-                    "apikey": SUPABASE_ANON_KEY,
-                    "Authorization": f"Bearer {token}"
-                }
-            )
-            
-            if response.status_code == 200:
-                user_data = response.json()
-                return {
-                    "id": user_data['id'],
-                    "email": user_data.get('email'),
-                    "role": "admin"
-                }
+        client = get_http_client()
+        response = await client.get(
+            f"{SUPABASE_URL}/auth/v1/user",
+            headers={
+                "apikey": SUPABASE_ANON_KEY,
+                "Authorization": f"Bearer {token}"
+            }
+        )
+        
+        if response.status_code == 200:
+            user_data = response.json()
+            return {
+                "id": user_data['id'],
+                "email": user_data.get('email'),
+                "role": "admin"
+            }
         
         raise HTTPException(status_code=401, detail="Invalid token")
         
@@ -329,28 +1723,40 @@ async def get_current_user(authorization: str = Header(None)):
 
 # ==================== MENU ENDPOINTS ====================
 
+def normalize_category(cat: Dict[str, Any]) -> Dict[str, Any]:
+    """Frontend field names for a categories row"""
+    cat['name'] = cat.get('name_en', cat.get('name', ''))
+    cat['name_ar'] = cat.get('name_ar', '')
+    cat['is_active'] = cat.get('status') == 'active'
+    return cat
+
+def normalize_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Frontend field names for an items row"""
+    item['name'] = item.get('name_en', item.get('name', ''))
+    item['name_ar'] = item.get('name_ar', '')
+    item['is_active'] = item.get('status') == 'active'
+    # Map base_price to price for frontend compatibility
+    item['price'] = item.get('base_price', item.get('price', 0))
+    return item
+
 @api_router.get("/menu/categories")
 async def get_categories():
     """Get all menu categories for this tenant"""
-    try:
+    async def load():
         response = await supabase_request(
             "GET",
-            f"categories?tenant_id=eq.{TENANT_ID}&status=eq.active&order=sort_order.asc",
+            f"categories?tenant_id=eq.{current_tenant_id()}&status=eq.active&order=sort_order.asc",
             use_service_key=True
         )
         
         if response.status_code != 200:
-            logger.error(f"Categories query failed: {response.status_code} - {response.text}")
-            return {"categories": []}
+            raise RuntimeError(f"Categories query failed: {response.status_code} - {response.text}")
         
         categories = response.json() or []
-        # Normalize field names
-        for cat in categories:
-            cat['name'] = cat.get('name_en', cat.get('name', ''))
-            cat['name_ar'] = cat.get('name_ar', '')
-            cat['is_active'] = cat.get('status') == 'active'
-        
-        return {"categories": categories}
+        return {"categories": [normalize_category(cat) for cat in categories]}
+    
+    try:
+        return await tenant_cache.get_or_load("menu:categories", load, MENU_CACHE_TTL)
     except Exception as e:
         logger.error(f"Get categories error: {e}")
         return {"categories": []}
@@ -358,27 +1764,21 @@ async def get_categories():
 @api_router.get("/menu/items")
 async def get_items(category_id: Optional[str] = None):
     """Get menu items for this tenant"""
-    try:
-        endpoint = f"items?tenant_id=eq.{TENANT_ID}&status=eq.active&order=sort_order.asc"
+    async def load():
+        endpoint = f"items?tenant_id=eq.{current_tenant_id()}&status=eq.active&order=sort_order.asc"
         if category_id:
             endpoint += f"&category_id=eq.{category_id}"
         
         response = await supabase_request("GET", endpoint, use_service_key=True)
         
         if response.status_code != 200:
-            logger.error(f"Items query failed: {response.status_code} - {response.text}")
-            return {"items": []}
+            raise RuntimeError(f"Items query failed: {response.status_code} - {response.text}")
         
         items = response.json() or []
-        # Normalize field names
-        for item in items:
-            item['name'] = item.get('name_en', item.get('name', ''))
-            item['name_ar'] = item.get('name_ar', '')
-            item['is_active'] = item.get('status') == 'active'
-            # Map base_price to price for frontend compatibility
-            item['price'] = item.get('base_price', item.get('price', 0))
-        
-        return {"items": items}
+        return {"items": [normalize_item(item) for item in items]}
+    
+    try:
+        return await tenant_cache.get_or_load(f"menu:items:{category_id or '*'}", load, MENU_CACHE_TTL)
     except Exception as e:
         logger.error(f"Get items error: {e}")
         return {"items": []}
@@ -386,11 +1786,11 @@ async def get_items(category_id: Optional[str] = None):
 @api_router.get("/menu/item/{item_id}")
 async def get_item_details(item_id: str):
     """Get item with variants and modifiers"""
-    try:
+    async def load():
         # Get item
         item_response = await supabase_request(
             "GET",
-            f"items?id=eq.{item_id}&tenant_id=eq.{TENANT_ID}",
+            f"items?id=eq.{item_id}&tenant_id=eq.{current_tenant_id()}",
             use_service_key=True
         )
         
@@ -410,58 +1810,1674 @@ async def get_item_details(item_id: str):
         )
         item['variants'] = variants_response.json() if variants_response.status_code == 200 else []
         
-        # Get modifier groups linked to this item
-        if item.get('modifier_group_ids'):
-            modifier_groups = []
-            for mg_id in item['modifier_group_ids']:
-                mg_response = await supabase_request(
+        # Get modifier groups linked to this item
+        if item.get('modifier_group_ids'):
+            modifier_groups = []
+            for mg_id in item['modifier_group_ids']:
+                mg_response = await supabase_request(
+                    "GET",
+                    f"modifier_groups?id=eq.{mg_id}&status=eq.active",
+                    use_service_key=True
+                )
+                if mg_response.status_code == 200 and mg_response.json():
+                    group = mg_response.json()[0]
+                    group['name'] = group.get('name_en', group.get('name', ''))
+                    
+                    # Get modifiers
+                    mods_response = await supabase_request(
+                        "GET",
+                        f"modifiers?modifier_group_id=eq.{mg_id}&status=eq.active&order=sort_order.asc",
+                        use_service_key=True
+                    )
+                    group['modifiers'] = mods_response.json() if mods_response.status_code == 200 else []
+                    modifier_groups.append(group)
+            
+            item['modifier_groups'] = modifier_groups
+        else:
+            item['modifier_groups'] = []
+        
+        return item
+    
+    try:
+        return await tenant_cache.get_or_load(f"menu:item:{item_id}", load, MENU_CACHE_TTL)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get item details error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== WRITE-BEHIND ====================
+
+# Audit-style rows (order_states, audit_logs) nobody waits on are buffered
+# and flushed as bulk inserts every WRITE_BEHIND_FLUSH_MS or WRITE_BEHIND_MAX_ROWS rows.
+WRITE_BEHIND_FLUSH_MS = int(os.environ.get('WRITE_BEHIND_FLUSH_MS', '250'))
+WRITE_BEHIND_MAX_ROWS = int(os.environ.get('WRITE_BEHIND_MAX_ROWS', '100'))
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get('WRITE_BEHIND_MAX_PENDING', '50000'))
+# A single row whose data is rejected (DATA_REJECTIONS) this many flushes in a
+# row is parked in WRITE_BEHIND_DEAD_PATH
+WRITE_BEHIND_MAX_FAILURES = int(os.environ.get('WRITE_BEHIND_MAX_FAILURES', '5'))
+WRITE_BEHIND_DEAD_PATH = os.environ.get('WRITE_BEHIND_DEAD_PATH', str(ROOT_DIR / 'data' / 'write_behind_dead.jsonl'))
+
+# Tables whose rows are merged into existing ones rather than inserted:
+# table -> (function taking the batch as `rows`, unique key for the fallback
+# upsert when the function is not installed)
+WRITE_BEHIND_MERGES = {
+    "kitchen_hourly_stats": ("rpc/riwa_merge_kitchen_stats", "tenant_id,hour_start,station"),
+}
+
+metrics.describe("riwa_write_behind_pending_rows", "gauge", "Rows buffered for write-behind insert, by table")
+metrics.describe("riwa_write_behind_flush_failures_total", "counter", "Failed write-behind bulk inserts, by table")
+metrics.describe("riwa_write_behind_dropped_rows_total", "counter", "Write-behind rows parked, by table and reason")
+
+def park_write_behind_rows(table: str, rows: List[Dict[str, Any]], reason: str, error: str = ""):
+    """Append rows the buffer gives up on to the dead file, for /write-behind/requeue"""
+    now = datetime.now(timezone.utc).isoformat()
+    try:
+        Path(WRITE_BEHIND_DEAD_PATH).parent.mkdir(parents=True, exist_ok=True)
+        with open(WRITE_BEHIND_DEAD_PATH, "a") as f:
+            for row in rows:
+                f.write(json.dumps({"table": table, "row": row, "reason": reason, "error": error,
+                                    "parked_at": now}, default=str) + "\n")
+    except OSError as e:
+        logger.error(f"Write-behind could not park {len(rows)} {table} rows, dropping them: {e}")
+    metrics.inc("riwa_write_behind_dropped_rows_total", len(rows), table=table, reason=reason)
+
+class WriteBehindBuffer:
+    """Buffered rows for one table, flushed as chunked bulk inserts.
+
+    Rows are queued with a sequence number, so a flush removes exactly the
+    rows it sent even if add() shed older ones while the insert was in
+    flight. When Supabase rejects a batch's data (DATA_REJECTIONS),
+    the batch is halved until the offending row is alone; that row is parked
+    after WRITE_BEHIND_MAX_FAILURES attempts instead of holding up the rest.
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+        self.rows: deque = deque()  # (seq, row), oldest first
+        self.seq = 0
+        self.batch_size = WRITE_BEHIND_MAX_ROWS
+        self.failing_seq = 0
+        self.failures = 0  # consecutive rejections of the row at failing_seq
+
+    def add(self, row: Dict[str, Any]):
+        if len(self.rows) >= WRITE_BEHIND_MAX_PENDING:
+            # Supabase has been down long enough to fill the buffer; shed the oldest audit rows
+            _, dropped = self.rows.popleft()
+            park_write_behind_rows(self.table, [dropped], "full")
+            logger.error(f"Write-behind buffer for {self.table} full, parked row {dropped.get('id')}")
+        self.seq += 1
+        self.rows.append((self.seq, row))
+        metrics.set_gauge("riwa_write_behind_pending_rows", len(self.rows), table=self.table)
+        if len(self.rows) >= WRITE_BEHIND_MAX_ROWS:
+            _write_behind_wakeup.set()
+
+    def _remove_through(self, seq: int):
+        while self.rows and self.rows[0][0] <= seq:
+            self.rows.popleft()
+        metrics.set_gauge("riwa_write_behind_pending_rows", len(self.rows), table=self.table)
+
+    async def _send(self, rows: List[Dict[str, Any]]) -> Any:
+        merge = WRITE_BEHIND_MERGES.get(self.table)
+        if merge is None:
+            # ignore-duplicates keeps retries idempotent if a previous attempt landed
+            return await supabase_request("POST", self.table, rows, use_service_key=True,
+                                          prefer="return=minimal,resolution=ignore-duplicates")
+        function, unique_key = merge
+        response = await supabase_request("POST", function, {"rows": rows}, use_service_key=True,
+                                          prefer="return=minimal")
+        if response.status_code != 404:
+            return response
+        # Merge function not installed: upsert on the unique key (last writer wins)
+        return await supabase_request("POST", f"{self.table}?on_conflict={unique_key}", rows, use_service_key=True,
+                                      prefer="return=minimal,resolution=merge-duplicates")
+
+    async def flush(self):
+        while self.rows:
+            batch = list(islice(self.rows, self.batch_size))
+            response = await self._send([row for _, row in batch])
+            if response.status_code in [200, 201, 204]:
+                # Rows added while the insert was in flight stay queued behind the batch
+                self._remove_through(batch[-1][0])
+                self.batch_size = min(WRITE_BEHIND_MAX_ROWS, self.batch_size * 2)
+                continue
+            metrics.inc("riwa_write_behind_flush_failures_total", table=self.table)
+            error = f"{self.table}: {response.status_code} {response.text[:200]}"
+            if response.status_code not in DATA_REJECTIONS:
+                raise RuntimeError(error)
+            if len(batch) > 1:
+                self.batch_size = max(1, len(batch) // 2)
+                continue
+            if batch[0][0] != self.failing_seq:
+                self.failing_seq, self.failures = batch[0][0], 0
+            self.failures += 1
+            if self.failures < WRITE_BEHIND_MAX_FAILURES:
+                raise RuntimeError(error)
+            self._remove_through(batch[-1][0])
+            park_write_behind_rows(self.table, [batch[-1][1]], "rejected", error)
+            logger.error(f"Write-behind parked row {batch[-1][1].get('id')} after {WRITE_BEHIND_MAX_FAILURES} rejections: {error}")
+
+_write_behind: Dict[str, WriteBehindBuffer] = {}
+_write_behind_wakeup = asyncio.Event()
+
+def write_behind_insert(table: str, row: Dict[str, Any]):
+    """Queue a row for a background bulk insert instead of awaiting it in the request"""
+    buffer = _write_behind.get(table)
+    if buffer is None:
+        buffer = _write_behind[table] = WriteBehindBuffer(table)
+    buffer.add(row)
+
+async def flush_write_behind():
+    """Flush every buffer; failures are logged and the rows stay queued for the next attempt"""
+    failed = False
+    for buffer in list(_write_behind.values()):
+        try:
+            await buffer.flush()
+        except Exception as e:
+            failed = True
+            logger.warning(f"Write-behind flush failed: {e}")
+    return not failed
+
+def requeue_write_behind_dead() -> int:
+    """Queue parked rows again (after fixing the cause, e.g. a migration)"""
+    path = Path(WRITE_BEHIND_DEAD_PATH)
+    if not path.exists():
+        return 0
+    # Renamed first so rows parked again while requeueing land in a fresh file
+    claimed = path.with_suffix(".requeue")
+    path.replace(claimed)
+    count = 0
+    with open(claimed) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                write_behind_insert(entry["table"], entry["row"])
+                count += 1
+    claimed.unlink()
+    _write_behind_wakeup.set()
+    return count
+
+@api_router.post("/write-behind/requeue")
+async def write_behind_requeue():
+    """Retry audit rows the write-behind buffer parked"""
+    return {"success": True, "requeued": requeue_write_behind_dead()}
+
+async def run_write_behind():
+    """Background task: flush buffers on an interval, or early when one fills up"""
+    backoff = WRITE_BEHIND_FLUSH_MS / 1000
+    while True:
+        try:
+            await asyncio.wait_for(_write_behind_wakeup.wait(), timeout=backoff)
+        except asyncio.TimeoutError:
+            pass
+        _write_behind_wakeup.clear()
+        if await flush_write_behind():
+            backoff = WRITE_BEHIND_FLUSH_MS / 1000
+        else:
+            backoff = min(backoff * 2, 30)
+
+# ==================== ORDER JOURNAL ====================
+
+# Orders are committed to a local SQLite write-ahead journal and replayed to
+# Supabase in the background, so checkout keeps working through outages.
+ORDER_JOURNAL_ENABLED = os.environ.get('ORDER_JOURNAL_ENABLED', 'true').lower() == 'true'
+ORDER_JOURNAL_PATH = os.environ.get('ORDER_JOURNAL_PATH', str(ROOT_DIR / 'data' / 'order_journal.db'))
+ORDER_JOURNAL_BATCH_SIZE = int(os.environ.get('ORDER_JOURNAL_BATCH_SIZE', '25'))
+ORDER_JOURNAL_MAX_BACKOFF = float(os.environ.get('ORDER_JOURNAL_MAX_BACKOFF', '60'))
+
+class OrderJournal:
+    """Append-only, durable journal of order writes pending replay to Supabase.
+
+    Entries are ``order`` (the order row plus its items), ``coupon`` (the
+    order's coupon redemption, appended with it), ``status`` (a status
+    change for an order that has not been replayed yet) or ``items`` (a KDS
+    status change for some of its items). They are replayed strictly in
+    sequence order, except that an entry Supabase rejects permanently (a 4xx,
+    e.g. a missing column) is dead-lettered so the entries behind it keep
+    draining. Later entries for the same order are held behind a dead one
+    (a status change for an order Supabase never got would match no rows)
+    and replay after it once requeued. Dead entries count as unreplayed
+    (reads still see them) until requeued.
+    """
+
+    # Entries queued behind a dead entry of the same order
+    HELD = ("EXISTS (SELECT 1 FROM journal d WHERE d.order_id = journal.order_id AND d.seq < journal.seq "
+            "AND d.dead_at IS NOT NULL AND d.replayed_at IS NULL)")
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")  # a sale must survive a power cut
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                order_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                replayed_at REAL,
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT
+            )
+        """)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(journal)")}
+        if "dead_at" not in columns:
+            self.conn.execute("ALTER TABLE journal ADD COLUMN dead_at REAL")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_journal_pending ON journal(replayed_at, seq)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_journal_order ON journal(order_id)")
+        self.wakeup = asyncio.Event()
+        self.last_error: Optional[str] = None
+        self.last_replayed_at: Optional[float] = None
+
+    def append(self, kind: str, order_id: str, payload: Dict[str, Any]) -> int:
+        cursor = self.conn.execute(
+            "INSERT INTO journal (kind, order_id, payload, created_at) VALUES (?, ?, ?, ?)",
+            (kind, order_id, json.dumps(payload), time.time())
+        )
+        self.wakeup.set()
+        return cursor.lastrowid
+
+    def append_all(self, entries: List[tuple]):
+        """Append several (kind, order_id, payload) entries atomically"""
+        now = time.time()
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(
+                "INSERT INTO journal (kind, order_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                [(kind, order_id, json.dumps(payload), now) for kind, order_id, payload in entries]
+            )
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        self.wakeup.set()
+
+    def pending_coupon_uses(self, coupon_id: str) -> int:
+        """Redemptions of a coupon taken at this till but not replayed to Supabase yet"""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM journal WHERE kind = 'coupon' AND replayed_at IS NULL "
+            "AND json_extract(payload, '$.coupon_id') = ?", (coupon_id,)
+        ).fetchone()[0]
+
+    def pending(self, limit: int) -> List[tuple]:
+        rows = self.conn.execute(
+            f"SELECT seq, kind, order_id, payload FROM journal WHERE replayed_at IS NULL AND dead_at IS NULL "
+            f"AND NOT {self.HELD} ORDER BY seq LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [(seq, kind, order_id, json.loads(payload)) for seq, kind, order_id, payload in rows]
+
+    def has_pending(self, order_id: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM journal WHERE order_id = ? AND replayed_at IS NULL LIMIT 1", (order_id,)
+        ).fetchone()
+        return row is not None
+
+    def pending_order_ids(self) -> List[str]:
+        rows = self.conn.execute("SELECT DISTINCT order_id FROM journal WHERE replayed_at IS NULL").fetchall()
+        return [row[0] for row in rows]
+
+    def get_order(self, order_id: str) -> Optional[Dict[str, Any]]:
+        """Latest journaled view of an order (for reads before it reaches Supabase)"""
+        rows = self.conn.execute(
+            "SELECT kind, payload FROM journal WHERE order_id = ? ORDER BY seq", (order_id,)
+        ).fetchall()
+        order = None
+        for kind, payload in rows:
+            entry = json.loads(payload)
+            if kind == "order":
+                order = dict(entry["order"], items=entry["items"])
+            elif kind == "status" and order is not None:
+                order["status"] = entry["status"]
+                order["updated_at"] = entry["updated_at"]
+            elif kind == "items" and order is not None:
+                changed = set(entry["item_ids"])
+                order["items"] = [dict(item, status=entry["status"]) if item["id"] in changed else item
+                                  for item in order["items"]]
+        return order
+
+    def mark_replayed(self, seqs: List[int]):
+        now = time.time()
+        self.conn.executemany("UPDATE journal SET replayed_at = ? WHERE seq = ?", [(now, seq) for seq in seqs])
+        self.last_replayed_at = now
+        self.last_error = None
+
+    def mark_failed(self, seqs: List[int], error: str):
+        self.conn.executemany(
+            "UPDATE journal SET attempts = attempts + 1, last_error = ? WHERE seq = ?", [(error, seq) for seq in seqs]
+        )
+        self.last_error = error
+
+    def dead_letter(self, seqs: List[int], error: str):
+        """Park permanently rejected entries; replay continues with the next ones"""
+        now = time.time()
+        self.conn.executemany(
+            "UPDATE journal SET attempts = attempts + 1, last_error = ?, dead_at = ? WHERE seq = ?",
+            [(error, now, seq) for seq in seqs]
+        )
+        self.last_error = error
+        metrics.inc("riwa_order_journal_dead_letters_total", len(seqs))
+        metrics.set_gauge("riwa_order_journal_dead_entries", self.dead_count())
+        logger.error(f"Order journal dead-lettered {len(seqs)} entries (seq {seqs[0]}): {error}")
+
+    def dead_count(self) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM journal WHERE dead_at IS NOT NULL AND replayed_at IS NULL"
+        ).fetchone()[0]
+
+    def requeue_dead(self) -> int:
+        """Put dead-lettered entries back in the replay queue (after fixing the cause, e.g. a migration)"""
+        cursor = self.conn.execute(
+            "UPDATE journal SET dead_at = NULL, attempts = 0 WHERE dead_at IS NOT NULL AND replayed_at IS NULL"
+        )
+        metrics.set_gauge("riwa_order_journal_dead_entries", 0)
+        self.wakeup.set()
+        return cursor.rowcount
+
+    def last_order_numbers(self, scan: int = 1000) -> Dict[str, str]:
+        """Most recent order number per branch among the last `scan` journaled orders"""
+        rows = self.conn.execute(
+            "SELECT payload FROM journal WHERE kind = 'order' ORDER BY seq DESC LIMIT ?", (scan,)
+        ).fetchall()
+        latest: Dict[str, str] = {}
+        for (payload,) in rows:
+            order = json.loads(payload)["order"]
+            latest.setdefault(order.get("branch_id"), order["order_number"])
+        return latest
+
+    def prune(self, older_than_seconds: float = 7 * 86400):
+        self.conn.execute(
+            "DELETE FROM journal WHERE replayed_at IS NOT NULL AND replayed_at < ?", (time.time() - older_than_seconds,)
+        )
+
+    def status(self) -> Dict[str, Any]:
+        count, oldest, attempts = self.conn.execute(
+            f"SELECT COUNT(*), MIN(created_at), MAX(attempts) FROM journal WHERE replayed_at IS NULL AND dead_at IS NULL "
+            f"AND NOT {self.HELD}"
+        ).fetchone()
+        held = self.conn.execute(
+            f"SELECT COUNT(*) FROM journal WHERE replayed_at IS NULL AND dead_at IS NULL AND {self.HELD}"
+        ).fetchone()[0]
+        dead = self.conn.execute(
+            "SELECT seq, kind, order_id, attempts, last_error, dead_at FROM journal "
+            "WHERE dead_at IS NOT NULL AND replayed_at IS NULL ORDER BY seq LIMIT 50"
+        ).fetchall()
+        return {
+            "pending_entries": count,
+            "dead_entries": self.dead_count(),
+            "held_entries": held,
+            "dead": [{"seq": seq, "kind": kind, "order_id": order_id, "attempts": n, "error": error,
+                      "dead_at": datetime.fromtimestamp(dead_at, timezone.utc).isoformat()}
+                     for seq, kind, order_id, n, error, dead_at in dead],
+            "oldest_pending_at": datetime.fromtimestamp(oldest, timezone.utc).isoformat() if oldest else None,
+            "lag_seconds": round(time.time() - oldest, 3) if oldest else 0,
+            "max_attempts": attempts or 0,
+            "last_error": self.last_error,
+            "last_replayed_at": datetime.fromtimestamp(self.last_replayed_at, timezone.utc).isoformat() if self.last_replayed_at else None
+        }
+
+metrics.describe("riwa_order_journal_dead_letters_total", "counter", "Journal entries Supabase rejected permanently")
+metrics.describe("riwa_order_journal_dead_entries", "gauge", "Dead-lettered journal entries awaiting requeue")
+
+order_journal: Optional[OrderJournal] = OrderJournal(ORDER_JOURNAL_PATH) if ORDER_JOURNAL_ENABLED else None
+
+def restore_bill_counters(journal: OrderJournal):
+    """Continue each branch's bill number sequence from its last journaled order after a restart"""
+    for branch_id, order_number in journal.last_order_numbers().items():
+        prefix, number = order_number.split('-')[:2]
+        _bill_counters[branch_id] = {"prefix": int(prefix), "number": int(number)}
+
+async def replay_journal_batch(journal: OrderJournal) -> int:
+    """Send the next run of pending journal entries to Supabase, in order. Returns entries replayed."""
+    entries = journal.pending(ORDER_JOURNAL_BATCH_SIZE)
+    if not entries:
+        return 0
+
+    # Consecutive order entries become one bulk insert for orders and one for their items
+    orders = []
+    for seq, kind, order_id, payload in entries:
+        if kind != "order":
+            break
+        orders.append((seq, payload))
+
+    if orders:
+        seqs = [seq for seq, _ in orders]
+        order_rows = [payload["order"] for _, payload in orders]
+        item_rows = [item for _, payload in orders for item in payload["items"]]
+        # ignore-duplicates makes a retried batch idempotent if a previous attempt half-succeeded
+        error = await storage.insert_order(order_rows, item_rows, "return=minimal,resolution=ignore-duplicates")
+        if error and permanent_storage_error(error):
+            if len(orders) == 1:
+                journal.dead_letter(seqs, error)
+            else:
+                # Some order in the batch is rejected: insert them one by one to find it
+                for seq, payload in orders:
+                    await replay_order_entry(journal, seq, payload)
+            return len(seqs)
+        if error:
+            journal.mark_failed(seqs, error)
+            raise RuntimeError(journal.last_error)
+        journal.mark_replayed(seqs)
+        return len(seqs)
+
+    seq, kind, order_id, payload = entries[0]
+    if kind == "coupon":
+        response = await redeem_coupon(payload["coupon_id"], order_id)
+        if response is not None:
+            replay_failed(journal, seq, response, "coupon")
+        else:
+            journal.mark_replayed([seq])
+            # The cached used_count plus pending_coupon_uses no longer covers this use
+            tenant_cache.invalidate("coupons:", payload["tenant_id"])
+        return 1
+    if kind == "items":
+        response = await supabase_request(
+            "PATCH",
+            f"order_items?id=in.({','.join(payload['item_ids'])})",
+            {"status": payload["status"]},
+            use_service_key=True,
+            prefer="return=minimal"
+        )
+        if response.status_code not in [200, 204]:
+            replay_failed(journal, seq, response, "items")
+        else:
+            journal.mark_replayed([seq])
+        return 1
+    
+    response = await supabase_request(
+        "PATCH",
+        f"orders?id=eq.{order_id}",
+        {"status": payload["status"], "updated_at": payload["updated_at"]},
+        use_service_key=True,
+        prefer="return=minimal"
+    )
+    if response.status_code not in [200, 204]:
+        replay_failed(journal, seq, response, "status")
+        return 1
+    write_behind_insert("order_states", payload["state"])
+    journal.mark_replayed([seq])
+    return 1
+
+async def replay_order_entry(journal: OrderJournal, seq: int, payload: Dict[str, Any]):
+    error = await storage.insert_order([payload["order"]], payload["items"], "return=minimal,resolution=ignore-duplicates")
+    if error and permanent_storage_error(error):
+        journal.dead_letter([seq], error)
+    elif error:
+        journal.mark_failed([seq], error)
+        raise RuntimeError(journal.last_error)
+    else:
+        journal.mark_replayed([seq])
+
+def replay_failed(journal: OrderJournal, seq: int, response: Any, kind: str):
+    """Dead-letter a permanently rejected entry; anything else is retried (raises)"""
+    error = f"{kind}: {response.status_code} {response.text[:200]}"
+    if permanent_failure(response.status_code):
+        journal.dead_letter([seq], error)
+        return
+    journal.mark_failed([seq], error)
+    raise RuntimeError(journal.last_error)
+
+async def run_journal_replayer(journal: OrderJournal):
+    """Background task: drain the journal to Supabase with exponential backoff on failure"""
+    backoff = 1.0
+    while True:
+        try:
+            replayed = await replay_journal_batch(journal)
+            backoff = 1.0
+            if replayed == 0:
+                journal.wakeup.clear()
+                try:
+                    await asyncio.wait_for(journal.wakeup.wait(), timeout=30)
+                except asyncio.TimeoutError:
+                    journal.prune()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Order journal replay failed, retrying in {backoff:.0f}s: {e}")
+            journal.last_error = str(e)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, ORDER_JOURNAL_MAX_BACKOFF)
+
+# ==================== PRICING ====================
+
+# reject: 422 on any mismatch; correct: charge the server-computed prices (the
+# client must print from the returned "pricing", or receipts show its own
+# figures); off: trust the client
+PRICING_MODE = os.environ.get('PRICING_MODE', 'reject').lower()
+# KWD has three decimals; anything below half a fils is rounding noise
+PRICE_TOLERANCE = 0.0005
+_IN_FILTER_CHUNK = 150
+
+async def load_menu_catalog() -> Dict[str, Dict[str, Any]]:
+    """Price lookup tables for the tenant's whole menu (cached, invalidated with the menu)"""
+    async def load():
+        response = await supabase_request(
+            "GET",
+            f"items?tenant_id=eq.{current_tenant_id()}&select=id,category_id,base_price,status,modifier_group_ids,name_en",
+            use_service_key=True
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"Catalog items query failed: {response.status_code} - {response.text}")
+        items = {row['id']: row for row in response.json()}
+        
+        variants: Dict[str, Dict[str, Any]] = {}
+        item_ids = list(items)
+        for start in range(0, len(item_ids), _IN_FILTER_CHUNK):
+            ids = ",".join(item_ids[start:start + _IN_FILTER_CHUNK])
+            response = await supabase_request(
+                "GET", f"item_variants?item_id=in.({ids})&select=id,item_id,price,status", use_service_key=True
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"Catalog variants query failed: {response.status_code} - {response.text}")
+            variants.update({row['id']: row for row in response.json()})
+        
+        modifiers: Dict[str, Dict[str, Any]] = {}
+        group_ids = sorted({g for item in items.values() for g in (item.get('modifier_group_ids') or [])})
+        for start in range(0, len(group_ids), _IN_FILTER_CHUNK):
+            ids = ",".join(group_ids[start:start + _IN_FILTER_CHUNK])
+            response = await supabase_request(
+                "GET", f"modifiers?modifier_group_id=in.({ids})&select=id,modifier_group_id,price,status", use_service_key=True
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"Catalog modifiers query failed: {response.status_code} - {response.text}")
+            modifiers.update({row['id']: row for row in response.json()})
+        
+        return {"items": items, "variants": variants, "modifiers": modifiers}
+    
+    return await tenant_cache.get_or_load("menu:catalog", load, MENU_CACHE_TTL)
+
+def price_order_lines(lines: List[Dict[str, Any]], catalog: Dict[str, Dict[str, Any]]) -> tuple:
+    """Compute unit and line totals from the catalog, mirroring the POS cart maths.
+
+    unit price = variant price (if set) else item base price; line total =
+    (unit + modifier prices) * quantity. Returns (priced lines, mismatches).
+    """
+    items, variants, modifiers = catalog["items"], catalog["variants"], catalog["modifiers"]
+    priced, mismatches = [], []
+    for idx, line in enumerate(lines):
+        quantity = line.get('quantity', 1)
+        item = items.get(line.get('item_id'))
+        if item is None or item.get('status') not in (None, 'active'):
+            mismatches.append({"line": idx, "item_id": line.get('item_id'), "error": "Unknown or inactive item"})
+            priced.append(None)
+            continue
+        if not isinstance(quantity, (int, float)) or quantity <= 0:
+            mismatches.append({"line": idx, "item_id": item['id'], "error": "Invalid quantity"})
+            priced.append(None)
+            continue
+        
+        unit = float(item.get('base_price') or 0)
+        variant_id = line.get('variant_id')
+        if variant_id:
+            variant = variants.get(variant_id)
+            if variant is None or variant.get('item_id') != item['id'] or \
+                    variant.get('status') not in (None, 'active'):
+                mismatches.append({"line": idx, "item_id": item['id'], "error": "Unknown or inactive variant"})
+                priced.append(None)
+                continue
+            unit = float(variant.get('price') or 0) or unit
+        
+        modifiers_total = 0.0
+        allowed_groups = set(item.get('modifier_group_ids') or [])
+        for selected in line.get('modifiers') or []:
+            modifier = modifiers.get(selected.get('id'))
+            if modifier is None or modifier.get('modifier_group_id') not in allowed_groups or \
+                    modifier.get('status') not in (None, 'active'):
+                mismatches.append({"line": idx, "item_id": item['id'],
+                                   "error": f"Unknown or inactive modifier {selected.get('id')}"})
+                break
+            modifiers_total += float(modifier.get('price') or 0)
+        else:
+            total = round((unit + modifiers_total) * quantity, 3)
+            unit = round(unit, 3)
+            if abs(float(line.get('unit_price', 0) or 0) - unit) > PRICE_TOLERANCE or \
+                    abs(float(line.get('total_price', 0) or 0) - total) > PRICE_TOLERANCE:
+                mismatches.append({
+                    "line": idx, "item_id": item['id'], "error": "Price mismatch",
+                    "submitted": {"unit_price": line.get('unit_price'), "total_price": line.get('total_price')},
+                    "expected": {"unit_price": unit, "total_price": total}
+                })
+            priced.append({"unit_price": unit, "total_price": total})
+            continue
+        priced.append(None)
+    return priced, mismatches
+
+async def price_order(request: OrderCreateRequest, delivery_fee: float,
+                      coupon: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Validate an order's lines and totals against the menu catalog (no extra round trips when cached).
+
+    Raises HTTPException(422) in reject mode or when the coupon does not
+    apply; in correct mode the returned breakdown carries the server prices to charge.
+    Tax and service charge are not charged (orders store them as 0), so a
+    non-zero one is refused rather than silently dropped. A total that is off
+    only because the zone's delivery fee replaced the submitted one is
+    corrected in every mode.
+    """
+    if PRICING_MODE != 'off' and (request.tax or request.service_charge):
+        raise HTTPException(status_code=422, detail="Tax and service charge are not charged; send them as 0")
+    fee_replaced = abs(request.delivery_fee - delivery_fee) > PRICE_TOLERANCE
+    breakdown = {
+        "subtotal": request.subtotal, "delivery_fee": delivery_fee, "discount": 0,
+        "total": round(request.total - request.delivery_fee + delivery_fee, 3), "lines": None,
+        "validated": False, "corrected": fee_replaced, "mismatches": []
+    }
+    catalog = None
+    if PRICING_MODE != 'off':
+        try:
+            catalog = await load_menu_catalog()
+        except Exception as e:
+            # Never block checkout because the menu is unreachable; the journal keeps trading going
+            logger.warning(f"Pricing skipped, catalog unavailable: {e}")
+    
+    if catalog is None:
+        if coupon:
+            discount, error = evaluate_coupon(coupon, request.items, None, request.subtotal)
+            if error:
+                raise HTTPException(status_code=422, detail={"message": error, "pricing": breakdown})
+            breakdown["discount"] = discount
+        return breakdown
+    
+    priced, mismatches = price_order_lines(request.items, catalog)
+    unknown = any(line is None for line in priced)
+    subtotal = round(sum(line['total_price'] if line else float(item.get('total_price', 0) or 0)
+                         for line, item in zip(priced, request.items)), 3)
+    discount = 0
+    if coupon:
+        discount, error = evaluate_coupon(coupon, request.items, priced, subtotal, catalog)
+        if error:
+            raise HTTPException(status_code=422, detail={"message": error, "pricing": breakdown})
+    total = round(subtotal + delivery_fee - discount, 3)
+    if abs(request.subtotal - subtotal) > PRICE_TOLERANCE:
+        mismatches.append({"error": "Subtotal mismatch", "submitted": request.subtotal, "expected": subtotal})
+    # The client's total is checked against its own delivery fee; the zone fee is charged either way
+    if abs(request.total - round(subtotal + request.delivery_fee - discount, 3)) > PRICE_TOLERANCE:
+        mismatches.append({"error": "Total mismatch", "submitted": request.total, "expected": total})
+    
+    breakdown.update(subtotal=subtotal, discount=discount, total=total, lines=priced,
+                     validated=not unknown, mismatches=mismatches)
+    if mismatches:
+        logger.warning(f"Order pricing mismatches ({PRICING_MODE}): {mismatches}")
+        if PRICING_MODE == 'reject' or unknown:
+            raise HTTPException(status_code=422, detail={
+                "message": "Order prices do not match the menu", "pricing": breakdown
+            })
+        breakdown["corrected"] = True
+    return breakdown
+
+# ==================== COUPONS ====================
+
+COUPON_REDEEM_RETRIES = int(os.environ.get('COUPON_REDEEM_RETRIES', '3'))
+
+def _parse_coupon_time(value: Optional[str], end_of_day: bool = False) -> Optional[datetime]:
+    """Coupon windows are stored either as dates (admin form) or ISO timestamps"""
+    if not value:
+        return None
+    try:
+        if len(value) == 10:
+            parsed = datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+            return parsed + timedelta(days=1) if end_of_day else parsed
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    except ValueError:
+        logger.warning(f"Ignoring unparseable coupon date: {value}")
+        return None
+
+async def load_coupon_index() -> Dict[str, Dict[str, Any]]:
+    """Active coupons for the tenant keyed by upper-cased code.
+
+    Windows and scopes are parsed once here so evaluating a code at the till
+    is a dict lookup plus a few comparisons.
+    """
+    async def load():
+        response = await supabase_request(
+            "GET", f"coupons?tenant_id=eq.{current_tenant_id()}&is_active=eq.true", use_service_key=True
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"Coupons query failed: {response.status_code} - {response.text}")
+        index = {}
+        for row in response.json():
+            if not row.get('code'):
+                continue
+            row['_valid_from'] = _parse_coupon_time(row.get('valid_from'))
+            row['_valid_until'] = _parse_coupon_time(row.get('valid_until'), end_of_day=True)
+            row['_item_ids'] = frozenset(row.get('item_ids') or [])
+            row['_category_ids'] = frozenset(row.get('category_ids') or [])
+            index[row['code'].strip().upper()] = row
+        return index
+    
+    return await tenant_cache.get_or_load("coupons:index", load, COUPON_CACHE_TTL)
+
+async def find_coupon(code: str) -> Optional[Dict[str, Any]]:
+    index = await load_coupon_index()
+    return index.get(code.strip().upper())
+
+def evaluate_coupon(coupon: Dict[str, Any], lines: List[Dict[str, Any]], priced: Optional[List[Any]],
+                    subtotal: float, catalog: Optional[Dict[str, Dict[str, Any]]] = None,
+                    now: Optional[datetime] = None) -> tuple:
+    """Work out the discount a coupon gives on a cart. Returns (discount, error).
+
+    Scoped coupons (item_ids / category_ids) only discount the matching
+    lines; server prices are used for those lines when available.
+    """
+    now = now or datetime.now(timezone.utc)
+    if coupon.get('_valid_from') and now < coupon['_valid_from']:
+        return 0, "Coupon is not active yet"
+    if coupon.get('_valid_until') and now >= coupon['_valid_until']:
+        return 0, "Coupon has expired"
+    max_uses = int(coupon.get('max_uses') or 0)
+    if max_uses and int(coupon.get('used_count') or 0) >= max_uses:
+        return 0, "Coupon usage limit reached"
+    min_order = float(coupon.get('min_order_amount') or 0)
+    if subtotal + PRICE_TOLERANCE < min_order:
+        return 0, f"Minimum order for this coupon is {min_order:.3f} KWD"
+    
+    eligible = subtotal
+    item_scope, category_scope = coupon.get('_item_ids'), coupon.get('_category_ids')
+    if item_scope or category_scope:
+        items = catalog["items"] if catalog else {}
+        eligible = 0.0
+        for idx, line in enumerate(lines):
+            item_id = line.get('item_id')
+            category_id = (items.get(item_id) or {}).get('category_id') or line.get('category_id')
+            if item_id in item_scope or category_id in category_scope:
+                priced_line = priced[idx] if priced else None
+                eligible += priced_line['total_price'] if priced_line else float(line.get('total_price', 0) or 0)
+        if eligible <= 0:
+            return 0, "Coupon does not apply to any item in this order"
+    
+    value = float(coupon.get('discount_value') or 0)
+    if coupon.get('discount_type') == 'percentage':
+        discount = eligible * min(value, 100) / 100
+    else:
+        discount = min(value, eligible)
+    return round(discount, 3), None
+
+async def redeem_coupon(coupon_id: str, order_id: str) -> Optional[Any]:
+    """Count one use of a coupon by an order. Returns the failed upstream response, if any.
+
+    riwa_redeem_coupon (migrations/011_coupon_redemptions.sql) records the
+    order and bumps used_count in one transaction, so replaying an order
+    counts it once. Without the function it falls back to a compare-and-swap
+    on used_count. The usage limit is enforced at checkout; by the time an
+    order is redeemed it has been sold, so the use is counted regardless.
+    """
+    response = await supabase_request(
+        "POST", "rpc/riwa_redeem_coupon", {"coupon": coupon_id, "order_ref": order_id}, use_service_key=True
+    )
+    if response.status_code != 404:
+        return None if response.status_code in [200, 204] else response
+    
+    for _ in range(COUPON_REDEEM_RETRIES):
+        response = await supabase_request("GET", f"coupons?id=eq.{coupon_id}&select=used_count", use_service_key=True)
+        if response.status_code != 200:
+            return response
+        rows = response.json()
+        if not rows:
+            return None  # coupon deleted since; nothing left to count
+        used = rows[0].get('used_count')
+        guard = f"used_count=eq.{used}" if used is not None else "used_count=is.null"
+        response = await supabase_request(
+            "PATCH",
+            f"coupons?id=eq.{coupon_id}&{guard}",
+            {"used_count": int(used or 0) + 1},
+            use_service_key=True,
+            prefer="return=representation"
+        )
+        if response.status_code not in [200, 204]:
+            return response
+        if response.json():
+            return None
+        # Lost the race to another till: re-read the counter and try again
+    return StorageResponse(503, {"message": "Coupon counter is busy"})
+
+@api_router.post("/coupons/validate")
+async def validate_coupon(request: CouponValidateRequest):
+    """Check a coupon against the current cart (evaluated from the in-memory index)"""
+    try:
+        coupon = await find_coupon(request.code)
+        if coupon is None:
+            return {"valid": False, "discount": 0, "error": "Invalid coupon code"}
+        
+        catalog, priced = None, None
+        subtotal = request.subtotal
+        try:
+            catalog = await load_menu_catalog()
+            priced, _ = price_order_lines(request.items, catalog)
+        except Exception as e:
+            logger.warning(f"Coupon validation without catalog: {e}")
+        if subtotal is None:
+            subtotal = round(sum(line['total_price'] if line else float(item.get('total_price', 0) or 0)
+                                 for line, item in zip(priced or [None] * len(request.items), request.items)), 3)
+        
+        discount, error = evaluate_coupon(coupon, request.items, priced, subtotal, catalog)
+        return {
+            "valid": error is None,
+            "discount": discount,
+            "error": error,
+            "coupon": {
+                "code": coupon['code'],
+                "discount_type": coupon.get('discount_type'),
+                "discount_value": coupon.get('discount_value'),
+                "min_order_amount": coupon.get('min_order_amount'),
+            }
+        }
+    except Exception as e:
+        logger.error(f"Validate coupon error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== DELIVERY ZONE RESOLVER ====================
+
+# Zones are bucketed on a lat/lng grid so a lookup only runs point-in-polygon
+# against the few zones overlapping the customer's cell.
+ZONE_GRID_DEGREES = float(os.environ.get('ZONE_GRID_DEGREES', '0.01'))  # ~1.1 km
+ZONE_GRID_MAX_CELLS = int(os.environ.get('ZONE_GRID_MAX_CELLS', '4096'))
+ZONE_CACHE_TTL = float(os.environ.get('ZONE_CACHE_TTL', '300'))
+# Zone edits only invalidate the cache of the worker that made them, so every
+# worker compares its index with the zones' ids and updated_at this often
+ZONE_VERSION_CHECK_SECONDS = float(os.environ.get('ZONE_VERSION_CHECK_SECONDS', '2'))
+
+_zone_checked_at: Dict[tuple, float] = {}  # (tenant_id, branch_id) -> monotonic time of the last check
+
+def _zone_polygons(polygon: Any) -> List[List[List[List[float]]]]:
+    """GeoJSON (string or object; Polygon, MultiPolygon or Feature) as a list of polygons of [lng, lat] rings"""
+    if not polygon:
+        return []
+    if isinstance(polygon, str):
+        polygon = json.loads(polygon)
+    if polygon.get('type') == 'Feature':
+        polygon = polygon.get('geometry') or {}
+    if polygon.get('type') == 'Polygon':
+        return [polygon['coordinates']]
+    if polygon.get('type') == 'MultiPolygon':
+        return polygon['coordinates']
+    raise ValueError(f"Unsupported geometry type {polygon.get('type')}")
+
+def _point_in_ring(lng: float, lat: float, ring: List[List[float]]) -> bool:
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        if (yi > lat) != (yj > lat) and lng < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+def _ring_area(ring: List[List[float]]) -> float:
+    return abs(sum(ring[i - 1][0] * ring[i][1] - ring[i][0] * ring[i - 1][1] for i in range(len(ring)))) / 2
+
+def _grid_cell(value: float) -> int:
+    return int(value // ZONE_GRID_DEGREES)
+
+def _area_tokens(text: str) -> str:
+    """Lower-cased words joined by single spaces, padded so matches land on word boundaries"""
+    return " " + " ".join(re.findall(r"\w+", text.lower())) + " "
+
+def build_zone_index(zones: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Grid index over active zones (plain dicts so it can live in the tenant cache)"""
+    entries, cells, wide, areas = [], {}, [], {}
+    for zone in zones:
+        if not zone.get('is_active', True):
+            continue
+        try:
+            polygons = _zone_polygons(zone.get('polygon'))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Skipping delivery zone {zone.get('id')} with bad polygon: {e}")
+            polygons = []
+        idx = len(entries)
+        points = [p for poly in polygons for p in poly[0]] if polygons else []
+        bbox = [min(p[0] for p in points), min(p[1] for p in points),
+                max(p[0] for p in points), max(p[1] for p in points)] if points else None
+        entries.append({
+            "id": zone.get('id'),
+            "zone_name": zone.get('zone_name'),
+            "zone_name_ar": zone.get('zone_name_ar'),
+            "delivery_fee": float(zone.get('delivery_fee') or 0),
+            "min_order_amount": float(zone.get('min_order_amount') or 0),
+            "eta_minutes": zone.get('eta_minutes'),
+            "polygons": polygons,
+            "bbox": bbox,
+            # Overlapping zones resolve to the smallest (most specific) one
+            "area": sum(_ring_area(poly[0]) for poly in polygons),
+        })
+        for name in zone.get('areas') or []:
+            key = _area_tokens(name or "")
+            if key.strip():
+                areas[key] = idx
+        if bbox is None:
+            continue
+        x0, y0, x1, y1 = _grid_cell(bbox[0]), _grid_cell(bbox[1]), _grid_cell(bbox[2]), _grid_cell(bbox[3])
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > ZONE_GRID_MAX_CELLS:
+            wide.append(idx)
+            continue
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                cells.setdefault(f"{x}:{y}", []).append(idx)
+    return {
+        "zones": entries, "cells": cells, "wide": wide, "areas": areas,
+        # Longest names first so "Salmiya Block 10" wins over "Salmiya"
+        "area_names": sorted(areas, key=len, reverse=True),
+    }
+
+def resolve_zone(index: Dict[str, Any], lat: Optional[float] = None, lng: Optional[float] = None,
+                 address: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Zone for a coordinate, or failing that for an address mentioning one of a zone's areas"""
+    zones = index["zones"]
+    if lat is not None and lng is not None:
+        candidates = index["cells"].get(f"{_grid_cell(lng)}:{_grid_cell(lat)}", []) + index["wide"]
+        best = None
+        for idx in candidates:
+            zone = zones[idx]
+            x0, y0, x1, y1 = zone["bbox"]
+            if not (x0 <= lng <= x1 and y0 <= lat <= y1):
+                continue
+            for rings in zone["polygons"]:
+                if _point_in_ring(lng, lat, rings[0]) and not any(_point_in_ring(lng, lat, hole) for hole in rings[1:]):
+                    if best is None or zone["area"] < best["area"]:
+                        best = zone
+                    break
+        if best is not None:
+            return best
+    if address:
+        # Whole words only, so "Block 1" does not match "Block 10"
+        text = _area_tokens(address)
+        for name in index["area_names"]:
+            if name in text:
+                return zones[index["areas"][name]]
+    return None
+
+def _zone_version(zones: List[Dict[str, Any]]) -> str:
+    """Fingerprint of the tenant's zones; changes on any insert, update or delete"""
+    stamps = sorted((str(z.get('id')), str(z.get('updated_at'))) for z in zones)
+    return hashlib.sha1(json.dumps(stamps).encode()).hexdigest()
+
+async def load_zone_index() -> Dict[str, Any]:
+    """Zone index for the current branch (zones without a branch apply everywhere).
+
+    At most every ZONE_VERSION_CHECK_SECONDS the cached index is checked
+    against the zones' ids and updated_at (one small query) and rebuilt if
+    another worker edited them.
+    """
+    scope = (current_tenant_id(), current_branch_id())
+
+    async def load():
+        response = await supabase_request(
+            "GET", f"delivery_zones?tenant_id=eq.{current_tenant_id()}&order=zone_name.asc", use_service_key=True
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"Delivery zones query failed: {response.status_code} - {response.text}")
+        _zone_checked_at[scope] = time.monotonic()
+        zones = response.json()
+        index = build_zone_index([z for z in zones if z.get('branch_id') in (None, scope[1])])
+        index["version"] = _zone_version(zones)
+        return index
+    
+    index = await tenant_cache.get_or_load("zones:index", load, ZONE_CACHE_TTL)
+    if time.monotonic() - _zone_checked_at.get(scope, 0) < ZONE_VERSION_CHECK_SECONDS:
+        return index
+    _zone_checked_at[scope] = time.monotonic()
+    response = await supabase_request(
+        "GET", f"delivery_zones?tenant_id=eq.{scope[0]}&select=id,updated_at", use_service_key=True
+    )
+    if response.status_code != 200:
+        logger.warning(f"Delivery zones version check failed, using cached index: {response.status_code}")
+        return index
+    if _zone_version(response.json()) != index.get("version"):
+        invalidate_cache("zones:")
+        index = await tenant_cache.get_or_load("zones:index", load, ZONE_CACHE_TTL)
+    return index
+
+def zone_summary(zone: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: zone[k] for k in ("id", "zone_name", "zone_name_ar", "delivery_fee", "min_order_amount", "eta_minutes")}
+
+async def delivery_fee_for(request: OrderCreateRequest) -> tuple:
+    """(delivery fee, zone) for a delivery order; the zone's fee replaces the client's.
+
+    Coordinates outside every zone are rejected. An address that matches no
+    area, or a zone table that cannot be loaded, keeps the submitted fee.
+    """
+    try:
+        index = await load_zone_index()
+    except Exception as e:
+        logger.warning(f"Delivery zones unavailable, keeping submitted fee: {e}")
+        return request.delivery_fee, None
+    zone = resolve_zone(index, request.customer_lat, request.customer_lng, request.customer_address)
+    if zone is not None:
+        return zone["delivery_fee"], zone
+    if request.customer_lat is not None and request.customer_lng is not None and index["zones"]:
+        raise HTTPException(status_code=422, detail="Address is outside the delivery zones")
+    return request.delivery_fee, None
+
+@api_router.post("/delivery-zones/resolve")
+async def resolve_delivery_zone(request: DeliveryResolveRequest):
+    """Resolve coordinates or an address to a delivery zone, fee and minimum order"""
+    try:
+        index = await load_zone_index()
+        zone = resolve_zone(index, request.lat, request.lng, request.address)
+        if zone is None:
+            return {"deliverable": False, "zone": None}
+        result = {"deliverable": True, "zone": zone_summary(zone)}
+        if request.subtotal is not None:
+            result["meets_minimum"] = request.subtotal + PRICE_TOLERANCE >= zone["min_order_amount"]
+        return result
+    except Exception as e:
+        logger.error(f"Resolve delivery zone error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== ORDER EVENTS ====================
+
+# In-process fan-out of order lifecycle events. Handlers run inline on the
+# request path, so they may only queue work, never await upstream calls.
+_event_handlers: Dict[str, List[Any]] = {}
+
+def subscribe(event: str, handler):
+    _event_handlers.setdefault(event, []).append(handler)
+
+def publish_event(event: str, payload: Dict[str, Any]):
+    for handler in _event_handlers.get(event, []):
+        try:
+            handler(payload)
+        except Exception as e:
+            logger.error(f"Handler {getattr(handler, '__name__', handler)} for {event} failed: {e}")
+
+# ==================== LOYALTY ENGINE ====================
+
+# Completed orders are queued per tenant and branch and accrued in batches off
+# the checkout path. Only rejections count towards LOYALTY_MAX_ATTEMPTS (an
+# order that never shows up, or a batch Supabase refuses); outages and open
+# circuits back off up to LOYALTY_MAX_BACKOFF and keep the queue. The queue is
+# saved to LOYALTY_QUEUE_PATH on shutdown and picked up again on startup.
+LOYALTY_BATCH_SIZE = int(os.environ.get('LOYALTY_BATCH_SIZE', '100'))
+LOYALTY_FLUSH_MS = int(os.environ.get('LOYALTY_FLUSH_MS', '1000'))
+LOYALTY_MAX_ATTEMPTS = int(os.environ.get('LOYALTY_MAX_ATTEMPTS', '20'))
+LOYALTY_MAX_BACKOFF = float(os.environ.get('LOYALTY_MAX_BACKOFF', '60'))
+LOYALTY_QUEUE_PATH = os.environ.get('LOYALTY_QUEUE_PATH', str(ROOT_DIR / 'data' / 'loyalty_pending.jsonl'))
+LOYALTY_BALANCE_TTL = float(os.environ.get('LOYALTY_BALANCE_TTL', '30'))
+
+metrics.describe("riwa_loyalty_pending_orders", "gauge", "Completed orders waiting for loyalty accrual")
+metrics.describe("riwa_loyalty_points_accrued_total", "counter", "Loyalty points credited to customers")
+metrics.describe("riwa_loyalty_failures_total", "counter", "Failed loyalty accrual batches")
+
+_loyalty_pending: Dict[tuple, Dict[str, int]] = {}  # (tenant_id, branch_id) -> {order_id: rejections}
+_loyalty_wakeup = asyncio.Event()
+
+class LoyaltyRejected(RuntimeError):
+    """Supabase refused an accrual batch's data; sending it again as-is will not help"""
+
+def loyalty_failure(what: str, response: Any) -> RuntimeError:
+    error = f"{what} failed: {response.status_code} - {response.text[:200]}"
+    return LoyaltyRejected(error) if response.status_code in DATA_REJECTIONS else RuntimeError(error)
+
+def normalize_phone(phone: Optional[str]) -> Optional[str]:
+    if not phone:
+        return None
+    phone = "".join(ch for ch in phone if ch.isdigit() or ch == '+')
+    return phone or None
+
+async def load_loyalty_program() -> Dict[str, Any]:
+    """Loyalty settings plus active rules for the tenant (cached, invalidated by the admin endpoints)"""
+    async def load():
+        settings = await supabase_request(
+            "GET", f"loyalty_settings?tenant_id=eq.{current_tenant_id()}", use_service_key=True
+        )
+        rules = await supabase_request(
+            "GET", f"loyalty_rules?tenant_id=eq.{current_tenant_id()}&order=created_at.asc", use_service_key=True
+        )
+        if settings.status_code != 200 or rules.status_code != 200:
+            raise RuntimeError(f"Loyalty program query failed: {settings.status_code}/{rules.status_code}")
+        rows = settings.json()
+        return {
+            "settings": rows[0] if rows else {},
+            "rules": [r for r in rules.json() if r.get('is_active', True) and r.get('reward_type') == 'points'],
+        }
+    
+    return await tenant_cache.get_or_load("loyalty:program", load, SETTINGS_CACHE_TTL)
+
+def evaluate_loyalty(program: Dict[str, Any], amount: float, balance: Dict[str, Any]) -> int:
+    """Points earned by one order, given the customer's running totals before it.
+
+    Base accrual is points_per_kwd per KWD spent; order_count rules fire on
+    every Nth order and spend_amount rules each time lifetime spend crosses
+    another multiple of trigger_value. Other triggers and non-point rewards
+    are not accrued here.
+    """
+    settings = program["settings"]
+    points = int(amount * float(settings.get('points_per_kwd') or 0))
+    orders_before = int(balance.get('orders_count') or 0)
+    spend_before = float(balance.get('lifetime_spend') or 0)
+    for rule in program["rules"]:
+        try:
+            trigger = float(rule.get('trigger_value') or 0)
+            reward = int(float(rule.get('reward_value') or 0))
+        except (TypeError, ValueError):
+            logger.warning(f"Skipping loyalty rule {rule.get('id')} with a non-numeric trigger or reward")
+            continue
+        if trigger <= 0:
+            continue
+        if rule.get('trigger_type') == 'order_count':
+            # Rules saved before validation may hold fractions below one order
+            if int(trigger) >= 1 and (orders_before + 1) % int(trigger) == 0:
+                points += reward
+        elif rule.get('trigger_type') == 'spend_amount':
+            points += reward * (int((spend_before + amount) // trigger) - int(spend_before // trigger))
+    return points
+
+def validate_loyalty_rule(rule: Dict[str, Any]) -> Optional[str]:
+    """Why a loyalty rule cannot be saved, or None"""
+    try:
+        trigger = float(rule.get('trigger_value') or 0)
+        float(rule.get('reward_value') or 0)
+    except (TypeError, ValueError):
+        return "trigger_value and reward_value must be numbers"
+    if rule.get('trigger_type') == 'order_count' and (trigger < 1 or trigger != int(trigger)):
+        return "trigger_value of an order_count rule must be a whole number of orders (1 or more)"
+    if rule.get('trigger_type') == 'spend_amount' and trigger <= 0:
+        return "trigger_value of a spend_amount rule must be positive"
+    return None
+
+def queue_loyalty_accrual(event: Dict[str, Any]):
+    if event.get('status') != 'completed':
+        return
+    _queue_loyalty(event['tenant_id'], event.get('branch_id'), event['order_id'], 0)
+
+def _queue_loyalty(tenant_id: str, branch_id: Optional[str], order_id: str, rejections: int):
+    pending = _loyalty_pending.setdefault((tenant_id, branch_id), {})
+    if order_id in pending:
+        return
+    pending[order_id] = rejections
+    metrics.add_gauge("riwa_loyalty_pending_orders", 1)
+    if len(pending) >= LOYALTY_BATCH_SIZE:
+        _loyalty_wakeup.set()
+
+subscribe("order.status", queue_loyalty_accrual)
+
+async def _fetch_accrual_orders(order_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    orders = {}
+    remote = []
+    for order_id in order_ids:
+        # Orders still in the local journal have not reached Supabase yet
+        if order_journal and order_journal.has_pending(order_id):
+            orders[order_id] = order_journal.get_order(order_id)
+        else:
+            remote.append(order_id)
+    for start in range(0, len(remote), _IN_FILTER_CHUNK):
+        ids = ",".join(remote[start:start + _IN_FILTER_CHUNK])
+        response = await supabase_request(
+            "GET",
+            f"orders?id=in.({ids})&tenant_id=eq.{current_tenant_id()}&select=id,customer_phone,total_amount,status",
+            use_service_key=True
+        )
+        if response.status_code != 200:
+            raise loyalty_failure("Loyalty orders query", response)
+        orders.update({row['id']: row for row in response.json()})
+    return orders
+
+async def _fetch_loyalty_balances(phones: List[str]) -> Dict[str, Dict[str, Any]]:
+    balances = {}
+    for start in range(0, len(phones), _IN_FILTER_CHUNK):
+        values = quote(",".join(f'"{p}"' for p in phones[start:start + _IN_FILTER_CHUNK]))
+        response = await supabase_request(
+            "GET",
+            f"loyalty_balances?tenant_id=eq.{current_tenant_id()}&customer_phone=in.({values})",
+            use_service_key=True
+        )
+        if response.status_code != 200:
+            raise loyalty_failure("Loyalty balances query", response)
+        balances.update({row['customer_phone']: row for row in response.json()})
+    return balances
+
+async def _persist_accruals(entries: List[Dict[str, Any]], balances: Dict[str, Dict[str, Any]]) -> set:
+    """Record transactions and bump balances; returns the order ids actually credited.
+
+    Uses the riwa_loyalty_accrue RPC (migrations/004_loyalty_engine.sql), which
+    does both atomically and skips orders already credited. Without it, the
+    transactions are inserted with ignore-duplicates and the balances upserted
+    from the values read at the start of the batch.
+    """
+    response = await supabase_request("POST", "rpc/riwa_loyalty_accrue", {
+        "tenant": current_tenant_id(), "entries": entries
+    }, use_service_key=True)
+    if response.status_code == 200:
+        return {r if isinstance(r, str) else r.get('riwa_loyalty_accrue') for r in response.json()}
+    if response.status_code != 404:
+        raise loyalty_failure("Loyalty accrual", response)
+    
+    now = datetime.now(timezone.utc).isoformat()
+    response = await supabase_request("POST", "loyalty_transactions?on_conflict=order_id", [
+        dict(entry, id=str(uuid.uuid4()), tenant_id=current_tenant_id(), created_at=now) for entry in entries
+    ], use_service_key=True, prefer="return=representation,resolution=ignore-duplicates")
+    if response.status_code not in [200, 201]:
+        raise loyalty_failure("Loyalty transactions insert", response)
+    credited = {row['order_id'] for row in response.json()}
+    
+    updated: Dict[str, Dict[str, Any]] = {}
+    for entry in entries:
+        if entry['order_id'] not in credited:
+            continue
+        phone = entry['customer_phone']
+        current = balances.get(phone, {})
+        row = updated.setdefault(phone, {
+            "tenant_id": current_tenant_id(), "customer_phone": phone,
+            "points": int(current.get('points') or 0),
+            "orders_count": int(current.get('orders_count') or 0),
+            "lifetime_spend": float(current.get('lifetime_spend') or 0),
+            "updated_at": now,
+        })
+        row["points"] += entry['points']
+        row["orders_count"] += 1
+        row["lifetime_spend"] = round(row["lifetime_spend"] + entry['amount'], 3)
+    if updated:
+        response = await supabase_request(
+            "POST", "loyalty_balances?on_conflict=tenant_id,customer_phone", list(updated.values()),
+            use_service_key=True, prefer="return=minimal,resolution=merge-duplicates"
+        )
+        if response.status_code not in [200, 201, 204]:
+            raise loyalty_failure("Loyalty balances upsert", response)
+    return credited
+
+async def accrue_loyalty_batch(order_ids: List[str]) -> List[str]:
+    """Credit points for completed orders of the current tenant.
+
+    Returns the ids to retry later (orders not visible yet).
+    """
+    program = await load_loyalty_program()
+    if not program["settings"].get('is_enabled'):
+        return []
+    
+    orders = await _fetch_accrual_orders(order_ids)
+    retry = [order_id for order_id in order_ids if order_id not in orders]
+    candidates = []
+    for order_id, order in orders.items():
+        phone = normalize_phone(order.get('customer_phone'))
+        if phone and order.get('status') == 'completed':
+            candidates.append((order_id, phone, round(float(order.get('total_amount') or 0), 3)))
+    if not candidates:
+        return retry
+    
+    balances = await _fetch_loyalty_balances(sorted({phone for _, phone, _ in candidates}))
+    running = {phone: dict(balance) for phone, balance in balances.items()}
+    entries = []
+    for order_id, phone, amount in candidates:
+        balance = running.setdefault(phone, {})
+        points = evaluate_loyalty(program, amount, balance)
+        balance['orders_count'] = int(balance.get('orders_count') or 0) + 1
+        balance['lifetime_spend'] = float(balance.get('lifetime_spend') or 0) + amount
+        entries.append({"order_id": order_id, "customer_phone": phone, "points": points, "amount": amount})
+    
+    credited = await _persist_accruals(entries, balances)
+    metrics.inc("riwa_loyalty_points_accrued_total", sum(e['points'] for e in entries if e['order_id'] in credited))
+    invalidate_cache("loyalty:balance:")
+    return retry
+
+async def flush_loyalty() -> bool:
+    """Accrue one batch per tenant and branch; False if any failed transiently (nothing counted)"""
+    ok = True
+    for scope in list(_loyalty_pending):
+        pending = _loyalty_pending[scope]
+        batch = list(pending)[:LOYALTY_BATCH_SIZE]
+        if not batch:
+            continue
+        token = _tenant_scope.set(scope)
+        try:
+            retry = set(await accrue_loyalty_batch(batch))
+        except LoyaltyRejected as e:
+            metrics.inc("riwa_loyalty_failures_total")
+            logger.warning(f"Loyalty accrual rejected for tenant {scope[0]}: {e}")
+            retry = set(batch)
+        except Exception as e:
+            metrics.inc("riwa_loyalty_failures_total")
+            logger.warning(f"Loyalty accrual failed for tenant {scope[0]}, will retry: {e}")
+            ok = False
+            continue
+        finally:
+            _tenant_scope.reset(token)
+        for order_id in batch:
+            if order_id in retry and pending[order_id] + 1 < LOYALTY_MAX_ATTEMPTS:
+                pending[order_id] += 1
+                continue
+            if order_id in retry:
+                logger.error(f"Giving up loyalty accrual for order {order_id}")
+            del pending[order_id]
+            metrics.add_gauge("riwa_loyalty_pending_orders", -1)
+        if len(pending) >= LOYALTY_BATCH_SIZE:
+            _loyalty_wakeup.set()
+    return ok
+
+def save_loyalty_queue() -> int:
+    """Append the queued orders to LOYALTY_QUEUE_PATH (shutdown); returns how many"""
+    entries = [(tenant_id, branch_id, order_id, rejections)
+               for (tenant_id, branch_id), pending in _loyalty_pending.items()
+               for order_id, rejections in pending.items()]
+    if entries:
+        Path(LOYALTY_QUEUE_PATH).parent.mkdir(parents=True, exist_ok=True)
+        with open(LOYALTY_QUEUE_PATH, "a") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in entries)
+    return len(entries)
+
+def load_loyalty_queue() -> int:
+    """Queue the orders a previous process saved (startup); the first worker to start claims them"""
+    path = Path(LOYALTY_QUEUE_PATH)
+    claimed = path.with_suffix(".claimed")
+    try:
+        path.replace(claimed)
+    except FileNotFoundError:
+        return 0
+    count = 0
+    with open(claimed) as f:
+        for line in f:
+            if line.strip():
+                _queue_loyalty(*json.loads(line))
+                count += 1
+    claimed.unlink()
+    return count
+
+async def run_loyalty_accrual():
+    """Background task: accrue queued orders every LOYALTY_FLUSH_MS, or early when a batch fills"""
+    backoff = LOYALTY_FLUSH_MS / 1000
+    while True:
+        try:
+            await asyncio.wait_for(_loyalty_wakeup.wait(), timeout=backoff)
+        except asyncio.TimeoutError:
+            pass
+        _loyalty_wakeup.clear()
+        if await flush_loyalty():
+            backoff = LOYALTY_FLUSH_MS / 1000
+        else:
+            backoff = min(backoff * 2, LOYALTY_MAX_BACKOFF)
+
+@api_router.get("/loyalty/balance/{phone}")
+async def get_loyalty_balance(phone: str):
+    """Points balance for a customer phone number (cached)"""
+    try:
+        customer_phone = normalize_phone(phone)
+        if not customer_phone:
+            raise HTTPException(status_code=400, detail="Invalid phone number")
+        
+        async def load():
+            balances = await _fetch_loyalty_balances([customer_phone])
+            return balances.get(customer_phone, {})
+        
+        balance = await tenant_cache.get_or_load(f"loyalty:balance:{customer_phone}", load, LOYALTY_BALANCE_TTL)
+        settings = (await load_loyalty_program())["settings"]
+        points = int(balance.get('points') or 0)
+        rate = float(settings.get('points_redemption_rate') or 0)
+        min_redeem = int(settings.get('min_points_redeem') or 0)
+        return {
+            "customer_phone": customer_phone,
+            "points": points,
+            "orders_count": int(balance.get('orders_count') or 0),
+            "lifetime_spend": float(balance.get('lifetime_spend') or 0),
+            "redeemable_value": round(points / rate, 3) if rate and points >= min_redeem else 0,
+            "enabled": bool(settings.get('is_enabled')),
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get loyalty balance error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== CUSTOMER DIRECTORY ====================
+
+# Repeat-customer lookup for the POS, built from past orders and kept current
+# from order.created events so keystroke searches never reach Supabase.
+CUSTOMER_INDEX_MAX_ORDERS = int(os.environ.get('CUSTOMER_INDEX_MAX_ORDERS', '50000'))
+CUSTOMER_INDEX_REFRESH = float(os.environ.get('CUSTOMER_INDEX_REFRESH', '3600'))
+CUSTOMER_SEARCH_SCAN = 500  # index entries examined per query at most
+CUSTOMER_INDEX_PAGE_SIZE = 1000
+
+metrics.describe("riwa_customer_index_size", "gauge", "Customers in the in-memory directory, by tenant")
+
+class CustomerDirectory:
+    """Prefix index over customers: a sorted list of (key, phone) searched with bisect.
+
+    Keys are the phone digits, the local 8-digit number, the full lower-cased
+    name and each name token, so "5555", "9655555", "ahmed" and
+    "mohammed ah" all find "Mohammed Ahmed / +965 5555 1234".
+    """
+
+    def __init__(self):
+        self.customers: Dict[str, Dict[str, Any]] = {}
+        self.keys: List[tuple] = []
+        self.built_at = 0.0
+        self.building: Optional[asyncio.Task] = None
+        self.ready = asyncio.Event()  # set once the first page is searchable
+        self.loading: Optional[set] = None  # order ids counted by the load in progress
+        self.missed: List[Dict[str, Any]] = []  # orders published during a refresh
+
+    @staticmethod
+    def _keys_for(phone: str, name: Optional[str]) -> set:
+        digits = phone.lstrip('+')
+        keys = {digits, digits[-8:]}
+        if name:
+            lowered = " ".join(name.lower().split())
+            keys.add(lowered)
+            keys.update(lowered.split(" "))
+        return keys
+
+    def upsert(self, phone: Optional[str], name: Optional[str], address: Optional[str], at: Optional[str]):
+        phone = normalize_phone(phone)
+        if not phone:
+            return
+        at = at or ""
+        customer = self.customers.get(phone)
+        if customer is None:
+            customer = self.customers[phone] = {
+                "customer_phone": phone, "customer_name": None, "customer_address": None,
+                "last_order_at": "", "orders_count": 0
+            }
+            old_keys = set()
+        else:
+            old_keys = self._keys_for(phone, customer["customer_name"])
+        customer["orders_count"] += 1
+        if at < customer["last_order_at"]:
+            # Older order seen while building: only fill gaps
+            customer["customer_name"] = customer["customer_name"] or name
+            customer["customer_address"] = customer["customer_address"] or address
+        else:
+            customer["customer_name"] = name or customer["customer_name"]
+            customer["customer_address"] = address or customer["customer_address"]
+            customer["last_order_at"] = at
+        
+        new_keys = self._keys_for(phone, customer["customer_name"])
+        for key in old_keys - new_keys:
+            idx = bisect.bisect_left(self.keys, (key, phone))
+            if idx < len(self.keys) and self.keys[idx] == (key, phone):
+                self.keys.pop(idx)
+        for key in new_keys - old_keys:
+            bisect.insort(self.keys, (key, phone))
+
+    def search(self, query: str, limit: int) -> List[Dict[str, Any]]:
+        query = " ".join(query.lower().split())
+        if query.lstrip('+').replace(' ', '').isdigit():
+            query = query.lstrip('+').replace(' ', '')
+        idx = bisect.bisect_left(self.keys, (query,))
+        phones = []
+        seen = set()
+        for key, phone in self.keys[idx:idx + CUSTOMER_SEARCH_SCAN]:
+            if not key.startswith(query):
+                break
+            if phone not in seen:
+                seen.add(phone)
+                phones.append(phone)
+        matches = [self.customers[phone] for phone in phones]
+        matches.sort(key=lambda c: c["last_order_at"], reverse=True)
+        return matches[:limit]
+
+    def add_order(self, order: Dict[str, Any]):
+        """Count a newly created order (once, even if the load in progress also reads it)"""
+        if self.loading is not None:
+            if order.get('id') in self.loading:
+                return
+            self.loading.add(order.get('id'))
+            self.missed.append(order)
+        self.upsert(order.get('customer_phone'), order.get('customer_name'),
+                    order.get('delivery_address'), order.get('created_at'))
+
+    async def build(self):
+        """Load customers from recent orders, newest first.
+
+        The first load fills this directory page by page so searches can be
+        served after one page; refreshes load into a fresh directory and swap
+        it in, replaying the orders published meanwhile. Each order id is
+        counted once, whether it comes from a page or an event.
+        """
+        target = CustomerDirectory() if self.customers else self
+        self.loading, self.missed = set(), []
+        try:
+            offset = 0
+            while offset < CUSTOMER_INDEX_MAX_ORDERS:
+                response = await supabase_request(
                     "GET",
-                    f"modifier_groups?id=eq.{mg_id}&status=eq.active",
+                    f"orders?tenant_id=eq.{current_tenant_id()}&customer_phone=not.is.null"
+                    f"&select=id,customer_phone,customer_name,delivery_address,created_at"
+                    f"&order=created_at.desc&limit={CUSTOMER_INDEX_PAGE_SIZE}&offset={offset}",
                     use_service_key=True
                 )
-                if mg_response.status_code == 200 and mg_response.json():
-                    group = mg_response.json()[0]
-                    group['name'] = group.get('name_en', group.get('name', ''))
-                    
-                    # Get modifiers
-                    mods_response = await supabase_request(
-                        "GET",
-                        f"modifiers?modifier_group_id=eq.{mg_id}&status=eq.active&order=sort_order.asc",
-                        use_service_key=True
-                    )
-                    group['modifiers'] = mods_response.json() if mods_response.status_code == 200 else []
-                    modifier_groups.append(group)
+                if response.status_code != 200:
+                    raise RuntimeError(f"Customer orders query failed: {response.status_code} - {response.text}")
+                rows = response.json()
+                for row in rows:
+                    # Orders created meanwhile shift the pages, so a row can come back
+                    if row.get('id') in self.loading:
+                        continue
+                    self.loading.add(row.get('id'))
+                    target.upsert(row.get('customer_phone'), row.get('customer_name'),
+                                  row.get('delivery_address'), row.get('created_at'))
+                self.ready.set()
+                if len(rows) < CUSTOMER_INDEX_PAGE_SIZE:
+                    break
+                offset += CUSTOMER_INDEX_PAGE_SIZE
             
-            item['modifier_groups'] = modifier_groups
-        else:
-            item['modifier_groups'] = []
-        
-        return item
-    except HTTPException:
-        raise
+            if target is not self:
+                for order in self.missed:
+                    target.upsert(order.get('customer_phone'), order.get('customer_name'),
+                                  order.get('delivery_address'), order.get('created_at'))
+                self.customers, self.keys = target.customers, target.keys
+        finally:
+            self.loading, self.missed = None, []
+        self.ready.set()
+        self.built_at = time.monotonic()
+        metrics.set_gauge("riwa_customer_index_size", len(self.customers), tenant=current_tenant_id())
+
+_customer_directories: Dict[str, CustomerDirectory] = {}
+
+async def get_customer_directory() -> CustomerDirectory:
+    """The tenant's directory; the first call waits for one page of the build, the rest loads in the background"""
+    tenant_id = current_tenant_id()
+    directory = _customer_directories.get(tenant_id)
+    if directory is None:
+        directory = _customer_directories[tenant_id] = CustomerDirectory()
+    if directory.building is None or directory.building.done():
+        if not directory.built_at or time.monotonic() - directory.built_at > CUSTOMER_INDEX_REFRESH:
+            directory.building = asyncio.create_task(directory.build())
+    if not directory.ready.is_set():
+        ready = asyncio.ensure_future(directory.ready.wait())
+        try:
+            await asyncio.wait({directory.building, ready}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            ready.cancel()
+        if not directory.ready.is_set():
+            # The build ended before its first page: surface its error
+            building, directory.building = directory.building, None
+            building.result()
+    return directory
+
+def index_order_customer(event: Dict[str, Any]):
+    directory = _customer_directories.get(event['tenant_id'])
+    if directory is None:
+        # Not built yet; the build will read this order from Supabase or the journal replay
+        return
+    directory.add_order(event['order'])
+
+subscribe("order.created", index_order_customer)
+
+@api_router.get("/customers/search")
+async def search_customers(q: str = "", limit: int = 10):
+    """Prefix search over repeat customers by phone or name (served from memory)"""
+    try:
+        if len(q.strip()) < 2:
+            return {"customers": []}
+        directory = await get_customer_directory()
+        return {"customers": directory.search(q, max(1, min(limit, 50)))}
     except Exception as e:
-        logger.error(f"Get item details error: {e}")
+        logger.error(f"Customer search error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # ==================== ORDER ENDPOINTS ====================
 
+# Allowed status changes. Skipping forward is fine (a KDS bump can take a
+# pending order straight to ready, a counter sale can complete at once);
+# the only step back is ready -> preparing when the kitchen recalls an item.
+ORDER_TRANSITIONS = {
+    "pending": ("accepted", "preparing", "ready", "completed", "cancelled"),
+    "accepted": ("preparing", "ready", "completed", "cancelled"),
+    "preparing": ("ready", "completed", "cancelled"),
+    "ready": ("preparing", "out_for_delivery", "completed", "cancelled"),
+    "out_for_delivery": ("completed", "cancelled"),
+    "completed": (),
+    "cancelled": (),
+}
+
+def order_status_sources(to_status: str) -> List[str]:
+    """Statuses an order may move to to_status from"""
+    return [status for status, targets in ORDER_TRANSITIONS.items() if to_status in targets]
+
+def order_status_conflict(order_id: str, current: Dict[str, Any], requested: str) -> HTTPException:
+    """409 carrying the order's current state, so the client can reconcile without re-fetching"""
+    allowed = ORDER_TRANSITIONS.get(current.get('status'), ())
+    # Already in the requested status: another screen got there first
+    reason = (f"cannot move from {current.get('status')} to {requested}"
+              if requested not in allowed and requested != current.get('status')
+              else "order changed since the expected version")
+    return HTTPException(status_code=409, detail={
+        "message": f"Order status conflict: {reason}",
+        "order_id": order_id,
+        "status": current.get('status'),
+        "updated_at": current.get('updated_at'),
+        "allowed": list(allowed),
+    })
+
 @api_router.post("/orders/create")
 async def create_order(request: OrderCreateRequest, authorization: str = Header(None)):
     """Create a new order and push to KDS"""
     try:
         # Get user from token
         user_id = None
-        user_branch_id = BRANCH_ID
+        user_branch_id = current_branch_id()
         if authorization:
             try:
                 token = authorization.replace("Bearer ", "")
                 payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
                 user_id = payload.get('user_id')
-                user_branch_id = payload.get('branch_id', BRANCH_ID)
+                user_branch_id = payload.get('branch_id', current_branch_id())
             except:
                 pass
         
-        order_number = generate_order_number()
+        coupon = None
+        if request.coupon_code:
+            coupon = await find_coupon(request.coupon_code)
+            if coupon is None:
+                raise HTTPException(status_code=422, detail="Invalid coupon code")
+            if order_journal:
+                # Uses sold here but not replayed yet count towards the limit
+                coupon = dict(coupon, used_count=int(coupon.get('used_count') or 0)
+                              + order_journal.pending_coupon_uses(coupon['id']))
+        
+        delivery_fee, zone = request.delivery_fee, None
+        if request.order_type.lower() == 'delivery':
+            delivery_fee, zone = await delivery_fee_for(request)
+        
+        # Check lines and totals against the menu before a bill number is used up
+        pricing = await price_order(request, delivery_fee, coupon)
+        if zone and pricing["subtotal"] + PRICE_TOLERANCE < zone["min_order_amount"]:
+            raise HTTPException(status_code=422, detail=f"Minimum order for {zone['zone_name']} is {zone['min_order_amount']:.3f} KWD")
+        if coupon:
+            pricing["coupon_code"] = coupon['code']
+        if zone:
+            pricing["delivery_zone"] = zone_summary(zone)
+        
+        order_number = generate_order_number(user_branch_id)
         order_id = str(uuid.uuid4())
         now = datetime.now(timezone.utc).isoformat()
         
@@ -469,19 +3485,20 @@ async def create_order(request: OrderCreateRequest, authorization: str = Header(
         # Note: bill_number and order_source columns need to be added via SQL
         order_data = {
             "id": order_id,
-            "tenant_id": TENANT_ID,
+            "tenant_id": current_tenant_id(),
             "branch_id": user_branch_id,
             "order_number": order_number,
             "order_type": request.order_type.lower(),
             "channel": request.order_source or 'pos',  # Use channel for order source
             "status": "pending",
+            "payment_method": request.payment_method,
             "payment_status": "paid" if request.payment_method else "pending",
-            "subtotal": request.subtotal,
+            "subtotal": pricing["subtotal"],
             "tax_amount": 0,  # No tax in Kuwait
             "service_charge": 0,  # No service charge
-            "delivery_fee": request.delivery_fee,
-            "discount_amount": 0,
-            "total_amount": request.total,
+            "delivery_fee": pricing["delivery_fee"],
+            "discount_amount": pricing["discount"],
+            "total_amount": pricing["total"],
             "customer_name": request.customer_name,
             "customer_phone": request.customer_phone,
             "delivery_address": request.customer_address,
@@ -491,18 +3508,14 @@ async def create_order(request: OrderCreateRequest, authorization: str = Header(
             "updated_at": now
         }
         
-        order_response = await supabase_request("POST", "orders", order_data, use_service_key=True)
-        
-        if order_response.status_code not in [200, 201]:
-            logger.error(f"Order creation failed: {order_response.status_code} - {order_response.text}")
-            raise HTTPException(status_code=500, detail="Failed to create order")
-        
-        # Create order items (the order_items table is used for KDS via real-time)
+        # Build order items (the order_items table is used for KDS via real-time)
+        order_items = []
         for idx, item in enumerate(request.items):
             order_item_id = str(uuid.uuid4())
+            priced = pricing["lines"][idx] if pricing["lines"] else None
             
             # Create order item with correct column names for Supabase schema
-            order_item_data = {
+            order_items.append({
                 "id": order_item_id,
                 "order_id": order_id,
                 "item_id": item.get('item_id'),
@@ -510,15 +3523,37 @@ async def create_order(request: OrderCreateRequest, authorization: str = Header(
                 "item_name_en": item.get('name', ''),
                 "item_name_ar": item.get('name_ar', ''),
                 "quantity": item.get('quantity', 1),
-                "unit_price": item.get('unit_price', 0),
-                "total_price": item.get('total_price', 0),
+                "unit_price": priced["unit_price"] if priced else item.get('unit_price', 0),
+                "total_price": priced["total_price"] if priced else item.get('total_price', 0),
                 "notes": item.get('notes'),
                 "status": "pending",
                 "created_at": now
-            }
-            item_response = await supabase_request("POST", "order_items", order_item_data, use_service_key=True)
-            if item_response.status_code not in [200, 201]:
-                logger.warning(f"Order item creation warning: {item_response.status_code} - {item_response.text}")
+            })
+        
+        if order_journal:
+            # Durable locally; the replayer pushes it to Supabase in the background,
+            # redeeming the coupon once the order is in
+            entries = [("order", order_id, {"order": order_data, "items": order_items})]
+            if coupon:
+                entries.append(("coupon", order_id, {"coupon_id": coupon['id'], "tenant_id": current_tenant_id()}))
+            order_journal.append_all(entries)
+        else:
+            # One transaction on the asyncpg backend, two bulk inserts over PostgREST
+            error = await storage.insert_order([order_data], order_items, "return=minimal")
+            if error:
+                logger.error(f"Order creation failed: {error}")
+                raise HTTPException(status_code=500, detail="Failed to create order")
+            if coupon:
+                # The sale stands either way; a lost count only loosens the usage limit
+                failed = await redeem_coupon(coupon['id'], order_id)
+                if failed is not None:
+                    logger.error(f"Coupon {coupon['code']} not counted for order {order_id}: "
+                                 f"{failed.status_code} {failed.text[:200]}")
+                invalidate_cache("coupons:")
+        
+        publish_event("order.created", {
+            "tenant_id": current_tenant_id(), "branch_id": user_branch_id, "order": order_data, "items": order_items
+        })
         
         return {
             "success": True,
@@ -528,8 +3563,9 @@ async def create_order(request: OrderCreateRequest, authorization: str = Header(
                 "bill_number": order_number,  # Use order_number as bill_number
                 "order_source": request.order_source,
                 "status": "pending",
-                "total": request.total
-            }
+                "total": pricing["total"]
+            },
+            "pricing": pricing
         }
         
     except HTTPException:
@@ -540,7 +3576,18 @@ async def create_order(request: OrderCreateRequest, authorization: str = Header(
 
 @api_router.patch("/orders/update-status")
 async def update_order_status(request: OrderStatusUpdateRequest, authorization: str = Header(None)):
-    """Update order status"""
+    """Move an order along ORDER_TRANSITIONS.
+
+    The write is conditional: on expected_status/expected_updated_at when the
+    client sends them, otherwise on the order being in a status the new one
+    may follow. Either way it is a single PATCH; when it matches nothing the
+    order is read once to answer 409 with its current state (or succeed as a
+    no-op if it already has the requested status).
+    """
+    if request.status not in ORDER_TRANSITIONS:
+        raise HTTPException(status_code=422, detail=f"Unknown order status: {request.status}")
+    if request.expected_status is not None and request.status not in ORDER_TRANSITIONS.get(request.expected_status, ()):
+        raise HTTPException(status_code=422, detail=f"Cannot move from {request.expected_status} to {request.status}")
     try:
         user_id = None
         if authorization:
@@ -553,33 +3600,70 @@ async def update_order_status(request: OrderStatusUpdateRequest, authorization:
         
         now = datetime.now(timezone.utc).isoformat()
         
-        # Update order
+        state_data = {
+            "id": str(uuid.uuid4()),
+            "order_id": request.order_id,
+            "status": request.status,
+            "changed_by": user_id,
+            "created_at": now
+        }
+        
+        # Order not replayed to Supabase yet: check and queue the change behind it in the journal
+        if order_journal and order_journal.has_pending(request.order_id):
+            current = order_journal.get_order(request.order_id) or {}
+            if current.get('status') == request.status and request.expected_status is None:
+                return {"success": True, "status": request.status, "updated_at": current.get('updated_at')}
+            if (request.status not in ORDER_TRANSITIONS.get(current.get('status'), ())
+                    or request.expected_status not in (None, current.get('status'))
+                    or request.expected_updated_at not in (None, current.get('updated_at'))):
+                raise order_status_conflict(request.order_id, current, request.status)
+            order_journal.append("status", request.order_id, {
+                "status": request.status, "updated_at": now, "state": state_data
+            })
+            publish_event("order.status", {
+                "tenant_id": current_tenant_id(), "branch_id": current_branch_id(),
+                "order_id": request.order_id, "status": request.status
+            })
+            return {"success": True, "status": request.status, "updated_at": now}
+        
+        # Update order, only from a status the new one may follow
         update_data = {
             "status": request.status,
             "updated_at": now
         }
+        sources = [request.expected_status] if request.expected_status else order_status_sources(request.status)
+        endpoint = (f"orders?id=eq.{request.order_id}&tenant_id=eq.{current_tenant_id()}"
+                    f"&status=in.({','.join(sources)})&select=id,status,updated_at")
+        if request.expected_updated_at:
+            endpoint += f"&updated_at=eq.{quote(request.expected_updated_at)}"
         
-        response = await supabase_request(
-            "PATCH",
-            f"orders?id=eq.{request.order_id}&tenant_id=eq.{TENANT_ID}",
-            update_data,
-            use_service_key=True
-        )
+        response = await supabase_request("PATCH", endpoint, update_data, use_service_key=True)
         
         if response.status_code not in [200, 204]:
             raise HTTPException(status_code=500, detail="Failed to update order")
         
-        # Add state record
-        state_data = {
-            "id": str(uuid.uuid4()),
-            "order_id": request.order_id,
-            "status": request.status,
-            "changed_by": user_id,
-            "created_at": now
-        }
-        await supabase_request("POST", "order_states", state_data, use_service_key=True)
+        if not response.json():
+            current_response = await supabase_request(
+                "GET",
+                f"orders?id=eq.{request.order_id}&tenant_id=eq.{current_tenant_id()}&select=id,status,updated_at",
+                use_service_key=True
+            )
+            rows = current_response.json() if current_response.status_code == 200 else []
+            if not rows:
+                raise HTTPException(status_code=404, detail="Order not found")
+            current = rows[0]
+            if current['status'] == request.status and not request.expected_status and not request.expected_updated_at:
+                return {"success": True, "status": request.status, "updated_at": current.get('updated_at')}
+            raise order_status_conflict(request.order_id, current, request.status)
+        
+        # State history is audit-only; it is bulk-inserted in the background
+        write_behind_insert("order_states", state_data)
+        publish_event("order.status", {
+            "tenant_id": current_tenant_id(), "branch_id": current_branch_id(),
+            "order_id": request.order_id, "status": request.status
+        })
         
-        return {"success": True, "status": request.status}
+        return {"success": True, "status": request.status, "updated_at": response.json()[0].get('updated_at', now)}
         
     except HTTPException:
         raise
@@ -587,12 +3671,19 @@ async def update_order_status(request: OrderStatusUpdateRequest, authorization:
         logger.error(f"Update status error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def normalize_order(order: Dict[str, Any]) -> Dict[str, Any]:
+    """Frontend field names for an orders row"""
+    order['subtotal'] = order.get('subtotal', 0)
+    order['tax'] = order.get('tax_amount', 0)
+    order['total'] = order.get('total_amount', 0)
+    return order
+
 @api_router.get("/orders")
 async def get_orders(status: Optional[str] = None, limit: int = 50):
     """Get orders for this tenant"""
     try:
         # Query all orders for the tenant, not filtering by branch_id since it's causing issues
-        endpoint = f"orders?tenant_id=eq.{TENANT_ID}&order=created_at.desc&limit={limit}"
+        endpoint = f"orders?tenant_id=eq.{current_tenant_id()}&order=created_at.desc&limit={limit}"
         if status:
             endpoint += f"&status=eq.{status}"
         
@@ -603,25 +3694,44 @@ async def get_orders(status: Optional[str] = None, limit: int = 50):
             return {"orders": []}
         
         orders = response.json() or []
-        # Normalize field names for frontend
-        for order in orders:
-            order['subtotal'] = order.get('subtotal', 0)
-            order['tax'] = order.get('tax_amount', 0)
-            order['total'] = order.get('total_amount', 0)
-        
-        return {"orders": orders}
+        return {"orders": [normalize_order(order) for order in orders]}
     except Exception as e:
         logger.error(f"Get orders error: {e}")
         return {"orders": []}
 
+@api_router.get("/orders/journal/status")
+async def get_order_journal_status():
+    """Report how far the local order journal is behind Supabase"""
+    if not order_journal:
+        return {"enabled": False}
+    return {"enabled": True, **order_journal.status()}
+
+@api_router.post("/orders/journal/requeue")
+async def requeue_order_journal():
+    """Retry dead-lettered journal entries once the cause (e.g. a pending migration) is fixed"""
+    if not order_journal:
+        raise HTTPException(status_code=404, detail="Order journal is disabled")
+    return {"success": True, "requeued": order_journal.requeue_dead()}
+
 @api_router.get("/orders/{order_id}")
 async def get_order(order_id: str):
     """Get single order with items"""
     try:
+        # Accepted locally but not yet replayed to Supabase: the journal is authoritative
+        if order_journal and order_journal.has_pending(order_id):
+            order = order_journal.get_order(order_id)
+            if order is None or order.get('tenant_id') != current_tenant_id():
+                raise HTTPException(status_code=404, detail="Order not found")
+            order['subtotal'] = order.get('subtotal', 0)
+            order['tax'] = order.get('tax_amount', 0)
+            order['total'] = order.get('total_amount', 0)
+            order['states'] = []
+            return order
+        
         # Get order
         order_response = await supabase_request(
             "GET",
-            f"orders?id=eq.{order_id}&tenant_id=eq.{TENANT_ID}",
+            f"orders?id=eq.{order_id}&tenant_id=eq.{current_tenant_id()}",
             use_service_key=True
         )
         
@@ -673,72 +3783,858 @@ async def get_order(order_id: str):
 
 # ==================== KDS ENDPOINTS ====================
 
-@api_router.get("/kds/items")
-async def get_kds_items(station: Optional[str] = None):
-    """Get KDS items from orders with pending/preparing status"""
-    try:
-        # Get orders with pending or preparing status
+# Kitchen screens poll a per-branch board held in memory and kept current by
+# order and bump events. Events only reach the worker that raised them, so a
+# poll also catches up (at most every KDS_DELTA_SECONDS) on orders whose
+# updated_at moved in Supabase: orders placed or bumped on other workers, or
+# written there directly. A full reconcile runs every KDS_RECONCILE_SECONDS.
+KDS_ACTIVE_STATUSES = ('pending', 'accepted', 'preparing')
+KDS_DEFAULT_STATION = os.environ.get('KDS_DEFAULT_STATION', 'main')
+KDS_RECONCILE_SECONDS = float(os.environ.get('KDS_RECONCILE_SECONDS', '30'))
+KDS_DELTA_SECONDS = float(os.environ.get('KDS_DELTA_SECONDS', '1'))
+# Rows are re-read this far behind the newest updated_at seen, for clock skew
+# and for journaled orders that reach Supabase with an older timestamp
+KDS_DELTA_OVERLAP_SECONDS = float(os.environ.get('KDS_DELTA_OVERLAP_SECONDS', '15'))
+KDS_DELTA_LIMIT = 500
+
+metrics.describe("riwa_kds_queue_items", "gauge", "Items waiting on kitchen screens, by station")
+
+async def load_station_map() -> Dict[str, Any]:
+    """item_id -> KDS station, from the item's kds_station or else its category's (invalidated with the menu)"""
+    async def load():
+        categories = await supabase_request(
+            "GET", f"categories?tenant_id=eq.{current_tenant_id()}&select=id,kds_station", use_service_key=True
+        )
+        items = await supabase_request(
+            "GET", f"items?tenant_id=eq.{current_tenant_id()}&select=id,category_id,kds_station", use_service_key=True
+        )
+        if categories.status_code != 200 or items.status_code != 200:
+            raise RuntimeError(f"Station map query failed: {categories.status_code}/{items.status_code}")
+        by_category = {c['id']: c.get('kds_station') for c in categories.json()}
+        return {
+            item['id']: item.get('kds_station') or by_category.get(item.get('category_id')) or KDS_DEFAULT_STATION
+            for item in items.json()
+        }
+    
+    return await tenant_cache.get_or_load("menu:stations", load, MENU_CACHE_TTL)
+
+class KDSBoard:
+    """Open kitchen items for one branch, split into per-station queues.
+
+    Each station queue is an insertion-ordered dict of item ids, so a screen's
+    poll costs O(items on that station) and a bump is O(1). Events change the
+    board through apply(), which also records them while a reconcile or a
+    catch-up is loading so they can be replayed on top of what it read.
+    """
+
+    def __init__(self, branch_id: Optional[str] = None):
+        self.branch_id = branch_id
+        self.items: Dict[str, Dict[str, Any]] = {}
+        self.stations: Dict[str, "OrderedDict[str, None]"] = {}
+        self.orders: Dict[str, set] = {}  # order_id -> open item ids
+        self.order_meta: Dict[str, Dict[str, Any]] = {}  # order_id -> header shown on each item
+        self.station_map: Dict[str, str] = {}
+        self.reconciled_at = 0.0
+        self.reconciling: Optional[asyncio.Task] = None
+        self.missed: Optional[List[tuple]] = None  # events applied while a reconcile is loading
+        self.catching_up: Optional[asyncio.Task] = None
+        self.caught_up_at = 0.0
+        self.delta_missed: Optional[List[tuple]] = None  # events applied while a catch-up is loading
+        self.watermark = 0.0  # newest orders.updated_at seen (epoch seconds)
+        self.seen: Dict[str, tuple] = {}  # order_id -> (updated_at, epoch) within the overlap window
+
+    def apply(self, operation: str, *args):
+        getattr(self, operation)(*args)
+        if self.missed is not None:
+            self.missed.append((operation, args))
+        if self.delta_missed is not None:
+            self.delta_missed.append((operation, args))
+
+    def add_item(self, item: Dict[str, Any], order: Dict[str, Any]):
+        item = dict(item)
+        meta = self.order_meta.get(item['order_id'])
+        if meta is None:
+            meta = self.order_meta[item['order_id']] = {
+                'order_number': order.get('order_number'),
+                'order_type': order.get('order_type'),
+                'status': order.get('status')
+            }
+        item['order'] = meta
+        item['order_number'] = order.get('order_number')
+        item['item_name'] = item.get('item_name_en', '')
+        item['item_name_ar'] = item.get('item_name_ar', '')
+        item['station'] = self.station_map.get(item.get('item_id'), KDS_DEFAULT_STATION)
+        self.remove_item(item['id'])
+        self.items[item['id']] = item
+        self.stations.setdefault(item['station'], OrderedDict())[item['id']] = None
+        self.orders.setdefault(item['order_id'], set()).add(item['id'])
+
+    def remove_item(self, item_id: str) -> Optional[Dict[str, Any]]:
+        item = self.items.pop(item_id, None)
+        if item is None:
+            return None
+        self.stations[item['station']].pop(item_id, None)
+        open_items = self.orders.get(item['order_id'])
+        if open_items is not None:
+            open_items.discard(item_id)
+            if not open_items:
+                del self.orders[item['order_id']]
+                self.order_meta.pop(item['order_id'], None)
+        return item
+
+    def set_order_status(self, order_id: str, status: str):
+        if status not in KDS_ACTIVE_STATUSES:
+            for item_id in list(self.orders.get(order_id, ())):
+                self.remove_item(item_id)
+            return
+        if order_id in self.order_meta:
+            self.order_meta[order_id]['status'] = status
+
+    def sync_order(self, order: Dict[str, Any], items: List[Dict[str, Any]]):
+        """Make an active order's open items match what Supabase has"""
+        open_ids = {item['id'] for item in items}
+        for item_id in list(self.orders.get(order['id'], ())):
+            if item_id not in open_ids:
+                self.remove_item(item_id)
+        for item in items:
+            if item['id'] not in self.items:
+                self.add_item(item, order)
+        if order['id'] in self.order_meta:
+            self.order_meta[order['id']]['status'] = order.get('status')
+
+    def remap(self, station_map: Dict[str, str]):
+        """Re-slot open items after the menu's station assignment changed"""
+        self.station_map = station_map
+        items = list(self.items.values())
+        self.stations = {}
+        for item in items:
+            item['station'] = station_map.get(item.get('item_id'), KDS_DEFAULT_STATION)
+            self.stations.setdefault(item['station'], OrderedDict())[item['id']] = None
+
+    def station_items(self, station: Optional[str]) -> List[Dict[str, Any]]:
+        if station:
+            return [self.items[item_id] for item_id in self.stations.get(station, ())]
+        return list(self.items.values())
+
+    def update_metrics(self):
+        for station, queue in self.stations.items():
+            metrics.set_gauge("riwa_kds_queue_items", len(queue), station=station, branch=self.branch_id)
+
+    async def reconcile(self):
+        """Rebuild from Supabase: active orders plus their open items in chunked in.() queries.
+
+        Events that arrive while the queries run are replayed on the snapshot
+        before it is swapped in (every board operation is idempotent).
+        """
+        self.missed = []
+        started = time.time()
+        try:
+            fresh = await self._load_snapshot()
+            for operation, args in self.missed:
+                getattr(fresh, operation)(*args)
+        finally:
+            self.missed = None
+        self.items, self.stations, self.orders = fresh.items, fresh.stations, fresh.orders
+        self.order_meta = fresh.order_meta
+        self.reconciled_at = time.monotonic()
+        self.watermark = max(self.watermark, started)
+        self.update_metrics()
+
+    async def catch_up(self):
+        """Apply orders whose updated_at moved since the last look, with their open items"""
+        since = datetime.fromtimestamp(self.watermark - KDS_DELTA_OVERLAP_SECONDS, timezone.utc).isoformat()
+        self.delta_missed = []
+        try:
+            response = await supabase_request(
+                "GET",
+                f"orders?tenant_id=eq.{current_tenant_id()}&branch_id=eq.{self.branch_id}"
+                f"&updated_at=gte.{quote(since)}&select=id,order_number,order_type,status,updated_at"
+                f"&order=updated_at.asc&limit={KDS_DELTA_LIMIT}",
+                use_service_key=True
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"KDS delta query failed: {response.status_code}")
+            rows = response.json() or []
+            changed = [order for order in rows if self.seen.get(order['id'], (None,))[0] != order.get('updated_at')]
+            active = [order['id'] for order in changed if order.get('status') in KDS_ACTIVE_STATUSES]
+            items: Dict[str, List[Dict[str, Any]]] = {order_id: [] for order_id in active}
+            for start in range(0, len(active), _IN_FILTER_CHUNK):
+                ids = ",".join(active[start:start + _IN_FILTER_CHUNK])
+                items_response = await supabase_request(
+                    "GET", f"order_items?order_id=in.({ids})&status=neq.completed&order=created_at.asc",
+                    use_service_key=True
+                )
+                if items_response.status_code != 200:
+                    raise RuntimeError(f"KDS delta items query failed: {items_response.status_code}")
+                for item in items_response.json() or []:
+                    items[item['order_id']].append(item)
+            missed, self.delta_missed = self.delta_missed, None
+            for order in changed:
+                if order['id'] in items:
+                    self.apply("sync_order", order, items[order['id']])
+                else:
+                    self.apply("set_order_status", order['id'], order.get('status'))
+            # Events raised while the queries ran are newer than what they read
+            for operation, args in missed:
+                self.apply(operation, *args)
+        finally:
+            self.delta_missed = None
+        for order in changed:
+            stamp = _iso_to_epoch(order.get('updated_at'))
+            if stamp is not None:
+                self.seen[order['id']] = (order.get('updated_at'), stamp)
+                self.watermark = max(self.watermark, stamp)
+        horizon = self.watermark - KDS_DELTA_OVERLAP_SECONDS
+        self.seen = {order_id: entry for order_id, entry in self.seen.items() if entry[1] >= horizon}
+        if len(rows) >= KDS_DELTA_LIMIT:
+            # More changed than one page: let the next poll rebuild instead
+            self.reconciled_at = min(self.reconciled_at, time.monotonic() - KDS_RECONCILE_SECONDS - 1)
+        self.caught_up_at = time.monotonic()
+        self.update_metrics()
+
+    async def _load_snapshot(self) -> "KDSBoard":
         orders_response = await supabase_request(
             "GET",
-            f"orders?tenant_id=eq.{TENANT_ID}&status=in.(pending,accepted,preparing)&order=created_at.asc",
+            f"orders?tenant_id=eq.{current_tenant_id()}&branch_id=eq.{self.branch_id}"
+            f"&status=in.({','.join(KDS_ACTIVE_STATUSES)})"
+            f"&select=id,order_number,order_type,status&order=created_at.asc",
             use_service_key=True
         )
-        
         if orders_response.status_code != 200:
-            logger.error(f"KDS orders query failed: {orders_response.status_code}")
-            return {"items": []}
+            raise RuntimeError(f"KDS orders query failed: {orders_response.status_code}")
+        orders = {order['id']: order for order in orders_response.json() or []}
         
-        orders = orders_response.json() or []
-        kds_items = []
-        
-        # Get items for each order
-        for order in orders:
+        items = []
+        order_ids = list(orders)
+        for start in range(0, len(order_ids), _IN_FILTER_CHUNK):
+            ids = ",".join(order_ids[start:start + _IN_FILTER_CHUNK])
             items_response = await supabase_request(
                 "GET",
-                f"order_items?order_id=eq.{order['id']}&status=neq.completed&order=created_at.asc",
+                f"order_items?order_id=in.({ids})&status=neq.completed&order=created_at.asc",
                 use_service_key=True
             )
-            
-            if items_response.status_code == 200:
-                items = items_response.json() or []
-                for item in items:
-                    item['order'] = {
-                        'order_number': order.get('order_number'),
-                        'order_type': order.get('order_type'),
-                        'status': order.get('status')
-                    }
-                    item['order_number'] = order.get('order_number')
-                    item['item_name'] = item.get('item_name_en', '')
-                    item['item_name_ar'] = item.get('item_name_ar', '')
-                    kds_items.append(item)
-        
-        return {"items": kds_items}
+            if items_response.status_code != 200:
+                raise RuntimeError(f"KDS items query failed: {items_response.status_code}")
+            items.extend(items_response.json() or [])
+        
+        fresh = KDSBoard(self.branch_id)
+        fresh.station_map = self.station_map
+        position = {order_id: idx for idx, order_id in enumerate(order_ids)}
+        for item in sorted(items, key=lambda i: (position[i['order_id']], i.get('created_at') or '')):
+            fresh.add_item(item, orders[item['order_id']])
+        # Orders still in the local journal are not in Supabase yet
+        for item in self.items.values():
+            if item['id'] not in fresh.items and order_journal and order_journal.has_pending(item['order_id']):
+                fresh.items[item['id']] = item
+                fresh.stations.setdefault(item['station'], OrderedDict())[item['id']] = None
+                fresh.orders.setdefault(item['order_id'], set()).add(item['id'])
+                fresh.order_meta[item['order_id']] = item['order']
+        if fresh.station_map is not self.station_map:
+            # The menu's stations changed while loading
+            fresh.remap(self.station_map)
+        return fresh
+
+_kds_boards: Dict[tuple, KDSBoard] = {}  # (tenant_id, branch_id) -> board
+
+def kds_boards_of(tenant_id: str) -> List[KDSBoard]:
+    return [board for (tenant, _), board in _kds_boards.items() if tenant == tenant_id]
+
+async def get_kds_board() -> KDSBoard:
+    """The branch's board; built on first poll and reconciled in the background every KDS_RECONCILE_SECONDS"""
+    key = (current_tenant_id(), current_branch_id())
+    board = _kds_boards.get(key)
+    if board is None:
+        board = _kds_boards[key] = KDSBoard(key[1])
+    station_map = await load_station_map()
+    if station_map is not board.station_map:
+        board.remap(station_map)
+    if board.reconciling is None or board.reconciling.done():
+        if not board.reconciled_at or time.monotonic() - board.reconciled_at > KDS_RECONCILE_SECONDS:
+            board.reconciling = asyncio.create_task(board.reconcile())
+    if not board.reconciled_at:
+        try:
+            await asyncio.shield(board.reconciling)
+        except Exception:
+            board.reconciling = None
+            raise
+    elif (board.catching_up is None or board.catching_up.done()) and \
+            time.monotonic() - board.caught_up_at > KDS_DELTA_SECONDS:
+        # In the background: what it finds shows on the next poll
+        board.catching_up = asyncio.create_task(catch_up_kds_board(board))
+    return board
+
+async def catch_up_kds_board(board: KDSBoard):
+    try:
+        await board.catch_up()
+    except Exception as e:
+        # The board stays as current as the last catch-up; try again after the interval
+        logger.warning(f"KDS catch-up failed: {e}")
+        board.caught_up_at = time.monotonic()
+
+def kds_on_order_created(event: Dict[str, Any]):
+    board = _kds_boards.get((event['tenant_id'], event['branch_id']))
+    if board is None:
+        return
+    for item in event['items']:
+        if item.get('status') != 'completed':
+            board.apply("add_item", item, event['order'])
+    board.update_metrics()
+
+def kds_on_order_status(event: Dict[str, Any]):
+    # Status events carry no branch; only the board holding the order changes
+    for board in kds_boards_of(event['tenant_id']):
+        board.apply("set_order_status", event['order_id'], event['status'])
+        board.update_metrics()
+
+def kds_on_update(event: Dict[str, Any]):
+    """One event per bump/recall batch: item rows with their new status plus affected order headers"""
+    for board in kds_boards_of(event['tenant_id']):
+        recalled_here = board.branch_id == event['branch_id']
+        for item in event['items']:
+            if event['status'] == 'completed':
+                board.apply("remove_item", item['id'])
+            elif recalled_here and event['orders'].get(item['order_id'], {}).get('status') in KDS_ACTIVE_STATUSES:
+                board.apply("add_item", item, event['orders'][item['order_id']])
+        for order_id, order in event['orders'].items():
+            board.apply("set_order_status", order_id, order.get('status'))
+        board.update_metrics()
+
+subscribe("order.created", kds_on_order_created)
+subscribe("order.status", kds_on_order_status)
+subscribe("kds.updated", kds_on_update)
+
+@api_router.get("/kds/items")
+async def get_kds_items(station: Optional[str] = None):
+    """Get KDS items from orders with pending/preparing status, optionally for one station"""
+    try:
+        board = await get_kds_board()
+        return {"items": board.station_items(station)}
     except Exception as e:
         logger.error(f"Get KDS items error: {e}")
         return {"items": []}
 
-@api_router.post("/kds/bump")
-async def bump_kds_item(request: KDSBumpRequest):
-    """Bump (complete) a KDS item - marks order_item as completed"""
+@api_router.get("/kds/stations")
+async def get_kds_stations():
+    """Stations with their open item counts"""
+    try:
+        board = await get_kds_board()
+        stations = set(board.station_map.values()) | set(board.stations) | {KDS_DEFAULT_STATION}
+        return {"stations": [
+            {"station": station, "open_items": len(board.stations.get(station, ()))} for station in sorted(stations)
+        ]}
+    except Exception as e:
+        logger.error(f"Get KDS stations error: {e}")
+        return {"stations": []}
+
+_kds_touches: set = set()  # in-flight touch_orders tasks
+
+async def _owned_order_items(item_ids: List[str], board: Optional[KDSBoard]) -> List[str]:
+    """The item ids on the current tenant's orders; items on its board are known to be"""
+    owned = [i for i in item_ids if board and i in board.items]
+    order_of: Dict[str, str] = {}
+    for chunk in _chunks(sorted({i for i in item_ids if i not in owned and _valid_uuid(i)}), _IN_FILTER_CHUNK):
+        response = await supabase_request(
+            "GET", f"order_items?id=in.({','.join(chunk)})&select=id,order_id", use_service_key=True
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"order_items scope query failed: {response.status_code} - {response.text[:200]}")
+        order_of.update((row['id'], row['order_id']) for row in response.json())
+    if order_of:
+        owned_orders = await _owned_ids("orders", list(set(order_of.values())))
+        owned.extend(item_id for item_id, order in order_of.items() if order in owned_orders)
+    return owned
+
+async def touch_orders(order_ids: List[str], now: str):
+    """Move orders' updated_at (off the bump's response path)"""
+    response = await supabase_request(
+        "PATCH", f"orders?id=in.({','.join(order_ids)})&tenant_id=eq.{current_tenant_id()}", {"updated_at": now},
+        use_service_key=True, prefer="return=minimal"
+    )
+    if response.status_code not in [200, 204]:
+        logger.warning(f"KDS order touch failed: {response.status_code} - {response.text[:200]}")
+
+async def set_kds_items_status(item_ids: List[str], order_id: Optional[str], status: str,
+                               user_id: Optional[str] = None) -> Dict[str, Any]:
+    """Bump (status='completed') or recall (status='pending') many order items at once.
+
+    Supabase sees one PATCH for the items and at most one for their orders:
+    a bump moves orders with nothing left open to ``ready``, a recall moves
+    ``ready`` orders back to ``preparing``. The other affected orders get
+    their updated_at touched in the background so other workers' boards
+    catch up. Orders still in the local journal get journal entries instead.
+    Publishes a single kds.updated event.
+    """
+    tenant_id = current_tenant_id()
+    board = _kds_boards.get((tenant_id, current_branch_id()))
+    now = datetime.now(timezone.utc).isoformat()
+    # Only touch items not already in the target state
+    status_filter = "status=neq.completed" if status == 'completed' else "status=eq.completed"
+    
+    # Split the work between the journal and Supabase
+    journaled: Dict[str, Dict[str, Any]] = {}
+    if order_journal:
+        candidates = {order_id} if order_id else {
+            board.items[i]['order_id'] for i in item_ids if board and i in board.items
+        }
+        for candidate in candidates:
+            if order_journal.has_pending(candidate):
+                journaled[candidate] = order_journal.get_order(candidate)
+    
+    rows: List[Dict[str, Any]] = []
+    for journal_order_id, order in journaled.items():
+        wanted = set(item_ids)
+        changed = [dict(item, status=status) for item in order["items"]
+                   if (item.get('status') == 'completed') != (status == 'completed')
+                   and (order_id or item['id'] in wanted)]
+        if changed:
+            order_journal.append("items", journal_order_id, {
+                "item_ids": [item['id'] for item in changed], "status": status, "updated_at": now
+            })
+            rows.extend(changed)
+    
+    remote_ids = [i for i in item_ids if not (board and i in board.items and board.items[i]['order_id'] in journaled)]
+    # order_items has no tenant_id: anything not on this tenant's board is checked through its order
+    item_filter = None
+    if order_id:
+        if order_id not in journaled and (board and order_id in board.order_meta
+                                          or order_id in await _owned_ids("orders", [order_id])):
+            item_filter = f"order_id=eq.{order_id}"
+    elif remote_ids:
+        owned = await _owned_order_items(remote_ids, board)
+        item_filter = f"id=in.({','.join(owned)})" if owned else None
+    if item_filter:
+        response = await supabase_request(
+            "PATCH",
+            f"order_items?{item_filter}&{status_filter}",
+            {"status": status},
+            use_service_key=True,
+            prefer="return=representation"
+        )
+        if response.status_code not in [200, 204]:
+            raise HTTPException(status_code=500, detail="Failed to update items")
+        rows.extend(response.json() if response.status_code == 200 else [])
+    
+    affected = {row['order_id'] for row in rows}
+    orders: Dict[str, Dict[str, Any]] = {}
+    if status == 'completed':
+        # Roll up: orders with no open items left are ready for pickup
+        changed_ids = {row['id'] for row in rows}
+        done = set()
+        unknown = []
+        for affected_id in affected:
+            if affected_id in journaled:
+                items = journaled[affected_id]["items"]
+                if all(i.get('status') == 'completed' or i['id'] in changed_ids for i in items):
+                    done.add(affected_id)
+            elif board and board.reconciled_at and affected_id in board.order_meta:
+                if not board.orders.get(affected_id, set()) - changed_ids:
+                    done.add(affected_id)
+            else:
+                unknown.append(affected_id)
+        if unknown:
+            response = await supabase_request(
+                "GET",
+                f"order_items?order_id=in.({','.join(unknown)})&status=neq.completed&select=order_id",
+                use_service_key=True
+            )
+            still_open = {row['order_id'] for row in response.json()} if response.status_code == 200 else set(unknown)
+            done.update(set(unknown) - still_open)
+        from_statuses, to_status = KDS_ACTIVE_STATUSES, 'ready'
+        targets = done
+    else:
+        from_statuses, to_status = ('ready',), 'preparing'
+        targets = affected
+    
+    for target in [t for t in targets if t in journaled]:
+        if journaled[target].get('status') in from_statuses:
+            order_journal.append("status", target, {"status": to_status, "updated_at": now, "state": {
+                "id": str(uuid.uuid4()), "order_id": target, "status": to_status, "changed_by": user_id, "created_at": now
+            }})
+            orders[target] = {k: journaled[target].get(k) for k in ('order_number', 'order_type')}
+            orders[target]['status'] = to_status
+    remote_targets = [t for t in targets if t not in journaled]
+    if remote_targets:
+        response = await supabase_request(
+            "PATCH",
+            f"orders?id=in.({','.join(remote_targets)})&tenant_id=eq.{tenant_id}"
+            f"&status=in.({','.join(from_statuses)})&select=id,order_number,order_type,status",
+            {"status": to_status, "updated_at": now},
+            use_service_key=True,
+            prefer="return=representation"
+        )
+        if response.status_code == 200:
+            for order in response.json():
+                orders[order['id']] = order
+                write_behind_insert("order_states", {
+                    "id": str(uuid.uuid4()), "order_id": order['id'], "status": to_status,
+                    "changed_by": user_id, "created_at": now
+                })
+        else:
+            logger.warning(f"KDS order roll-up failed: {response.status_code} - {response.text[:200]}")
+    # Other workers' boards only catch up on orders whose updated_at moved
+    untouched = [a for a in affected if a not in journaled and a not in orders]
+    if untouched:
+        task = asyncio.create_task(touch_orders(untouched, now))
+        _kds_touches.add(task)
+        task.add_done_callback(_kds_touches.discard)
+    
+    if status == 'pending':
+        # Recalled items need their order header to go back on the board
+        for affected_id in affected - set(orders):
+            if board and affected_id in board.order_meta:
+                orders[affected_id] = dict(board.order_meta[affected_id])
+            elif affected_id in journaled:
+                orders[affected_id] = {k: journaled[affected_id].get(k) for k in ('order_number', 'order_type', 'status')}
+        missing = [i for i in affected if i not in orders]
+        if missing:
+            response = await supabase_request(
+                "GET", f"orders?id=in.({','.join(missing)})&tenant_id=eq.{tenant_id}"
+                f"&select=id,order_number,order_type,status", use_service_key=True
+            )
+            if response.status_code == 200:
+                orders.update({order['id']: order for order in response.json()})
+    
+    publish_event("kds.updated", {
+        "tenant_id": tenant_id, "branch_id": current_branch_id(), "status": status, "items": rows, "orders": orders
+    })
+    return {
+        "items": [row['id'] for row in rows],
+        "orders": {order_id: order.get('status') for order_id, order in orders.items()}
+    }
+
+def _kds_user(authorization: Optional[str]) -> Optional[str]:
+    if not authorization:
+        return None
+    try:
+        payload = jwt.decode(authorization.replace("Bearer ", ""), JWT_SECRET, algorithms=["HS256"])
+        return payload.get('user_id')
+    except JWTError:
+        return None
+
+@api_router.post("/kds/bump")
+async def bump_kds_item(request: KDSBumpRequest, authorization: str = Header(None)):
+    """Bump (complete) a KDS item - marks order_item as completed"""
+    try:
+        result = await set_kds_items_status([request.kds_item_id], None, 'completed', _kds_user(authorization))
+        return {"success": True, **result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Bump KDS item error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/kds/bump/bulk")
+async def bump_kds_items(request: KDSBulkRequest, authorization: str = Header(None)):
+    """Bump many items, or every open item of an order, in one go"""
+    try:
+        if not request.item_ids and not request.order_id:
+            raise HTTPException(status_code=400, detail="Provide item_ids or order_id")
+        result = await set_kds_items_status(request.item_ids, request.order_id, 'completed', _kds_user(authorization))
+        return {"success": True, **result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Bulk bump KDS error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/kds/recall")
+async def recall_kds_items(request: KDSBulkRequest, authorization: str = Header(None)):
+    """Undo a bump: put items (or a whole order) back on the kitchen screens"""
+    try:
+        if not request.item_ids and not request.order_id:
+            raise HTTPException(status_code=400, detail="Provide item_ids or order_id")
+        result = await set_kds_items_status(request.item_ids, request.order_id, 'pending', _kds_user(authorization))
+        return {"success": True, **result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Recall KDS error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== KITCHEN ANALYTICS ====================
+
+# Prep and ticket times are collected from kds.updated / order events into
+# bounded in-memory structures; each finished hour is rolled up into one row
+# per station in kitchen_hourly_stats so history never rescans order_states.
+PREP_BUCKETS = (60, 120, 180, 300, 420, 600, 900, 1200, 1800, 2700, 3600)  # seconds
+KITCHEN_RING_SIZE = int(os.environ.get('KITCHEN_RING_SIZE', '5000'))
+KITCHEN_SAMPLE_SECONDS = float(os.environ.get('KITCHEN_SAMPLE_SECONDS', '30'))
+KITCHEN_TRACKED_TICKETS = 5000
+KITCHEN_ALL = "all"
+
+metrics.describe("riwa_kitchen_prep_seconds_total", "counter", "Sum of item prep times, by station")
+metrics.describe("riwa_kitchen_items_prepared_total", "counter", "Items bumped on the KDS, by station")
+
+def _iso_to_epoch(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return (parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)).timestamp()
+    except ValueError:
+        return None
+
+def histogram_quantile(counts: List[int], q: float) -> Optional[float]:
+    """Upper bound of the PREP_BUCKETS bucket holding the q-quantile (None past the last bucket)"""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for idx, count in enumerate(counts):
+        seen += count
+        if seen >= rank:
+            return PREP_BUCKETS[idx] if idx < len(PREP_BUCKETS) else None
+    return None
+
+def _summary(count: int, total: float, peak: float, counts: List[int]) -> Dict[str, Any]:
+    return {
+        "count": count,
+        "avg_seconds": round(total / count, 1) if count else None,
+        "p50_seconds": histogram_quantile(counts, 0.5),
+        "p90_seconds": histogram_quantile(counts, 0.9),
+        "max_seconds": round(peak, 1) if count else None,
+    }
+
+class HourAggregate:
+    """Count / sum / max plus a PREP_BUCKETS histogram for one hour and station"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.peak = 0.0
+        self.counts = [0] * (len(PREP_BUCKETS) + 1)
+        self.tickets = 0
+        self.tickets_total = 0.0
+        self.tickets_peak = 0.0
+        self.max_queue = 0
+
+    def add_prep(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.peak = max(self.peak, seconds)
+        self.counts[bisect.bisect_left(PREP_BUCKETS, seconds)] += 1
+
+    def add_ticket(self, seconds: float):
+        self.tickets += 1
+        self.tickets_total += seconds
+        self.tickets_peak = max(self.tickets_peak, seconds)
+
+    def row(self, tenant_id: str, hour: float, station: str) -> Dict[str, Any]:
+        prep = _summary(self.count, self.total, self.peak, self.counts)
+        # Merged into the (tenant_id, hour_start, station) row by riwa_merge_kitchen_stats
+        return {
+            "tenant_id": tenant_id,
+            "hour_start": datetime.fromtimestamp(hour, timezone.utc).isoformat(),
+            "station": station,
+            "items_prepared": self.count,
+            "prep_total_seconds": round(self.total, 1),
+            "prep_avg_seconds": prep["avg_seconds"],
+            "prep_p50_seconds": prep["p50_seconds"],
+            "prep_p90_seconds": prep["p90_seconds"],
+            "prep_max_seconds": prep["max_seconds"],
+            "prep_histogram": self.counts,
+            "tickets": self.tickets,
+            "ticket_total_seconds": round(self.tickets_total, 1),
+            "ticket_avg_seconds": round(self.tickets_total / self.tickets, 1) if self.tickets else None,
+            "ticket_max_seconds": round(self.tickets_peak, 1) if self.tickets else None,
+            "max_queue": self.max_queue,
+        }
+
+class KitchenStats:
+    """Per-tenant kitchen performance: ring buffers for the live view, hourly aggregates for history"""
+
+    def __init__(self, tenant_id: str):
+        self.tenant_id = tenant_id
+        self.preps: deque = deque(maxlen=KITCHEN_RING_SIZE)    # (at, seconds, station, item name, order number)
+        self.tickets: deque = deque(maxlen=KITCHEN_RING_SIZE)  # (at, seconds, order number, order id)
+        self.queue: deque = deque(maxlen=int(3600 / KITCHEN_SAMPLE_SECONDS) + 1)  # (at, {station: open items})
+        self.started: "OrderedDict[str, float]" = OrderedDict()  # order id -> ticket start
+        self.hour = self._hour_of(time.time())
+        self.hourly: Dict[str, HourAggregate] = {}
+
+    @staticmethod
+    def _hour_of(at: float) -> float:
+        return at - at % 3600
+
+    def _roll(self, now: float):
+        """Persist the finished hour (write-behind) and start a new one"""
+        hour = self._hour_of(now)
+        if hour == self.hour:
+            return
+        self.persist_hour()
+        self.hour = hour
+
+    def persist_hour(self):
+        """Queue what the current hour has so far; the rows are merged, so the rest can follow later"""
+        for station, aggregate in self.hourly.items():
+            write_behind_insert("kitchen_hourly_stats", aggregate.row(self.tenant_id, self.hour, station))
+        self.hourly = {}
+
+    def _aggregate(self, station: str) -> HourAggregate:
+        aggregate = self.hourly.get(station)
+        if aggregate is None:
+            aggregate = self.hourly[station] = HourAggregate()
+        return aggregate
+
+    def ticket_started(self, order_id: str, at: float):
+        self.started[order_id] = at
+        while len(self.started) > KITCHEN_TRACKED_TICKETS:
+            self.started.popitem(last=False)
+
+    def record_prep(self, now: float, seconds: float, station: str, name: str, order_number: Optional[str]):
+        self._roll(now)
+        self.preps.append((now, seconds, station, name, order_number))
+        self._aggregate(station).add_prep(seconds)
+        self._aggregate(KITCHEN_ALL).add_prep(seconds)
+        metrics.inc("riwa_kitchen_prep_seconds_total", seconds, station=station)
+        metrics.inc("riwa_kitchen_items_prepared_total", station=station)
+
+    def record_ready(self, now: float, order_id: str, order_number: Optional[str], fallback_start: Optional[float]):
+        start = self.started.pop(order_id, None) or fallback_start
+        if start is None or now < start:
+            return
+        self._roll(now)
+        self.tickets.append((now, now - start, order_number, order_id))
+        self._aggregate(KITCHEN_ALL).add_ticket(now - start)
+
+    def sample_queue(self, now: float, boards: List["KDSBoard"]):
+        self._roll(now)
+        sizes: Dict[str, int] = {}
+        for board in boards:
+            for station, queue in board.stations.items():
+                sizes[station] = sizes.get(station, 0) + len(queue)
+        sizes[KITCHEN_ALL] = sum(sizes.values())
+        self.queue.append((now, sizes))
+        for station, size in sizes.items():
+            aggregate = self._aggregate(station)
+            aggregate.max_queue = max(aggregate.max_queue, size)
+
+    def live(self, station: Optional[str], window: float = 3600, top: int = 10) -> Dict[str, Any]:
+        now = time.time()
+        since = now - window
+        per_station: Dict[str, HourAggregate] = {}
+        per_item: Dict[str, List[float]] = {}
+        for at, seconds, item_station, name, _ in self.preps:
+            if at < since or (station and item_station != station):
+                continue
+            for key in (item_station, KITCHEN_ALL):
+                aggregate = per_station.get(key)
+                if aggregate is None:
+                    aggregate = per_station[key] = HourAggregate()
+                aggregate.add_prep(seconds)
+            stats = per_item.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+        
+        items = sorted(per_item.items(), key=lambda kv: kv[1][1] / kv[1][0], reverse=True)[:top]
+        tickets = sorted((t for t in self.tickets if t[0] >= since), key=lambda t: t[1], reverse=True)[:top]
+        return {
+            "window_seconds": window,
+            "stations": {key: _summary(a.count, a.total, a.peak, a.counts) for key, a in per_station.items()},
+            "slowest_items": [
+                {"item_name": name, "count": s[0], "avg_seconds": round(s[1] / s[0], 1), "max_seconds": round(s[2], 1)}
+                for name, s in items
+            ],
+            "slowest_tickets": [
+                {"order_id": t[3], "order_number": t[2], "seconds": round(t[1], 1),
+                 "ready_at": datetime.fromtimestamp(t[0], timezone.utc).isoformat()}
+                for t in tickets
+            ],
+            "queue": [
+                {"at": datetime.fromtimestamp(at, timezone.utc).isoformat(),
+                 "open_items": sizes.get(station or KITCHEN_ALL, 0)}
+                for at, sizes in self.queue if at >= since
+            ],
+        }
+
+_kitchen_stats: Dict[str, KitchenStats] = {}
+
+def kitchen_stats_for(tenant_id: str) -> KitchenStats:
+    stats = _kitchen_stats.get(tenant_id)
+    if stats is None:
+        stats = _kitchen_stats[tenant_id] = KitchenStats(tenant_id)
+    return stats
+
+def kitchen_on_order_created(event: Dict[str, Any]):
+    order = event['order']
+    kitchen_stats_for(event['tenant_id']).ticket_started(order['id'], _iso_to_epoch(order.get('created_at')) or time.time())
+
+def kitchen_on_kds_update(event: Dict[str, Any]):
+    stats = kitchen_stats_for(event['tenant_id'])
+    now = time.time()
+    board = _kds_boards.get((event['tenant_id'], event.get('branch_id')))
+    station_map = board.station_map if board else {}
+    first_seen: Dict[str, float] = {}
+    if event['status'] == 'completed':
+        for item in event['items']:
+            created = _iso_to_epoch(item.get('created_at'))
+            if created is None:
+                continue
+            first_seen[item['order_id']] = min(first_seen.get(item['order_id'], created), created)
+            order = event['orders'].get(item['order_id']) or (board.order_meta.get(item['order_id']) if board else None) or {}
+            stats.record_prep(now, max(0.0, now - created), station_map.get(item.get('item_id'), KDS_DEFAULT_STATION),
+                              item.get('item_name_en') or item.get('item_id') or '', order.get('order_number'))
+    for order_id, order in event['orders'].items():
+        if order.get('status') == 'ready':
+            stats.record_ready(now, order_id, order.get('order_number'), first_seen.get(order_id))
+
+def kitchen_on_order_status(event: Dict[str, Any]):
+    stats = _kitchen_stats.get(event['tenant_id'])
+    if stats is None:
+        return
+    if event['status'] == 'ready':
+        stats.record_ready(time.time(), event['order_id'], None, None)
+    elif event['status'] not in KDS_ACTIVE_STATUSES:
+        stats.started.pop(event['order_id'], None)
+
+subscribe("order.created", kitchen_on_order_created)
+subscribe("kds.updated", kitchen_on_kds_update)
+subscribe("order.status", kitchen_on_order_status)
+
+async def run_kitchen_sampler():
+    """Background task: sample KDS queue lengths and roll finished hours into kitchen_hourly_stats"""
+    while True:
+        await asyncio.sleep(KITCHEN_SAMPLE_SECONDS)
+        now = time.time()
+        for tenant_id in {tenant for tenant, _ in _kds_boards} | set(_kitchen_stats):
+            kitchen_stats_for(tenant_id).sample_queue(now, kds_boards_of(tenant_id))
+
+@api_router.get("/kitchen/performance/live")
+async def get_kitchen_live(station: Optional[str] = None, minutes: int = 60):
+    """Prep times, slowest items and tickets, and queue length over the last hour (from memory)"""
+    window = max(1, min(minutes, 60)) * 60
+    return kitchen_stats_for(current_tenant_id()).live(station, window)
+
+@api_router.get("/kitchen/performance/history")
+async def get_kitchen_history(start: Optional[str] = None, end: Optional[str] = None, station: str = KITCHEN_ALL):
+    """Hourly kitchen rollups between start and end (ISO dates; default last 7 days)"""
     try:
-        now = datetime.now(timezone.utc).isoformat()
-        
-        # Update order_item status
+        now = datetime.now(timezone.utc)
+        start = start or (now - timedelta(days=7)).isoformat()
+        end = end or now.isoformat()
         response = await supabase_request(
-            "PATCH",
-            f"order_items?id=eq.{request.kds_item_id}",
-            {"status": "completed"},
+            "GET",
+            f"kitchen_hourly_stats?tenant_id=eq.{current_tenant_id()}&station=eq.{quote(station)}"
+            f"&hour_start=gte.{quote(start)}&hour_start=lt.{quote(end)}&order=hour_start.asc",
             use_service_key=True
         )
+        if response.status_code != 200:
+            raise HTTPException(status_code=500, detail="Failed to load kitchen history")
+        hours = response.json()
         
-        if response.status_code not in [200, 204]:
-            raise HTTPException(status_code=500, detail="Failed to bump item")
-        
-        return {"success": True}
+        # The current hour is still in memory
+        stats = _kitchen_stats.get(current_tenant_id())
+        if stats and station in stats.hourly:
+            row = stats.hourly[station].row(current_tenant_id(), stats.hour, station)
+            if start <= row["hour_start"] < end:
+                hours.append(dict(row, partial=True))
+        return {"station": station, "hours": hours}
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Bump KDS item error: {e}")
+        logger.error(f"Kitchen history error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # ==================== ADMIN ENDPOINTS ====================
@@ -746,17 +4642,19 @@ async def bump_kds_item(request: KDSBumpRequest):
 @api_router.get("/admin/dashboard")
 async def get_dashboard_stats():
     """Get dashboard statistics"""
-    try:
+    async def load():
         today = datetime.now(timezone.utc).date().isoformat()
         
-        # Today's orders
+        # Today's orders (only the columns the summary needs)
         orders_response = await supabase_request(
             "GET",
-            f"orders?tenant_id=eq.{TENANT_ID}&branch_id=eq.{BRANCH_ID}&created_at=gte.{today}T00:00:00",
+            f"orders?tenant_id=eq.{current_tenant_id()}&branch_id=eq.{current_branch_id()}&created_at=gte.{today}T00:00:00&select=total_amount,status",
             use_service_key=True
         )
         
-        orders = orders_response.json() if orders_response.status_code == 200 else []
+        if orders_response.status_code != 200:
+            raise RuntimeError(f"Dashboard query failed: {orders_response.status_code} - {orders_response.text}")
+        orders = orders_response.json()
         
         total_sales = sum(o.get('total_amount', 0) for o in orders)
         pending_count = len([o for o in orders if o.get('status') == 'pending'])
@@ -767,6 +4665,9 @@ async def get_dashboard_stats():
             "pending_count": pending_count,
             "currency": "KWD"
         }
+    
+    try:
+        return await tenant_cache.get_or_load("dashboard:today", load, DASHBOARD_CACHE_TTL)
     except Exception as e:
         logger.error(f"Dashboard error: {e}")
         return {"today_orders": 0, "today_sales": 0, "pending_count": 0, "currency": "KWD"}
@@ -777,7 +4678,7 @@ async def admin_get_categories():
     try:
         response = await supabase_request(
             "GET",
-            f"categories?tenant_id=eq.{TENANT_ID}&order=sort_order.asc",
+            f"categories?tenant_id=eq.{current_tenant_id()}&order=sort_order.asc",
             use_service_key=True
         )
         
@@ -797,7 +4698,7 @@ async def admin_create_category(category: Dict[str, Any]):
     """Create a category"""
     try:
         category['id'] = str(uuid.uuid4())
-        category['tenant_id'] = TENANT_ID
+        category['tenant_id'] = current_tenant_id()
         category['name_en'] = category.pop('name', '')
         category['status'] = 'active' if category.pop('is_active', True) else 'inactive'
         category['created_at'] = datetime.now(timezone.utc).isoformat()
@@ -807,6 +4708,8 @@ async def admin_create_category(category: Dict[str, Any]):
         if response.status_code not in [200, 201]:
             raise HTTPException(status_code=500, detail="Failed to create category")
         
+        invalidate_cache("menu:")
+        
         return {"success": True, "category": response.json()[0] if response.json() else category}
     except HTTPException:
         raise
@@ -826,12 +4729,19 @@ async def admin_update_category(category_id: str, category: Dict[str, Any]):
         
         response = await supabase_request(
             "PATCH",
-            f"categories?id=eq.{category_id}&tenant_id=eq.{TENANT_ID}",
+            f"categories?id=eq.{category_id}&tenant_id=eq.{current_tenant_id()}",
             category,
             use_service_key=True
         )
         
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Update category failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to update category")
+        invalidate_cache("menu:")
+        
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Update category error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -840,12 +4750,18 @@ async def admin_update_category(category_id: str, category: Dict[str, Any]):
 async def admin_delete_category(category_id: str):
     """Delete a category"""
     try:
-        await supabase_request(
+        response = await supabase_request(
             "DELETE",
-            f"categories?id=eq.{category_id}&tenant_id=eq.{TENANT_ID}",
+            f"categories?id=eq.{category_id}&tenant_id=eq.{current_tenant_id()}",
             use_service_key=True
         )
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Delete category failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to delete category")
+        invalidate_cache("menu:")
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Delete category error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -856,7 +4772,7 @@ async def admin_get_items():
     try:
         response = await supabase_request(
             "GET",
-            f"items?tenant_id=eq.{TENANT_ID}&order=sort_order.asc",
+            f"items?tenant_id=eq.{current_tenant_id()}&order=sort_order.asc",
             use_service_key=True
         )
         
@@ -877,7 +4793,7 @@ async def admin_create_item(item: Dict[str, Any]):
     """Create an item"""
     try:
         item['id'] = str(uuid.uuid4())
-        item['tenant_id'] = TENANT_ID
+        item['tenant_id'] = current_tenant_id()
         item['name_en'] = item.pop('name', '')
         if 'price' in item:
             item['base_price'] = item.pop('price')
@@ -892,6 +4808,7 @@ async def admin_create_item(item: Dict[str, Any]):
         
         result = response.json()[0] if response.json() else item
         result['price'] = result.get('base_price', 0)
+        invalidate_cache("menu:")
         return {"success": True, "item": result}
     except HTTPException:
         raise
@@ -913,12 +4830,19 @@ async def admin_update_item(item_id: str, item: Dict[str, Any]):
         
         response = await supabase_request(
             "PATCH",
-            f"items?id=eq.{item_id}&tenant_id=eq.{TENANT_ID}",
+            f"items?id=eq.{item_id}&tenant_id=eq.{current_tenant_id()}",
             item,
             use_service_key=True
         )
         
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Update item failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to update item")
+        invalidate_cache("menu:")
+        
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Update item error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -927,16 +4851,385 @@ async def admin_update_item(item_id: str, item: Dict[str, Any]):
 async def admin_delete_item(item_id: str):
     """Delete an item"""
     try:
-        await supabase_request(
+        response = await supabase_request(
             "DELETE",
-            f"items?id=eq.{item_id}&tenant_id=eq.{TENANT_ID}",
+            f"items?id=eq.{item_id}&tenant_id=eq.{current_tenant_id()}",
             use_service_key=True
         )
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Delete item failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to delete item")
+        invalidate_cache("menu:")
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Delete item error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# ==================== BULK MENU ====================
+
+MENU_BULK_CHUNK_SIZE = int(os.environ.get('MENU_BULK_CHUNK_SIZE', '200'))
+MENU_EXPORT_PAGE_SIZE = 1000
+
+# entity -> (table, fields required on create, scoped by tenant_id)
+MENU_ENTITIES = {
+    "categories": ("categories", ["name_en"], True),
+    "items": ("items", ["name_en", "category_id", "base_price"], True),
+    "variants": ("item_variants", ["item_id", "name_en"], False),
+    "modifiers": ("modifiers", ["modifier_group_id", "name_en"], False),
+}
+# entity -> (parent column, parent table); parents belong to a tenant, and
+# variants and modifiers (no tenant_id of their own) are scoped through them
+MENU_PARENTS = {
+    "items": ("category_id", "categories"),
+    "variants": ("item_id", "items"),
+    "modifiers": ("modifier_group_id", "modifier_groups"),
+}
+# csv.DictReader collects values beyond the header under None; the import moves them here
+MENU_EXTRA_VALUES = "_extra_values"
+
+def normalize_menu_row(entity: str, row: Dict[str, Any]) -> Dict[str, Any]:
+    """Map admin UI field names to the Supabase schema (same rules as the single-row endpoints)"""
+    if row.get(MENU_EXTRA_VALUES):
+        raise ValueError("more values than header columns")
+    # The tenant always comes from the session, never from the payload
+    row = {k: v for k, v in row.items()
+           if v != "" and isinstance(k, str) and not k.startswith('_') and k != 'tenant_id'}
+    if 'name' in row:
+        row['name_en'] = row.pop('name')
+    if entity == "items" and 'price' in row:
+        row['base_price'] = row.pop('price')
+    if 'is_active' in row:
+        active = row.pop('is_active')
+        if isinstance(active, str):
+            active = active.strip().lower() in ('1', 'true', 'yes', 'active')
+        row['status'] = 'active' if active else 'inactive'
+    for field in ('base_price', 'price', 'sort_order'):
+        if field in row and isinstance(row[field], str):
+            row[field] = float(row[field]) if field != 'sort_order' else int(row[field])
+    return row
+
+def validate_menu_rows(entity: str, rows: List[Dict[str, Any]], results: List[Dict[str, Any]]) -> tuple:
+    """One pass over the rows: (creates, updates) of normalized rows; invalid rows are reported"""
+    _, required, tenant_scoped = MENU_ENTITIES[entity]
+    creates, updates = [], []
+    now = datetime.now(timezone.utc).isoformat()
+    for idx, raw in enumerate(rows):
+        result = {"entity": entity, "row": idx, "id": raw.get('id'), "action": "update" if raw.get('id') else "create"}
+        results.append(result)
+        try:
+            row = normalize_menu_row(entity, raw)
+        except (TypeError, ValueError) as e:
+            result.update(status="error", error=f"Invalid value: {e}")
+            continue
+        if row.get('id') and not _valid_uuid(row['id']):
+            result.update(status="error", error="Invalid id")
+            continue
+        price = row.get('base_price', row.get('price'))
+        if price is not None and (not isinstance(price, (int, float)) or price < 0):
+            result.update(status="error", error="Price must be a non-negative number")
+            continue
+        if row.get('id'):
+            row['updated_at'] = now
+            updates.append((result, row))
+            continue
+        missing = [f for f in required if row.get(f) in (None, '')]
+        if missing:
+            result.update(status="error", error=f"Missing required fields: {', '.join(missing)}")
+            continue
+        row['id'] = result['id'] = str(uuid.uuid4())
+        row.setdefault('status', 'active')
+        row['created_at'] = now
+        if tenant_scoped:
+            row['tenant_id'] = current_tenant_id()
+        creates.append((result, row))
+    return creates, updates
+
+def _chunks(rows: List[Any], size: int):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+async def _owned_ids(table: str, ids: List[str]) -> set:
+    """The subset of ids whose rows in a tenant-scoped table belong to the current tenant"""
+    owned = set()
+    for chunk in _chunks(sorted({i for i in ids if _valid_uuid(i)}), _IN_FILTER_CHUNK):
+        response = await supabase_request(
+            "GET", f"{table}?id=in.({','.join(chunk)})&tenant_id=eq.{current_tenant_id()}&select=id",
+            use_service_key=True
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"{table} scope query failed: {response.status_code} - {response.text[:200]}")
+        owned.update(row['id'] for row in response.json())
+    return owned
+
+async def _owned_menu_ids(entity: str, ids: List[str]) -> set:
+    """The subset of ids of one menu entity that belong to the current tenant, via the parent if needed"""
+    table, _, tenant_scoped = MENU_ENTITIES[entity]
+    if tenant_scoped:
+        return await _owned_ids(table, ids)
+    parent_column, parent_table = MENU_PARENTS[entity]
+    parents: Dict[str, Any] = {}
+    for chunk in _chunks(sorted({i for i in ids if _valid_uuid(i)}), _IN_FILTER_CHUNK):
+        response = await supabase_request(
+            "GET", f"{table}?id=in.({','.join(chunk)})&select=id,{parent_column}", use_service_key=True
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"{table} scope query failed: {response.status_code} - {response.text[:200]}")
+        parents.update((row['id'], row.get(parent_column)) for row in response.json())
+    owned_parents = await _owned_ids(parent_table, [p for p in parents.values() if isinstance(p, str)])
+    return {row_id for row_id, parent in parents.items() if parent in owned_parents}
+
+async def scope_menu_rows(entity: str, creates: List[tuple], updates: List[tuple]) -> tuple:
+    """Report rows that update another tenant's row or point at another tenant's parent; return the rest"""
+    if updates:
+        owned = await _owned_menu_ids(entity, [row['id'] for _, row in updates])
+        for result, row in updates:
+            if row['id'] not in owned:
+                result.update(status="error", error="Not found")
+    if entity in MENU_PARENTS:
+        parent_column, parent_table = MENU_PARENTS[entity]
+        referencing = [(result, row) for result, row in creates + updates
+                       if "status" not in result and parent_column in row]
+        owned_parents = await _owned_ids(parent_table, [str(row[parent_column]) for _, row in referencing])
+        for result, row in referencing:
+            if row[parent_column] not in owned_parents:
+                result.update(status="error", error=f"Unknown {parent_column}")
+    return ([(r, row) for r, row in creates if "status" not in r],
+            [(r, row) for r, row in updates if "status" not in r])
+
+async def _bulk_insert(table: str, creates: List[tuple]):
+    # PostgREST bulk inserts need identical keys on every row, so group by key set
+    groups: Dict[tuple, List[tuple]] = {}
+    for result, row in creates:
+        groups.setdefault(tuple(sorted(row)), []).append((result, row))
+    for group in groups.values():
+        for chunk in _chunks(group, MENU_BULK_CHUNK_SIZE):
+            response = await supabase_request("POST", table, [row for _, row in chunk], use_service_key=True,
+                                              prefer="return=minimal")
+            ok = response.status_code in [200, 201, 204]
+            for result, _ in chunk:
+                if ok:
+                    result.update(status="ok")
+                else:
+                    result.update(status="error", error=f"Upstream {response.status_code}: {response.text[:200]}")
+
+async def _bulk_patch(entity: str, updates: List[tuple]):
+    """Partial updates in one round trip per chunk via the riwa_bulk_patch RPC.
+
+    Falls back to one PATCH ... id=in.(...) per distinct payload when the
+    function (migrations/002_bulk_menu.sql) is not installed.
+    """
+    table, _, tenant_scoped = MENU_ENTITIES[entity]
+    # Variants and modifiers have no tenant_id; scope_menu_rows already limited
+    # the updates to rows whose parent belongs to the tenant
+    tenant = current_tenant_id() if tenant_scoped else None
+    for chunk in _chunks(updates, MENU_BULK_CHUNK_SIZE):
+        response = await supabase_request("POST", "rpc/riwa_bulk_patch", {
+            "target_table": table, "tenant": tenant, "rows": [row for _, row in chunk]
+        }, use_service_key=True)
+        if response.status_code == 404:
+            await _bulk_patch_grouped(table, tenant, chunk)
+            continue
+        if response.status_code != 200:
+            for result, _ in chunk:
+                result.update(status="error", error=f"Upstream {response.status_code}: {response.text[:200]}")
+            continue
+        updated = {r if isinstance(r, str) else r.get('riwa_bulk_patch') for r in response.json()}
+        for result, row in chunk:
+            if row['id'] in updated:
+                result.update(status="ok")
+            else:
+                result.update(status="error", error="Not found")
+
+async def _bulk_patch_grouped(table: str, tenant: Optional[str], updates: List[tuple]):
+    groups: Dict[str, List[tuple]] = {}
+    for result, row in updates:
+        payload = {k: v for k, v in row.items() if k != 'id'}
+        groups.setdefault(json.dumps(payload, sort_keys=True, default=str), []).append((result, row))
+    for payload, group in groups.items():
+        ids = ",".join(row['id'] for _, row in group)
+        endpoint = f"{table}?id=in.({ids})&select=id"
+        if tenant:
+            endpoint += f"&tenant_id=eq.{tenant}"
+        response = await supabase_request("PATCH", endpoint, json.loads(payload), use_service_key=True)
+        if response.status_code not in [200, 204]:
+            for result, _ in group:
+                result.update(status="error", error=f"Upstream {response.status_code}: {response.text[:200]}")
+            continue
+        updated = {r['id'] for r in response.json()} if response.status_code == 200 else {row['id'] for _, row in group}
+        for result, row in group:
+            if row['id'] in updated:
+                result.update(status="ok")
+            else:
+                result.update(status="error", error="Not found")
+
+async def _bulk_delete(entity: str, ids: List[str], results: List[Dict[str, Any]]):
+    table, _, tenant_scoped = MENU_ENTITIES[entity]
+    pending = []
+    for idx, item_id in enumerate(ids):
+        result = {"entity": entity, "row": idx, "id": item_id, "action": "delete"}
+        results.append(result)
+        if _valid_uuid(item_id):
+            pending.append(result)
+        else:
+            result.update(status="error", error="Invalid id")
+    if not tenant_scoped and pending:
+        owned = await _owned_menu_ids(entity, [r['id'] for r in pending])
+        for result in pending:
+            if result['id'] not in owned:
+                result.update(status="error", error="Not found")
+        pending = [r for r in pending if r['id'] in owned]
+    for chunk in _chunks(pending, MENU_BULK_CHUNK_SIZE):
+        endpoint = f"{table}?id=in.({','.join(r['id'] for r in chunk)})&select=id"
+        if tenant_scoped:
+            endpoint += f"&tenant_id=eq.{current_tenant_id()}"
+        response = await supabase_request("DELETE", endpoint, use_service_key=True)
+        if response.status_code not in [200, 204]:
+            for result in chunk:
+                result.update(status="error", error=f"Upstream {response.status_code}: {response.text[:200]}")
+            continue
+        deleted = {r['id'] for r in response.json()} if response.status_code == 200 else {r['id'] for r in chunk}
+        for result in chunk:
+            if result['id'] in deleted:
+                result.update(status="ok")
+            else:
+                result.update(status="error", error="Not found")
+
+async def apply_menu_bulk(request: MenuBulkRequest, atomic: bool = False) -> Dict[str, Any]:
+    """Validate and scope everything first, then apply chunked upserts and deletes; invalidate the menu cache once.
+
+    atomic only covers validation and tenant scoping: if any row is rejected
+    nothing is written. Upstream failures while applying are reported per row
+    and are not rolled back (PostgREST has no multi-request transaction).
+    """
+    results: List[Dict[str, Any]] = []
+    planned = {}
+    for entity in MENU_ENTITIES:
+        creates, updates = validate_menu_rows(entity, getattr(request, entity), results)
+        planned[entity] = await scope_menu_rows(entity, creates, updates)
+    invalid = [r for r in results if r.get("status") == "error"]
+    if atomic and invalid:
+        return {"success": False, "applied": False, "summary": _bulk_summary(results), "results": results}
+
+    # Parents before children on create, children before parents on delete
+    for entity in MENU_ENTITIES:
+        creates, updates = planned[entity]
+        if creates:
+            await _bulk_insert(MENU_ENTITIES[entity][0], creates)
+        if updates:
+            await _bulk_patch(entity, updates)
+    for entity in reversed(list(MENU_ENTITIES)):
+        if request.delete.get(entity):
+            await _bulk_delete(entity, request.delete[entity], results)
+
+    invalidate_cache("menu:")
+    summary = _bulk_summary(results)
+    return {"success": summary["failed"] == 0, "applied": True, "summary": summary, "results": results}
+
+def _bulk_summary(results: List[Dict[str, Any]]) -> Dict[str, int]:
+    failed = sum(1 for r in results if r.get("status") == "error")
+    return {"total": len(results), "succeeded": sum(1 for r in results if r.get("status") == "ok"), "failed": failed}
+
+@api_router.post("/admin/menu/bulk")
+async def admin_menu_bulk(request: MenuBulkRequest, atomic: bool = False):
+    """Create, update and delete categories, items, variants and modifiers in bulk.
+
+    With atomic=true nothing is written unless every row validates; see apply_menu_bulk.
+    """
+    try:
+        return await apply_menu_bulk(request, atomic)
+    except Exception as e:
+        logger.error(f"Menu bulk error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/admin/menu/import")
+async def admin_menu_import(request: Request, entity: str = "items", atomic: bool = False):
+    """Import a CSV of one entity; rows with an id update, rows without create, _action=delete deletes"""
+    if entity not in MENU_ENTITIES:
+        raise HTTPException(status_code=400, detail=f"Unknown entity: {entity}")
+    try:
+        # Spool the upload (in memory up to 1 MB, then to disk) and parse it in a single pass
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode='w+b') as spool:
+            async for chunk in request.stream():
+                spool.write(chunk)
+            spool.seek(0)
+            reader = csv.DictReader(io.TextIOWrapper(spool, encoding='utf-8-sig', newline=''))
+            rows, deletes = [], []
+            for row in reader:
+                if None in row:
+                    row[MENU_EXTRA_VALUES] = row.pop(None)
+                if (row.pop('_action', '') or '').strip().lower() == 'delete':
+                    deletes.append((row.get('id') or '').strip())
+                else:
+                    rows.append(row)
+        bulk = MenuBulkRequest(**{entity: rows, "delete": {entity: deletes}})
+        return await apply_menu_bulk(bulk, atomic)
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid CSV: {e}")
+    except Exception as e:
+        logger.error(f"Menu import error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/admin/menu/export")
+async def admin_menu_export(entity: str = "items", format: str = "csv"):
+    """Stream all rows of one menu entity as CSV or JSON lines, paging through Supabase"""
+    if entity not in MENU_ENTITIES:
+        raise HTTPException(status_code=400, detail=f"Unknown entity: {entity}")
+    table, _, tenant_scoped = MENU_ENTITIES[entity]
+    tenant = current_tenant_id()
+
+    async def paged(base: str):
+        offset = 0
+        while True:
+            response = await supabase_request("GET", f"{base}&offset={offset}", use_service_key=True)
+            if response.status_code != 200:
+                raise RuntimeError(f"Export query failed: {response.status_code} - {response.text}")
+            rows = response.json()
+            if rows:
+                yield rows
+            if len(rows) < MENU_EXPORT_PAGE_SIZE:
+                return
+            offset += MENU_EXPORT_PAGE_SIZE
+
+    async def pages():
+        if tenant_scoped:
+            async for rows in paged(f"{table}?tenant_id=eq.{tenant}&order=id.asc&limit={MENU_EXPORT_PAGE_SIZE}"):
+                yield rows
+            return
+        # No tenant_id on variants/modifiers: export the children of the tenant's parents
+        parent_column, parent_table = MENU_PARENTS[entity]
+        parent_ids = []
+        async for rows in paged(f"{parent_table}?tenant_id=eq.{tenant}&select=id&order=id.asc"
+                                f"&limit={MENU_EXPORT_PAGE_SIZE}"):
+            parent_ids.extend(row['id'] for row in rows)
+        for chunk in _chunks(parent_ids, _IN_FILTER_CHUNK):
+            async for rows in paged(f"{table}?{parent_column}=in.({','.join(chunk)})&order=id.asc"
+                                    f"&limit={MENU_EXPORT_PAGE_SIZE}"):
+                yield rows
+
+    async def as_csv():
+        columns = None
+        async for rows in pages():
+            out = io.StringIO()
+            if columns is None:
+                columns = sorted({key for row in rows for key in row})
+                csv.DictWriter(out, fieldnames=columns).writeheader()
+            writer = csv.DictWriter(out, fieldnames=columns, extrasaction='ignore')
+            for row in rows:
+                writer.writerow({k: json.dumps(v) if isinstance(v, (list, dict)) else v for k, v in row.items()})
+            yield out.getvalue()
+
+    async def as_jsonl():
+        async for rows in pages():
+            yield "".join(json.dumps(row) + "\n" for row in rows)
+
+    if format == "json":
+        return StreamingResponse(as_jsonl(), media_type="application/x-ndjson")
+    return StreamingResponse(as_csv(), media_type="text/csv", headers={
+        "Content-Disposition": f'attachment; filename="{entity}.csv"'
+    })
+
 # ==================== DELIVERY ZONES ====================
 
 @api_router.get("/admin/delivery-zones")
@@ -945,7 +5238,7 @@ async def get_delivery_zones():
     try:
         response = await supabase_request(
             "GET",
-            f"delivery_zones?tenant_id=eq.{TENANT_ID}&order=zone_name.asc",
+            f"delivery_zones?tenant_id=eq.{current_tenant_id()}&order=zone_name.asc",
             use_service_key=True
         )
         return {"zones": response.json() if response.status_code == 200 else []}
@@ -958,8 +5251,8 @@ async def create_delivery_zone(zone: Dict[str, Any]):
     """Create a delivery zone"""
     try:
         zone['id'] = str(uuid.uuid4())
-        zone['tenant_id'] = TENANT_ID
-        zone['branch_id'] = BRANCH_ID
+        zone['tenant_id'] = current_tenant_id()
+        zone['branch_id'] = current_branch_id()
         zone['created_at'] = datetime.now(timezone.utc).isoformat()
         
         response = await supabase_request("POST", "delivery_zones", zone, use_service_key=True)
@@ -967,6 +5260,7 @@ async def create_delivery_zone(zone: Dict[str, Any]):
         if response.status_code not in [200, 201]:
             raise HTTPException(status_code=500, detail="Failed to create zone")
         
+        invalidate_cache("zones:")
         return {"success": True, "zone": response.json()[0] if response.json() else zone}
     except HTTPException:
         raise
@@ -980,14 +5274,20 @@ async def update_delivery_zone(zone_id: str, zone: Dict[str, Any]):
     try:
         zone['updated_at'] = datetime.now(timezone.utc).isoformat()
         
-        await supabase_request(
+        response = await supabase_request(
             "PATCH",
-            f"delivery_zones?id=eq.{zone_id}&tenant_id=eq.{TENANT_ID}",
+            f"delivery_zones?id=eq.{zone_id}&tenant_id=eq.{current_tenant_id()}",
             zone,
             use_service_key=True
         )
         
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Update zone failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to update zone")
+        invalidate_cache("zones:")
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Update zone error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -996,12 +5296,18 @@ async def update_delivery_zone(zone_id: str, zone: Dict[str, Any]):
 async def delete_delivery_zone(zone_id: str):
     """Delete a delivery zone"""
     try:
-        await supabase_request(
+        response = await supabase_request(
             "DELETE",
-            f"delivery_zones?id=eq.{zone_id}&tenant_id=eq.{TENANT_ID}",
+            f"delivery_zones?id=eq.{zone_id}&tenant_id=eq.{current_tenant_id()}",
             use_service_key=True
         )
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Delete zone failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to delete zone")
+        invalidate_cache("zones:")
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Delete zone error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1014,7 +5320,7 @@ async def get_coupons():
     try:
         response = await supabase_request(
             "GET",
-            f"coupons?tenant_id=eq.{TENANT_ID}&order=created_at.desc",
+            f"coupons?tenant_id=eq.{current_tenant_id()}&order=created_at.desc",
             use_service_key=True
         )
         return {"coupons": response.json() if response.status_code == 200 else []}
@@ -1027,7 +5333,7 @@ async def create_coupon(coupon: Dict[str, Any]):
     """Create a coupon"""
     try:
         coupon['id'] = str(uuid.uuid4())
-        coupon['tenant_id'] = TENANT_ID
+        coupon['tenant_id'] = current_tenant_id()
         coupon['created_at'] = datetime.now(timezone.utc).isoformat()
         
         response = await supabase_request("POST", "coupons", coupon, use_service_key=True)
@@ -1035,6 +5341,7 @@ async def create_coupon(coupon: Dict[str, Any]):
         if response.status_code not in [200, 201]:
             raise HTTPException(status_code=500, detail="Failed to create coupon")
         
+        invalidate_cache("coupons:")
         return {"success": True, "coupon": response.json()[0] if response.json() else coupon}
     except HTTPException:
         raise
@@ -1046,12 +5353,18 @@ async def create_coupon(coupon: Dict[str, Any]):
 async def delete_coupon(coupon_id: str):
     """Delete a coupon"""
     try:
-        await supabase_request(
+        response = await supabase_request(
             "DELETE",
-            f"coupons?id=eq.{coupon_id}&tenant_id=eq.{TENANT_ID}",
+            f"coupons?id=eq.{coupon_id}&tenant_id=eq.{current_tenant_id()}",
             use_service_key=True
         )
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Delete coupon failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to delete coupon")
+        invalidate_cache("coupons:")
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Delete coupon error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1064,7 +5377,7 @@ async def get_loyalty_settings():
     try:
         response = await supabase_request(
             "GET",
-            f"loyalty_settings?tenant_id=eq.{TENANT_ID}",
+            f"loyalty_settings?tenant_id=eq.{current_tenant_id()}",
             use_service_key=True
         )
         settings = response.json() if response.status_code == 200 else []
@@ -1077,28 +5390,34 @@ async def get_loyalty_settings():
 async def save_loyalty_settings(settings: Dict[str, Any]):
     """Save loyalty settings"""
     try:
-        settings['tenant_id'] = TENANT_ID
+        settings['tenant_id'] = current_tenant_id()
         settings['updated_at'] = datetime.now(timezone.utc).isoformat()
         
         existing = await supabase_request(
             "GET",
-            f"loyalty_settings?tenant_id=eq.{TENANT_ID}",
+            f"loyalty_settings?tenant_id=eq.{current_tenant_id()}",
             use_service_key=True
         )
         
         if existing.status_code == 200 and existing.json():
-            await supabase_request(
+            response = await supabase_request(
                 "PATCH",
-                f"loyalty_settings?tenant_id=eq.{TENANT_ID}",
+                f"loyalty_settings?tenant_id=eq.{current_tenant_id()}",
                 settings,
                 use_service_key=True
             )
         else:
             settings['id'] = str(uuid.uuid4())
             settings['created_at'] = datetime.now(timezone.utc).isoformat()
-            await supabase_request("POST", "loyalty_settings", settings, use_service_key=True)
+            response = await supabase_request("POST", "loyalty_settings", settings, use_service_key=True)
         
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Save loyalty settings failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to save loyalty settings")
+        invalidate_cache("loyalty:program")
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Save loyalty settings error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1109,7 +5428,7 @@ async def get_loyalty_rules():
     try:
         response = await supabase_request(
             "GET",
-            f"loyalty_rules?tenant_id=eq.{TENANT_ID}&order=created_at.asc",
+            f"loyalty_rules?tenant_id=eq.{current_tenant_id()}&order=created_at.asc",
             use_service_key=True
         )
         return {"rules": response.json() if response.status_code == 200 else []}
@@ -1120,31 +5439,49 @@ async def get_loyalty_rules():
 @api_router.post("/admin/loyalty-rules")
 async def create_loyalty_rule(rule: Dict[str, Any]):
     """Create a loyalty rule"""
+    error = validate_loyalty_rule(rule)
+    if error:
+        raise HTTPException(status_code=422, detail=error)
     try:
         rule['id'] = str(uuid.uuid4())
-        rule['tenant_id'] = TENANT_ID
+        rule['tenant_id'] = current_tenant_id()
         rule['created_at'] = datetime.now(timezone.utc).isoformat()
         
         response = await supabase_request("POST", "loyalty_rules", rule, use_service_key=True)
         
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Create loyalty rule failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to create loyalty rule")
+        invalidate_cache("loyalty:program")
         return {"success": True, "rule": response.json()[0] if response.json() else rule}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Create loyalty rule error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # ==================== SYSTEM SETTINGS ====================
 
-@api_router.get("/admin/settings")
-async def get_system_settings():
-    """Get system settings"""
-    try:
+async def load_system_settings() -> Optional[Dict[str, Any]]:
+    """System settings row for the current branch (cached)"""
+    async def load():
         response = await supabase_request(
             "GET",
-            f"system_settings?tenant_id=eq.{TENANT_ID}&branch_id=eq.{BRANCH_ID}",
+            f"system_settings?tenant_id=eq.{current_tenant_id()}&branch_id=eq.{current_branch_id()}",
             use_service_key=True
         )
-        settings = response.json() if response.status_code == 200 else []
-        return {"settings": settings[0] if settings else None}
+        if response.status_code != 200:
+            raise RuntimeError(f"Settings query failed: {response.status_code} - {response.text}")
+        settings = response.json()
+        return settings[0] if settings else None
+    
+    return await tenant_cache.get_or_load("settings:system", load, SETTINGS_CACHE_TTL)
+
+@api_router.get("/admin/settings")
+async def get_system_settings():
+    """Get system settings"""
+    try:
+        return {"settings": await load_system_settings()}
     except Exception as e:
         logger.error(f"Get settings error: {e}")
         return {"settings": None}
@@ -1153,29 +5490,36 @@ async def get_system_settings():
 async def save_system_settings(settings: Dict[str, Any]):
     """Save system settings"""
     try:
-        settings['tenant_id'] = TENANT_ID
-        settings['branch_id'] = BRANCH_ID
+        settings['tenant_id'] = current_tenant_id()
+        settings['branch_id'] = current_branch_id()
         settings['updated_at'] = datetime.now(timezone.utc).isoformat()
         
         existing = await supabase_request(
             "GET",
-            f"system_settings?tenant_id=eq.{TENANT_ID}&branch_id=eq.{BRANCH_ID}",
+            f"system_settings?tenant_id=eq.{current_tenant_id()}&branch_id=eq.{current_branch_id()}",
             use_service_key=True
         )
         
         if existing.status_code == 200 and existing.json():
-            await supabase_request(
+            response = await supabase_request(
                 "PATCH",
-                f"system_settings?tenant_id=eq.{TENANT_ID}&branch_id=eq.{BRANCH_ID}",
+                f"system_settings?tenant_id=eq.{current_tenant_id()}&branch_id=eq.{current_branch_id()}",
                 settings,
                 use_service_key=True
             )
         else:
             settings['id'] = str(uuid.uuid4())
             settings['created_at'] = datetime.now(timezone.utc).isoformat()
-            await supabase_request("POST", "system_settings", settings, use_service_key=True)
+            response = await supabase_request("POST", "system_settings", settings, use_service_key=True)
+        
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Save settings failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to save settings")
+        invalidate_cache("settings:")
         
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Save settings error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1186,7 +5530,7 @@ async def save_api_key(request: Dict[str, Any]):
     try:
         key_data = {
             "id": str(uuid.uuid4()),
-            "tenant_id": TENANT_ID,
+            "tenant_id": current_tenant_id(),
             "provider": request.get('provider'),
             "api_key": request.get('api_key'),
             "api_secret": request.get('api_secret'),
@@ -1196,7 +5540,7 @@ async def save_api_key(request: Dict[str, Any]):
         
         await supabase_request(
             "DELETE",
-            f"payment_providers?tenant_id=eq.{TENANT_ID}&provider=eq.{request.get('provider')}",
+            f"payment_providers?tenant_id=eq.{current_tenant_id()}&provider=eq.{request.get('provider')}",
             use_service_key=True
         )
         
@@ -1224,13 +5568,18 @@ async def test_api_key(request: Dict[str, Any]):
 @api_router.get("/admin/printers")
 async def get_printers():
     """Get printer configurations"""
-    try:
+    async def load():
         response = await supabase_request(
             "GET",
-            f"printers?tenant_id=eq.{TENANT_ID}&branch_id=eq.{BRANCH_ID}",
+            f"printers?tenant_id=eq.{current_tenant_id()}&branch_id=eq.{current_branch_id()}",
             use_service_key=True
         )
-        return {"printers": response.json() if response.status_code == 200 else []}
+        if response.status_code != 200:
+            raise RuntimeError(f"Printers query failed: {response.status_code} - {response.text}")
+        return {"printers": response.json()}
+    
+    try:
+        return await tenant_cache.get_or_load("printers:admin", load, PRINTER_CACHE_TTL)
     except Exception as e:
         logger.error(f"Get printers error: {e}")
         return {"printers": []}
@@ -1239,23 +5588,30 @@ async def get_printers():
 async def save_printer(printer: Dict[str, Any]):
     """Save printer configuration"""
     try:
-        printer['tenant_id'] = TENANT_ID
-        printer['branch_id'] = BRANCH_ID
+        printer['tenant_id'] = current_tenant_id()
+        printer['branch_id'] = current_branch_id()
         printer['updated_at'] = datetime.now(timezone.utc).isoformat()
         
         if printer.get('id'):
-            await supabase_request(
+            response = await supabase_request(
                 "PATCH",
-                f"printers?id=eq.{printer['id']}&tenant_id=eq.{TENANT_ID}",
+                f"printers?id=eq.{printer['id']}&tenant_id=eq.{current_tenant_id()}",
                 printer,
                 use_service_key=True
             )
         else:
             printer['id'] = str(uuid.uuid4())
             printer['created_at'] = datetime.now(timezone.utc).isoformat()
-            await supabase_request("POST", "printers", printer, use_service_key=True)
+            response = await supabase_request("POST", "printers", printer, use_service_key=True)
+        
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Save printer failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to save printer")
+        invalidate_cache("printers:")
         
         return {"success": True, "printer": printer}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Save printer error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1264,64 +5620,525 @@ async def save_printer(printer: Dict[str, Any]):
 async def delete_printer(printer_id: str):
     """Delete a printer"""
     try:
-        await supabase_request(
+        response = await supabase_request(
             "DELETE",
-            f"printers?id=eq.{printer_id}&tenant_id=eq.{TENANT_ID}",
+            f"printers?id=eq.{printer_id}&tenant_id=eq.{current_tenant_id()}",
             use_service_key=True
         )
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Delete printer failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to delete printer")
+        invalidate_cache("printers:")
         return {"success": True}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Delete printer error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== REPORTS ====================
+
+@api_router.get("/admin/reports/orders")
+async def get_orders_report(start_date: Optional[str] = None, end_date: Optional[str] = None):
+    """Get orders report"""
+    try:
+        endpoint = f"orders?tenant_id=eq.{current_tenant_id()}&branch_id=eq.{current_branch_id()}&order=created_at.desc"
+        if start_date:
+            endpoint += f"&created_at=gte.{start_date}T00:00:00"
+        if end_date:
+            endpoint += f"&created_at=lte.{end_date}T23:59:59"
+        
+        response = await supabase_request("GET", endpoint, use_service_key=True)
+        orders = response.json() if response.status_code == 200 else []
+        
+        # Normalize and calculate summary
+        for order in orders:
+            order['total'] = order.get('total_amount', 0)
+        
+        total_sales = sum(o.get('total_amount', 0) for o in orders)
+        total_orders = len(orders)
+        avg_order = total_sales / total_orders if total_orders > 0 else 0
+        
+        return {
+            "orders": orders,
+            "summary": {
+                "total_orders": total_orders,
+                "total_sales": total_sales,
+                "average_order": avg_order
+            }
+        }
+    except Exception as e:
+        logger.error(f"Orders report error: {e}")
+        return {"orders": [], "summary": {}}
+
+@api_router.get("/admin/audit-logs")
+async def get_audit_logs(limit: int = 100):
+    """Get audit logs"""
+    try:
+        response = await supabase_request(
+            "GET",
+            f"audit_logs?tenant_id=eq.{current_tenant_id()}&order=created_at.desc&limit={limit}",
+            use_service_key=True
+        )
+        return {"logs": response.json() if response.status_code == 200 else []}
+    except Exception as e:
+        logger.error(f"Audit logs error: {e}")
+        return {"logs": []}
+
+# ==================== SHIFTS ====================
+
+# One open shift per branch. Its Z-report totals are kept in memory and moved
+# by order.created / order.status events, so the live X-report and the close
+# never re-read the shift's orders. A worker that starts mid-shift rebuilds
+# the totals once from the orders placed since opened_at. Like the KDS board
+# the running totals are per worker: the live X-report (/shifts/current,
+# /shifts/{id}) counts the orders this worker restored or saw created since,
+# so with several workers it can trail the branch's real sales. Closing
+# recomputes the Z-report from the shift's orders (plus any still in the
+# journal) and freezes that into shifts.report. A worker re-reads whether its
+# cached shift is still open every SHIFT_RECHECK_SECONDS, since another
+# worker may have closed it; opening and closing always re-read it.
+SHIFT_RECHECK_SECONDS = float(os.environ.get('SHIFT_RECHECK_SECONDS', '10'))
+SHIFT_BREAKDOWNS = ("payment_method", "channel", "cashier", "order_type")
+SHIFT_CASH_METHODS = ("cash",)
+SHIFT_ORDER_COLUMNS = "id,order_type,channel,payment_method,user_id,status,subtotal,discount_amount,delivery_fee,total_amount"
+SHIFT_LIST_COLUMNS = ("id,branch_id,status,opened_by,closed_by,opened_at,closed_at,"
+                      "opening_float,expected_cash,counted_cash,cash_variance,total_sales")
+
+metrics.describe("riwa_shift_orders_total", "counter", "Orders counted into an open shift, by payment method")
+metrics.describe("riwa_shifts_closed_total", "counter", "Shifts closed")
+
+def _money(value: Any) -> float:
+    return round(float(value or 0), 3)
+
+class ShiftTotals:
+    """Running Z-report totals for one open shift"""
+
+    def __init__(self, shift: Dict[str, Any]):
+        self.shift = shift
+        self.restored = False
+        self.checked_at = time.monotonic()  # when the shift was last seen open in the database
+        self.orders: Dict[str, tuple] = {}  # order_id -> (breakdown keys, amounts), to reverse on cancel
+        self.cancelled: set = set()
+        self.cashier_names: Dict[str, str] = {}
+        self.sales = {"orders": 0, "subtotal": 0.0, "discounts": 0.0, "delivery_fees": 0.0, "total": 0.0}
+        self.voids = {"orders": 0, "total": 0.0}
+        self.breakdowns: Dict[str, Dict[str, Dict[str, Any]]] = {name: {} for name in SHIFT_BREAKDOWNS}
+
+    def add(self, order: Dict[str, Any]) -> bool:
+        if order['id'] in self.orders:
+            return False
+        keys = {
+            "payment_method": (order.get('payment_method') or 'unknown').lower(),
+            "channel": order.get('channel') or 'pos',
+            "cashier": order.get('user_id') or 'unknown',
+            "order_type": order.get('order_type') or 'unknown',
+        }
+        amounts = {
+            "subtotal": float(order.get('subtotal') or 0),
+            "discounts": float(order.get('discount_amount') or 0),
+            "delivery_fees": float(order.get('delivery_fee') or 0),
+            "total": float(order.get('total_amount') or 0),
+        }
+        self.orders[order['id']] = (keys, amounts)
+        self._apply(keys, amounts, 1)
+        if order.get('status') == 'cancelled':
+            self.cancel(order['id'])
+        return True
+
+    def cancel(self, order_id: str) -> bool:
+        """Move a cancelled order from sales to voids"""
+        entry = self.orders.get(order_id)
+        if entry is None or order_id in self.cancelled:
+            return False
+        self.cancelled.add(order_id)
+        keys, amounts = entry
+        self._apply(keys, amounts, -1)
+        self.voids["orders"] += 1
+        self.voids["total"] += amounts["total"]
+        return True
+
+    def _apply(self, keys: Dict[str, str], amounts: Dict[str, float], sign: int):
+        self.sales["orders"] += sign
+        for field, amount in amounts.items():
+            self.sales[field] += sign * amount
+        for name, key in keys.items():
+            bucket = self.breakdowns[name].setdefault(key, {"orders": 0, "total": 0.0})
+            bucket["orders"] += sign
+            bucket["total"] += sign * amounts["total"]
+
+    def report(self) -> Dict[str, Any]:
+        """The shift's X-report (or Z-report once frozen at close)"""
+        opening_float = float(self.shift.get('opening_float') or 0)
+        cash_sales = sum(self.breakdowns["payment_method"].get(method, {}).get("total", 0.0)
+                         for method in SHIFT_CASH_METHODS)
+        report = {
+            "shift_id": self.shift['id'],
+            "branch_id": self.shift.get('branch_id'),
+            "opened_at": self.shift.get('opened_at'),
+            "generated_at": datetime.now(timezone.utc).isoformat(),
+            "sales": {field: value if field == "orders" else _money(value) for field, value in self.sales.items()},
+            "voids": {"orders": self.voids["orders"], "total": _money(self.voids["total"])},
+            "cash": {
+                "opening_float": _money(opening_float),
+                "cash_sales": _money(cash_sales),
+                "expected": _money(opening_float + cash_sales),
+            },
+        }
+        for name, buckets in self.breakdowns.items():
+            rows = [{"key": key, "orders": bucket["orders"], "total": _money(bucket["total"])}
+                    for key, bucket in buckets.items() if bucket["orders"]]
+            if name == "cashier":
+                for row in rows:
+                    row["name"] = self.cashier_names.get(row["key"])
+            report[f"by_{name}"] = sorted(rows, key=lambda row: -row["total"])
+        return report
+
+_open_shifts: Dict[tuple, ShiftTotals] = {}  # (tenant_id, branch_id) -> totals
+_shift_lock = asyncio.Lock()
+
+def shift_actor(authorization: Optional[str]) -> tuple:
+    """(user_id, branch_id) from the session token, as create_order reads them"""
+    if authorization:
+        try:
+            payload = jwt.decode(authorization.replace("Bearer ", ""), JWT_SECRET, algorithms=["HS256"])
+            return payload.get('user_id'), payload.get('branch_id', current_branch_id())
+        except JWTError:
+            pass
+    return None, current_branch_id()
+
+async def load_shift_orders(shift: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Every order placed since the shift opened: one orders query plus those still in the journal"""
+    response = await supabase_request(
+        "GET",
+        f"orders?tenant_id=eq.{shift['tenant_id']}&branch_id=eq.{shift['branch_id']}"
+        f"&created_at=gte.{quote(shift['opened_at'])}&select={SHIFT_ORDER_COLUMNS}",
+        use_service_key=True
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"Shift orders query failed: {response.status_code} - {response.text[:200]}")
+    orders = response.json() or []
+    if order_journal is not None:
+        for order_id in order_journal.pending_order_ids():
+            order = order_journal.get_order(order_id)
+            if (order and order.get('tenant_id') == shift['tenant_id'] and order.get('branch_id') == shift['branch_id']
+                    and str(order.get('created_at', '')) >= shift['opened_at']):
+                orders.append(order)
+    return orders
+
+async def restore_shift(shift: Dict[str, Any]) -> ShiftTotals:
+    """Register totals for an open shift, then fold in the orders it already has"""
+    key = (shift['tenant_id'], shift['branch_id'])
+    async with _shift_lock:
+        totals = _open_shifts.get(key)
+        if totals is not None and totals.shift['id'] == shift['id'] and totals.restored:
+            return totals
+        # Registered before the query so orders created meanwhile are counted (add() ignores repeats)
+        totals = _open_shifts[key] = ShiftTotals(shift)
+        try:
+            orders = await load_shift_orders(shift)
+        except Exception:
+            _open_shifts.pop(key, None)
+            raise
+        for order in orders:
+            totals.add(order)
+        totals.restored = True
+        return totals
+
+async def get_open_shift(tenant_id: str, branch_id: str,
+                         max_age: float = SHIFT_RECHECK_SECONDS) -> Optional[ShiftTotals]:
+    """The branch's open shift, trusting this worker's copy for max_age seconds"""
+    key = (tenant_id, branch_id)
+    totals = _open_shifts.get(key)
+    if totals is not None and totals.restored and time.monotonic() - totals.checked_at < max_age:
+        return totals
+    response = await supabase_request(
+        "GET", f"shifts?tenant_id=eq.{tenant_id}&branch_id=eq.{branch_id}&status=eq.open&limit=1",
+        use_service_key=True
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=500, detail="Failed to load shift")
+    rows = response.json()
+    if not rows:
+        # Closed through another worker
+        if totals is not None and _open_shifts.get(key) is totals:
+            _open_shifts.pop(key)
+        return None
+    totals = await restore_shift(rows[0])
+    totals.checked_at = time.monotonic()
+    return totals
+
+async def restore_open_shifts():
+    """Warm-up step: rebuild totals for every open shift so no order is missed"""
+    response = await supabase_request("GET", "shifts?status=eq.open", use_service_key=True)
+    if response.status_code != 200:
+        raise RuntimeError(f"Open shifts query failed: {response.status_code}")
+    for shift in response.json():
+        await restore_shift(shift)
+
+async def load_cashier_names(totals: ShiftTotals):
+    """Fill in names for cashiers not seen before (one users query)"""
+    missing = [key for key in totals.breakdowns["cashier"] if key != 'unknown' and key not in totals.cashier_names]
+    if not missing:
+        return
+    response = await supabase_request(
+        "GET", f"users?tenant_id=eq.{totals.shift['tenant_id']}&id=in.({','.join(missing)})&select=id,name",
+        use_service_key=True
+    )
+    if response.status_code == 200:
+        totals.cashier_names.update({user['id']: user.get('name') for user in response.json()})
+
+def shift_on_order_created(event: Dict[str, Any]):
+    totals = _open_shifts.get((event['tenant_id'], event['branch_id']))
+    if totals is not None and totals.add(event['order']):
+        metrics.inc("riwa_shift_orders_total", payment_method=(event['order'].get('payment_method') or 'unknown').lower())
+
+def shift_on_order_status(event: Dict[str, Any]):
+    if event['status'] != 'cancelled':
+        return
+    for (tenant_id, _), totals in _open_shifts.items():
+        if tenant_id == event['tenant_id'] and totals.cancel(event['order_id']):
+            break
+
+subscribe("order.created", shift_on_order_created)
+subscribe("order.status", shift_on_order_status)
+
+def _escpos_row(label: str, value: Any) -> bytes:
+    """One 32-column line: label left, value right"""
+    value = f"{value:.3f}" if isinstance(value, float) else str(value)
+    return f"{label[:31 - len(value)]:<{32 - len(value)}}{value}\n".encode('utf-8')
+
+def generate_escpos_shift_report(shift: Dict[str, Any], report: Dict[str, Any]) -> bytes:
+    """Compact ESC/POS X/Z-report for a 58mm cashier printer"""
+    data = b'\x1B\x40'  # Initialize
+    data += b'\x1B\x61\x01'  # Center align
+    data += b'\x1B\x21\x30'  # Double height/width
+    data += b'Z REPORT\n' if shift.get('status') == 'closed' else b'X REPORT\n'
+    data += b'\x1B\x21\x00'  # Normal size
+    data += f"Shift {shift['id'][:8]}\n".encode('utf-8')
+    data += b'\x1B\x61\x00'  # Left align
+    for label, field in (("Opened", 'opened_at'), ("Closed", 'closed_at')):
+        if shift.get(field):
+            stamp = datetime.fromisoformat(str(shift[field]).replace('Z', '+00:00'))
+            data += _escpos_row(label, stamp.strftime("%d %b %Y %I:%M %p"))
+    data += b'--------------------------------\n'
+
+    sales = report["sales"]
+    data += _escpos_row("Orders", sales["orders"])
+    data += _escpos_row("Subtotal", sales["subtotal"])
+    data += _escpos_row("Discounts", sales["discounts"])
+    data += _escpos_row("Delivery fees", sales["delivery_fees"])
+    data += b'\x1B\x21\x10'  # Double height
+    data += _escpos_row("Net sales", sales["total"])
+    data += b'\x1B\x21\x00'  # Normal
+    data += _escpos_row(f"Voids ({report['voids']['orders']})", report["voids"]["total"])
+
+    for title, name in (("Payment", "payment_method"), ("Channel", "channel"),
+                        ("Order type", "order_type"), ("Cashier", "cashier")):
+        data += f"-- {title} --\n".encode('utf-8')
+        for row in report[f"by_{name}"]:
+            label = row.get("name") or row["key"]
+            data += _escpos_row(f"{label[:16]} ({row['orders']})", row["total"])
+
+    cash = report["cash"]
+    data += b'--------------------------------\n'
+    data += _escpos_row("Opening float", cash["opening_float"])
+    data += _escpos_row("Cash sales", cash["cash_sales"])
+    data += _escpos_row("Expected cash", cash["expected"])
+    if "counted" in cash:
+        data += _escpos_row("Counted cash", cash["counted"])
+        data += b'\x1B\x21\x10'  # Double height
+        data += _escpos_row("Variance", f"{cash['variance']:+.3f}")
+        data += b'\x1B\x21\x00'  # Normal
+    data += b'\n\n\n'
+    data += b'\x1D\x56\x00'  # GS V 0 - Full cut
+    return data
+
+@api_router.post("/shifts/open")
+async def open_shift(request: ShiftOpenRequest, authorization: str = Header(None)):
+    """Open a shift for the branch with the cash float in the drawer"""
+    try:
+        user_id, branch_id = shift_actor(authorization)
+        if await get_open_shift(current_tenant_id(), branch_id, max_age=0):
+            raise HTTPException(status_code=409, detail="A shift is already open for this branch")
+
+        now = datetime.now(timezone.utc).isoformat()
+        shift = {
+            "id": str(uuid.uuid4()),
+            "tenant_id": current_tenant_id(),
+            "branch_id": branch_id,
+            "status": "open",
+            "opened_by": user_id,
+            "opened_at": now,
+            "opening_float": _money(request.opening_float),
+            "notes": request.notes,
+            "created_at": now,
+            "updated_at": now
+        }
+        # Registered first so orders rung up during the insert are counted
+        key = (shift['tenant_id'], branch_id)
+        totals = _open_shifts[key] = ShiftTotals(shift)
+        totals.restored = True
+        response = await supabase_request("POST", "shifts", shift, use_service_key=True, prefer="return=minimal")
+        if response.status_code not in [200, 201, 204] and _open_shifts.get(key) is totals:
+            _open_shifts.pop(key)
+        if response.status_code == 409:
+            # The one-open-shift-per-branch index: another terminal got there first
+            raise HTTPException(status_code=409, detail="A shift is already open for this branch")
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Open shift failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to open shift")
+
+        return {"success": True, "shift": shift}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Open shift error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/shifts/current")
+async def get_current_shift(authorization: str = Header(None)):
+    """The branch's open shift with its live X-report (this worker's running totals)"""
+    try:
+        _, branch_id = shift_actor(authorization)
+        totals = await get_open_shift(current_tenant_id(), branch_id)
+        if totals is None:
+            return {"shift": None, "report": None}
+        await load_cashier_names(totals)
+        return {"shift": totals.shift, "report": totals.report()}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Current shift error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/shifts/close")
+async def close_shift(request: ShiftCloseRequest, authorization: str = Header(None)):
+    """Close the branch's shift: freeze its Z-report with counted vs expected cash"""
+    try:
+        user_id, branch_id = shift_actor(authorization)
+        key = (current_tenant_id(), branch_id)
+        totals = await get_open_shift(*key, max_age=0)
+        if totals is None:
+            raise HTTPException(status_code=404, detail="No open shift for this branch")
+
+        # Other workers took some of the shift's orders, so this worker's
+        # running totals are not the whole shift: count the Z-report afresh
+        closing = ShiftTotals(totals.shift)
+        closing.cashier_names = dict(totals.cashier_names)
+        for order in await load_shift_orders(totals.shift):
+            closing.add(order)
+        await load_cashier_names(closing)
+        report = closing.report()
+        cash = report["cash"]
+        cash["counted"] = _money(request.counted_cash)
+        cash["variance"] = _money(request.counted_cash - cash["expected"])
+        now = datetime.now(timezone.utc).isoformat()
+        report["closed_at"] = now
+        update_data = {
+            "status": "closed",
+            "closed_by": user_id,
+            "closed_at": now,
+            "expected_cash": cash["expected"],
+            "counted_cash": cash["counted"],
+            "cash_variance": cash["variance"],
+            "total_sales": report["sales"]["total"],
+            "report": report,
+            "updated_at": now
+        }
+        if request.notes:
+            update_data["notes"] = request.notes
+
+        # Only an open shift closes, so a second close cannot overwrite the frozen report
+        response = await supabase_request(
+            "PATCH", f"shifts?id=eq.{totals.shift['id']}&tenant_id=eq.{key[0]}&status=eq.open",
+            update_data, use_service_key=True
+        )
+        if response.status_code not in [200, 204]:
+            logger.error(f"Close shift failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to close shift")
+
+        if _open_shifts.get(key) is totals:
+            _open_shifts.pop(key)
+        rows = response.json()
+        if not rows:
+            raise HTTPException(status_code=409, detail="Shift is already closed")
+        metrics.inc("riwa_shifts_closed_total")
+        return {"success": True, "shift": rows[0], "report": report}
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Delete printer error: {e}")
+        logger.error(f"Close shift error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-# ==================== REPORTS ====================
+async def load_shift(shift_id: str) -> Dict[str, Any]:
+    """A shift row with its report: frozen if closed, live if open"""
+    response = await supabase_request(
+        "GET", f"shifts?id=eq.{shift_id}&tenant_id=eq.{current_tenant_id()}", use_service_key=True
+    )
+    rows = response.json() if response.status_code == 200 else []
+    if not rows:
+        raise HTTPException(status_code=404, detail="Shift not found")
+    shift = rows[0]
+    if shift['status'] == 'open':
+        totals = await restore_shift(shift)
+        await load_cashier_names(totals)
+        shift['report'] = totals.report()
+    return shift
 
-@api_router.get("/admin/reports/orders")
-async def get_orders_report(start_date: Optional[str] = None, end_date: Optional[str] = None):
-    """Get orders report"""
+@api_router.get("/shifts/{shift_id}")
+async def get_shift(shift_id: str):
+    """One shift with its report"""
     try:
-        endpoint = f"orders?tenant_id=eq.{TENANT_ID}&branch_id=eq.{BRANCH_ID}&order=created_at.desc"
-        if start_date:
-            endpoint += f"&created_at=gte.{start_date}T00:00:00"
-        if end_date:
-            endpoint += f"&created_at=lte.{end_date}T23:59:59"
-        
-        response = await supabase_request("GET", endpoint, use_service_key=True)
-        orders = response.json() if response.status_code == 200 else []
-        
-        # Normalize and calculate summary
-        for order in orders:
-            order['total'] = order.get('total_amount', 0)
-        
-        total_sales = sum(o.get('total_amount', 0) for o in orders)
-        total_orders = len(orders)
-        avg_order = total_sales / total_orders if total_orders > 0 else 0
-        
-        return {
-            "orders": orders,
-            "summary": {
-                "total_orders": total_orders,
-                "total_sales": total_sales,
-                "average_order": avg_order
-            }
-        }
+        return {"shift": await load_shift(shift_id)}
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Orders report error: {e}")
-        return {"orders": [], "summary": {}}
+        logger.error(f"Get shift error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/admin/audit-logs")
-async def get_audit_logs(limit: int = 100):
-    """Get audit logs"""
+@api_router.post("/shifts/{shift_id}/print")
+async def print_shift_report(shift_id: str, request: ShiftPrintRequest):
+    """Print the shift's X/Z-report on a cashier printer"""
+    try:
+        shift = await load_shift(shift_id)
+        printers = [p for p in await load_printer_configs() if p.get('enabled')]
+        if request.printer_id:
+            printer = next((p for p in printers if p.get('id') == request.printer_id), None)
+        else:
+            printer = next((p for p in printers if p.get('location') == 'cashier'), printers[0] if printers else None)
+        if not printer:
+            raise HTTPException(status_code=404, detail="No enabled printer for the report")
+
+        try:
+            # Blocking socket write (up to the timeout), kept off the event loop
+            await asyncio.to_thread(send_to_printer, printer['ip_address'], printer['port'],
+                                    generate_escpos_shift_report(shift, shift['report']),
+                                    timeout=10, kind="shift_report")
+            return {"success": True, "message": "Shift report sent to printer"}
+        except socket.error as e:
+            logger.error(f"Shift report print error: {e}")
+            return {"success": False, "message": f"Failed to print: {str(e)}"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Print shift error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/admin/shifts")
+async def admin_list_shifts(limit: int = 30):
+    """Recent shifts for the branch, newest first (reports via /shifts/{id})"""
     try:
         response = await supabase_request(
             "GET",
-            f"audit_logs?tenant_id=eq.{TENANT_ID}&order=created_at.desc&limit={limit}",
+            f"shifts?tenant_id=eq.{current_tenant_id()}&branch_id=eq.{current_branch_id()}"
+            f"&select={SHIFT_LIST_COLUMNS}&order=opened_at.desc&limit={limit}",
             use_service_key=True
         )
-        return {"logs": response.json() if response.status_code == 200 else []}
+        return {"shifts": response.json() if response.status_code == 200 else []}
     except Exception as e:
-        logger.error(f"Audit logs error: {e}")
-        return {"logs": []}
+        logger.error(f"List shifts error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 # ==================== RECEIPT ====================
 
@@ -1342,17 +6159,25 @@ async def get_receipt_data(order_id: str):
 
 # ==================== PRINTER ENDPOINTS ====================
 
-@api_router.get("/printers")
-async def get_printers():
-    """Get all printer configurations"""
-    try:
+async def load_printer_configs() -> List[Dict[str, Any]]:
+    """All printer_configs rows for the current tenant (cached)"""
+    async def load():
         response = await supabase_request(
             "GET",
-            f"printer_configs?tenant_id=eq.{TENANT_ID}&order=created_at.desc",
+            f"printer_configs?tenant_id=eq.{current_tenant_id()}&order=created_at.desc",
             use_service_key=True
         )
-        printers = response.json() if response.status_code == 200 else []
-        return {"printers": printers}
+        if response.status_code != 200:
+            raise RuntimeError(f"Printer configs query failed: {response.status_code} - {response.text}")
+        return response.json()
+    
+    return await tenant_cache.get_or_load("printers:configs", load, PRINTER_CACHE_TTL)
+
+@api_router.get("/printers")
+async def get_printers():
+    """Get all printer configurations"""
+    try:
+        return {"printers": await load_printer_configs()}
     except Exception as e:
         logger.error(f"Get printers error: {e}")
         return {"printers": []}
@@ -1363,8 +6188,8 @@ async def create_printer(config: PrinterConfig):
     try:
         printer_data = {
             "id": str(uuid.uuid4()),
-            "tenant_id": TENANT_ID,
-            "branch_id": BRANCH_ID,
+            "tenant_id": current_tenant_id(),
+            "branch_id": current_branch_id(),
             "name": config.name,
             "description": config.description,
             "ip_address": config.ip_address,
@@ -1385,6 +6210,8 @@ async def create_printer(config: PrinterConfig):
             logger.error(f"Create printer failed: {response.status_code} - {response.text}")
             raise HTTPException(status_code=500, detail="Failed to create printer")
         
+        invalidate_cache("printers:")
+        
         return {"success": True, "printer": response.json()[0] if response.json() else printer_data}
     except HTTPException:
         raise
@@ -1400,12 +6227,19 @@ async def update_printer(printer_id: str, config: Dict[str, Any]):
         
         response = await supabase_request(
             "PATCH",
-            f"printer_configs?id=eq.{printer_id}&tenant_id=eq.{TENANT_ID}",
+            f"printer_configs?id=eq.{printer_id}&tenant_id=eq.{current_tenant_id()}",
             config,
             use_service_key=True
         )
         
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Update printer failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to update printer")
+        invalidate_cache("printers:")
+        
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Update printer error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1414,30 +6248,50 @@ async def update_printer(printer_id: str, config: Dict[str, Any]):
 async def delete_printer(printer_id: str):
     """Delete a printer configuration"""
     try:
-        await supabase_request(
+        response = await supabase_request(
             "DELETE",
-            f"printer_configs?id=eq.{printer_id}&tenant_id=eq.{TENANT_ID}",
+            f"printer_configs?id=eq.{printer_id}&tenant_id=eq.{current_tenant_id()}",
             use_service_key=True
         )
+        if response.status_code not in [200, 201, 204]:
+            logger.error(f"Delete printer failed: {response.status_code} - {response.text}")
+            raise HTTPException(status_code=500, detail="Failed to delete printer")
+        invalidate_cache("printers:")
         return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Delete printer error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def send_to_printer(ip_address: str, port: int, data: bytes, timeout: float, kind: str = "receipt"):
+    """Send raw ESC/POS bytes to a network printer over TCP, recording latency and failures"""
+    target = f"{ip_address}:{port}"
+    start = time.perf_counter()
+    status = "ok"
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect((ip_address, port))
+        sock.sendall(data)
+    except socket.timeout:
+        status = "timeout"
+        metrics.inc("riwa_printer_failures_total", printer=target, kind=kind, reason=status)
+        raise
+    except socket.error:
+        status = "error"
+        metrics.inc("riwa_printer_failures_total", printer=target, kind=kind, reason=status)
+        raise
+    finally:
+        sock.close()
+        metrics.observe("riwa_printer_send_seconds", time.perf_counter() - start, printer=target, kind=kind)
+        record_span("printer", target, kind, start, status)
+
 @api_router.post("/printers/test")
 async def test_printer(request: PrinterTestRequest):
     """Test printer connection via TCP"""
-    import socket
-    
     try:
-        # Create TCP socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5)  # 5 second timeout
-        
         try:
-            # Try to connect
-            sock.connect((request.ip_address, request.port))
-            
             # ESC/POS test print command
             # Initialize printer + Print "RIWA POS - Test Print" + Cut paper
             test_data = b'\x1B\x40'  # Initialize printer
@@ -1451,8 +6305,7 @@ async def test_printer(request: PrinterTestRequest):
             test_data += b'\n\n\n'
             test_data += b'\x1D\x56\x00'  # Cut paper
             
-            sock.send(test_data)
-            sock.close()
+            send_to_printer(request.ip_address, request.port, test_data, timeout=5, kind="test")
             
             return {
                 "success": True,
@@ -1469,8 +6322,6 @@ async def test_printer(request: PrinterTestRequest):
                 "success": False,
                 "message": f"Connection failed: {str(e)}"
             }
-        finally:
-            sock.close()
             
     except Exception as e:
         logger.error(f"Test printer error: {e}")
@@ -1482,8 +6333,8 @@ async def queue_print_job(request: PrintJobRequest):
     try:
         job_data = {
             "id": str(uuid.uuid4()),
-            "tenant_id": TENANT_ID,
-            "branch_id": BRANCH_ID,
+            "tenant_id": current_tenant_id(),
+            "branch_id": current_branch_id(),
             "printer_id": request.printer_id,
             "order_id": request.order_id,
             "print_type": request.print_type,
@@ -1514,7 +6365,7 @@ async def get_print_queue():
     try:
         response = await supabase_request(
             "GET",
-            f"printer_queues?tenant_id=eq.{TENANT_ID}&order=created_at.desc&limit=50",
+            f"printer_queues?tenant_id=eq.{current_tenant_id()}&order=created_at.desc&limit=50",
             use_service_key=True
         )
         return {"jobs": response.json() if response.status_code == 200 else []}
@@ -1525,21 +6376,13 @@ async def get_print_queue():
 @api_router.post("/prints/direct")
 async def direct_print(request: PrintJobRequest):
     """Print directly to a printer via TCP (server-side printing)"""
-    import socket
-    
     try:
         # Get printer config
-        printer_response = await supabase_request(
-            "GET",
-            f"printer_configs?id=eq.{request.printer_id}&tenant_id=eq.{TENANT_ID}",
-            use_service_key=True
-        )
+        printer = next((p for p in await load_printer_configs() if p.get('id') == request.printer_id), None)
         
-        if printer_response.status_code != 200 or not printer_response.json():
+        if not printer:
             raise HTTPException(status_code=404, detail="Printer not found")
         
-        printer = printer_response.json()[0]
-        
         if not printer.get('enabled'):
             raise HTTPException(status_code=400, detail="Printer is disabled")
         
@@ -1553,13 +6396,8 @@ async def direct_print(request: PrintJobRequest):
         esc_pos_data = generate_escpos_receipt(receipt_data, printer.get('open_drawer_before', False), printer.get('open_drawer_after', True) or request.open_drawer)
         
         # Send to printer via TCP
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(10)
-        
         try:
-            sock.connect((printer['ip_address'], printer['port']))
-            sock.send(esc_pos_data)
-            sock.close()
+            send_to_printer(printer['ip_address'], printer['port'], esc_pos_data, timeout=10)
             
             # Update print job status if in queue
             await supabase_request(
@@ -1574,8 +6412,6 @@ async def direct_print(request: PrintJobRequest):
         except socket.error as e:
             logger.error(f"Print error: {e}")
             return {"success": False, "message": f"Failed to print: {str(e)}"}
-        finally:
-            sock.close()
             
     except HTTPException:
         raise
@@ -1664,17 +6500,1091 @@ def generate_escpos_receipt(order_data: Dict, drawer_before: bool = False, drawe
     
     return data
 
+# ==================== DEVICES ====================
+
+# POS, KDS and kiosk terminals POST a heartbeat every DEVICE_HEARTBEAT_SECONDS.
+# Heartbeats only touch memory; a background task upserts devices whose
+# details changed, or whose last_seen has not been written for
+# DEVICE_PERSIST_SECONDS, to the devices table in one request.
+DEVICE_HEARTBEAT_SECONDS = float(os.environ.get('DEVICE_HEARTBEAT_SECONDS', '10'))
+DEVICE_STALE_SECONDS = float(os.environ.get('DEVICE_STALE_SECONDS', '30'))
+DEVICE_OFFLINE_SECONDS = float(os.environ.get('DEVICE_OFFLINE_SECONDS', '120'))
+DEVICE_PERSIST_SECONDS = float(os.environ.get('DEVICE_PERSIST_SECONDS', '30'))
+DEVICE_SLOW_POLL_MS = float(os.environ.get('DEVICE_SLOW_POLL_MS', '1500'))
+DEVICE_MAX_PER_TENANT = int(os.environ.get('DEVICE_MAX_PER_TENANT', '500'))
+DEVICE_PERSISTED_FIELDS = ("role", "name", "app_version", "station", "branch_id", "ip_address", "printer_status")
+
+metrics.describe("riwa_device_heartbeats_total", "counter", "Device heartbeats received, by role")
+metrics.describe("riwa_devices", "gauge", "Devices known in memory, by health state")
+
+class DeviceRegistry:
+    """Latest heartbeat per (tenant, device), plus which devices need persisting"""
+
+    def __init__(self):
+        self.devices: Dict[str, "OrderedDict[str, Dict[str, Any]]"] = {}  # tenant -> device_id -> record, oldest first
+        self.dirty: set = set()  # (tenant_id, device_id)
+
+    def heartbeat(self, tenant_id: str, branch_id: str, beat: DeviceHeartbeat, ip_address: Optional[str]):
+        devices = self.devices.setdefault(tenant_id, OrderedDict())
+        record = devices.get(beat.device_id)
+        if record is None:
+            if len(devices) >= DEVICE_MAX_PER_TENANT:
+                devices.popitem(last=False)
+            record = devices[beat.device_id] = {"device_id": beat.device_id, "tenant_id": tenant_id,
+                                                "heartbeats": 0, "persisted_at": 0.0}
+        else:
+            devices.move_to_end(beat.device_id)
+        details = {"role": beat.role, "name": beat.name or record.get("name"), "app_version": beat.app_version,
+                   "station": beat.station, "branch_id": branch_id, "ip_address": ip_address,
+                   "printer_status": beat.printer_status}
+        changed = any(record.get(field) != details[field] for field in DEVICE_PERSISTED_FIELDS)
+        record.update(details)
+        now = time.time()
+        record["last_seen"] = now
+        record["heartbeats"] += 1
+        if beat.poll_latency_ms is not None:
+            record["poll_latency_ms"] = beat.poll_latency_ms
+            previous = record.get("poll_latency_avg_ms")
+            record["poll_latency_avg_ms"] = beat.poll_latency_ms if previous is None else previous * 0.8 + beat.poll_latency_ms * 0.2
+        if changed or now - record["persisted_at"] >= DEVICE_PERSIST_SECONDS:
+            self.dirty.add((tenant_id, beat.device_id))
+        metrics.inc("riwa_device_heartbeats_total", role=beat.role)
+
+    def forget(self, tenant_id: str, device_id: str):
+        self.devices.get(tenant_id, {}).pop(device_id, None)
+        self.dirty.discard((tenant_id, device_id))
+
+    def take_dirty(self) -> List[Dict[str, Any]]:
+        rows = []
+        for tenant_id, device_id in self.dirty:
+            record = self.devices.get(tenant_id, {}).get(device_id)
+            if record is not None:
+                rows.append(record)
+        self.dirty.clear()
+        return rows
+
+    def refresh_gauges(self):
+        counts = {"online": 0, "stale": 0, "offline": 0}
+        now = time.time()
+        for devices in self.devices.values():
+            for record in devices.values():
+                counts[device_state(record["last_seen"], now)] += 1
+        for state, count in counts.items():
+            metrics.set_gauge("riwa_devices", count, state=state)
+
+device_registry = DeviceRegistry()
+
+def device_state(last_seen: Optional[float], now: float) -> str:
+    if last_seen is None or now - last_seen >= DEVICE_OFFLINE_SECONDS:
+        return "offline"
+    return "online" if now - last_seen < DEVICE_STALE_SECONDS else "stale"
+
+def device_row(record: Dict[str, Any]) -> Dict[str, Any]:
+    """devices table row for a registry record"""
+    row = {field: record.get(field) for field in DEVICE_PERSISTED_FIELDS}
+    row.update({
+        "tenant_id": record["tenant_id"],
+        "device_id": record["device_id"],
+        "poll_latency_ms": record.get("poll_latency_avg_ms"),
+        "last_seen": datetime.fromtimestamp(record["last_seen"], timezone.utc).isoformat(),
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    })
+    return row
+
+def device_health(record: Dict[str, Any], now: float) -> Dict[str, Any]:
+    """Registry record (or stored row) as the admin API shows it"""
+    last_seen = record.get("last_seen")
+    if isinstance(last_seen, str):
+        last_seen = datetime.fromisoformat(last_seen).timestamp()
+    issues = [f"printer {printer}: {status}" for printer, status in (record.get("printer_status") or {}).items()
+              if status != "ok"]
+    latency = record.get("poll_latency_avg_ms", record.get("poll_latency_ms"))
+    if latency is not None and latency > DEVICE_SLOW_POLL_MS:
+        issues.append(f"slow polling ({latency:.0f}ms)")
+    return {
+        "device_id": record["device_id"],
+        "name": record.get("name"),
+        "role": record.get("role"),
+        "station": record.get("station"),
+        "branch_id": record.get("branch_id"),
+        "app_version": record.get("app_version"),
+        "ip_address": record.get("ip_address"),
+        "status": device_state(last_seen, now),
+        "last_seen": datetime.fromtimestamp(last_seen, timezone.utc).isoformat() if last_seen else None,
+        "seconds_since_seen": round(now - last_seen, 1) if last_seen else None,
+        "poll_latency_ms": record.get("poll_latency_ms"),
+        "poll_latency_avg_ms": round(latency, 1) if latency is not None else None,
+        "printer_status": record.get("printer_status") or {},
+        "issues": issues,
+    }
+
+async def persist_devices() -> bool:
+    """Upsert dirty devices in one request; on failure they are retried next time"""
+    records = device_registry.take_dirty()
+    if not records:
+        return True
+    try:
+        response = await supabase_request(
+            "POST", "devices?on_conflict=tenant_id,device_id", [device_row(r) for r in records],
+            use_service_key=True, prefer="return=minimal,resolution=merge-duplicates"
+        )
+        if response.status_code not in [200, 201, 204]:
+            raise RuntimeError(f"{response.status_code} {response.text[:200]}")
+    except Exception as e:
+        device_registry.dirty.update((r["tenant_id"], r["device_id"]) for r in records)
+        logger.warning(f"Device persist failed: {e}")
+        return False
+    now = time.time()
+    for record in records:
+        record["persisted_at"] = now
+    return True
+
+async def run_device_persister():
+    """Background task: persist heartbeats every few seconds and refresh the device gauges"""
+    while True:
+        await asyncio.sleep(min(DEVICE_PERSIST_SECONDS, 5))
+        await persist_devices()
+        device_registry.refresh_gauges()
+
+@api_router.post("/devices/heartbeat")
+async def device_heartbeat(beat: DeviceHeartbeat, request: Request):
+    """Record a terminal heartbeat (memory only; persisted in the background)"""
+    # Behind an ingress the peer is the ingress, not the terminal
+    device_registry.heartbeat(current_tenant_id(), current_branch_id(), beat, client_address(request))
+    return {"success": True, "interval": DEVICE_HEARTBEAT_SECONDS}
+
+@api_router.get("/admin/devices")
+async def admin_list_devices(role: Optional[str] = None, status: Optional[str] = None):
+    """Live devices from memory plus known devices from the devices table, with health"""
+    try:
+        now = time.time()
+        live = device_registry.devices.get(current_tenant_id(), {})
+        response = await supabase_request(
+            "GET", f"devices?tenant_id=eq.{current_tenant_id()}&order=last_seen.desc", use_service_key=True
+        )
+        stored = response.json() if response.status_code == 200 else []
+        devices = [device_health(record, now) for record in live.values()]
+        devices += [device_health(row, now) for row in stored if row["device_id"] not in live]
+        if role:
+            devices = [d for d in devices if d["role"] == role]
+        summary = {"online": 0, "stale": 0, "offline": 0}
+        for device in devices:
+            summary[device["status"]] += 1
+        if status:
+            devices = [d for d in devices if d["status"] == status]
+        devices.sort(key=lambda d: (d["status"] != "online", d["seconds_since_seen"] is None, d["seconds_since_seen"] or 0))
+        return {"devices": devices, "summary": summary}
+    except Exception as e:
+        logger.error(f"List devices error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/admin/devices/{device_id}")
+async def admin_get_device(device_id: str):
+    """One device's health"""
+    try:
+        record = device_registry.devices.get(current_tenant_id(), {}).get(device_id)
+        if record is None:
+            response = await supabase_request(
+                "GET", f"devices?tenant_id=eq.{current_tenant_id()}&device_id=eq.{quote(device_id)}",
+                use_service_key=True
+            )
+            rows = response.json() if response.status_code == 200 else []
+            if not rows:
+                raise HTTPException(status_code=404, detail="Device not found")
+            record = rows[0]
+        return {"device": device_health(record, time.time())}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get device error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.delete("/admin/devices/{device_id}")
+async def admin_delete_device(device_id: str):
+    """Forget a retired device (it reappears if it sends another heartbeat)"""
+    try:
+        device_registry.forget(current_tenant_id(), device_id)
+        await supabase_request(
+            "DELETE", f"devices?tenant_id=eq.{current_tenant_id()}&device_id=eq.{quote(device_id)}",
+            use_service_key=True
+        )
+        return {"success": True}
+    except Exception as e:
+        logger.error(f"Delete device error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== DELTA SYNC ====================
+
+# POS tablets call /api/sync once on launch (no cursor: full snapshot) and then
+# with the returned cursor to get only rows whose updated_at moved, plus ids
+# from sync_tombstones (filled by DELETE triggers, see 008_delta_sync.sql).
+# Cursors carry the tenant, branch and SYNC_CURSOR_VERSION; a cursor for
+# another scope, an older version or older than the tombstone retention gets a
+# full snapshot again. Bump SYNC_CURSOR_VERSION whenever SYNC_SOURCES changes.
+SYNC_CURSOR_VERSION = 1
+SYNC_OVERLAP_SECONDS = float(os.environ.get('SYNC_OVERLAP_SECONDS', '5'))
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.environ.get('SYNC_TOMBSTONE_RETENTION_DAYS', '30'))
+# At most PostgREST's max-rows (1000 on Supabase): a shorter page ends the source
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', '1000'))
+
+# name -> (table, filters, normalizer). Filters are formatted with tenant_id, branch_id and today.
+# Every order ends in id so offset paging is stable.
+SYNC_SOURCES = {
+    "categories": ("categories", "tenant_id=eq.{tenant_id}&order=sort_order.asc,id.asc", normalize_category),
+    "items": ("items", "tenant_id=eq.{tenant_id}&order=sort_order.asc,id.asc", normalize_item),
+    "settings": ("system_settings", "tenant_id=eq.{tenant_id}&branch_id=eq.{branch_id}&order=id.asc", None),
+    "printers": ("printer_configs", "tenant_id=eq.{tenant_id}&order=created_at.desc,id.asc", None),
+    "orders": ("orders", "tenant_id=eq.{tenant_id}&created_at=gte.{today}T00:00:00&order=created_at.desc,id.asc",
+               normalize_order),
+}
+
+metrics.describe("riwa_sync_requests_total", "counter", "Delta sync requests, by kind (full or delta)")
+metrics.describe("riwa_sync_rows_total", "counter", "Rows returned by delta sync, by source")
+
+def encode_sync_cursor(at: datetime, day: str) -> str:
+    raw = json.dumps({"v": SYNC_CURSOR_VERSION, "t": current_tenant_id(), "b": current_branch_id(),
+                      "ts": at.isoformat(), "d": day}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_sync_cursor(cursor: Optional[str]) -> Optional[Dict[str, Any]]:
+    """The cursor's payload, or None when the client needs a full snapshot"""
+    if not cursor:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        since = datetime.fromisoformat(payload["ts"])
+    except (ValueError, KeyError, TypeError):
+        return None
+    if (payload.get("v") != SYNC_CURSOR_VERSION or payload.get("t") != current_tenant_id()
+            or payload.get("b") != current_branch_id()):
+        return None
+    if since < datetime.now(timezone.utc) - timedelta(days=SYNC_TOMBSTONE_RETENTION_DAYS):
+        return None
+    return payload
+
+async def fetch_sync_pages(name: str, endpoint: str) -> Optional[List[Dict[str, Any]]]:
+    """Every row of a sync query, paged under PostgREST's max-rows cap; None on 404"""
+    rows: List[Dict[str, Any]] = []
+    offset = 0
+    while True:
+        response = await supabase_request("GET", f"{endpoint}&limit={SYNC_PAGE_SIZE}&offset={offset}",
+                                          use_service_key=True)
+        if response.status_code == 404 and not offset:
+            return None
+        if response.status_code != 200:
+            raise RuntimeError(f"Sync {name} query failed: {response.status_code} - {response.text}")
+        page = response.json() or []
+        rows.extend(page)
+        if len(page) < SYNC_PAGE_SIZE:
+            return rows
+        offset += SYNC_PAGE_SIZE
+
+async def fetch_sync_source(name: str, since: Optional[str], today: str) -> List[Dict[str, Any]]:
+    table, filters, normalize = SYNC_SOURCES[name]
+    endpoint = f"{table}?" + filters.format(tenant_id=current_tenant_id(), branch_id=current_branch_id(), today=today)
+    if since:
+        endpoint += f"&updated_at=gt.{quote(since)}"
+    rows = await fetch_sync_pages(name, endpoint)
+    if rows is None:
+        raise RuntimeError(f"Sync {name} query failed: 404")
+    if name == "orders" and order_journal is not None:
+        # Journaled orders are not in Supabase yet, and replay keeps their
+        # original updated_at, so they are always sent until replayed
+        known = {row['id'] for row in rows}
+        for order_id in order_journal.pending_order_ids():
+            order = order_journal.get_order(order_id)
+            if (order and order_id not in known and order.get('tenant_id') == current_tenant_id()
+                    and str(order.get('created_at', '')) >= today):
+                order.pop('items', None)
+                rows.append(order)
+    return [normalize(row) for row in rows] if normalize else rows
+
+async def fetch_sync_tombstones(since: str) -> Dict[str, List[str]]:
+    tables = {table: name for name, (table, _, _) in SYNC_SOURCES.items()}
+    rows = await fetch_sync_pages(
+        "tombstones",
+        f"sync_tombstones?tenant_id=eq.{current_tenant_id()}&deleted_at=gt.{quote(since)}"
+        f"&table_name=in.({','.join(tables)})&select=table_name,row_id&order=deleted_at.asc,id.asc"
+    )
+    if rows is None:
+        logger.warning("sync_tombstones table missing; run migration 008_delta_sync.sql")
+        return {}
+    deleted: Dict[str, List[str]] = {}
+    for row in rows:
+        deleted.setdefault(tables[row['table_name']], []).append(row['row_id'])
+    return deleted
+
+@api_router.get("/sync")
+async def delta_sync(since: Optional[str] = None):
+    """Rows changed since the cursor (or everything), tombstoned ids, and the next cursor.
+
+    ``reset`` lists the sources sent in full; the client replaces those
+    collections instead of merging into them.
+    """
+    try:
+        started = datetime.now(timezone.utc)
+        today = started.date().isoformat()
+        cursor = decode_sync_cursor(since)
+        since_ts = cursor["ts"] if cursor else None
+        # Today's orders restart at midnight
+        reset = list(SYNC_SOURCES) if cursor is None else (["orders"] if cursor.get("d") != today else [])
+        
+        names = list(SYNC_SOURCES)
+        results = await asyncio.gather(
+            *[fetch_sync_source(name, None if name in reset else since_ts, today) for name in names],
+            fetch_sync_tombstones(since_ts) if since_ts else asyncio.sleep(0, {})
+        )
+        changes = dict(zip(names, results[:-1]))
+        deleted = {name: ids for name, ids in results[-1].items() if name not in reset}
+        
+        metrics.inc("riwa_sync_requests_total", kind="full" if cursor is None else "delta")
+        for name, rows in changes.items():
+            metrics.inc("riwa_sync_rows_total", len(rows), source=name)
+        
+        # Overlap so rows committed with a slightly older updated_at are not
+        # skipped; clients upsert by id, so repeats are harmless
+        next_cursor = encode_sync_cursor(started - timedelta(seconds=SYNC_OVERLAP_SECONDS), today)
+        return {"cursor": next_cursor, "full": cursor is None, "reset": reset,
+                "changes": changes, "deleted": deleted, "server_time": started.isoformat()}
+    except Exception as e:
+        logger.error(f"Delta sync error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ==================== WARM-UP ====================
+
+# Startup opens upstream connections and preloads what the first tills ask for
+# (menu, settings, printers, the KDS board of today's open orders) before
+# /api/health reports ready, so rolling restarts never route traffic to a cold
+# worker. /api/health/live only says the process is up and responsive.
+WARMUP_ENABLED = os.environ.get('WARMUP_ENABLED', 'true').lower() == 'true'
+WARMUP_TIMEOUT = float(os.environ.get('WARMUP_TIMEOUT', '30'))
+WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', '4'))
+PRINTER_PROBE_TIMEOUT = float(os.environ.get('PRINTER_PROBE_TIMEOUT', '2'))
+
+metrics.describe("riwa_printer_up", "gauge", "1 if the printer accepted a TCP connection at the last probe")
+
+_warmup_state: Dict[str, Any] = {"ready": not WARMUP_ENABLED, "started_at": None, "finished_at": None, "steps": {}}
+_printer_status: Dict[str, Dict[str, Any]] = {}
+
+async def probe_printer(ip_address: str, port: int) -> bool:
+    """Open and close a TCP connection to a printer, recording whether it answered"""
+    target = f"{ip_address}:{port}"
+    error = None
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip_address, port), PRINTER_PROBE_TIMEOUT)
+        writer.close()
+    except (OSError, asyncio.TimeoutError) as e:
+        error = str(e) or type(e).__name__
+    _printer_status[target] = {"reachable": error is None, "error": error,
+                               "checked_at": datetime.now(timezone.utc).isoformat()}
+    metrics.set_gauge("riwa_printer_up", 1 if error is None else 0, printer=target)
+    return error is None
+
+async def warm_printers():
+    configs = await load_printer_configs()
+    targets = {(c['ip_address'], int(c.get('port') or 9100)) for c in configs if c.get('enabled', True) and c.get('ip_address')}
+    await asyncio.gather(*[probe_printer(ip, port) for ip, port in targets])
+
+async def warm_menu():
+    await asyncio.gather(load_menu_catalog(), load_station_map(), get_categories(), get_items())
+
+WARMUP_STEPS = {
+    "upstream": lambda: storage.warm(WARMUP_CONNECTIONS),
+    "menu": warm_menu,
+    "settings": load_system_settings,
+    "printers": warm_printers,
+    "orders": get_kds_board,
+    "shifts": restore_open_shifts,
+}
+
+async def run_warmup():
+    """Run every warm-up step concurrently; ready once all finish or WARMUP_TIMEOUT passes.
+
+    A failed step does not keep the worker out of rotation: it would not do
+    better on a later probe than live traffic does, and the journal/edge paths
+    still serve while Supabase is down.
+    """
+    _warmup_state["started_at"] = datetime.now(timezone.utc).isoformat()
+    steps = _warmup_state["steps"]
+    
+    async def step(name: str, run):
+        start = time.perf_counter()
+        try:
+            await run()
+            steps[name] = {"status": "ok"}
+        except Exception as e:
+            steps[name] = {"status": "failed", "error": str(e)}
+            logger.warning(f"Warm-up step {name} failed: {e}")
+        steps[name]["seconds"] = round(time.perf_counter() - start, 3)
+    
+    tasks = [asyncio.create_task(step(name, run)) for name, run in WARMUP_STEPS.items()]
+    _, pending = await asyncio.wait(tasks, timeout=WARMUP_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    for name in WARMUP_STEPS:
+        steps.setdefault(name, {"status": "timeout"})
+    
+    _warmup_state["finished_at"] = datetime.now(timezone.utc).isoformat()
+    _warmup_state["ready"] = True
+    summary = ", ".join(f"{name}={result['status']}" for name, result in steps.items())
+    logger.info(f"Warm-up finished: {summary}")
+
 # ==================== HEALTH CHECK ====================
 
 @api_router.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
+    """Readiness probe: 503 until startup warm-up has finished"""
+    body = {
+        "status": "ready" if _warmup_state["ready"] else "starting",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "storage": storage.name,
+        "warmup": _warmup_state,
+        "printers": _printer_status,
+        "upstream": upstream_status(),
+        "admission": admission_status(),
+    }
+    if not _warmup_state["ready"]:
+        return JSONResponse(status_code=503, content=body)
+    return body
+
+@api_router.get("/health/live")
+async def liveness_check():
+    """Liveness probe: the process is up and its event loop is serving"""
+    return {"status": "alive", "timestamp": datetime.now(timezone.utc).isoformat()}
 
 @api_router.get("/")
 async def root():
     return {"message": "RIWA POS API", "version": "1.0.0"}
 
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus scrape endpoint"""
+    _refresh_cache_ratios()
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# ==================== EDGE SYNC ====================
+
+# With STORAGE_BACKEND=sqlite the server trades from the local file; this task
+# pushes local writes (the _outbox) to Supabase and pulls menu/settings changes
+# newer than each table's updated_at high-water mark.
+EDGE_SYNC_INTERVAL = float(os.environ.get('EDGE_SYNC_INTERVAL', '5'))
+EDGE_PUSH_BATCH = int(os.environ.get('EDGE_PUSH_BATCH', '500'))
+EDGE_PULL_PAGE = 1000
+EDGE_PULL_TABLES = [t.strip() for t in os.environ.get(
+    'EDGE_PULL_TABLES',
+    'users,categories,items,item_variants,modifier_groups,modifiers,system_settings,printers,'
+    'printer_configs,payment_providers,delivery_zones,coupons,loyalty_settings,loyalty_rules'
+).split(",") if t.strip()]
+# The edge store trades for one tenant and branch (TENANT_ID / BRANCH_ID), so
+# pulls only copy their rows. Tables without tenant_id are scoped through the
+# parent they embed; the embedded parent is dropped before storing.
+EDGE_PULL_PARENTS = {"item_variants": "items", "modifiers": "modifier_groups"}
+EDGE_PULL_BRANCH_TABLES = {"system_settings", "printers"}
+EDGE_PULL_SHARED_BRANCH_TABLES = {"delivery_zones"}  # rows without a branch apply to every branch
+
+metrics.describe("riwa_edge_outbox_rows", "gauge", "Local writes waiting to be pushed to Supabase")
+metrics.describe("riwa_edge_sync_failures_total", "counter", "Failed edge sync passes, by direction")
+metrics.describe("riwa_edge_pulled_rows_total", "counter", "Rows pulled from Supabase into the edge store, by table")
+metrics.describe("riwa_edge_dead_rows_total", "counter", "Local writes Supabase rejected permanently, by table")
+
+_edge_sync_state: Dict[str, Any] = {"last_push": None, "last_pull": None, "last_error": None}
+
+async def edge_push(store: SqliteBackend, upstream: PostgrestBackend) -> int:
+    """Push the next outbox batch: merged upserts per table, then deletes. Returns rows pushed."""
+    entries = store.outbox(EDGE_PUSH_BATCH)
+    if not entries:
+        return 0
+    upserts: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    deletes: Dict[str, set] = {}
+    for _, table, row_id, op in entries:
+        if op == "delete":
+            deletes.setdefault(table, set()).add(row_id)
+            upserts.get(table, {}).pop(row_id, None)
+            continue
+        row = store.get_row(table, row_id)
+        if row is not None:
+            upserts.setdefault(table, {})[row_id] = row
+            deletes.get(table, set()).discard(row_id)
+    
+    # Parents before children so foreign keys hold
+    rejected: Dict[tuple, str] = {}
+    order = {"orders": 0, "order_items": 1}
+    for table in sorted(upserts, key=lambda t: order.get(t, 2)):
+        rows = list(upserts[table].values())
+        for keys, group in _group_by_keys(rows).items():
+            rejected.update(await _edge_upsert(upstream, table, group))
+    for table, ids in deletes.items():
+        if ids:
+            rejected.update(await _edge_delete(upstream, table, sorted(ids)))
+    if rejected:
+        # Park them like the order journal does, so one bad row cannot stall the outbox
+        store.dead_letter_outbox(entries[-1][0], rejected)
+        for table, _ in rejected:
+            metrics.inc("riwa_edge_dead_rows_total", table=table)
+        logger.error(f"Edge push dead-lettered {len(rejected)} rows: {next(iter(rejected.values()))}")
+    store.clear_outbox(entries[-1][0])
+    return len(entries)
+
+async def _edge_upsert(upstream: PostgrestBackend, table: str, rows: List[Dict[str, Any]]) -> Dict[tuple, str]:
+    """Upsert rows; returns those Supabase rejects permanently, retrying a rejected batch row by row"""
+    response = await upstream.request("POST", f"{table}?on_conflict=id", rows, True,
+                                      "return=minimal,resolution=merge-duplicates")
+    if response.status_code in [200, 201, 204]:
+        return {}
+    error = f"push {table}: {response.status_code} {response.text[:200]}"
+    if not permanent_failure(response.status_code):
+        raise RuntimeError(error)
+    if len(rows) == 1:
+        return {(table, rows[0]['id']): error}
+    rejected: Dict[tuple, str] = {}
+    for row in rows:
+        rejected.update(await _edge_upsert(upstream, table, [row]))
+    return rejected
+
+async def _edge_delete(upstream: PostgrestBackend, table: str, ids: List[str]) -> Dict[tuple, str]:
+    response = await upstream.request("DELETE", f"{table}?id=in.({','.join(ids)})", None, True, "return=minimal")
+    if response.status_code in [200, 204]:
+        return {}
+    error = f"push delete {table}: {response.status_code} {response.text[:200]}"
+    if not permanent_failure(response.status_code):
+        raise RuntimeError(error)
+    if len(ids) == 1:
+        return {(table, ids[0]): error}
+    rejected: Dict[tuple, str] = {}
+    for row_id in ids:
+        rejected.update(await _edge_delete(upstream, table, [row_id]))
+    return rejected
+
+def edge_pull_scope(table: str) -> str:
+    """PostgREST filters limiting a pulled table to the edge tenant (and branch)"""
+    parent = EDGE_PULL_PARENTS.get(table)
+    if parent:
+        return f"select=*,{parent}!inner(tenant_id)&{parent}.tenant_id=eq.{TENANT_ID}"
+    scope = f"tenant_id=eq.{TENANT_ID}"
+    if table in EDGE_PULL_BRANCH_TABLES:
+        scope += f"&branch_id=eq.{BRANCH_ID}"
+    elif table in EDGE_PULL_SHARED_BRANCH_TABLES:
+        scope += f"&or=(branch_id.is.null,branch_id.eq.{BRANCH_ID})"
+    return scope
+
+def _group_by_keys(rows: List[Dict[str, Any]]) -> Dict[tuple, List[Dict[str, Any]]]:
+    """PostgREST bulk inserts need the same columns on every row"""
+    groups: Dict[tuple, List[Dict[str, Any]]] = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    return groups
+
+def _after_cursor(column: str, stamp: str, row_id: Optional[str]) -> str:
+    """PostgREST filter for rows after (stamp, row_id) in (column, id) order.
+
+    Rows sharing a timestamp (one statement, one NOW()) can straddle a page
+    boundary, so paging on the timestamp alone would skip the rest of them.
+    Uses and=() because the scope filters may already carry an or=().
+    """
+    if not row_id:
+        # Legacy mark: re-applying the rows at it is harmless
+        return f"{column}=gte.{quote(stamp)}"
+    stamp = quote(stamp)
+    return f"and=({column}.gte.{stamp},or({column}.gt.{stamp},id.gt.{row_id}))"
+
+async def edge_pull(store: SqliteBackend, upstream: PostgrestBackend) -> int:
+    """Pull rows changed since each table's high-water mark. Returns rows applied."""
+    applied = 0
+    for table in EDGE_PULL_TABLES:
+        stamp, row_id = store.pull_cursor(table)
+        while True:
+            endpoint = f"{table}?{edge_pull_scope(table)}&order=updated_at.asc.nullsfirst,id.asc&limit={EDGE_PULL_PAGE}"
+            if stamp:
+                endpoint += f"&{_after_cursor('updated_at', stamp, row_id)}"
+            response = await upstream.request("GET", endpoint, None, True, "return=representation")
+            if response.status_code != 200:
+                raise RuntimeError(f"pull {table}: {response.status_code} {response.text[:200]}")
+            rows = response.json()
+            if table in EDGE_PULL_PARENTS:
+                for row in rows:
+                    row.pop(EDGE_PULL_PARENTS[table], None)
+            applied += store.apply_remote(table, rows)
+            metrics.inc("riwa_edge_pulled_rows_total", len(rows), table=table)
+            stamped = [row for row in rows if row.get('updated_at')]
+            if stamped:
+                # Rows come in (updated_at, id) order, so the last one is the cursor
+                stamp, row_id = stamped[-1]['updated_at'], stamped[-1]['id']
+                store.set_pull_cursor(table, stamp, row_id)
+            if len(rows) < EDGE_PULL_PAGE or not stamped:
+                break
+    applied += await edge_pull_tombstones(store, upstream)
+    if applied:
+        # Pulled menu/settings/printer rows must not be served from stale caches
+        for prefix in ("menu:", "settings:", "printers:", "coupons:", "zones:", "loyalty:"):
+            tenant_cache.invalidate(prefix)
+    return applied
+
+async def edge_pull_tombstones(store: SqliteBackend, upstream: PostgrestBackend) -> int:
+    """Apply upstream deletes recorded in sync_tombstones (migration 008)"""
+    applied = 0
+    stamp, row_id = store.pull_cursor("sync_tombstones")
+    while True:
+        # Tables without tenant_id leave tombstones without one; deleting an id
+        # the edge store never had is a no-op
+        endpoint = (f"sync_tombstones?table_name=in.({','.join(EDGE_PULL_TABLES)})"
+                    f"&or=(tenant_id.eq.{TENANT_ID},tenant_id.is.null)"
+                    f"&order=deleted_at.asc,id.asc&limit={EDGE_PULL_PAGE}")
+        if stamp:
+            endpoint += f"&{_after_cursor('deleted_at', stamp, row_id)}"
+        response = await upstream.request("GET", endpoint, None, True, "return=representation")
+        if response.status_code == 404:
+            return applied
+        if response.status_code != 200:
+            raise RuntimeError(f"pull sync_tombstones: {response.status_code} {response.text[:200]}")
+        rows = response.json()
+        by_table: Dict[str, List[str]] = {}
+        for row in rows:
+            by_table.setdefault(row['table_name'], []).append(row['row_id'])
+        for table, ids in by_table.items():
+            applied += store.apply_remote_deletes(table, ids)
+        if rows:
+            stamp, row_id = rows[-1]['deleted_at'], rows[-1]['id']
+            store.set_pull_cursor("sync_tombstones", stamp, row_id)
+        if len(rows) < EDGE_PULL_PAGE:
+            return applied
+
+async def run_edge_sync(store: SqliteBackend):
+    """Background task: push then pull every EDGE_SYNC_INTERVAL, backing off while Supabase is unreachable"""
+    upstream = PostgrestBackend()
+    backoff = EDGE_SYNC_INTERVAL
+    while True:
+        try:
+            while await edge_push(store, upstream) == EDGE_PUSH_BATCH:
+                pass
+            _edge_sync_state["last_push"] = datetime.now(timezone.utc).isoformat()
+            await edge_pull(store, upstream)
+            _edge_sync_state["last_pull"] = datetime.now(timezone.utc).isoformat()
+            _edge_sync_state["last_error"] = None
+            backoff = EDGE_SYNC_INTERVAL
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.inc("riwa_edge_sync_failures_total")
+            _edge_sync_state["last_error"] = str(e)
+            logger.warning(f"Edge sync failed, retrying in {backoff:.0f}s: {e}")
+            backoff = min(backoff * 2, 300)
+        metrics.set_gauge("riwa_edge_outbox_rows", store.outbox_size())
+        await asyncio.sleep(backoff)
+
+@api_router.get("/edge/status")
+async def edge_status():
+    """Sync state of the local edge store (storage backend sqlite only)"""
+    if not isinstance(storage, SqliteBackend):
+        return {"enabled": False, "backend": storage.name}
+    return {
+        "enabled": True,
+        "backend": storage.name,
+        "path": storage.path,
+        "outbox_rows": storage.outbox_size(),
+        "dead_rows": storage.dead_outbox_size(),
+        "high_water": {table: storage.pull_cursor(table)[0] for table in EDGE_PULL_TABLES},
+        **_edge_sync_state,
+    }
+
+@api_router.post("/edge/requeue")
+async def edge_requeue():
+    """Put dead-lettered local writes back in the outbox (after fixing the cause)"""
+    if not isinstance(storage, SqliteBackend):
+        raise HTTPException(status_code=400, detail="Edge store not enabled")
+    return {"success": True, "requeued": storage.requeue_dead_outbox()}
+
+# ==================== LIFECYCLE ====================
+
+_background_tasks: List[asyncio.Task] = []
+
+@app.on_event("startup")
+async def start_background_tasks():
+    await storage.start()
+    if isinstance(storage, SqliteBackend):
+        _background_tasks.append(asyncio.create_task(run_edge_sync(storage)))
+    _background_tasks.append(asyncio.create_task(run_write_behind()))
+    if load_loyalty_queue():
+        logger.info("Restored the loyalty accrual queue saved at shutdown")
+    _background_tasks.append(asyncio.create_task(run_loyalty_accrual()))
+    _background_tasks.append(asyncio.create_task(run_kitchen_sampler()))
+    _background_tasks.append(asyncio.create_task(run_device_persister()))
+    if order_journal:
+        restore_bill_counters(order_journal)
+        _background_tasks.append(asyncio.create_task(run_journal_replayer(order_journal)))
+    if WARMUP_ENABLED:
+        _background_tasks.append(asyncio.create_task(run_warmup()))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    # The open kitchen hour would otherwise be lost; it merges with later rows
+    for stats in _kitchen_stats.values():
+        stats.persist_hour()
+    # Last chance for buffered audit rows
+    if not await flush_write_behind():
+        pending = sum(len(b.rows) for b in _write_behind.values())
+        logger.error(f"Shutdown with {pending} write-behind rows not persisted")
+    await flush_loyalty()
+    try:
+        saved = save_loyalty_queue()
+        if saved:
+            logger.warning(f"Saved {saved} orders awaiting loyalty accrual for the next start")
+    except OSError as e:
+        logger.error(f"Shutdown with loyalty accrual queue not saved: {e}")
+    if not await persist_devices():
+        logger.error("Shutdown with device heartbeats not persisted")
+    await storage.close()
+    await close_http_client()
+    await rate_limiter.close()
+
+# ==================== ADMISSION CONTROL ====================
+
+# Each request class (see REQUEST_CLASS_ROUTES) has its own concurrency limit
+# and bounded FIFO queue. A full queue answers 429 and a request that waited
+# ADMISSION_QUEUE_TIMEOUT answers 503. Background work (reports, exports) is
+# shed with 503 as soon as critical requests are queueing, here or for
+# upstream permits. Every rejection carries Retry-After.
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+ADMISSION_LIMITS = parse_class_limits('ADMISSION_LIMITS', 'critical=64,normal=32,background=4')
+ADMISSION_QUEUES = parse_class_limits('ADMISSION_QUEUES', 'critical=256,normal=64,background=8')
+ADMISSION_RETRY_AFTER = parse_class_limits('ADMISSION_RETRY_AFTER', 'critical=1,normal=2,background=30')
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '10'))
+
+metrics.describe("riwa_admission_active", "gauge", "Requests running, by request class")
+metrics.describe("riwa_admission_queued", "gauge", "Requests waiting for admission, by request class")
+metrics.describe("riwa_admission_wait_seconds", "histogram", "Time spent queued before admission, by request class")
+metrics.describe("riwa_admission_rejections_total", "counter", "Requests rejected by admission control, by class and reason")
+
+class AdmissionGate:
+    """Concurrency limit with a bounded FIFO queue for one request class"""
+
+    def __init__(self, cls: str, limit: int, max_queue: int):
+        self.cls = cls
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiters: deque = deque()
+
+    def _gauges(self):
+        metrics.set_gauge("riwa_admission_active", self.active, request_class=self.cls)
+        metrics.set_gauge("riwa_admission_queued", len(self.waiters), request_class=self.cls)
+
+    async def enter(self) -> Optional[str]:
+        """None once admitted, else the rejection reason"""
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            self._gauges()
+            return None
+        if len(self.waiters) >= self.max_queue:
+            return "queue_full"
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        self._gauges()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), ADMISSION_QUEUE_TIMEOUT)
+            return None
+        except asyncio.TimeoutError:
+            if future.done():
+                return None  # admitted as the timeout fired
+            future.cancel()
+            return "queue_timeout"
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.leave()  # admitted, but the client went away
+            future.cancel()
+            raise
+        finally:
+            if future in self.waiters:
+                self.waiters.remove(future)
+            metrics.observe("riwa_admission_wait_seconds", time.perf_counter() - start, request_class=self.cls)
+            self._gauges()
+
+    def leave(self):
+        # Hand the slot straight to the next waiter, if any
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(True)
+                self._gauges()
+                return
+        self.active -= 1
+        self._gauges()
+
+class AdmittedResponse:
+    """Sends the wrapped response, then gives its admission slot back (also on disconnect)"""
+
+    def __init__(self, response, gate: AdmissionGate):
+        self.response = response
+        self.gate = gate
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.gate.leave()
+
+admission_gates = {cls: AdmissionGate(cls, ADMISSION_LIMITS[cls], ADMISSION_QUEUES[cls]) for cls in REQUEST_CLASSES}
+
+def critical_saturated() -> bool:
+    return bool(admission_gates["critical"].waiters) or upstream_scheduler.waiting("critical") > 0
+
+def admission_status() -> Dict[str, Any]:
+    return {cls: {"limit": gate.limit, "active": gate.active, "queued": len(gate.waiters)}
+            for cls, gate in admission_gates.items()}
+
+# ==================== RATE LIMITING ====================
+
+# Token buckets per (rule, client). The client is the X-Device-ID header, else
+# the user in our JWT, else the client address. Rules under
+# RATE_LIMIT_ADDRESS_PREFIXES (the login brute-force guard) always key on the
+# client address: a device id is whatever the client sends, so rotating it
+# would get a fresh bucket per guess. Behind an ingress the peer is
+# the ingress itself, so list it in TENANT_TRUSTED_PROXIES (or set
+# RATE_LIMIT_TRUST_PROXY) and the client address is taken from X-Forwarded-For;
+# otherwise every anonymous caller shares the ingress's buckets. The first rule
+# whose method and path prefix match applies; RATE_LIMIT_RULES overrides the
+# defaults as "METHOD /path=rate/burst" entries separated by commas (rate in
+# requests/s, burst at least 1). The defaults are per terminal, so they sit
+# above what a busy till does and only stop runaway clients.
+# memory keeps buckets per worker, evicting idle (refilled) and least recently
+# used ones; redis shares them across workers (needs the redis package).
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory').lower()
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0')
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get('RATE_LIMIT_MAX_BUCKETS', '50000'))
+RATE_LIMIT_TRUST_PROXY = os.environ.get('RATE_LIMIT_TRUST_PROXY', 'false').lower() == 'true'
+RATE_LIMIT_ADDRESS_PREFIXES = tuple(p.strip() for p in os.environ.get(
+    'RATE_LIMIT_ADDRESS_PREFIXES', '/api/auth').split(',') if p.strip())
+DEFAULT_RATE_LIMIT_RULES = (
+    "POST /api/auth=0.2/10,"          # PIN/email login: 10 tries, then one per 5s
+    "GET /api/kds/items=2/20,"        # KDS screens poll every few seconds
+    "GET /api/orders=20/100,"
+    "POST /api/orders=20/100,"
+    "PATCH /api/orders=20/100,"
+    "* /api/sync=1/10,"
+    "* /api/admin/reports=2/20,"
+    "* /api/admin/menu/export=0.1/2,"
+    "* /api/=50/200"
+)
+
+def parse_rate_limit_rules(raw: str) -> List[tuple]:
+    """(method, path prefix, rate per second, burst) tuples"""
+    rules = []
+    for entry in filter(None, (e.strip() for e in raw.split(","))):
+        route, _, limit = entry.rpartition("=")
+        method, _, prefix = route.strip().partition(" ")
+        rate, _, burst = limit.partition("/")
+        rate, burst = float(rate), float(burst or rate)
+        if not rate > 0 or not burst >= 1:
+            raise ValueError(f"Rate limit rule {entry!r} needs a rate above 0 and a burst of at least 1")
+        rules.append((method.upper(), prefix.strip(), rate, burst))
+    return rules
+
+RATE_LIMIT_RULES = parse_rate_limit_rules(os.environ.get('RATE_LIMIT_RULES', DEFAULT_RATE_LIMIT_RULES))
+
+metrics.describe("riwa_rate_limited_total", "counter", "Requests rejected by the rate limiter, by rule")
+metrics.describe("riwa_rate_limit_buckets", "gauge", "Token buckets held in memory")
+metrics.describe("riwa_rate_limit_errors_total", "counter", "Shared rate-limit backend errors (requests were let through)")
+
+def rate_limit_rule(method: str, path: str) -> Optional[tuple]:
+    for rule in RATE_LIMIT_RULES:
+        if (rule[0] == "*" or rule[0] == method) and path.startswith(rule[1]):
+            return rule
+    return None
+
+def rate_limit_identity(request: Request, prefix: str = "") -> str:
+    if prefix.startswith(RATE_LIMIT_ADDRESS_PREFIXES):
+        return f"ip:{client_address(request, RATE_LIMIT_TRUST_PROXY) or 'unknown'}"
+    device_id = request.headers.get("x-device-id")
+    if device_id:
+        return f"device:{device_id[:64]}"
+    authorization = request.headers.get("authorization")
+    if authorization:
+        try:
+            payload = jwt.decode(authorization.replace("Bearer ", ""), JWT_SECRET, algorithms=["HS256"])
+            if payload.get('user_id'):
+                return f"user:{payload['user_id']}"
+        except JWTError:
+            pass
+    return f"ip:{client_address(request, RATE_LIMIT_TRUST_PROXY) or 'unknown'}"
+
+class MemoryRateLimiter:
+    """Token buckets in an LRU dict. A bucket that would have refilled is the
+    same as no bucket, so idle ones are dropped from the cold end."""
+
+    def __init__(self, max_buckets: int):
+        self.max_buckets = max_buckets
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()  # key -> [tokens, updated_at, full_at]
+
+    async def hit(self, key: str, rate: float, burst: float) -> float:
+        """0 if allowed, else seconds until a token is available"""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = burst
+        else:
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            self._buckets.move_to_end(key)
+        if tokens < 1:
+            self._buckets[key] = [tokens, now, now + (burst - tokens) / rate]
+            return (1 - tokens) / rate
+        tokens -= 1
+        self._buckets[key] = [tokens, now, now + (burst - tokens) / rate]
+        self._expire(now)
+        return 0
+
+    def _expire(self, now: float):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if bucket[2] > now and len(self._buckets) <= self.max_buckets:
+                break
+            del self._buckets[key]
+        metrics.set_gauge("riwa_rate_limit_buckets", len(self._buckets))
+
+    async def close(self):
+        pass
+
+class RedisRateLimiter:
+    """Token buckets shared by every worker; each bucket expires once it would be full"""
+
+    SCRIPT = """
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    if state[2] then tokens = math.min(burst, tokens + (now - tonumber(state[2])) * rate) end
+    local wait = 0
+    if tokens < 1 then wait = (1 - tokens) / rate else tokens = tokens - 1 end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        if aioredis is None:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the redis package")
+        self.client = aioredis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    async def hit(self, key: str, rate: float, burst: float) -> float:
+        try:
+            return float(await self.script(keys=[f"riwa:rl:{key}"], args=[rate, burst, time.time()]))
+        except Exception as e:
+            # Fail open: a limiter outage must not stop the tills
+            metrics.inc("riwa_rate_limit_errors_total")
+            logger.warning(f"Rate limiter backend error: {e}")
+            return 0
+
+    async def close(self):
+        await self.client.aclose()
+
+rate_limiter = RedisRateLimiter(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_BACKEND == "redis" else MemoryRateLimiter(RATE_LIMIT_MAX_BUCKETS)
+
+# ==================== MIDDLEWARE ====================
+
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    """Queue or reject the request by class so checkout and the KDS keep their capacity"""
+    cls = request_class_for(request.url.path)
+    if cls is None:
+        return await call_next(request)
+    _request_class.set(cls)
+    if not ADMISSION_ENABLED:
+        return await call_next(request)
+    gate = admission_gates[cls]
+    reason = "shed" if cls == "background" and critical_saturated() else await gate.enter()
+    if reason is not None:
+        metrics.inc("riwa_admission_rejections_total", request_class=cls, reason=reason)
+        return JSONResponse(
+            status_code=429 if reason == "queue_full" else 503,
+            content={"detail": f"Server busy ({cls} requests: {reason.replace('_', ' ')}), retry later"},
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER[cls])}
+        )
+    try:
+        response = await call_next(request)
+    except BaseException:
+        gate.leave()
+        raise
+    # call_next returns once the headers are ready; streamed bodies (the menu
+    # export) keep querying Supabase until sent, so they keep the slot till then
+    return AdmittedResponse(response, gate)
+
+@app.middleware("http")
+async def rate_limit_middleware(request: Request, call_next):
+    """Reject clients that exceed their route's token bucket before they cost anything"""
+    rule = rate_limit_rule(request.method, request.url.path) if RATE_LIMIT_ENABLED else None
+    if rule is None:
+        return await call_next(request)
+    method, prefix, rate, burst = rule
+    wait = await rate_limiter.hit(f"{method} {prefix}|{rate_limit_identity(request, prefix)}", rate, burst)
+    if wait > 0:
+        metrics.inc("riwa_rate_limited_total", rule=f"{method} {prefix}")
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Too many requests, slow down"},
+            headers={"Retry-After": str(max(1, math.ceil(wait)))}
+        )
+    return await call_next(request)
+
+@app.middleware("http")
+async def tenant_middleware(request: Request, call_next):
+    """Resolve the tenant and branch for this request"""
+    try:
+        scope = resolve_tenant_scope(
+            request.headers.get("authorization"),
+            request.headers.get("x-tenant-id"),
+            request.headers.get("x-branch-id"),
+            request.client.host if request.client else None
+        )
+    except PermissionError as e:
+        return JSONResponse(status_code=403, content={"detail": str(e)})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"detail": str(e)})
+    _tenant_scope.set(scope)
+    return await call_next(request)
+
+@app.middleware("http")
+async def observability_middleware(request: Request, call_next):
+    """Record per-route metrics and trace the upstream calls each request makes"""
+    trace = start_request_trace()
+    start = trace["start"]
+    status = 500
+    response = None
+    metrics.add_gauge("riwa_http_requests_in_flight", 1)
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.add_gauge("riwa_http_requests_in_flight", -1)
+        total_ms = (time.perf_counter() - start) * 1000
+        # Label by route template (/api/orders/{order_id}), not the raw path, to bound cardinality
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        metrics.observe("riwa_http_request_duration_seconds", total_ms / 1000, route=path, method=request.method)
+        metrics.inc("riwa_http_requests_total", route=path, method=request.method, status=str(status))
+
+        summary = summarize_trace(trace)
+        if response is not None:
+            response.headers["Server-Timing"] = server_timing_header(summary, total_ms)
+        upstream_calls = summary.get("supabase", {}).get("count", 0)
+        if total_ms > SLOW_REQUEST_MS or upstream_calls > UPSTREAM_CALL_BUDGET:
+            by_target: Dict[str, int] = {}
+            for span in trace["spans"]:
+                label = f'{span["method"]} {span["name"]}'
+                by_target[label] = by_target.get(label, 0) + 1
+            logger.warning(
+                f"Slow request {request.method} {path}: {total_ms:.0f}ms, "
+                f"{upstream_calls} upstream calls (budget {UPSTREAM_CALL_BUDGET}), breakdown={by_target}"
+            )
+        try:
+            export_trace(trace, path, request.method, status, total_ms)
+        except Exception as e:
+            logger.error(f"Trace export error: {e}")
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""
+RIWA POS load benchmark.
+
+Starts the FastAPI backend against an in-process fake Supabase PostgREST
+server (configurable latency/jitter) and a fake ESC/POS network printer,
+then drives realistic traffic mixes at a target concurrency and reports
+p50/p95/p99 latency, requests per second and upstream calls per request.
+
+Results are written to test_reports/benchmarks/ so runs can be compared:
+
+    python backend_benchmark.py --concurrency 20 --duration 30
+    python backend_benchmark.py --compare test_reports/benchmarks/<previous>.json
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+ROOT_DIR = Path(__file__).parent
+RESULTS_DIR = ROOT_DIR / "test_reports" / "benchmarks"
+
+BENCH_TENANT_ID = "af8d6568-fb4d-43ce-a97d-8cebca6a44d9"
+BENCH_BRANCH_ID = "d73bf34c-5c8c-47c8-9518-b85c7447ebde"
+
+DEFAULT_MIX = "checkout=4,kds=3,menu=2,dashboard=1"
+
+
+# ==================== FAKE POSTGREST ====================
+
+class FakePostgrest:
+    """In-memory stand-in for the Supabase PostgREST API used by server.py"""
+
+    def __init__(self, latency_ms: float, jitter_ms: float, seed: int = 7):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tables = {}
+        self.calls = 0
+        self.random = random.Random(seed)
+
+    async def _delay(self):
+        delay = self.random.gauss(self.latency_ms, self.jitter_ms) / 1000
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _coerce(value):
+        if value == "null":
+            return None
+        if value in ("true", "false"):
+            return value == "true"
+        return value
+
+    @classmethod
+    def _matches(cls, row, column, expression):
+        op, _, raw = expression.partition(".")
+        if op == "not":
+            return not cls._matches(row, column, raw)
+        actual = row.get(column)
+        if op == "in":
+            return str(actual) in [v.strip('"') for v in raw.strip("()").split(",") if v]
+        if op == "is":
+            return actual is cls._coerce(raw)
+        expected = cls._coerce(raw)
+        if op == "eq":
+            return str(actual).lower() == str(expected).lower() if isinstance(actual, bool) else str(actual) == str(expected)
+        if op == "neq":
+            return str(actual) != str(expected)
+        if actual is None:
+            return False
+        try:
+            left, right = float(actual), float(expected)
+        except (TypeError, ValueError):
+            left, right = str(actual), str(expected)
+        return {"gt": left > right, "gte": left >= right, "lt": left < right, "lte": left <= right}.get(op, False)
+
+    def _filter(self, table, params):
+        rows = self.tables.setdefault(table, [])
+        filters = [(k, v) for k, v in params if k not in ("select", "order", "limit", "offset", "on_conflict")]
+        return [row for row in rows if all(self._matches(row, k, v) for k, v in filters)]
+
+    @staticmethod
+    def _apply_order_limit(rows, params):
+        options = dict(params)
+        for clause in reversed(options.get("order", "").split(",")):
+            if not clause:
+                continue
+            column, _, direction = clause.partition(".")
+            rows.sort(key=lambda r: (r.get(column) is None, str(r.get(column)) if not isinstance(r.get(column), (int, float)) else r.get(column)),
+                      reverse=direction.startswith("desc"))
+        offset = int(options.get("offset", 0))
+        if "limit" in options:
+            return rows[offset:offset + int(options["limit"])]
+        return rows[offset:]
+
+    async def handle(self, request: Request):
+        self.calls += 1
+        await self._delay()
+        table = request.path_params["table"]
+        params = parse_qsl(request.url.query, keep_blank_values=True)
+        prefer = request.headers.get("prefer", "")
+
+        if request.method == "GET":
+            rows = self._apply_order_limit(list(self._filter(table, params)), params)
+            return JSONResponse(copy.deepcopy(rows))
+
+        if request.method == "POST":
+            body = await request.json()
+            rows = body if isinstance(body, list) else [body]
+            stored = self.tables.setdefault(table, [])
+            if "merge-duplicates" in prefer:
+                conflict = dict(params).get("on_conflict", "id").split(",")
+                for row in rows:
+                    key = [row.get(c) for c in conflict]
+                    existing = next((r for r in stored if [r.get(c) for c in conflict] == key), None)
+                    if existing is not None:
+                        existing.update(row)
+                    else:
+                        stored.append(dict(row))
+            else:
+                stored.extend(dict(row) for row in rows)
+            return JSONResponse(copy.deepcopy(rows), status_code=201)
+
+        if request.method == "PATCH":
+            body = await request.json()
+            matched = self._filter(table, params)
+            for row in matched:
+                row.update(body)
+            return JSONResponse(copy.deepcopy(matched))
+
+        if request.method == "DELETE":
+            matched = self._filter(table, params)
+            ids = {id(row) for row in matched}
+            self.tables[table] = [row for row in self.tables.get(table, []) if id(row) not in ids]
+            return JSONResponse(copy.deepcopy(matched))
+
+        return JSONResponse({"message": "method not allowed"}, status_code=405)
+
+    def app(self):
+        return Starlette(routes=[
+            Route("/rest/v1/{table}", self.handle, methods=["GET", "POST", "PATCH", "DELETE"])
+        ])
+
+    def seed(self, printer_port: int, categories: int = 8, items_per_category: int = 8, open_orders: int = 25):
+        """Populate tables with a realistic single-branch menu and some open orders"""
+        now = datetime.now(timezone.utc)
+        t = self.tables
+        t["users"] = [{
+            "id": str(uuid.uuid4()), "name": "Cashier 1", "email": "cashier1@riwa.test", "role": "cashier",
+            "pin": "1234", "tenant_id": BENCH_TENANT_ID, "branch_id": BENCH_BRANCH_ID
+        }]
+        t["modifier_groups"] = []
+        t["modifiers"] = []
+        for g in range(4):
+            group_id = str(uuid.uuid4())
+            t["modifier_groups"].append({"id": group_id, "name_en": f"Extras {g}", "status": "active", "tenant_id": BENCH_TENANT_ID})
+            for m in range(4):
+                t["modifiers"].append({
+                    "id": str(uuid.uuid4()), "modifier_group_id": group_id, "name_en": f"Extra {g}-{m}",
+                    "price": 0.1 * (m + 1), "status": "active", "sort_order": m
+                })
+        t["categories"], t["items"], t["item_variants"] = [], [], []
+        for c in range(categories):
+            category_id = str(uuid.uuid4())
+            t["categories"].append({
+                "id": category_id, "tenant_id": BENCH_TENANT_ID, "name_en": f"Category {c}", "name_ar": "",
+                "status": "active", "sort_order": c, "updated_at": now.isoformat()
+            })
+            for i in range(items_per_category):
+                item_id = str(uuid.uuid4())
+                t["items"].append({
+                    "id": item_id, "tenant_id": BENCH_TENANT_ID, "category_id": category_id,
+                    "name_en": f"Item {c}-{i}", "name_ar": "", "base_price": round(1.25 + 0.25 * i, 3),
+                    "status": "active", "sort_order": i, "updated_at": now.isoformat(),
+                    "modifier_group_ids": [g["id"] for g in t["modifier_groups"][:2]] if i % 2 == 0 else []
+                })
+                for v in range(2):
+                    t["item_variants"].append({
+                        "id": str(uuid.uuid4()), "item_id": item_id, "name_en": ["Regular", "Large"][v],
+                        "price": round(0.5 * v, 3), "status": "active", "sort_order": v
+                    })
+        t["printer_configs"] = [{
+            "id": str(uuid.uuid4()), "tenant_id": BENCH_TENANT_ID, "branch_id": BENCH_BRANCH_ID,
+            "name": "Bench Cashier", "ip_address": "127.0.0.1", "port": printer_port, "enabled": True,
+            "open_drawer_before": False, "open_drawer_after": False, "created_at": now.isoformat(),
+            "updated_at": now.isoformat()
+        }]
+        t["system_settings"] = [{"id": str(uuid.uuid4()), "tenant_id": BENCH_TENANT_ID, "branch_id": BENCH_BRANCH_ID,
+                                 "currency": "KWD", "updated_at": now.isoformat()}]
+        t["orders"], t["order_items"], t["order_states"] = [], [], []
+        for o in range(open_orders):
+            order_id = str(uuid.uuid4())
+            created = (now - timedelta(minutes=open_orders - o)).isoformat()
+            t["orders"].append({
+                "id": order_id, "tenant_id": BENCH_TENANT_ID, "branch_id": BENCH_BRANCH_ID,
+                "order_number": f"001-{o:03d}-000000", "order_type": "qsr", "channel": "walkin",
+                "status": ["pending", "accepted", "preparing"][o % 3], "subtotal": 3.0, "total_amount": 3.0,
+                "created_at": created, "updated_at": created
+            })
+            for _ in range(3):
+                item = self.random.choice(t["items"])
+                t["order_items"].append({
+                    "id": str(uuid.uuid4()), "order_id": order_id, "item_id": item["id"],
+                    "item_name_en": item["name_en"], "quantity": 1, "unit_price": item["base_price"],
+                    "total_price": item["base_price"], "status": "pending", "created_at": created
+                })
+
+
+# ==================== FAKE PRINTER ====================
+
+class FakePrinter:
+    """Accepts raw ESC/POS jobs on a TCP port and counts them"""
+
+    def __init__(self):
+        self.jobs = 0
+        self.bytes = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        data = await reader.read()
+        self.jobs += 1
+        self.bytes += len(data)
+        writer.close()
+
+
+# ==================== WORKLOADS ====================
+
+class Workload:
+    """Realistic request mixes against the running API"""
+
+    def __init__(self, client: httpx.AsyncClient, fake: FakePostgrest, token: str, rng: random.Random):
+        self.client = client
+        self.fake = fake
+        self.token = token
+        self.rng = rng
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+    async def checkout(self, record):
+        items = self.rng.sample(self.fake.tables["items"], k=self.rng.randint(1, 5))
+        lines = [{
+            "item_id": i["id"], "name": i["name_en"], "quantity": 1,
+            "unit_price": i["base_price"], "total_price": i["base_price"]
+        } for i in items]
+        total = round(sum(line["total_price"] for line in lines), 3)
+        response = await record("checkout.create_order", "POST", "/api/orders/create", json={
+            "order_type": "qsr", "order_source": "walkin", "items": lines, "subtotal": total,
+            "total": total, "payment_method": "cash", "cash_received": total, "change_due": 0
+        }, headers=self._headers())
+        if response is None or response.status_code != 200:
+            return
+        order_id = response.json()["order"]["id"]
+        printer_id = self.fake.tables["printer_configs"][0]["id"]
+        await record("checkout.direct_print", "POST", "/api/prints/direct", json={
+            "printer_id": printer_id, "order_id": order_id, "receipt_data": {
+                "order_number": response.json()["order"]["order_number"], "items": lines, "total": total
+            }
+        })
+        await record("checkout.update_status", "PATCH", "/api/orders/update-status",
+                     json={"order_id": order_id, "status": "accepted"}, headers=self._headers())
+
+    async def kds(self, record):
+        response = await record("kds.poll", "GET", "/api/kds/items")
+        if response is not None and response.status_code == 200 and self.rng.random() < 0.3:
+            items = response.json().get("items", [])
+            if items:
+                await record("kds.bump", "POST", "/api/kds/bump", json={"kds_item_id": self.rng.choice(items)["id"]})
+
+    async def menu(self, record):
+        await record("menu.categories", "GET", "/api/menu/categories")
+        category = self.rng.choice(self.fake.tables["categories"])
+        await record("menu.items", "GET", f"/api/menu/items?category_id={category['id']}")
+        item = self.rng.choice(self.fake.tables["items"])
+        await record("menu.item_details", "GET", f"/api/menu/item/{item['id']}")
+
+    async def dashboard(self, record):
+        await record("dashboard.stats", "GET", "/api/admin/dashboard")
+        await record("dashboard.orders", "GET", "/api/orders?limit=50")
+        today = datetime.now(timezone.utc).date().isoformat()
+        await record("dashboard.report", "GET", f"/api/admin/reports/orders?start_date={today}&end_date={today}")
+
+
+# ==================== RUNNER ====================
+
+UPSTREAM_TIMING = re.compile(r'supabase;dur=([\d.]+);desc="(\d+) calls"')
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples, elapsed):
+    def stats(entries):
+        # Rejections (429/503 from admission control and rate limiting) are
+        # errors; latency and throughput are measured over 2xx responses only
+        ok = [e for e in entries if 200 <= e["status"] < 300]
+        latencies = [e["latency_ms"] for e in ok]
+        statuses = {}
+        for e in entries:
+            statuses[str(e["status"])] = statuses.get(str(e["status"]), 0) + 1
+        return {
+            "requests": len(entries),
+            "errors": len(entries) - len(ok),
+            "statuses": dict(sorted(statuses.items())),
+            "rps": round(len(ok) / elapsed, 2) if elapsed else 0,
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "upstream_calls_per_request": round(sum(e["upstream_calls"] for e in entries) / len(entries), 2) if entries else 0,
+        }
+
+    by_op = {}
+    for sample in samples:
+        by_op.setdefault(sample["op"], []).append(sample)
+    return {"overall": stats(samples), "operations": {op: stats(entries) for op, entries in sorted(by_op.items())}}
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_uvicorn(app, port, lifespan="off"):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan=lifespan))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    printer = FakePrinter()
+    printer_server = await asyncio.start_server(printer.handle, "127.0.0.1", 0)
+    printer_port = printer_server.sockets[0].getsockname()[1]
+
+    fake = FakePostgrest(args.latency_ms, args.jitter_ms, seed=args.seed)
+    fake.seed(printer_port)
+    postgrest_port = free_port()
+    postgrest_server, postgrest_task = await start_uvicorn(fake.app(), postgrest_port)
+
+    # server.py reads its configuration at import time
+    os.environ["SUPABASE_URL"] = f"http://127.0.0.1:{postgrest_port}"
+    os.environ.setdefault("SUPABASE_LEGACY_JWT_SECRET", "benchmark-secret")
+    os.environ.setdefault("SUPABASE_PUBLIC_ANON_KEY", "benchmark-anon-key")
+    os.environ.setdefault("ORDER_JOURNAL_PATH", str(Path(tempfile.mkdtemp()) / "order_journal.db"))
+    os.environ.setdefault("SUPABASE_SECRET_SERVICE_ROLE_KEY", "benchmark-service-key")
+    sys.path.insert(0, str(ROOT_DIR / "backend"))
+    import server as riwa_server
+    riwa_server.logging.getLogger("httpx").setLevel("WARNING")
+    if not args.verbose:
+        riwa_server.logger.setLevel("ERROR")
+
+    api_port = free_port()
+    api_server, api_task = await start_uvicorn(riwa_server.app, api_port, lifespan="on")
+
+    mix = {}
+    for part in args.mix.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+
+    samples = []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{api_port}", limits=limits, timeout=30) as client:
+        login = await client.post("/api/auth/pin-login", json={"username": "Cashier 1", "pin": "1234"})
+        login.raise_for_status()
+        workload = Workload(client, fake, login.json()["token"], rng)
+
+        def recorder(device_id):
+            # Each worker is its own terminal, so per-client rate limits apply per worker
+            async def record(op, method, path, headers=None, **kwargs):
+                return await send(op, method, path, headers={"X-Device-ID": device_id, **(headers or {})}, **kwargs)
+            return record
+
+        async def send(op, method, path, **kwargs):
+            start = time.perf_counter()
+            response, status, upstream = None, 0, 0
+            try:
+                response = await client.request(method, path, **kwargs)
+                status = response.status_code
+                match = UPSTREAM_TIMING.search(response.headers.get("server-timing", ""))
+                upstream = int(match.group(2)) if match else 0
+            except httpx.HTTPError:
+                pass
+            samples.append({"op": op, "status": status, "upstream_calls": upstream,
+                            "latency_ms": (time.perf_counter() - start) * 1000})
+            return response
+
+        scenarios, weights = list(mix), list(mix.values())
+        deadline = time.perf_counter() + args.duration
+
+        async def worker(index):
+            record = recorder(f"bench-{index}")
+            while time.perf_counter() < deadline:
+                scenario = rng.choices(scenarios, weights)[0]
+                await getattr(workload, scenario)(record)
+
+        print(f"Running {args.mix} at concurrency {args.concurrency} for {args.duration}s "
+              f"(upstream latency {args.latency_ms}±{args.jitter_ms}ms)")
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(index) for index in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    # The API flushes write-behind rows on shutdown, so stop it before the fake upstream
+    api_server.should_exit = True
+    await api_task
+    postgrest_server.should_exit = True
+    await postgrest_task
+    printer_server.close()
+
+    result = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "concurrency": args.concurrency, "duration": args.duration, "mix": args.mix,
+            "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "seed": args.seed
+        },
+        "elapsed_s": round(elapsed, 3),
+        "upstream_calls_total": fake.calls,
+        "printer_jobs": printer.jobs,
+        **summarize(samples, elapsed)
+    }
+    return result
+
+
+def print_report(result):
+    print(f"\n{'operation':<26}{'reqs':>7}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'up/req':>8}")
+    rows = list(result["operations"].items()) + [("OVERALL", result["overall"])]
+    for op, s in rows:
+        print(f"{op:<26}{s['requests']:>7}{s['errors']:>6}{s['rps']:>9.1f}{s['p50_ms']:>9.1f}"
+              f"{s['p95_ms']:>9.1f}{s['p99_ms']:>9.1f}{s['upstream_calls_per_request']:>8.2f}")
+    failed = [(op, s["statuses"]) for op, s in rows if s["errors"]]
+    if failed:
+        print("\nNon-2xx responses (status 0 = connection error):")
+        for op, statuses in failed:
+            breakdown = ", ".join(f"{code} x{count}" for code, count in statuses.items() if not code.startswith("2"))
+            print(f"  {op:<26}{breakdown}")
+    print(f"\nUpstream calls: {result['upstream_calls_total']}, printer jobs: {result['printer_jobs']}")
+
+
+def compare(result, baseline, threshold):
+    """Print deltas against a previous run; returns True if any p95 regressed beyond threshold"""
+    regressed = False
+    print(f"\nComparison against baseline from {baseline['timestamp']} (threshold {threshold:.0%}):")
+    for op, current in list(result["operations"].items()) + [("OVERALL", result["overall"])]:
+        previous = baseline["operations"].get(op) if op != "OVERALL" else baseline["overall"]
+        if not previous or not previous["p95_ms"]:
+            continue
+        change = (current["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"]
+        calls = current["upstream_calls_per_request"] - previous["upstream_calls_per_request"]
+        flag = ""
+        if change > threshold or calls > 0.5:
+            flag = "  <-- REGRESSION"
+            regressed = True
+        print(f"  {op:<26} p95 {previous['p95_ms']:>8.1f} -> {current['p95_ms']:>8.1f} ms ({change:+.0%}), "
+              f"upstream/req {calls:+.2f}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RIWA POS backend load benchmark")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="scenario weights, e.g. checkout=4,kds=3,menu=2,dashboard=1")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="fake PostgREST mean latency")
+    parser.add_argument("--jitter-ms", type=float, default=5.0, help="fake PostgREST latency std deviation")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="result file (default: test_reports/benchmarks/bench_<timestamp>.json)")
+    parser.add_argument("--compare", help="previous result file to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=0.2, help="allowed p95 increase (fraction)")
+    parser.add_argument("--verbose", action="store_true", help="show server warnings such as slow-request logs")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        return 1 if compare(result, baseline, args.regression_threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
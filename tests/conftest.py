@@ -0,0 +1,13 @@
+import os
+import sys
+from pathlib import Path
+
+# server.py reads its configuration at import time
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_SECRET_SERVICE_ROLE_KEY", "test-service-key")
+os.environ.setdefault("SUPABASE_PUBLIC_ANON_KEY", "test-anon-key")
+os.environ.setdefault("SUPABASE_LEGACY_JWT_SECRET", "test-secret")
+os.environ.setdefault("ORDER_JOURNAL_ENABLED", "false")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import server
+
+
+@pytest.fixture
+def gates(monkeypatch):
+    gates = {cls: server.AdmissionGate(cls, 1, 1) for cls in server.REQUEST_CLASSES}
+    monkeypatch.setattr(server, "admission_gates", gates)
+    monkeypatch.setattr(server, "ADMISSION_ENABLED", True)
+    return gates
+
+
+def test_gate_queues_then_hands_the_slot_over_in_order():
+    async def scenario():
+        gate = server.AdmissionGate("normal", 1, 2)
+        assert await gate.enter() is None
+        first = asyncio.create_task(gate.enter())
+        second = asyncio.create_task(gate.enter())
+        await asyncio.sleep(0)
+        assert await gate.enter() == "queue_full"
+        gate.leave()
+        assert await first is None and not second.done()
+        assert gate.active == 1
+        gate.leave()
+        assert await second is None
+        gate.leave()
+        assert gate.active == 0 and not gate.waiters
+
+    asyncio.run(scenario())
+
+
+def test_queued_requests_time_out(monkeypatch):
+    monkeypatch.setattr(server, "ADMISSION_QUEUE_TIMEOUT", 0.01)
+
+    async def scenario():
+        gate = server.AdmissionGate("normal", 1, 1)
+        await gate.enter()
+        assert await gate.enter() == "queue_timeout"
+        assert gate.active == 1 and not gate.waiters
+
+    asyncio.run(scenario())
+
+
+def test_upstream_permits_go_to_the_highest_class_first():
+    async def scenario():
+        scheduler = server.UpstreamScheduler(1, {"critical": 1, "normal": 1, "background": 1})
+        assert await scheduler.acquire("normal", 1)
+        background = asyncio.create_task(scheduler.acquire("background", 1))
+        await asyncio.sleep(0)
+        critical = asyncio.create_task(scheduler.acquire("critical", 1))
+        await asyncio.sleep(0)
+        scheduler.release("normal")
+        assert await critical and not background.done()
+        scheduler.release("critical")
+        assert await background
+        assert scheduler.in_use == 1 and scheduler.by_class["background"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_class_caps_let_lower_classes_past_a_capped_one():
+    async def scenario():
+        scheduler = server.UpstreamScheduler(3, {"critical": 2, "normal": 2, "background": 1})
+        assert await scheduler.acquire("background", 1)
+        assert not await scheduler.acquire("background", 0.01)
+        assert await scheduler.acquire("critical", 1) and await scheduler.acquire("normal", 1)
+
+    asyncio.run(scenario())
+
+
+def test_streamed_bodies_keep_their_slot_until_sent(gates):
+    seen = []
+
+    async def export(request):
+        async def body():
+            for chunk in (b"a", b"b"):
+                seen.append(gates["background"].active)
+                yield chunk
+        return StreamingResponse(body())
+
+    app = Starlette(routes=[Route("/api/admin/menu/export", export)])
+    app.add_middleware(BaseHTTPMiddleware, dispatch=server.admission_middleware)
+
+    assert TestClient(app).get("/api/admin/menu/export").content == b"ab"
+    assert seen == [1, 1]
+    assert gates["background"].active == 0
+
+
+def test_background_work_is_shed_while_critical_requests_queue(gates, monkeypatch):
+    monkeypatch.setattr(server, "critical_saturated", lambda: True)
+
+    async def report(request):
+        return StreamingResponse(iter([b"report"]))
+
+    app = Starlette(routes=[Route("/api/admin/reports/sales", report)])
+    app.add_middleware(BaseHTTPMiddleware, dispatch=server.admission_middleware)
+
+    response = TestClient(app).get("/api/admin/reports/sales")
+    assert response.status_code == 503 and response.headers["Retry-After"] == str(server.ADMISSION_RETRY_AFTER["background"])
+    assert gates["background"].active == 0
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+import server
+
+PHONE = "+96555551234"
+
+
+def order(order_id, at, name="Mohammed Ahmed"):
+    return {"id": order_id, "customer_phone": PHONE, "customer_name": name,
+            "delivery_address": None, "created_at": at}
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    monkeypatch.setattr(server, "CUSTOMER_INDEX_PAGE_SIZE", 2)
+    monkeypatch.setattr(server, "_customer_directories", {})
+    state = {"rows": [order(f"o{i}", f"2026-01-0{9 - i}") for i in range(3)], "calls": 0, "on_page": None,
+             "gate": None}
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        state["calls"] += 1
+        offset = int(endpoint.rsplit("offset=", 1)[1])
+        if state["on_page"]:
+            state["on_page"](offset)
+        if state["gate"] and offset:
+            await state["gate"].wait()
+        return server.StorageResponse(200, state["rows"][offset:offset + 2])
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    return state
+
+
+def count():
+    return server._customer_directories[server.current_tenant_id()].customers[PHONE]["orders_count"]
+
+
+def test_orders_created_during_a_refresh_are_counted_once(upstream):
+    async def run():
+        directory = await server.get_customer_directory()
+        await directory.building
+        assert count() == 3
+
+        new = order("o9", "2026-02-01")
+
+        def on_page(offset):
+            if offset == 0:
+                # A new order is published and also shifts the next page by one
+                upstream["rows"].insert(0, new)
+                server.index_order_customer({"tenant_id": server.current_tenant_id(), "order": new})
+
+        upstream["on_page"] = on_page
+        directory.built_at = 0.0
+        directory.building = asyncio.create_task(directory.build())
+        await directory.building
+        assert count() == 4
+
+    asyncio.run(run())
+
+
+def test_first_search_waits_for_one_page_only(upstream):
+    async def run():
+        upstream["gate"] = asyncio.Event()
+        directory = await server.get_customer_directory()
+        assert not directory.building.done()
+        assert directory.search("mohammed", 5)
+        upstream["gate"].set()
+        await directory.building
+        assert count() == 3
+
+    asyncio.run(run())
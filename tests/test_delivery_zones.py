@@ -0,0 +1,59 @@
+import asyncio
+
+import server
+
+INDEX = server.build_zone_index([
+    {"id": "z1", "zone_name": "Block 1", "areas": ["Salmiya Block 1"]},
+    {"id": "z10", "zone_name": "Block 10", "areas": ["Salmiya  Block 10"]},
+    {"id": "z2", "zone_name": "Salmiya", "areas": ["Salmiya"]},
+])
+
+
+def zone_for(address):
+    zone = server.resolve_zone(INDEX, address=address)
+    return zone and zone["id"]
+
+
+def test_area_must_match_whole_words():
+    assert zone_for("Street 5, Salmiya Block 10, House 3") == "z10"
+    assert zone_for("salmiya block 1, street 12") == "z1"
+
+
+def test_punctuation_and_spacing_are_ignored():
+    assert zone_for("SALMIYA - block   1") == "z1"
+
+
+def test_falls_back_to_the_wider_area():
+    assert zone_for("Salmiya, Block 12") == "z2"
+    assert zone_for("Salmiyah") is None
+
+
+def test_zone_edits_from_another_worker_are_picked_up(monkeypatch):
+    monkeypatch.setattr(server, "ZONE_VERSION_CHECK_SECONDS", 0)
+    monkeypatch.setattr(server, "_zone_checked_at", {})
+    zones = [{"id": "z1", "zone_name": "Salmiya", "areas": ["Salmiya"], "delivery_fee": 1.0,
+              "updated_at": "2026-01-01T00:00:00+00:00"}]
+    loads = []
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        if "select=id,updated_at" not in endpoint:
+            loads.append(endpoint)
+        return server.StorageResponse(200, [dict(zone) for zone in zones])
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+
+    async def fee():
+        index = await server.load_zone_index()
+        return server.resolve_zone(index, address="Salmiya")["delivery_fee"]
+
+    async def run():
+        server.invalidate_cache("zones:")
+        assert await fee() == 1.0
+        assert await fee() == 1.0
+        assert len(loads) == 1
+        # Another worker edits the zone; only its own cache was invalidated
+        zones[0].update(delivery_fee=2.0, updated_at="2026-01-02T00:00:00+00:00")
+        assert await fee() == 2.0
+        assert len(loads) == 2
+
+    asyncio.run(run())
@@ -0,0 +1,77 @@
+import asyncio
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+
+def cursor(days_ago=0, day=None, **overrides):
+    at = datetime.now(timezone.utc) - timedelta(days=days_ago)
+    payload = {"v": server.SYNC_CURSOR_VERSION, "t": server.current_tenant_id(), "b": server.current_branch_id(),
+               "ts": at.isoformat(), "d": day or at.date().isoformat(), **overrides}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Records sync queries; serves printer rows in pages and tombstones for orders and printers"""
+    calls = []
+    printers = [{"id": f"p{n}"} for n in range(5)]
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        calls.append(endpoint)
+        offset = int(endpoint.rsplit("&offset=", 1)[1])
+        if endpoint.startswith("printer_configs?"):
+            return server.StorageResponse(200, printers[offset:offset + server.SYNC_PAGE_SIZE])
+        if endpoint.startswith("sync_tombstones?"):
+            tombstones = [{"table_name": "orders", "row_id": "o1"}, {"table_name": "printer_configs", "row_id": "p9"}]
+            return server.StorageResponse(200, tombstones[offset:offset + server.SYNC_PAGE_SIZE])
+        return server.StorageResponse(200, [])
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    monkeypatch.setattr(server, "SYNC_PAGE_SIZE", 2)
+    return calls
+
+
+def test_cursor_round_trips():
+    now = datetime.now(timezone.utc)
+    payload = server.decode_sync_cursor(server.encode_sync_cursor(now, "2026-01-01"))
+    assert payload["ts"] == now.isoformat() and payload["d"] == "2026-01-01"
+
+
+@pytest.mark.parametrize("raw", [
+    None, "", "not-base64!", cursor(t="another-tenant"), cursor(b="another-branch"),
+    cursor(v=server.SYNC_CURSOR_VERSION - 1), cursor(days_ago=server.SYNC_TOMBSTONE_RETENTION_DAYS + 1),
+])
+def test_unusable_cursors_ask_for_a_full_snapshot(raw):
+    assert server.decode_sync_cursor(raw) is None
+
+
+def test_sources_are_paged_past_the_max_rows_cap(upstream):
+    result = asyncio.run(server.delta_sync(None))
+
+    assert result["full"] and [p["id"] for p in result["changes"]["printers"]] == ["p0", "p1", "p2", "p3", "p4"]
+    offsets = [call.rsplit("&offset=", 1)[1] for call in upstream if call.startswith("printer_configs?")]
+    assert offsets == ["0", "2", "4"]
+
+
+def test_orders_reset_at_midnight(upstream):
+    result = asyncio.run(server.delta_sync(cursor(day="2000-01-01")))
+
+    assert result["reset"] == ["orders"]
+    orders = next(call for call in upstream if call.startswith("orders?"))
+    items = next(call for call in upstream if call.startswith("items?"))
+    assert "updated_at=gt." not in orders and "updated_at=gt." in items
+    # Tombstones of a reset source are moot: the client replaces it
+    assert result["deleted"] == {"printers": ["p9"]}
+
+
+def test_delta_sends_tombstones(upstream):
+    result = asyncio.run(server.delta_sync(cursor()))
+
+    assert result["reset"] == [] and not result["full"]
+    assert result["deleted"] == {"orders": ["o1"], "printers": ["p9"]}
+    assert server.decode_sync_cursor(result["cursor"])["d"] == datetime.now(timezone.utc).date().isoformat()
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+import server
+
+TENANT = "t1"
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = server.DeviceRegistry()
+    monkeypatch.setattr(server, "device_registry", registry)
+    return registry
+
+
+def beat(**fields):
+    return server.DeviceHeartbeat(**{"device_id": "till-1", "name": "Till 1", **fields})
+
+
+def test_only_changed_or_overdue_devices_are_dirty(registry):
+    registry.heartbeat(TENANT, "b1", beat(), "192.0.2.1")
+    assert [r["device_id"] for r in registry.take_dirty()] == ["till-1"]
+    record = registry.devices[TENANT]["till-1"]
+    record["persisted_at"] = server.time.time()
+
+    registry.heartbeat(TENANT, "b1", beat(poll_latency_ms=40), "192.0.2.1")
+    assert not registry.dirty
+    registry.heartbeat(TENANT, "b1", beat(printer_status={"kitchen": "paper_out"}), "192.0.2.1")
+    assert registry.take_dirty() == [record]
+
+    record["persisted_at"] -= server.DEVICE_PERSIST_SECONDS
+    registry.heartbeat(TENANT, "b1", beat(printer_status={"kitchen": "paper_out"}), "192.0.2.1")
+    assert registry.dirty == {(TENANT, "till-1")}
+
+
+def test_failed_persist_keeps_devices_dirty(registry, monkeypatch):
+    statuses = [503, 201]
+    posted = []
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        posted.append(data)
+        return server.StorageResponse(statuses.pop(0))
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    registry.heartbeat(TENANT, "b1", beat(), "192.0.2.1")
+
+    assert asyncio.run(server.persist_devices()) is False
+    assert registry.dirty == {(TENANT, "till-1")}
+    assert asyncio.run(server.persist_devices()) is True
+    assert not registry.dirty and registry.devices[TENANT]["till-1"]["persisted_at"] > 0
+    assert [row["device_id"] for row in posted[1]] == ["till-1"]
+    # Nothing dirty: no request
+    assert asyncio.run(server.persist_devices()) is True and len(posted) == 2
+
+
+@pytest.mark.parametrize("age, state", [
+    (0, "online"), (server.DEVICE_STALE_SECONDS, "stale"), (server.DEVICE_OFFLINE_SECONDS, "offline"),
+])
+def test_devices_go_stale_then_offline(age, state):
+    assert server.device_state(1000.0 - age, 1000.0) == state
+
+
+def test_never_seen_devices_are_offline():
+    assert server.device_state(None, 1000.0) == "offline"
+
+
+def test_heartbeat_records_the_terminal_behind_a_trusted_ingress(registry, monkeypatch):
+    monkeypatch.setattr(server, "TENANT_TRUSTED_PROXIES", [server.ipaddress.ip_network("10.0.0.0/8")])
+    request = Request({"type": "http", "method": "POST", "path": "/api/devices/heartbeat",
+                       "headers": [(b"x-forwarded-for", b"192.0.2.44")], "client": ("10.0.0.5", 50000)})
+
+    asyncio.run(server.device_heartbeat(beat(), request))
+
+    record = registry.devices[server.current_tenant_id()]["till-1"]
+    assert record["ip_address"] == "192.0.2.44"
+    assert server.device_health(record, record["last_seen"])["status"] == "online"
@@ -0,0 +1,112 @@
+import asyncio
+from urllib.parse import unquote
+
+import pytest
+
+import server
+
+
+class FakeUpstream:
+    """PostgREST stand-in for the edge sync: rejects rows marked bad, records pulls"""
+
+    def __init__(self, status=400):
+        self.status = status
+        self.upserted = []
+        self.endpoints = []
+
+    async def request(self, method, endpoint, data, use_service_key, prefer):
+        self.endpoints.append(endpoint)
+        if method == "GET":
+            return server.StorageResponse(200, [])
+        if any(row.get("bad") for row in data):
+            return server.StorageResponse(self.status, {"message": "violates check constraint"})
+        self.upserted.extend(row["id"] for row in data)
+        return server.StorageResponse(201)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = server.SqliteBackend(str(tmp_path / "edge.db"))
+    asyncio.run(store.start())
+    yield store
+    asyncio.run(store.close())
+
+
+def test_rejected_rows_are_dead_lettered_and_the_rest_pushed(store):
+    store._write("orders", {"id": "o1"})
+    store._write("orders", {"id": "o2", "bad": True})
+    store._write("orders", {"id": "o3"})
+    upstream = FakeUpstream()
+
+    assert asyncio.run(server.edge_push(store, upstream)) == 3
+
+    assert sorted(upstream.upserted) == ["o1", "o3"]
+    assert store.outbox_size() == 0
+    assert store.dead_outbox_size() == 1
+    assert store.requeue_dead_outbox() == 1
+    assert store.outbox(10)[0][1:] == ("orders", "o2", "upsert")
+
+
+def test_transient_failures_keep_the_outbox(store):
+    store._write("orders", {"id": "o1", "bad": True})
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.edge_push(store, FakeUpstream(status=503)))
+    assert store.outbox_size() == 1
+    assert store.dead_outbox_size() == 0
+
+
+def test_pulls_are_scoped_to_the_edge_tenant(store, monkeypatch):
+    monkeypatch.setattr(server, "EDGE_PULL_TABLES", ["users", "item_variants", "delivery_zones", "printers"])
+    upstream = FakeUpstream()
+
+    asyncio.run(server.edge_pull(store, upstream))
+
+    users, variants, zones, printers, tombstones = upstream.endpoints
+    assert f"tenant_id=eq.{server.TENANT_ID}" in users
+    assert f"items.tenant_id=eq.{server.TENANT_ID}" in variants and "items!inner" in variants
+    assert f"branch_id.eq.{server.BRANCH_ID}" in zones
+    assert f"branch_id=eq.{server.BRANCH_ID}" in printers
+    assert f"tenant_id.eq.{server.TENANT_ID}" in tombstones
+
+
+class PagedUpstream:
+    """Serves rows in (timestamp, id) order, honouring the pull's keyset filter and limit"""
+
+    def __init__(self, rows, tombstones):
+        self.tables = {"users": ("updated_at", rows), "sync_tombstones": ("deleted_at", tombstones)}
+        self.endpoints = []
+
+    async def request(self, method, endpoint, data, use_service_key, prefer):
+        self.endpoints.append(endpoint)
+        table = endpoint.split("?")[0]
+        column, rows = self.tables[table]
+        params = dict(part.split("=", 1) for part in endpoint.split("?")[1].split("&"))
+        after = params.get("and")
+        if after:
+            # and=(col.gte.S,or(col.gt.S,id.gt.I))
+            stamp = unquote(after.split(".gte.")[1].split(",")[0])
+            row_id = after.split("id.gt.")[1].rstrip("))")
+            rows = [row for row in rows if (row[column], row["id"]) > (stamp, row_id)]
+        return server.StorageResponse(200, rows[:int(params["limit"])])
+
+
+def test_rows_tied_on_a_timestamp_across_a_page_boundary_are_all_pulled(store, monkeypatch):
+    monkeypatch.setattr(server, "EDGE_PULL_TABLES", ["users"])
+    monkeypatch.setattr(server, "EDGE_PULL_PAGE", 2)
+    stamp = "2026-01-01T08:00:00+00:00"
+    rows = [{"id": f"u{n}", "updated_at": stamp} for n in range(3)] + [{"id": "u3", "updated_at": "2026-01-01T09:00:00+00:00"}]
+    tombstones = [{"id": f"t{n}", "table_name": "users", "row_id": f"u{n}", "deleted_at": stamp} for n in range(3)]
+
+    upstream = PagedUpstream(rows, [])
+    assert asyncio.run(server.edge_pull(store, upstream)) == 4
+    assert store.pull_cursor("users") == ("2026-01-01T09:00:00+00:00", "u3")
+
+    upstream.tables["sync_tombstones"] = ("deleted_at", tombstones)
+    assert asyncio.run(server.edge_pull(store, upstream)) == 3
+    assert store.pull_cursor("sync_tombstones") == (stamp, "t2")
+
+
+def test_marks_without_an_id_resume_inclusively(store):
+    store.set_high_water("users", "2026-01-01T08:00:00+00:00")
+    assert store.pull_cursor("users") == ("2026-01-01T08:00:00+00:00", None)
+    assert server._after_cursor("updated_at", "2026-01-01T08:00:00+00:00", None).startswith("updated_at=gte.")
@@ -0,0 +1,170 @@
+import asyncio
+
+import pytest
+
+import server
+
+TENANT = "t1"
+
+
+def order(order_id, branch_id):
+    return {"id": order_id, "tenant_id": TENANT, "branch_id": branch_id, "order_number": order_id,
+            "order_type": "qsr", "status": "pending"}
+
+
+def item(item_id, order_id):
+    return {"id": item_id, "order_id": order_id, "item_id": "menu-1", "status": "pending", "created_at": "2026-01-01"}
+
+
+@pytest.fixture
+def boards(monkeypatch):
+    monkeypatch.setattr(server, "_kds_boards", {})
+    for branch in ("b1", "b2"):
+        board = server._kds_boards[(TENANT, branch)] = server.KDSBoard(branch)
+        board.reconciled_at = 1.0
+    return server._kds_boards
+
+
+def test_orders_only_reach_their_branch_board(boards):
+    server.kds_on_order_created({"tenant_id": TENANT, "branch_id": "b1",
+                                 "order": order("o1", "b1"), "items": [item("i1", "o1")]})
+    assert list(boards[(TENANT, "b1")].items) == ["i1"]
+    assert boards[(TENANT, "b2")].items == {}
+
+
+def test_reconcile_is_branch_scoped_and_keeps_events_that_arrive_meanwhile(boards, monkeypatch):
+    board = boards[(TENANT, "b1")]
+    board.add_item(item("i1", "o1"), order("o1", "b1"))
+    endpoints = []
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        endpoints.append(endpoint)
+        if endpoint.startswith("orders?"):
+            # The bump lands while the snapshot is being read
+            server.kds_on_update({"tenant_id": TENANT, "branch_id": "b1", "status": "completed",
+                                  "items": [item("i1", "o1")], "orders": {}})
+            return server.StorageResponse(200, [order("o1", "b1")])
+        return server.StorageResponse(200, [item("i1", "o1")])
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    token = server._tenant_scope.set((TENANT, "b1"))
+    try:
+        asyncio.run(board.reconcile())
+    finally:
+        server._tenant_scope.reset(token)
+
+    assert "branch_id=eq.b1" in endpoints[0]
+    assert board.items == {}
+    assert board.missed is None
+
+
+def test_polls_catch_up_on_orders_changed_by_other_workers(boards, monkeypatch):
+    board = boards[(TENANT, "b1")]
+    board.add_item(item("i1", "o1"), order("o1", "b1"))
+    board.add_item(item("i3", "o3"), order("o3", "b1"))
+    station_map = board.station_map
+    bumped_meanwhile = []
+
+    async def stations():
+        return station_map
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        assert "branch_id=eq.b1" in endpoint or endpoint.startswith("order_items?")
+        if endpoint.startswith("orders?"):
+            assert "updated_at=gte." in endpoint
+            # i3 is bumped on this worker while the delta is in flight
+            server.kds_on_update({"tenant_id": TENANT, "branch_id": "b1", "status": "completed",
+                                  "items": [item("i3", "o3")], "orders": {}})
+            bumped_meanwhile.append(True)
+            return server.StorageResponse(200, [
+                dict(order("o1", "b1"), status="completed", updated_at="2026-01-01T10:00:00+00:00"),
+                dict(order("o2", "b1"), updated_at="2026-01-01T10:00:01+00:00"),
+                dict(order("o3", "b1"), updated_at="2026-01-01T09:59:00+00:00"),
+            ])
+        return server.StorageResponse(200, [item("i2", "o2"), item("i3", "o3")])
+
+    monkeypatch.setattr(server, "load_station_map", stations)
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    board.reconciled_at = server.time.monotonic()
+    token = server._tenant_scope.set((TENANT, "b1"))
+    async def poll_twice():
+        await server.get_kds_board()
+        await board.catching_up
+        return await server.get_kds_board()
+
+    try:
+        assert asyncio.run(poll_twice()) is board
+    finally:
+        server._tenant_scope.reset(token)
+
+    # o1 was completed and o2 placed elsewhere; the local bump of i3 is not undone
+    assert bumped_meanwhile and list(board.items) == ["i2"]
+    assert board.watermark == server._iso_to_epoch("2026-01-01T10:00:01+00:00")
+    # o3 is older than the overlap window, so it is no longer tracked
+    assert set(board.seen) == {"o1", "o2"}
+
+
+ORDER_ID, ITEM_A, ITEM_B, FOREIGN_ITEM = (f"00000000-0000-4000-8000-00000000000{n}" for n in range(4))
+
+
+@pytest.fixture
+def kds_upstream(monkeypatch):
+    """Fake PostgREST for bumps: FOREIGN_ITEM belongs to another tenant's order"""
+    calls = []
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        calls.append((method, endpoint.split("&select")[0], data))
+        if method == "GET" and endpoint.startswith("order_items?id=in."):
+            orders = {FOREIGN_ITEM: "foreign-order", ITEM_A: ORDER_ID}
+            return server.StorageResponse(200, [{"id": i, "order_id": orders[i]}
+                                                for i in orders if i in endpoint])
+        if method == "GET" and endpoint.startswith("orders?id=in."):
+            assert f"tenant_id=eq.{TENANT}" in endpoint
+            return server.StorageResponse(200, [{"id": ORDER_ID}] if ORDER_ID in endpoint else [])
+        if method == "PATCH" and endpoint.startswith("order_items?"):
+            ids = endpoint.split("id=in.(")[1].split(")")[0].split(",")
+            return server.StorageResponse(200, [dict(item(i, ORDER_ID), status=data["status"]) for i in ids])
+        if method == "PATCH" and "status=in." in endpoint:
+            return server.StorageResponse(200, [dict(order(ORDER_ID, "b1"), status=data["status"])])
+        return server.StorageResponse(204)
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    monkeypatch.setattr(server, "write_behind_insert", lambda table, row: None)
+    return calls
+
+
+def set_status(item_ids, status):
+    token = server._tenant_scope.set((TENANT, "b1"))
+    try:
+        return asyncio.run(server.set_kds_items_status(item_ids, None, status))
+    finally:
+        server._tenant_scope.reset(token)
+
+
+def test_items_of_other_tenants_are_not_bumped(boards, kds_upstream):
+    result = set_status([FOREIGN_ITEM], "completed")
+
+    assert result["items"] == []
+    assert not any(method == "PATCH" for method, _, _ in kds_upstream)
+
+
+def test_bumping_the_last_open_items_rolls_the_order_up_to_ready(boards, kds_upstream):
+    board = boards[(TENANT, "b1")]
+    board.add_item(item(ITEM_A, ORDER_ID), order(ORDER_ID, "b1"))
+    board.add_item(item(ITEM_B, ORDER_ID), order(ORDER_ID, "b1"))
+
+    result = set_status([ITEM_A, ITEM_B], "completed")
+
+    assert sorted(result["items"]) == [ITEM_A, ITEM_B] and result["orders"] == {ORDER_ID: "ready"}
+    # Board items need no ownership lookup
+    assert not any(method == "GET" for method, _, _ in kds_upstream)
+    assert board.items == {}
+
+
+def test_recall_is_scoped_and_moves_ready_orders_back(boards, kds_upstream):
+    result = set_status([ITEM_A, FOREIGN_ITEM], "pending")
+
+    assert result["items"] == [ITEM_A] and result["orders"] == {ORDER_ID: "preparing"}
+    patched = [endpoint for method, endpoint, _ in kds_upstream if method == "PATCH"]
+    assert patched[0] == f"order_items?id=in.({ITEM_A})&status=eq.completed"
+    assert list(boards[(TENANT, "b1")].items) == [ITEM_A]
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+import server
+
+PROGRAM = {"settings": {"points_per_kwd": 0}, "rules": []}
+
+
+@pytest.fixture
+def pending(monkeypatch):
+    monkeypatch.setattr(server, "_loyalty_pending", {})
+    return server._loyalty_pending
+
+
+def gauge():
+    return server.metrics._gauges.get("riwa_loyalty_pending_orders", {}).get((), 0)
+
+
+def test_repeated_completion_events_are_queued_once(pending):
+    before = gauge()
+    for _ in range(3):
+        server.queue_loyalty_accrual({"tenant_id": "t1", "branch_id": "b1", "order_id": "o1", "status": "completed"})
+    assert pending == {("t1", "b1"): {"o1": 0}}
+    assert gauge() == before + 1
+
+
+def test_fractional_order_count_rules_are_skipped():
+    program = dict(PROGRAM, rules=[
+        {"id": "r1", "trigger_type": "order_count", "trigger_value": 0.5, "reward_value": 10},
+        {"id": "r2", "trigger_type": "order_count", "trigger_value": "x", "reward_value": 10},
+        {"id": "r3", "trigger_type": "order_count", "trigger_value": 2, "reward_value": 5},
+    ])
+    assert server.evaluate_loyalty(program, 1.0, {"orders_count": 1}) == 5
+
+
+@pytest.mark.parametrize("rule", [
+    {"trigger_type": "order_count", "trigger_value": 0.5, "reward_value": 1},
+    {"trigger_type": "order_count", "trigger_value": 2.5, "reward_value": 1},
+    {"trigger_type": "spend_amount", "trigger_value": 0, "reward_value": 1},
+    {"trigger_type": "order_count", "trigger_value": "ten", "reward_value": 1},
+])
+def test_invalid_triggers_cannot_be_saved(rule):
+    assert server.validate_loyalty_rule(rule)
+
+
+def test_whole_order_count_trigger_is_valid():
+    assert server.validate_loyalty_rule({"trigger_type": "order_count", "trigger_value": 5, "reward_value": 1}) is None
+
+
+@pytest.mark.parametrize("status, counted", [(503, 0), (401, 0), (400, 1)])
+def test_only_rejections_count_as_attempts(pending, monkeypatch, status, counted):
+    scopes = []
+
+    async def fail(order_ids):
+        scopes.append(server._tenant_scope.get())
+        raise server.loyalty_failure("Loyalty accrual", server.StorageResponse(status, {"message": "no"}))
+
+    monkeypatch.setattr(server, "accrue_loyalty_batch", fail)
+    server.queue_loyalty_accrual({"tenant_id": "t1", "branch_id": "b1", "order_id": "o1", "status": "completed"})
+
+    assert asyncio.run(server.flush_loyalty()) is (status in server.DATA_REJECTIONS)
+    assert pending == {("t1", "b1"): {"o1": counted}}
+    assert scopes == [("t1", "b1")]
+
+
+def test_queue_survives_a_restart(pending, monkeypatch, tmp_path):
+    monkeypatch.setattr(server, "LOYALTY_QUEUE_PATH", str(tmp_path / "loyalty.jsonl"))
+    server.queue_loyalty_accrual({"tenant_id": "t1", "branch_id": "b1", "order_id": "o1", "status": "completed"})
+    assert server.save_loyalty_queue() == 1
+    pending.clear()
+
+    assert server.load_loyalty_queue() == 1
+    assert pending == {("t1", "b1"): {"o1": 0}}
+    assert server.load_loyalty_queue() == 0
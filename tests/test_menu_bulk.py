@@ -0,0 +1,96 @@
+import asyncio
+import sys
+import uuid
+from pathlib import Path
+
+import httpx
+import pytest
+from jose import jwt
+
+import server
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from backend_benchmark import FakePostgrest  # noqa: E402
+
+TENANT_A = str(uuid.uuid4())
+TENANT_B = str(uuid.uuid4())
+BRANCH = str(uuid.uuid4())
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakePostgrest(latency_ms=0, jitter_ms=0)
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake.app()), base_url="http://fake")
+
+    async def request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        return await client.request(method, f"/rest/v1/{endpoint}", json=data, headers={"prefer": prefer})
+
+    monkeypatch.setattr(server, "supabase_request", request)
+    for tenant in (TENANT_A, TENANT_B):
+        category, item = str(uuid.uuid4()), str(uuid.uuid4())
+        fake.tables.setdefault("categories", []).append({"id": category, "tenant_id": tenant, "name_en": "Drinks"})
+        fake.tables.setdefault("items", []).append({"id": item, "tenant_id": tenant, "category_id": category})
+        fake.tables.setdefault("item_variants", []).append({"id": str(uuid.uuid4()), "item_id": item, "name_en": "Large"})
+    return fake
+
+
+def run_as(tenant, coro_fn):
+    async def scoped():
+        server._tenant_scope.set((tenant, BRANCH))
+        return await coro_fn()
+    return asyncio.run(scoped())
+
+
+def rows_of(fake, table, tenant):
+    owned = {row["id"] for row in fake.tables["items"] if row["tenant_id"] == tenant}
+    if table == "item_variants":
+        return [row for row in fake.tables[table] if row["item_id"] in owned]
+    return [row for row in fake.tables[table] if row["tenant_id"] == tenant]
+
+
+def test_variants_of_another_tenant_cannot_be_patched_or_deleted(fake):
+    foreign = rows_of(fake, "item_variants", TENANT_B)[0]
+    bulk = server.MenuBulkRequest(variants=[{"id": foreign["id"], "name": "Hijacked"}],
+                                  delete={"variants": [foreign["id"]]})
+    result = run_as(TENANT_A, lambda: server.apply_menu_bulk(bulk))
+    assert [r["error"] for r in result["results"]] == ["Not found", "Not found"]
+    assert foreign in fake.tables["item_variants"]
+    assert foreign["name_en"] == "Large"
+
+
+def test_rows_cannot_point_at_another_tenants_parent(fake):
+    own_variant = rows_of(fake, "item_variants", TENANT_A)[0]
+    foreign_item = rows_of(fake, "items", TENANT_B)[0]
+    bulk = server.MenuBulkRequest(variants=[{"id": own_variant["id"], "item_id": foreign_item["id"]},
+                                            {"item_id": foreign_item["id"], "name": "Small"}])
+    result = run_as(TENANT_A, lambda: server.apply_menu_bulk(bulk, atomic=True))
+    assert result["applied"] is False
+    assert {r["error"] for r in result["results"]} == {"Unknown item_id"}
+
+
+def test_tenant_id_in_the_payload_is_ignored(fake):
+    own_item = rows_of(fake, "items", TENANT_A)[0]
+    bulk = server.MenuBulkRequest(items=[{"id": own_item["id"], "tenant_id": TENANT_B, "name": "Tea"}])
+    result = run_as(TENANT_A, lambda: server.apply_menu_bulk(bulk))
+    assert result["success"] is True
+    assert own_item["tenant_id"] == TENANT_A
+    assert own_item["name_en"] == "Tea"
+
+
+def test_csv_rows_with_extra_values_are_rejected_per_row(fake):
+    own_variant = rows_of(fake, "item_variants", TENANT_A)[0]
+    body = f"id,name\n{own_variant['id']},Medium\n{own_variant['id']},Small,oops\n"
+    transport = httpx.ASGITransport(app=server.app)
+    claims = {"user_id": "u1", "tenant_id": TENANT_A, "branch_id": BRANCH}
+    token = "Bearer " + jwt.encode(claims, server.JWT_SECRET, algorithm="HS256")
+
+    async def post():
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/api/admin/menu/import?entity=variants", content=body,
+                                     headers={"Authorization": token})
+
+    response = asyncio.run(post())
+    assert response.status_code == 200, response.text
+    results = response.json()["results"]
+    assert results[0]["status"] == "ok"
+    assert results[1]["status"] == "error" and "more values" in results[1]["error"]
@@ -0,0 +1,167 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+class FakeStorage:
+    """insert_order stand-in that rejects chosen order ids"""
+
+    def __init__(self, rejected=(), error="orders: 400 column \"payment_method\" does not exist"):
+        self.rejected = set(rejected)
+        self.error = error
+        self.inserted = []
+
+    async def insert_order(self, orders, items, prefer):
+        if any(order["id"] in self.rejected for order in orders):
+            return self.error
+        self.inserted.extend(order["id"] for order in orders)
+        return None
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return server.OrderJournal(str(tmp_path / "journal.db"))
+
+
+@pytest.fixture
+def patches(monkeypatch):
+    def apply(storage, patch_status=204):
+        calls = []
+
+        async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+            calls.append((method, endpoint, data))
+            return server.StorageResponse(patch_status, {"message": "rejected"} if patch_status >= 400 else None)
+
+        monkeypatch.setattr(server, "storage", storage)
+        monkeypatch.setattr(server, "supabase_request", fake_request)
+        monkeypatch.setattr(server, "write_behind_insert", lambda table, row: None)
+        return calls
+    return apply
+
+
+def order_entry(order_id):
+    return {"order": {"id": order_id, "tenant_id": "t1"}, "items": [{"id": f"{order_id}-item", "order_id": order_id}]}
+
+
+def drain(journal):
+    async def run():
+        while await server.replay_journal_batch(journal):
+            pass
+    asyncio.run(run())
+
+
+def test_replays_in_sequence_order(journal, patches):
+    storage = FakeStorage()
+    calls = patches(storage)
+    journal.append("order", "o1", order_entry("o1"))
+    journal.append("order", "o2", order_entry("o2"))
+    journal.append("status", "o1", {"status": "ready", "updated_at": "2026-01-01T00:00:00+00:00", "state": {}})
+    journal.append("order", "o3", order_entry("o3"))
+
+    drain(journal)
+
+    # o1 and o2 go as one batch, then the status change, then o3
+    assert storage.inserted == ["o1", "o2", "o3"]
+    assert [c[1] for c in calls] == ["orders?id=eq.o1"]
+    assert journal.status()["pending_entries"] == 0
+
+
+def test_poison_order_is_dead_lettered_and_rest_drain(journal, patches):
+    storage = FakeStorage(rejected={"o2"})
+    patches(storage)
+    for order_id in ("o1", "o2", "o3"):
+        journal.append("order", order_id, order_entry(order_id))
+
+    drain(journal)
+
+    assert storage.inserted == ["o1", "o3"]
+    status = journal.status()
+    assert status["pending_entries"] == 0
+    assert status["dead_entries"] == 1
+    assert status["dead"][0]["order_id"] == "o2"
+    # Still readable locally, and retried once requeued
+    assert journal.has_pending("o2")
+    storage.rejected.clear()
+    assert journal.requeue_dead() == 1
+    drain(journal)
+    assert storage.inserted == ["o1", "o3", "o2"]
+    assert journal.status()["dead_entries"] == 0
+
+
+def test_transient_failure_keeps_order(journal, patches):
+    storage = FakeStorage(rejected={"o1"}, error="orders: 503 upstream circuit open")
+    patches(storage)
+    journal.append("order", "o1", order_entry("o1"))
+    journal.append("order", "o2", order_entry("o2"))
+
+    with pytest.raises(RuntimeError):
+        drain(journal)
+
+    # Nothing behind the failing entry is replayed out of order
+    assert storage.inserted == []
+    assert journal.status()["pending_entries"] == 2
+    assert journal.status()["dead_entries"] == 0
+
+
+def test_rejected_status_change_is_dead_lettered(journal, patches):
+    patches(FakeStorage(), patch_status=400)
+    journal.append("status", "o1", {"status": "ready", "updated_at": "2026-01-01T00:00:00+00:00", "state": {}})
+    journal.append("status", "o1", {"status": "completed", "updated_at": "2026-01-01T00:01:00+00:00", "state": {}})
+
+    drain(journal)
+
+    # The second change waits behind the first rather than overtaking it
+    status = journal.status()
+    assert (status["dead_entries"], status["held_entries"]) == (1, 1)
+
+
+@pytest.mark.parametrize("error, permanent", [
+    ("orders: 400 bad column", True),
+    ("orders: 409 duplicate order_number", True),
+    ("orders: 429 slow down", False),
+    ("orders: 408 timeout", False),
+    ("orders: 503 circuit open", False),
+    ("orders: 42703 column does not exist", True),
+    ("orders: 08006 connection failure", False),
+])
+def test_permanent_storage_error(error, permanent):
+    assert server.permanent_storage_error(error) is permanent
+
+
+def test_coupon_is_redeemed_after_its_order(journal, patches):
+    storage = FakeStorage()
+    calls = patches(storage, patch_status=200)
+    journal.append_all([("order", "o1", order_entry("o1")),
+                        ("coupon", "o1", {"coupon_id": "c1", "tenant_id": "t1"})])
+    assert journal.pending_coupon_uses("c1") == 1
+
+    drain(journal)
+
+    assert storage.inserted == ["o1"]
+    assert calls == [("POST", "rpc/riwa_redeem_coupon", {"coupon": "c1", "order_ref": "o1"})]
+    assert journal.pending_coupon_uses("c1") == 0
+
+
+def test_entries_behind_a_dead_order_wait_for_it(journal, patches):
+    storage = FakeStorage(rejected={"o1"})
+    calls = patches(storage)
+    journal.append("order", "o1", order_entry("o1"))
+    journal.append("status", "o1", {"status": "ready", "updated_at": "2026-01-01T00:00:00+00:00", "state": {}})
+    journal.append("order", "o2", order_entry("o2"))
+
+    drain(journal)
+
+    # The status change does not go to an order Supabase does not have
+    assert storage.inserted == ["o2"]
+    assert calls == []
+    status = journal.status()
+    assert (status["pending_entries"], status["dead_entries"], status["held_entries"]) == (0, 1, 1)
+
+    storage.rejected.clear()
+    journal.requeue_dead()
+    drain(journal)
+    assert storage.inserted == ["o2", "o1"]
+    assert [c[1] for c in calls] == ["orders?id=eq.o1"]
+    assert journal.status()["held_entries"] == 0
@@ -0,0 +1,101 @@
+import asyncio
+import re
+from urllib.parse import unquote
+
+import pytest
+
+import server
+
+ORDER_ID = "00000000-0000-4000-8000-000000000001"
+
+
+@pytest.fixture
+def orders(monkeypatch):
+    """One order in a fake orders table honouring the PATCH's status/updated_at conditions"""
+    rows = {ORDER_ID: {"id": ORDER_ID, "status": "preparing", "updated_at": "2026-01-01T08:00:00+00:00"}}
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        order_id = re.search(r"id=eq\.([^&]+)", endpoint).group(1)
+        row = rows.get(order_id)
+        if method == "GET":
+            return server.StorageResponse(200, [dict(row)] if row else [])
+        statuses = re.search(r"status=in\.\(([^)]*)\)", endpoint).group(1).split(",")
+        version = re.search(r"updated_at=eq\.([^&]+)", endpoint)
+        if not row or row["status"] not in statuses or (version and unquote(version.group(1)) != row["updated_at"]):
+            return server.StorageResponse(200, [])
+        row.update(data)
+        return server.StorageResponse(200, [dict(row)])
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    monkeypatch.setattr(server, "write_behind_insert", lambda table, row: None)
+    return rows
+
+
+def update(status, **expected):
+    request = server.OrderStatusUpdateRequest(order_id=ORDER_ID, status=status, **expected)
+    return asyncio.run(server.update_order_status(request, None))
+
+
+def conflict(status, **expected):
+    with pytest.raises(server.HTTPException) as error:
+        update(status, **expected)
+    return error.value
+
+
+@pytest.mark.parametrize("status", ["ready", "completed", "cancelled"])
+def test_allowed_transitions_apply(orders, status):
+    result = update(status)
+    assert result["success"] and orders[ORDER_ID]["status"] == status
+    assert result["updated_at"] == orders[ORDER_ID]["updated_at"]
+
+
+def test_every_source_can_reach_its_targets():
+    for source, targets in server.ORDER_TRANSITIONS.items():
+        for target in targets:
+            assert source in server.order_status_sources(target)
+    assert server.order_status_sources("pending") == []
+
+
+@pytest.mark.parametrize("current, status", [("preparing", "accepted"), ("completed", "ready"), ("cancelled", "preparing")])
+def test_refused_transitions_answer_409_with_the_current_state(orders, current, status):
+    orders[ORDER_ID]["status"] = current
+
+    error = conflict(status)
+
+    assert error.status_code == 409 and orders[ORDER_ID]["status"] == current
+    assert error.detail["status"] == current and "cannot move" in error.detail["message"]
+    assert error.detail["allowed"] == list(server.ORDER_TRANSITIONS[current])
+
+
+def test_unknown_or_impossible_requests_are_422(orders):
+    assert conflict("lost").status_code == 422
+    assert conflict("pending", expected_status="ready").status_code == 422
+
+
+def test_losing_a_race_answers_409(orders):
+    # Two screens bump the same order from preparing
+    assert update("ready", expected_status="preparing")["success"]
+
+    error = conflict("ready", expected_status="preparing")
+
+    assert error.status_code == 409 and error.detail["status"] == "ready"
+    assert error.detail["message"].endswith("order changed since the expected version")
+
+
+def test_stale_version_answers_409(orders):
+    seen = orders[ORDER_ID]["updated_at"]
+    update("ready")
+
+    error = conflict("completed", expected_updated_at=seen)
+
+    assert error.status_code == 409 and orders[ORDER_ID]["status"] == "ready"
+
+
+def test_repeating_an_applied_change_is_a_no_op(orders):
+    update("ready")
+    assert update("ready") == {"success": True, "status": "ready", "updated_at": orders[ORDER_ID]["updated_at"]}
+
+
+def test_unknown_orders_are_404(orders):
+    orders.clear()
+    assert conflict("ready").status_code == 404
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+import server
+
+CATALOG = {
+    "items": {"i1": {"id": "i1", "base_price": 1.5, "status": "active", "modifier_group_ids": ["g1"]}},
+    "variants": {
+        "v1": {"id": "v1", "item_id": "i1", "price": 2.0, "status": "active"},
+        "v2": {"id": "v2", "item_id": "i1", "price": 0.5, "status": "inactive"},
+    },
+    "modifiers": {
+        "m1": {"id": "m1", "modifier_group_id": "g1", "price": 0.25, "status": "active"},
+        "m2": {"id": "m2", "modifier_group_id": "g1", "price": 0.0, "status": "inactive"},
+    },
+}
+
+
+def line(**overrides):
+    return {"item_id": "i1", "quantity": 2, "unit_price": 2.0, "total_price": 4.5,
+            "variant_id": "v1", "modifiers": [{"id": "m1"}], **overrides}
+
+
+def test_active_variant_and_modifier_are_priced():
+    priced, mismatches = server.price_order_lines([line()], CATALOG)
+    assert mismatches == []
+    assert priced == [{"unit_price": 2.0, "total_price": 4.5}]
+
+
+def test_inactive_variant_is_refused():
+    priced, mismatches = server.price_order_lines([line(variant_id="v2", unit_price=0.5, total_price=1.5)], CATALOG)
+    assert priced == [None]
+    assert mismatches[0]["error"] == "Unknown or inactive variant"
+
+
+def test_inactive_modifier_is_refused():
+    priced, mismatches = server.price_order_lines([line(modifiers=[{"id": "m2"}], total_price=4.0)], CATALOG)
+    assert priced == [None]
+    assert mismatches[0]["error"].startswith("Unknown or inactive modifier")
+
+
+
+def order(**overrides):
+    return server.OrderCreateRequest(**{
+        "order_type": "delivery", "items": [line()], "subtotal": 4.5, "delivery_fee": 1.5, "total": 6.0,
+        "payment_method": "cash", **overrides})
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    async def load():
+        return CATALOG
+    monkeypatch.setattr(server, "load_menu_catalog", load)
+    monkeypatch.setattr(server, "PRICING_MODE", "reject")
+
+
+def test_zone_fee_replacing_the_submitted_fee_is_corrected(catalog):
+    pricing = asyncio.run(server.price_order(order(), 2.0))
+    assert (pricing["delivery_fee"], pricing["total"], pricing["corrected"]) == (2.0, 6.5, True)
+    assert pricing["mismatches"] == []
+
+
+def test_a_wrong_total_is_still_refused_when_the_fee_was_replaced(catalog):
+    with pytest.raises(server.HTTPException) as error:
+        asyncio.run(server.price_order(order(total=5.0), 2.0))
+    assert error.value.status_code == 422
+
+
+@pytest.mark.parametrize("charges", [{"tax": 0.3, "total": 6.3}, {"service_charge": 0.5, "total": 6.5}])
+def test_tax_and_service_charge_are_refused_explicitly(catalog, charges):
+    with pytest.raises(server.HTTPException) as error:
+        asyncio.run(server.price_order(order(**charges), 1.5))
+    assert error.value.status_code == 422 and "Tax and service charge" in error.value.detail
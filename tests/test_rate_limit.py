@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+import server
+
+
+def request(peer, forwarded=None):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "method": "GET", "path": "/api/menu", "headers": headers,
+                    "client": (peer, 50000)})
+
+
+@pytest.mark.parametrize("raw", ["POST /api/auth=0.2/0.5", "* /api/=0/10", "* /api/=-1"])
+def test_rules_without_a_whole_token_are_refused(raw):
+    with pytest.raises(ValueError):
+        server.parse_rate_limit_rules(raw)
+
+
+def test_default_rules_parse():
+    assert all(burst >= 1 for _, _, _, burst in server.parse_rate_limit_rules(server.DEFAULT_RATE_LIMIT_RULES))
+
+
+def test_exhausted_bucket_keeps_refusing():
+    limiter = server.MemoryRateLimiter(10)
+    assert asyncio.run(limiter.hit("k", 1, 1)) == 0
+    assert asyncio.run(limiter.hit("k", 1, 1)) > 0
+    assert asyncio.run(limiter.hit("k", 1, 1)) > 0
+
+
+def test_clients_behind_a_trusted_ingress_get_their_own_bucket(monkeypatch):
+    monkeypatch.setattr(server, "TENANT_TRUSTED_PROXIES", [server.ipaddress.ip_network("10.0.0.0/8")])
+    assert server.rate_limit_identity(request("10.0.0.5", "203.0.113.7")) == "ip:203.0.113.7"
+    # A spoofed left-most entry does not pick the bucket
+    assert server.rate_limit_identity(request("10.0.0.5", "1.1.1.1, 203.0.113.7, 10.0.0.9")) == "ip:203.0.113.7"
+    # Anyone else's X-Forwarded-For is ignored
+    assert server.rate_limit_identity(request("198.51.100.2", "203.0.113.7")) == "ip:198.51.100.2"
+
+
+def test_login_attempts_are_keyed_on_the_address_not_the_device(monkeypatch):
+    monkeypatch.setattr(server, "TENANT_TRUSTED_PROXIES", [server.ipaddress.ip_network("10.0.0.0/8")])
+    guesses = [Request({"type": "http", "method": "POST", "path": "/api/auth/pin-login", "client": ("10.0.0.5", 50000),
+                        "headers": [(b"x-device-id", f"rotated-{n}".encode()), (b"x-forwarded-for", b"203.0.113.7")]})
+               for n in range(2)]
+    assert {server.rate_limit_identity(guess, "/api/auth") for guess in guesses} == {"ip:203.0.113.7"}
+    # Per-terminal rules still tell the tills apart
+    assert server.rate_limit_identity(guesses[0], "/api/kds/items") == "device:rotated-0"
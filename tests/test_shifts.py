@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+import server
+
+SHIFT = {"id": "s1", "tenant_id": server.TENANT_ID, "branch_id": server.BRANCH_ID, "status": "open",
+         "opened_at": "2026-01-01T08:00:00+00:00", "opening_float": 10}
+
+
+def order(order_id, total, payment_method="cash"):
+    return {"id": order_id, "order_type": "qsr", "channel": "pos", "payment_method": payment_method,
+            "user_id": None, "status": "completed", "subtotal": total, "discount_amount": 0,
+            "delivery_fee": 0, "total_amount": total}
+
+
+def test_close_counts_orders_taken_by_other_workers(monkeypatch):
+    totals = server.ShiftTotals(dict(SHIFT))
+    totals.add(order("o1", 5))
+    totals.restored = True
+    monkeypatch.setattr(server, "_open_shifts", {(server.TENANT_ID, server.BRANCH_ID): totals})
+    patched = []
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        if method == "PATCH":
+            patched.append(data)
+            return server.StorageResponse(200, [dict(SHIFT, status="closed")])
+        if endpoint.startswith("shifts?"):
+            return server.StorageResponse(200, [dict(SHIFT)])
+        assert endpoint.startswith("orders?") and "created_at=gte." in endpoint
+        # o2 was placed through another worker, so only the database knows it
+        return server.StorageResponse(200, [order("o1", 5), order("o2", 7, "card")])
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    result = asyncio.run(server.close_shift(server.ShiftCloseRequest(counted_cash=15), None))
+
+    report = result["report"]
+    assert report["sales"]["orders"] == 2 and report["sales"]["total"] == 12
+    assert report["cash"]["expected"] == 15 and report["cash"]["variance"] == 0
+    assert patched[0]["report"] is report and patched[0]["total_sales"] == 12
+    assert server._open_shifts == {}
+
+
+def test_failed_orders_query_fails_the_close(monkeypatch):
+    totals = server.ShiftTotals(dict(SHIFT))
+    totals.restored = True
+    monkeypatch.setattr(server, "_open_shifts", {(server.TENANT_ID, server.BRANCH_ID): totals})
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        assert method == "GET"
+        if endpoint.startswith("shifts?"):
+            return server.StorageResponse(200, [dict(SHIFT)])
+        return server.StorageResponse(503, {"message": "unavailable"})
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    with pytest.raises(server.HTTPException) as error:
+        asyncio.run(server.close_shift(server.ShiftCloseRequest(counted_cash=0), None))
+    assert error.value.status_code == 500
+
+
+def test_a_shift_closed_by_another_worker_is_dropped_after_the_recheck(monkeypatch):
+    totals = server.ShiftTotals(dict(SHIFT))
+    totals.restored = True
+    monkeypatch.setattr(server, "_open_shifts", {(server.TENANT_ID, server.BRANCH_ID): totals})
+    queries = []
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        queries.append(endpoint)
+        assert endpoint.startswith("shifts?") and "status=eq.open" in endpoint
+        return server.StorageResponse(200, [])
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    # Within the recheck window the cached shift is trusted
+    assert asyncio.run(server.get_open_shift(server.TENANT_ID, server.BRANCH_ID)) is totals
+    assert queries == []
+
+    totals.checked_at -= server.SHIFT_RECHECK_SECONDS
+    assert asyncio.run(server.get_current_shift(None)) == {"shift": None, "report": None}
+    assert server._open_shifts == {}
+
+
+def test_opening_rechecks_a_cached_shift(monkeypatch):
+    totals = server.ShiftTotals(dict(SHIFT))
+    totals.restored = True
+    monkeypatch.setattr(server, "_open_shifts", {(server.TENANT_ID, server.BRANCH_ID): totals})
+    inserted = []
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        if method == "POST":
+            inserted.append(data)
+            return server.StorageResponse(201)
+        return server.StorageResponse(200, [])  # closed through another worker
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    result = asyncio.run(server.open_shift(server.ShiftOpenRequest(opening_float=20), None))
+
+    assert result["success"] and inserted[0]["opening_float"] == 20
+    assert server._open_shifts[(server.TENANT_ID, server.BRANCH_ID)].shift["id"] == inserted[0]["id"]
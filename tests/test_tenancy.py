@@ -0,0 +1,49 @@
+import uuid
+
+import pytest
+from jose import jwt
+
+import server
+
+TENANT_A = str(uuid.uuid4())
+TENANT_B = str(uuid.uuid4())
+BRANCH_A1 = str(uuid.uuid4())
+BRANCH_A2 = str(uuid.uuid4())
+
+
+def token(tenant_id, branch_id):
+    claims = {"user_id": "u1", "tenant_id": tenant_id, "branch_id": branch_id}
+    return "Bearer " + jwt.encode(claims, server.JWT_SECRET, algorithm="HS256")
+
+
+@pytest.fixture
+def trusted(monkeypatch):
+    monkeypatch.setattr(server, "TENANT_TRUSTED_PROXIES", [server.ipaddress.ip_network("10.0.0.0/8")])
+
+
+def test_token_claims_decide_the_tenant():
+    assert server.resolve_tenant_scope(token(TENANT_A, BRANCH_A1), None, None) == (TENANT_A, BRANCH_A1)
+
+
+def test_branch_header_picks_another_branch_of_the_token_tenant():
+    assert server.resolve_tenant_scope(token(TENANT_A, BRANCH_A1), TENANT_A, BRANCH_A2) == (TENANT_A, BRANCH_A2)
+
+
+def test_tenant_header_cannot_override_the_token():
+    with pytest.raises(PermissionError):
+        server.resolve_tenant_scope(token(TENANT_A, BRANCH_A1), TENANT_B, None)
+
+
+def test_headers_without_a_token_are_refused(trusted):
+    with pytest.raises(PermissionError):
+        server.resolve_tenant_scope(None, TENANT_B, BRANCH_A1, "203.0.113.9")
+    with pytest.raises(PermissionError):
+        server.resolve_tenant_scope("Bearer forged", TENANT_B, BRANCH_A1, "203.0.113.9")
+
+
+def test_headers_from_a_trusted_proxy_are_honoured(trusted):
+    assert server.resolve_tenant_scope(None, TENANT_B, BRANCH_A1, "10.1.2.3") == (TENANT_B, BRANCH_A1)
+
+
+def test_no_headers_fall_back_to_the_defaults():
+    assert server.resolve_tenant_scope(None, None, None) == (server.TENANT_ID, server.BRANCH_ID)
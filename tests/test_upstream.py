@@ -0,0 +1,20 @@
+import server
+
+
+def test_background_failures_do_not_open_the_critical_breaker():
+    background = server.upstream_target("orders_test", "background")
+    critical = server.upstream_target("orders_test", "critical")
+    for _ in range(server.BREAKER_FAILURE_THRESHOLD):
+        background.record(False)
+    assert background.state == "open"
+    assert critical.state == "closed" and critical.allow()
+
+
+def test_read_timeouts_are_learned_per_request_class():
+    background = server.upstream_target("reports_test", "background")
+    critical = server.upstream_target("reports_test", "critical")
+    for _ in range(server.LATENCY_MIN_SAMPLES):
+        critical.record(True, 0.01)
+        background.record(True, 5.0)
+    assert critical.timeout("GET") == server.UPSTREAM_TIMEOUT_MIN
+    assert background.timeout("GET") > critical.timeout("GET")
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def dead_path(tmp_path, monkeypatch):
+    path = tmp_path / "write_behind_dead.jsonl"
+    monkeypatch.setattr(server, "WRITE_BEHIND_DEAD_PATH", str(path))
+    return path
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Fake PostgREST insert: records accepted rows, rejects rows marked bad with a 400"""
+    state = {"accepted": [], "requests": 0, "during": None, "status": 400}
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        state["requests"] += 1
+        if state["during"]:
+            hook, state["during"] = state["during"], None
+            hook()
+        await asyncio.sleep(0)
+        if any(row.get("bad") for row in data):
+            return server.StorageResponse(state["status"], {"message": "violates check constraint"})
+        state["accepted"].extend(row["id"] for row in data)
+        return server.StorageResponse(201)
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    return state
+
+
+def test_rows_shed_during_flush_are_not_confused_with_sent_ones(upstream, monkeypatch):
+    monkeypatch.setattr(server, "WRITE_BEHIND_MAX_PENDING", 3)
+    buffer = server.WriteBehindBuffer("audit_logs")
+    for i in range(3):
+        buffer.add({"id": i})
+    # While the first insert is in flight the buffer is full: 3 more rows shed 0, 1 and 2
+    upstream["during"] = lambda: [buffer.add({"id": i}) for i in range(3, 6)]
+
+    asyncio.run(buffer.flush())
+
+    assert upstream["accepted"] == [0, 1, 2, 3, 4, 5]
+    assert len(buffer.rows) == 0
+
+
+def test_rejected_row_is_dropped_and_the_rest_are_inserted(upstream, monkeypatch):
+    monkeypatch.setattr(server, "WRITE_BEHIND_MAX_FAILURES", 2)
+    buffer = server.WriteBehindBuffer("order_states")
+    for i in range(10):
+        buffer.add({"id": i, "bad": i == 6})
+
+    for _ in range(server.WRITE_BEHIND_MAX_FAILURES - 1):
+        with pytest.raises(RuntimeError):
+            asyncio.run(buffer.flush())
+    asyncio.run(buffer.flush())
+
+    assert sorted(upstream["accepted"]) == [0, 1, 2, 3, 4, 5, 7, 8, 9]
+    assert len(buffer.rows) == 0
+
+
+def test_parked_rows_can_be_requeued(upstream, monkeypatch, dead_path):
+    monkeypatch.setattr(server, "WRITE_BEHIND_MAX_FAILURES", 1)
+    buffer = server.WriteBehindBuffer("order_states")
+    monkeypatch.setattr(server, "_write_behind", {"order_states": buffer})
+    buffer.add({"id": 1, "bad": True})
+
+    asyncio.run(buffer.flush())
+    assert len(buffer.rows) == 0 and dead_path.exists()
+
+    assert server.requeue_write_behind_dead() == 1
+    assert not dead_path.exists()
+    assert [row["id"] for _, row in buffer.rows] == [1]
+
+
+@pytest.mark.parametrize("status", [401, 403, 404, 429, 503])
+def test_auth_route_and_outage_errors_never_drop_rows(upstream, monkeypatch, dead_path, status):
+    monkeypatch.setattr(server, "WRITE_BEHIND_MAX_FAILURES", 1)
+    upstream["status"] = status
+    buffer = server.WriteBehindBuffer("audit_logs")
+    buffer.add({"id": 1, "bad": True})
+
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            asyncio.run(buffer.flush())
+
+    assert [row["id"] for _, row in buffer.rows] == [1]
+    assert not dead_path.exists()
+
+
+def test_transient_failure_keeps_rows(upstream):
+    upstream["status"] = 503
+    buffer = server.WriteBehindBuffer("audit_logs")
+    buffer.add({"id": 1, "bad": True})
+    buffer.add({"id": 2})
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(buffer.flush())
+
+    assert [row["id"] for _, row in buffer.rows] == [1, 2]
+    assert buffer.batch_size == server.WRITE_BEHIND_MAX_ROWS
+
+
+def test_kitchen_rows_are_merged_on_their_unique_key(monkeypatch):
+    calls = []
+
+    async def fake_request(method, endpoint, data=None, use_service_key=False, prefer="return=representation"):
+        calls.append((endpoint, prefer))
+        # The merge function is not installed on this database
+        return server.StorageResponse(404 if endpoint.startswith("rpc/") else 201)
+
+    monkeypatch.setattr(server, "supabase_request", fake_request)
+    stats = server.KitchenStats("t1")
+    stats.record_prep(stats.hour + 10, 90.0, "grill", "Burger", "1-1")
+    buffer = server.WriteBehindBuffer("kitchen_hourly_stats")
+    monkeypatch.setattr(server, "_write_behind", {"kitchen_hourly_stats": buffer})
+
+    stats.persist_hour()
+    row = buffer.rows[0][1]
+    asyncio.run(buffer.flush())
+
+    assert "id" not in row and row["prep_total_seconds"] == 90.0
+    assert calls == [
+        ("rpc/riwa_merge_kitchen_stats", "return=minimal"),
+        ("kitchen_hourly_stats?on_conflict=tenant_id,hour_start,station", "return=minimal,resolution=merge-duplicates"),
+    ]
+    assert stats.hourly == {} and len(buffer.rows) == 0